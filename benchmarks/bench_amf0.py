@@ -0,0 +1,124 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+
+"""AMF0 encoding and decoding of the command and metadata payloads
+exchanged in a typical session.
+
+Run as: python -m benchmarks.bench_amf0 [options] [CASE ...]
+"""
+
+from benchmarks import common
+from twimp import amf0
+from twimp.vecbuf import VecBuf
+
+
+def _connect():
+    return ('connect', 1.0,
+            amf0.Object(app='live', flashVer='WIN 10,3,181,14',
+                        swfUrl='http://example.com/player.swf',
+                        tcUrl='rtmp://example.com/live', fpad=False,
+                        capabilities=239.0, audioCodecs=3575.0,
+                        videoCodecs=252.0, videoFunction=1.0,
+                        pageUrl='http://example.com/watch',
+                        objectEncoding=0.0))
+
+def _connect_result():
+    return ('_result', 1.0,
+            amf0.Object(fmsVer='FMS/3,5,1,525', capabilities=31.0,
+                        mode=1.0),
+            amf0.Object(level='status',
+                        code='NetConnection.Connect.Success',
+                        description='Connection succeeded.',
+                        objectEncoding=0.0))
+
+def _play():
+    return ('play', 0.0, None, 'livestream', -1000.0)
+
+def _on_status():
+    return ('onStatus', 0.0, None,
+            amf0.Object(code='NetStream.Play.Start', level='status',
+                        description='Started playing livestream.',
+                        details='livestream', clientid='1'))
+
+def _on_metadata():
+    meta = amf0.ECMAArray()
+    for k, v in [('duration', 0.0), ('width', 1280.0), ('height', 720.0),
+                 ('videodatarate', 1500.0), ('framerate', 25.0),
+                 ('videocodecid', 7.0), ('audiodatarate', 128.0),
+                 ('audiosamplerate', 44100.0), ('audiosamplesize', 16.0),
+                 ('stereo', True), ('audiocodecid', 10.0),
+                 ('encoder', 'Lavf52.87.1'), ('filesize', 0.0)]:
+        meta[k] = v
+    return ('onMetaData', meta)
+
+# (name, function returning the values of the payload)
+payloads = [
+    ('connect', _connect),
+    ('connect-result', _connect_result),
+    ('play', _play),
+    ('onStatus', _on_status),
+    ('onMetaData', _on_metadata),
+    ]
+
+cases = (['encode/%s' % p[0] for p in payloads] +
+         ['decode/%s' % p[0] for p in payloads])
+
+# payloads encoded/decoded by each iteration
+batch = 1000
+
+
+def bench_encode(values):
+    encode = amf0.encode
+    def f():
+        for _ in xrange(batch):
+            encode(*values)
+    return f
+
+
+def bench_decode(values):
+    encoded = amf0.encode(*values)
+    data = encoded.read(len(encoded))
+    decode = amf0.decode
+    def f():
+        for _ in xrange(batch):
+            decode(VecBuf([data]))
+    return f
+
+
+def run(scale=1.0, selected=None):
+    count = common.scaled(20, scale)
+    results = []
+    for kind, make in [('encode', bench_encode), ('decode', bench_decode)]:
+        for name, payload in payloads:
+            name = '%s/%s' % (kind, name)
+            if not common.is_selected(name, selected):
+                continue
+            values = payload()
+            size = len(amf0.encode(*values))
+            results.append(common.bench(name, make(values), count,
+                                        unit_bytes=size * batch,
+                                        batch=batch, size=size))
+    return common.report('amf0', results)
+
+
+def main(argv):
+    common.main(run, argv, cases)
+
+
+if __name__ == '__main__':
+    import sys
+
+    main(sys.argv[1:])
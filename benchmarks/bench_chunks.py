@@ -0,0 +1,203 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+
+"""Chunk stream muxing and demuxing: sessions of synthetic audio/video
+frames muxed (and then parsed back) at various chunk sizes, and
+optionally parsing of recorded sessions.
+
+Run as: python -m benchmarks.bench_chunks [options] [CASE ...]
+"""
+
+import optparse
+import struct
+
+from benchmarks import common
+from twimp import chunks
+from twimp.proto import DispatchProtocol
+from twimp.scripts.demux_file import handshake_size, read_blocks
+from twimp.sources import SyntheticSource
+from twimp.vecbuf import VecBuf
+
+
+chunk_sizes = [128, 4096, 65536]
+
+cases = (['mux/%d' % cs for cs in chunk_sizes] +
+         ['chunk/%d' % cs for cs in chunk_sizes] +
+         ['demux/%d' % cs for cs in chunk_sizes] +
+         ['demux/file'])
+
+options = [
+    optparse.make_option('-f', '--file', action='append', dest='files',
+                         metavar='FILE', default=[],
+                         help=('a dump of the client side of a connection'
+                               ' (or a capture, see twimp.capture) to parse'
+                               ' in the demux/file case; can be given more'
+                               ' than once')),
+    ]
+
+# seconds of frames in the synthetic sessions
+duration = 10.0
+
+# size of the blocks fed to the demuxer, like socket reads
+block_size = 4096
+
+_s_ulong = struct.Struct('>L')
+
+
+class _NullTransport(object):
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def writeSequence(self, seq):
+        for data in seq:
+            self.written += len(data)
+
+
+class _StringTransport(object):
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(str(data))
+
+    def writeSequence(self, seq):
+        for data in seq:
+            self.data.append(str(data))
+
+
+class _Protocol(DispatchProtocol):
+    """Parses the messages down to the AMF/media payloads, like the
+    server would."""
+
+    def check_send_ack(self):
+        # no peer to acknowledge the bytes to
+        pass
+
+
+def frames(seconds=duration):
+    source = SyntheticSource(realtime=False)
+    frames = []
+    while True:
+        type_, ts, data = source.next_frame()
+        if ts > seconds * 1000:
+            break
+        frames.append((type_, ts, data.peek(len(data))))
+    return frames
+
+
+def mux(frames, chunk_size, transport):
+    muxer = chunks.Muxer(transport)
+    muxer.sendMessage(0, chunks.PROTO_SET_CHUNK_SIZE, 0,
+                      VecBuf([_s_ulong.pack(chunk_size)]))
+    muxer.set_chunk_size(chunk_size)
+    for type_, ts, data in frames:
+        muxer.sendMessage(ts, type_, 1, VecBuf([data]))
+
+
+def session(frames, chunk_size):
+    """Return the chunk stream of the frames, muxed at chunk_size."""
+    t = _StringTransport()
+    mux(frames, chunk_size, t)
+    return ''.join(t.data)
+
+
+def demux(data):
+    """Parse the chunk stream, return the demuxer."""
+    p = _Protocol()
+    demuxer = p.buildDemuxer(p)
+    p.init_handler(demuxer.gen_handler())
+    for offset in xrange(0, len(data), block_size):
+        ret = p.dataReceived(data[offset:offset + block_size])
+        if ret:
+            raise ret
+    return demuxer
+
+
+def bench_mux(frames, chunk_size):
+    def f():
+        mux(frames, chunk_size, _NullTransport())
+    return f
+
+
+def bench_chunk(frames, chunk_size):
+    chunker = chunks.Chunker()
+    chunker.set_chunk_size(chunk_size)
+    header = chunks.encode_full_header(3, 0, 0, chunks.MSG_VIDEO, 1)
+    def f():
+        for _type, _ts, data in frames:
+            for _header, _body in chunker(3, header, VecBuf([data])):
+                pass
+    return f
+
+
+def bench_demux(data):
+    def f():
+        demux(data)
+    return f
+
+
+def run(scale=1.0, selected=None, files=()):
+    count = common.scaled(20, scale)
+    fs = frames()
+    size = sum(len(data) for _type, _ts, data in fs)
+    results = []
+
+    for chunk_size in chunk_sizes:
+        params = dict(chunk_size=chunk_size, frames=len(fs),
+                      duration=duration)
+
+        name = 'mux/%d' % chunk_size
+        if common.is_selected(name, selected):
+            results.append(common.bench(name, bench_mux(fs, chunk_size),
+                                        count, unit_bytes=size, **params))
+
+        name = 'chunk/%d' % chunk_size
+        if common.is_selected(name, selected):
+            results.append(common.bench(name, bench_chunk(fs, chunk_size),
+                                        count, unit_bytes=size, **params))
+
+        name = 'demux/%d' % chunk_size
+        if common.is_selected(name, selected):
+            data = session(fs, chunk_size)
+            results.append(common.bench(name, bench_demux(data), count,
+                                        unit_bytes=len(data), **params))
+
+    if files and common.is_selected('demux/file', selected):
+        for path in files:
+            f = open(path, 'rb')
+            data = ''.join(read_blocks(f))[handshake_size:]
+            f.close()
+
+            demuxer = demux(data)
+            results.append(common.bench('demux/file', bench_demux(data),
+                                        count, unit_bytes=len(data),
+                                        file=path,
+                                        messages=sum(demuxer
+                                                     .received_by_type)))
+    return common.report('chunks', results)
+
+
+def main(argv):
+    common.main(run, argv, cases, options)
+
+
+if __name__ == '__main__':
+    import sys
+
+    main(sys.argv[1:])
@@ -0,0 +1,141 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Handshakes per second: complete client <-> server handshakes run in
+memory, with the plain and the crypto (digest) handshakers.
+
+Run as: python -m benchmarks.bench_handshake [options] [CASE ...]
+"""
+
+import random
+import time
+
+from benchmarks import common
+from twimp.crypto.handshake import CryptoHandshaker
+from twimp.handshake import Handshaker
+from twimp.utils import GeneratorWrapperProtocol
+
+
+def getrandbits_padding(count):
+    # how the padding used to be generated, for comparison
+    n = random.getrandbits(count * 8)
+    fmt = '%%0%dx' % (count * 2)
+    return (fmt % n).decode('hex')
+
+
+class _Transport(object):
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+
+    def writeSequence(self, seq):
+        self.data.extend(seq)
+
+    def loseConnection(self):
+        pass
+
+    def take(self):
+        data, self.data = ''.join(self.data), []
+        return data
+
+
+class _Protocol(GeneratorWrapperProtocol):
+    status = None
+
+    def handshakeSucceeded(self, init_ts, hs_delay):
+        self.status = 'ok'
+
+    def handshakeFailed(self):
+        self.status = 'fail'
+
+
+def handshake(client_class, server_class):
+    """Run one complete handshake, return True if both sides
+    succeeded."""
+    now = time.time()
+    p_cli, p_srv = _Protocol(), _Protocol()
+    t_cli, t_srv = _Transport(), _Transport()
+
+    p_srv.init_handler(server_class(p_srv, now).gen_handler())
+    p_cli.init_handler(client_class(p_cli, now, is_client=True).gen_handler(),
+                       do_init=False)
+    p_srv.makeConnection(t_srv)
+    p_cli.makeConnection(t_cli)
+    p_cli.init_handler()
+
+    p_srv.dataReceived(t_cli.take())
+    p_cli.dataReceived(t_srv.take())
+    p_srv.dataReceived(t_cli.take())
+
+    return p_cli.status == p_srv.status == 'ok'
+
+
+def _getrandbits_random_padding(self, count):
+    return getrandbits_padding(count)
+
+def _variant(base, padding):
+    attrs = {}
+    if padding == 'reused':
+        attrs['reuse_padding'] = True
+    elif padding == 'getrandbits':
+        attrs['random_padding'] = _getrandbits_random_padding
+    return type('%s_%s' % (base.__name__, padding), (base,), attrs)
+
+
+handshakers = [('plain', Handshaker), ('crypto', CryptoHandshaker)]
+paddings = ['getrandbits', 'pooled', 'reused']
+
+
+cases = ['%s/%s' % (h, p) for h, _ in handshakers for p in paddings]
+
+
+def bench(name, client_class, server_class, count):
+    # warm up (and fill the entropy pool) first
+    for _ in xrange(min(count, 50)):
+        handshake(client_class, server_class)
+
+    start = time.time()
+    failed = 0
+    for _ in xrange(count):
+        if not handshake(client_class, server_class):
+            failed += 1
+    elapsed = time.time() - start
+
+    return common.result(name, count, elapsed, failed=failed)
+
+
+def run(scale=1.0, selected=None):
+    count = common.scaled(2000, scale)
+    results = []
+    for hs_name, base in handshakers:
+        for padding in paddings:
+            name = '%s/%s' % (hs_name, padding)
+            if not common.is_selected(name, selected):
+                continue
+            cls = _variant(base, padding)
+            results.append(bench(name, cls, cls, count))
+    return common.report('handshake', results)
+
+
+def main(argv):
+    common.main(run, argv, cases)
+
+
+if __name__ == '__main__':
+    import sys
+
+    main(sys.argv[1:])
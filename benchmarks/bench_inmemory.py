@@ -0,0 +1,153 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+
+"""In-memory live streams: writing frames to the subscribers while
+keeping a window of them buffered (with write() and with the
+Deferred-less write_now()), trimming and subscribing with a preroll,
+at various window sizes.
+
+Run as: python -m benchmarks.bench_inmemory [options] [CASE ...]
+"""
+
+from benchmarks import common
+from twimp.server import inmemory
+
+
+# buffered windows, in ms (0: no buffering)
+windows = [0, 1000, 5000, 30000]
+
+subscribers = [0, 1, 10]
+
+write_methods = ['write', 'write_now']
+
+cases = (['%s/%d/%d' % (m, w, s)
+          for m in write_methods for w in windows for s in subscribers] +
+         ['trim/%d' % w for w in windows if w] +
+         ['subscribe/%d' % w for w in windows if w])
+
+# frames of 25fps video, a keyframe every 2 seconds, 60 seconds long
+framerate = 25
+keyframe_interval = 50
+frame_count = 60 * framerate
+keyframe_flag = 1
+
+# buffered windows are cut at keyframes, as the players want to start
+# playing from one
+flag_mask = -keyframe_flag
+
+
+def make_frames():
+    data = 'x' * 2000
+    return [(i * 1000 // framerate,
+             keyframe_flag if i % keyframe_interval == 0 else 0, data)
+            for i in xrange(frame_count)]
+
+
+def make_stream(window):
+    s = inmemory.IMLiveStream(inmemory.IMServerStream())
+    s.set_buffering(grpos_range=window, flag_mask=flag_mask)
+    return s
+
+
+def _subscriber():
+    # the listeners are kept in a set, each needs to be a new callable
+    def subscriber(grpos, flags, data):
+        pass
+    return subscriber
+
+
+def bench_write(frames, window, subscribers, method='write'):
+    def f():
+        s = make_stream(window)
+        for _ in xrange(subscribers):
+            s.subscribe(_subscriber())
+        write = getattr(s, method)
+        for grpos, flags, data in frames:
+            write(grpos, flags, data)
+    return f
+
+
+def bench_trim(frames, window):
+    # trimming a whole minute down to the window: the stream gets
+    # refilled each time
+    s = inmemory.IMStream(inmemory.IMServerStream())
+    def f():
+        s._s.data[:] = frames
+        s._s.data_offset = 0
+        s.trim(window, flag_mask=flag_mask)
+    return f
+
+
+def bench_subscribe(frames, window):
+    # subscribing and unsubscribing to a stream with the window
+    # buffered, the preroll being the whole window
+    s = make_stream(window)
+    for grpos, flags, data in frames:
+        s.write(grpos, flags, data)
+    subscriber = _subscriber()
+    def f():
+        for _ in xrange(100):
+            s.subscribe(subscriber, preroll_grpos_range=window,
+                        flag_mask=flag_mask)
+            s.unsubscribe(subscriber)
+    return f
+
+
+def run(scale=1.0, selected=None):
+    count = common.scaled(20, scale)
+    frames = make_frames()
+    results = []
+
+    for method in write_methods:
+        for window in windows:
+            for subs in subscribers:
+                name = '%s/%d/%d' % (method, window, subs)
+                if not common.is_selected(name, selected):
+                    continue
+                results.append(common.bench(name,
+                                            bench_write(frames, window, subs,
+                                                        method),
+                                            count, window=window,
+                                            subscribers=subs,
+                                            frames=frame_count))
+
+    for window in windows:
+        if not window:
+            continue
+        name = 'trim/%d' % window
+        if common.is_selected(name, selected):
+            results.append(common.bench(name, bench_trim(frames, window),
+                                        count * 10, window=window,
+                                        frames=frame_count))
+
+        name = 'subscribe/%d' % window
+        if common.is_selected(name, selected):
+            results.append(common.bench(name,
+                                        bench_subscribe(frames, window),
+                                        count, window=window,
+                                        subscriptions=100))
+
+    return common.report('inmemory', results)
+
+
+def main(argv):
+    common.main(run, argv, cases)
+
+
+if __name__ == '__main__':
+    import sys
+
+    main(sys.argv[1:])
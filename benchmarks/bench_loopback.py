@@ -0,0 +1,115 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+
+"""End to end, over loopback: a stream published to an in-process live
+server and played by N players (connected from the same process), the
+frames pushed as fast as the server takes them.
+
+The reactor can only be run once: all the cases get run in a single
+run of it, one after the other.
+
+Run as: python -m benchmarks.bench_loopback [options] [CASE ...]
+"""
+
+import time
+
+from benchmarks import common
+from twimp.scripts import load_test
+from twimp.server import inmemory
+from twimp.server.appserver import URLDispatchingServerFactory
+
+
+fanouts = [1, 10, 100]
+
+cases = ['fanout/%d' % n for n in fanouts]
+
+# seconds each case is run for (scaled)
+duration = 5.0
+
+# seconds to let the connections of a case close before the next one
+pause = 0.5
+
+
+def listen():
+    # (importing the reactor: only once the chosen one is installed)
+    from twisted.internet import reactor
+    from twimp.scripts import simple_live_server
+
+    server = inmemory.IMServer([None, '1', '2'])
+    factory = URLDispatchingServerFactory(time.time(), server,
+                                          simple_live_server.urls)
+    return reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+
+def _result(name, players, results):
+    frames = results['frames']
+    return common.result(name, frames['received'], results['elapsed'],
+                         params=dict(players=players,
+                                     duration=results['params']['duration']),
+                         connected=results['connected'],
+                         failed=results['failed'],
+                         lost=frames['lost'],
+                         first_frame_ms=results['first_frame_ms'],
+                         receive_kbps=results['receive_kbps'],
+                         cpu_percent=results['cpu_percent']['client'])
+
+
+def run(scale=1.0, selected=None):
+    seconds = max(1.0, duration * scale)
+    todo = [n for n in fanouts
+            if common.is_selected('fanout/%d' % n, selected)]
+    results = []
+    if not todo:
+        return common.report('loopback', results)
+
+    from twisted.internet import reactor
+
+    port = listen()
+    url = 'rtmp://127.0.0.1:%d/live' % port.getHost().port
+
+    def next_case():
+        if not todo:
+            port.stopListening()
+            reactor.stop()
+            return
+        players = todo.pop(0)
+        name = 'fanout/%d' % players
+
+        def done(r):
+            results.append(_result(name, players, r))
+            reactor.callLater(pause, next_case)
+
+        load = load_test.LoadRun(url, stream_name='bench-%d' % players,
+                                 players=players, duration=seconds,
+                                 connect_rate=1000.0, realtime=False)
+        load.done = done
+        load.start()
+
+    reactor.callWhenRunning(next_case)
+    reactor.run()
+
+    return common.report('loopback', results)
+
+
+def main(argv):
+    load_test.install_reactor()
+    common.main(run, argv, cases)
+
+
+if __name__ == '__main__':
+    import sys
+
+    main(sys.argv[1:])
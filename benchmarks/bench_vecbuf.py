@@ -0,0 +1,123 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""VecBuf read/write patterns: the socket reads buffered and consumed
+in header-sized and chunk-sized bits, the way the demuxer does.
+
+Run as: python -m benchmarks.bench_vecbuf [options] [CASE ...]
+"""
+
+from benchmarks import common
+from twimp.vecbuf import VecBuf, flatten
+
+
+# (name, size of the writes, size of the reads)
+patterns = [
+    ('small-writes', 64, 12),
+    ('socket-reads', 4096, 12),
+    ('socket-chunks', 4096, 128),
+    ('large-chunks', 65536, 4096),
+    ]
+
+cases = (['write/%s' % p[0] for p in patterns] +
+         ['read/%s' % p[0] for p in patterns] +
+         ['read_seq/%s' % p[0] for p in patterns] +
+         ['peek/%s' % p[0] for p in patterns])
+
+# bytes written and read by each iteration
+total = 256 * 1024
+
+
+def _writes(write_size):
+    data = 'x' * write_size
+    return [data] * (total // write_size)
+
+
+def bench_write(write_size, read_size):
+    writes = _writes(write_size)
+    def f():
+        vb = VecBuf()
+        for data in writes:
+            vb.write(data)
+    return f
+
+
+def bench_read(write_size, read_size):
+    writes = _writes(write_size)
+    reads = total // read_size
+    def f():
+        vb = VecBuf()
+        for data in writes:
+            vb.write(data)
+        read = vb.read
+        for _ in xrange(reads):
+            read(read_size)
+    return f
+
+
+def bench_read_seq(write_size, read_size):
+    writes = _writes(write_size)
+    reads = total // read_size
+    def f():
+        vb = VecBuf()
+        for data in writes:
+            vb.write(data)
+        read_seq = vb.read_seq
+        for _ in xrange(reads):
+            flatten(read_seq(read_size))
+    return f
+
+
+def bench_peek(write_size, read_size):
+    writes = _writes(write_size)
+    reads = total // read_size
+    def f():
+        vb = VecBuf()
+        for data in writes:
+            vb.write(data)
+        peek, read = vb.peek, vb.read
+        for _ in xrange(reads):
+            peek(read_size)
+            read(read_size)
+    return f
+
+
+kinds = [('write', bench_write), ('read', bench_read),
+         ('read_seq', bench_read_seq), ('peek', bench_peek)]
+
+
+def run(scale=1.0, selected=None):
+    count = common.scaled(50, scale)
+    results = []
+    for kind, make in kinds:
+        for name, write_size, read_size in patterns:
+            name = '%s/%s' % (kind, name)
+            if not common.is_selected(name, selected):
+                continue
+            results.append(common.bench(name, make(write_size, read_size),
+                                        count, unit_bytes=total,
+                                        write_size=write_size,
+                                        read_size=read_size))
+    return common.report('vecbuf', results)
+
+
+def main(argv):
+    common.main(run, argv, cases)
+
+
+if __name__ == '__main__':
+    import sys
+
+    main(sys.argv[1:])
@@ -0,0 +1,131 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Helpers shared by the benchmarks: timing, selecting the cases to run
+and writing the results out as JSON.
+
+Each benchmark module has a run(scale=1.0, selected=None) function,
+returning the report (see report()), and can be run on its own as:
+
+  python -m benchmarks.bench_NAME [-s SCALE] [-o FILE] [CASE ...]
+"""
+
+import platform
+import time
+
+import twimp
+
+
+def is_selected(name, selected):
+    """Return whether the case name is to be run: all are if nothing is
+    selected, otherwise the ones named or within a group (the part of
+    the name before a '/') named."""
+    if not selected:
+        return True
+    for s in selected:
+        if name == s or name.startswith(s + '/'):
+            return True
+    return False
+
+
+def bench(name, f, count, unit_bytes=None, warmup=None, **params):
+    """Call f() count times (after warming up), timing all the calls.
+
+    @param unit_bytes: the bytes processed by each call, if any, to
+                       report the throughput
+    @param params: the parameters of the case, to report
+
+    @return: the result of the case
+    """
+    if warmup is None:
+        warmup = max(1, count // 10)
+    for _ in xrange(warmup):
+        f()
+
+    start = time.time()
+    for _ in xrange(count):
+        f()
+    elapsed = time.time() - start
+
+    return result(name, count, elapsed, unit_bytes, params)
+
+
+def result(name, count, seconds, unit_bytes=None, params=None, **extra):
+    r = dict(name=name, iterations=count, seconds=seconds,
+             per_second=count / seconds if seconds > 0 else None,
+             params=params or {})
+    r.update(extra)
+    if unit_bytes is not None and seconds > 0:
+        r['mbytes_per_second'] = count * unit_bytes / seconds / 1e6
+    return r
+
+
+def scaled(count, scale):
+    return max(1, int(count * scale))
+
+
+def report(benchmark, results):
+    return dict(benchmark=benchmark, time=time.time(),
+                version=twimp.__version__,
+                python=platform.python_version(),
+                platform=platform.platform(),
+                results=results)
+
+
+def write_json(data, output=None):
+    import sys
+
+    from twimp.utils import json
+
+    data = json.dumps(data, indent=2, sort_keys=True)
+    if output:
+        f = open(output, 'w')
+        f.write(data + '\n')
+        f.close()
+    else:
+        sys.stdout.write(data + '\n')
+
+
+def main(run, argv, cases=None, options=()):
+    """Parse the command line of a benchmark module and run it.
+
+    @param options: additional optparse options of the module, the
+                    values of which get passed to run() as keyword
+                    arguments
+    """
+    import optparse
+
+    usage = '%prog [options] [CASE ...]'
+    epilog = None
+    if cases:
+        epilog = ('CASE is one of: %s (or the part before a "/"). All of'
+                  ' them are run by default.' % ', '.join(cases))
+    parser = optparse.OptionParser(usage=usage, epilog=epilog)
+
+    parser.add_option('-s', '--scale', action='store', type='float',
+                      dest='scale', default=1.0,
+                      help=('multiply the iteration counts by SCALE'
+                            ' (default: %default)'))
+    parser.add_option('-o', '--output', action='store', dest='output',
+                      metavar='FILE',
+                      help='write the results to FILE (default: stdout)')
+    for option in options:
+        parser.add_option(option)
+
+    opts, args = parser.parse_args(argv)
+
+    kw = dict((option.dest, getattr(opts, option.dest))
+              for option in options)
+    write_json(run(opts.scale, args, **kw), opts.output)
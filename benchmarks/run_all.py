@@ -0,0 +1,74 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+
+"""Run all the benchmarks, writing the reports of all of them out as a
+single JSON document.
+
+Run as: python -m benchmarks.run_all [options] [BENCHMARK ...]
+"""
+
+from benchmarks import bench_amf0, bench_chunks, bench_handshake
+from benchmarks import bench_inmemory, bench_loopback, bench_vecbuf
+from benchmarks import common
+from twimp.scripts import load_test
+
+
+# (name, module); the loopback one last, it runs the reactor
+benchmarks = [
+    ('vecbuf', bench_vecbuf),
+    ('chunks', bench_chunks),
+    ('amf0', bench_amf0),
+    ('handshake', bench_handshake),
+    ('inmemory', bench_inmemory),
+    ('loopback', bench_loopback),
+    ]
+
+
+def run(scale=1.0, selected=None):
+    reports = []
+    for name, module in benchmarks:
+        if selected and name not in selected:
+            continue
+        reports.append(module.run(scale))
+    return dict(benchmarks=reports)
+
+
+def main(argv):
+    import optparse
+
+    usage = '%prog [options] [BENCHMARK ...]'
+    epilog = ('BENCHMARK is one of: %s. All of them are run by default.' %
+              ', '.join(name for name, _m in benchmarks))
+    parser = optparse.OptionParser(usage=usage, epilog=epilog)
+
+    parser.add_option('-s', '--scale', action='store', type='float',
+                      dest='scale', default=1.0,
+                      help=('multiply the iteration counts by SCALE'
+                            ' (default: %default)'))
+    parser.add_option('-o', '--output', action='store', dest='output',
+                      metavar='FILE',
+                      help='write the results to FILE (default: stdout)')
+
+    options, args = parser.parse_args(argv)
+
+    load_test.install_reactor()
+    common.write_json(run(options.scale, args), options.output)
+
+
+if __name__ == '__main__':
+    import sys
+
+    main(sys.argv[1:])
@@ -13,6 +13,7 @@
 #   limitations under the License.
 
 
+from twisted.internet import defer, reactor, task
 from twisted.test import proto_helpers
 
 from twimp.amf0 import decode as decode_amf
@@ -42,3 +43,21 @@ def muxer_messages(mux):
 
 def unvb(vb):
     return vb.read(len(vb))[:]
+
+
+def wait_for(predicate, timeout=5.0):
+    """Poll until predicate() is true - for tests using real sockets."""
+    d = defer.Deferred()
+    start = reactor.seconds()
+
+    def check():
+        if predicate():
+            call.stop()
+            d.callback(None)
+        elif reactor.seconds() - start > timeout:
+            call.stop()
+            d.errback(AssertionError('timed out waiting'))
+
+    call = task.LoopingCall(check)
+    call.start(0.01)
+    return d
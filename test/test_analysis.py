@@ -0,0 +1,189 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import struct
+from StringIO import StringIO
+
+from twisted.trial import unittest
+
+from twimp import analysis
+from twimp import chunks
+from twimp import const
+from twimp.vecbuf import VecBuf
+
+
+_s_ulong = struct.Struct('>L')
+
+
+class _Transport(object):
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(str(data))
+
+    def writeSequence(self, seq):
+        for data in seq:
+            self.write(data)
+
+    def value(self):
+        return ''.join(self.data)
+
+
+class _Recorder(object):
+    def __init__(self):
+        self.messages = []
+        self.chunk_sizes = []
+
+    def message(self, type_, size, ms_id, time, first_byte):
+        self.messages.append((type_, size, ms_id, time, first_byte))
+
+    def chunk_size_changed(self, size):
+        self.chunk_sizes.append(size)
+
+
+def _session(messages, chunk_size=None):
+    t = _Transport()
+    muxer = chunks.Muxer(t)
+    if chunk_size is not None:
+        muxer.sendMessage(0, chunks.PROTO_SET_CHUNK_SIZE, 0,
+                          VecBuf([_s_ulong.pack(chunk_size)]))
+        muxer.set_chunk_size(chunk_size)
+    for time, type_, ms_id, data in messages:
+        muxer.sendMessage(time, type_, ms_id, VecBuf([data]))
+    return t.value()
+
+
+def _blocks(data, size):
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+# (time, type, ms_id, body)
+_messages = [
+    (0, chunks.MSG_VIDEO, 1, '\x17' + 'k' * 300),
+    (0, chunks.MSG_AUDIO, 1, '\xaf' + 'a' * 20),
+    (40, chunks.MSG_VIDEO, 1, '\x27' + 'i' * 100),
+    (46, chunks.MSG_AUDIO, 1, '\xaf' + 'a' * 20),
+    (80, chunks.MSG_VIDEO, 1, '\x27' + 'i' * 100),
+    (2080, chunks.MSG_VIDEO, 1, '\x17' + 'k' * 300),
+    (2120, chunks.MSG_VIDEO, 1, '\x27' + 'i' * 100),
+    (2000, chunks.MSG_AUDIO, 1, '\x2f' + 'a' * 20),
+    (0x1000000, chunks.MSG_VIDEO, 2, '\x12' + 'x' * 500),
+    (0x1000040, chunks.MSG_VIDEO, 2, '\x22' + 'x' * 500),
+    ]
+
+
+class TestChunkScanner(unittest.TestCase):
+    def _expected(self, chunk_size):
+        expected = []
+        if chunk_size is not None:
+            expected.append((const.RTMP_CHUNK_SIZE, 4, 0, 0, chunk_size))
+        for time, type_, ms_id, data in _messages:
+            type_ = {chunks.MSG_VIDEO: const.RTMP_VIDEO,
+                     chunks.MSG_AUDIO: const.RTMP_AUDIO}[type_]
+            expected.append((type_, len(data), ms_id, time, ord(data[0])))
+        return expected
+
+    def _scan(self, data, block_size):
+        r = _Recorder()
+        scanner = analysis.ChunkScanner(r)
+        for block in _blocks(data, block_size):
+            scanner.feed(buffer(block))
+        self.assertEquals(scanner.finish(), 0)
+        self.assertEquals(scanner.bytes_scanned, len(data))
+        return r
+
+    def test_messages(self):
+        for chunk_size in (None, 64, 4096):
+            data = _session(_messages, chunk_size)
+            for block_size in (1, 7, 128, len(data)):
+                r = self._scan(data, block_size)
+                self.assertEquals(r.messages, self._expected(chunk_size))
+                self.assertEquals(r.chunk_sizes,
+                                  [chunk_size] if chunk_size else [])
+
+    def test_incomplete(self):
+        data = _session(_messages)
+        r = _Recorder()
+        scanner = analysis.ChunkScanner(r)
+        scanner.feed(data[:-10])
+        # the body of the last message isn't read, only skipped over
+        self.assertEquals(scanner.finish(), 10)
+        self.assertEquals(r.messages, self._expected(None))
+
+        r = _Recorder()
+        scanner = analysis.ChunkScanner(r)
+        scanner.feed(data[:-500])
+        self.assertTrue(scanner.finish() > 0)
+        self.assertEquals(r.messages, self._expected(None)[:-1])
+
+    def test_relative_header(self):
+        scanner = analysis.ChunkScanner(_Recorder())
+        # fmt 1 header on an unknown chunk stream
+        self.assertRaises(chunks.ChunkStreamParseError, scanner.feed,
+                          '\x45' + '\x00' * 30)
+
+
+class TestSessionAnalyzer(unittest.TestCase):
+    def setUp(self):
+        data = _session(_messages, 128)
+        self.analyzer = analysis.analyze(_blocks(data, 100),
+                                         analysis.SessionAnalyzer(gap=500))
+
+    def test_report(self):
+        r = self.analyzer.report()
+        self.assertEquals(r['messages'], len(_messages) + 1)
+        self.assertEquals(r['types']['chunk_size'],
+                          dict(messages=1, bytes=4))
+        self.assertEquals(r['types']['video']['messages'], 7)
+        self.assertEquals(r['chunk_sizes'], [(1, 128)])
+
+        audio, video, video2 = r['streams']
+        self.assertEquals((audio['ms_id'], audio['type']), (1, 'audio'))
+        self.assertEquals(audio['codecs'], {'AAC': 2, 'MP3': 1})
+        self.assertEquals(audio['gaps']['first'], [(2000, 1954)])
+        self.assertEquals(audio['jumps']['count'], 0)
+
+        self.assertEquals(video['codecs'], {'H.264': 5})
+        self.assertEquals(video['keyframes'], 2)
+        self.assertEquals(video['keyframe_intervals']['max'], 2080)
+        self.assertEquals(video['gaps']['first'], [(2080, 2000)])
+        self.assertEquals(video['bytes'], 301 * 2 + 101 * 3)
+
+        self.assertEquals(video2['ms_id'], 2)
+        self.assertEquals(video2['codecs'], {'H.263': 2})
+        self.assertEquals(video2['keyframes'], 1)
+        self.assertEquals(video2['first_time'], 0x1000000)
+        self.assertEquals(video2['deltas']['max'], 0x40)
+
+        self.assertTrue(self.analyzer.format_report())
+
+    def test_jumps(self):
+        a = analysis.SessionAnalyzer()
+        for t in (0, 100, 50, 150):
+            a.message(const.RTMP_AUDIO, 10, 1, t, 0x2f)
+        s = a.report()['streams'][0]
+        self.assertEquals(s['jumps'], dict(count=1, first=[(50, -50)]))
+        self.assertEquals(s['gaps']['count'], 0)
+
+    def test_csv(self):
+        f = StringIO()
+        self.analyzer.write_csv(f)
+        rows = f.getvalue().splitlines()
+        self.assertEquals(rows[0], 'ms_id,type,time_ms,kbps')
+        # first second of the video of stream 1
+        self.assertIn('1,video,0,%.3f' % ((301 + 101 * 2) * 8 / 1000.0),
+                      rows)
+        self.assertIn('1,video,1000,0.000', rows)
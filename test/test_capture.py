@@ -0,0 +1,158 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+from StringIO import StringIO
+import time
+
+from twisted.internet import address
+from twisted.trial import unittest
+
+from twimp import capture
+from twimp.proto import BaseProtocol
+
+from test.helpers import StringTransport
+from test.test_proto import TestFactory
+
+
+class _File(StringIO):
+    closed_value = None
+
+    def close(self):
+        self.closed_value = self.getvalue()
+        StringIO.close(self)
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def _records(data):
+    is_client, started, records = capture.read_capture(StringIO(data))
+    return is_client, started, list(records)
+
+
+class TestSessionCapture(unittest.TestCase):
+    def make_capture(self, is_client=False):
+        self.clock = _Clock()
+        self.patch(capture.SessionCapture, 'clock', self.clock)
+        self.f = _File()
+        return capture.SessionCapture(self.f, is_client)
+
+    def test_round_trip(self):
+        c = self.make_capture(is_client=True)
+        c.received('abc')
+        self.clock.now += 0.25
+        c.sent(buffer('defg', 1))
+        self.clock.now += 1.5
+        c.sent_sequence(['h', buffer('ijk')])
+        c.close()
+
+        is_client, started, records = _records(self.f.closed_value)
+        self.assertTrue(is_client)
+        self.assertEquals(started, 100.0)
+        self.assertEquals([(d, o, data) for d, o, data in records],
+                          [(capture.IN, 0.0, 'abc'),
+                           (capture.OUT, 0.25, 'efg'),
+                           (capture.OUT, 1.75, 'hijk')])
+
+    def test_truncated(self):
+        c = self.make_capture()
+        c.received('abc')
+        c.received('defg')
+        is_client, started, records = _records(self.f.getvalue()[:-1])
+        self.assertFalse(is_client)
+        self.assertEquals([data for _d, _o, data in records], ['abc'])
+
+    def test_not_capture(self):
+        f = StringIO('\x03' + 'x' * 1536)
+        self.assertFalse(capture.is_capture(f))
+        self.assertEquals(f.tell(), 0)
+        self.assertRaises(capture.CaptureError, capture.read_capture, f)
+
+        self.make_capture()
+        f = StringIO(self.f.getvalue())
+        self.assertTrue(capture.is_capture(f))
+
+
+class _Protocol(object):
+    is_client = False
+
+    def __init__(self, port):
+        self.transport = StringTransport(
+            peerAddress=address.IPv4Address('TCP', '10.0.0.1', port))
+
+
+class TestSessionCapturer(unittest.TestCase):
+    def test_sample(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        capturer = capture.SessionCapturer(directory, sample=2,
+                                           max_sessions=2)
+
+        captures = [capturer.open(_Protocol(port))
+                    for port in range(1000, 1006)]
+        self.assertEquals([c is not None for c in captures],
+                          [False, True, False, True, False, False])
+        for c in captures:
+            if c is not None:
+                c.close()
+
+        names = sorted(os.listdir(directory))
+        self.assertEquals(len(names), 2)
+        self.assertTrue(names[0].endswith('-10.0.0.1-1001.twcap'))
+
+    def test_unwritable(self):
+        capturer = capture.SessionCapturer(self.mktemp())
+        self.assertIdentical(capturer.open(_Protocol(1000)), None)
+
+
+class _Capturer(object):
+    def __init__(self):
+        self.f = _File()
+
+    def open(self, protocol):
+        return capture.SessionCapture(self.f, protocol.is_client)
+
+
+class TestProtocolCapture(unittest.TestCase):
+    def test_handshake(self):
+        factory = TestFactory()
+        factory.init_time = time.time()
+        factory.capture = _Capturer()
+        p = BaseProtocol()
+        p.factory = factory
+        t = StringTransport()
+        p.makeConnection(t)
+
+        hs = '\x03' + '\0' * 1536
+        p.dataReceived(hs)
+        p.connectionLost()
+
+        self.assertIdentical(p.capture, None)
+        self.assertFalse('write' in t.__dict__)
+
+        is_client, started, records = _records(factory.capture.f.closed_value)
+        self.assertFalse(is_client)
+        self.assertEquals([data for d, _o, data in records
+                           if d == capture.IN], [hs])
+        # the server's version, handshake packet and response
+        self.assertEquals(''.join(data for d, _o, data in records
+                                  if d == capture.OUT), t.value())
+        self.assertEquals(len(t.value()), 1 + 1536 + 1536)
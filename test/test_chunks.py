@@ -626,3 +626,138 @@ class TestMuxerDemuxer(unittest.TestCase):
             self.assertEquals((h.cs_id, h.time, h.size, h.type, h.ms_id),
                               (i + first_csid, 0, 0, 18, i))
             self.assertEquals(len(body), 0)
+
+
+class HeadRecordingTransport(StringTransport):
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.heads = []
+
+    def write(self, data):
+        StringTransport.write(self, data)
+        self.heads.append(data)
+
+    def writeSequence(self, iovec):
+        for elt in iovec:
+            StringTransport.write(self, elt)
+
+    def cs_ids(self):
+        return [ord(h[0]) & 0x3f for h in self.heads]
+
+
+class TestInterleavingMuxer(unittest.TestCase):
+    def setUp(self):
+        self.t = HeadRecordingTransport()
+        self.mux = chunks.InterleavingMuxer(self.t)
+
+    def demux(self):
+        p = TestDemuxerProtocol()
+        dmx = MessagePassingDemuxer(p)
+        p.init_handler(dmx.gen_handler())
+        p.makeConnection(StringTransport())
+        p.dataReceived(self.t.value())
+        return [(h.ms_id, h.type, body.read(len(body)))
+                for h, body in p.pop_messages()]
+
+    def send(self, ms_id, type_, body):
+        self.mux.sendMessage(0, type_, ms_id, VecBuf([body]))
+
+    def test_unpaused(self):
+        self.send(1, chunks.MSG_VIDEO, 'v' * 300)
+        self.assertEquals(len(self.t.heads), 3)
+        self.assertEquals(self.mux.producer.queued(), 0)
+
+    def test_round_robin(self):
+        self.mux.producer.pauseProducing()
+        self.send(1, chunks.MSG_VIDEO, 'a' * 300)
+        self.send(2, chunks.MSG_VIDEO, 'b' * 200)
+        self.send(1, chunks.MSG_VIDEO, 'c' * 100)
+        self.assertEquals(self.t.value(), '')
+        self.assertEquals(self.mux.producer.queued(), 3)
+
+        self.mux.producer.resumeProducing()
+        a, b = self.t.cs_ids()[:2]
+        self.assertEquals(self.t.cs_ids(), [a, b, a, b, a, a])
+        self.assertEquals(self.demux(), [(2, 9, 'b' * 200),
+                                         (1, 9, 'a' * 300),
+                                         (1, 9, 'c' * 100)])
+
+    def test_priorities(self):
+        self.mux.producer.pauseProducing()
+        self.send(1, chunks.MSG_VIDEO, 'v' * 200)
+        self.send(1, chunks.MSG_AUDIO, 'a' * 200)
+        self.mux.sendMessage(0, chunks.PROTO_SET_CHUNK_SIZE, 0,
+                             VecBuf(['\x00\x00\x01\x00']))
+        # forced out, paused or not
+        self.mux.set_chunk_size(256)
+        self.assertEquals(len(self.t.heads), 1)
+
+        self.mux.producer.resumeProducing()
+        self.assertEquals([m[1] for m in self.demux()],
+                          [chunks.PROTO_SET_CHUNK_SIZE + 1, 8, 9])
+        # one chunk each, of the new size
+        self.assertEquals(len(self.t.heads), 3)
+
+    def test_stream_order(self):
+        self.mux.producer.pauseProducing()
+        self.send(1, chunks.MSG_VIDEO, 'v' * 300)
+        self.send(2, chunks.MSG_VIDEO, 'w' * 200)
+        # the stream's video goes out before its command...
+        self.send(1, chunks.MSG_COMMAND, 'c' * 10)
+        self.assertEquals(self.mux.producer.queued(), 2)
+        # ... which goes out before the stream's audio
+        self.send(1, chunks.MSG_AUDIO, 'a' * 10)
+        self.send(2, chunks.MSG_AUDIO, 'b' * 10)
+        self.assertEquals(self.mux.producer.queued(), 3)
+
+        self.mux.producer.resumeProducing()
+        self.assertEquals(self.mux.producer.queued(), 0)
+        self.assertEquals(self.demux(), [(1, 9, 'v' * 300),
+                                         (1, 0x14, 'c' * 10),
+                                         (1, 8, 'a' * 10),
+                                         (2, 8, 'b' * 10),
+                                         (2, 9, 'w' * 200)])
+
+    def test_paused_while_writing(self):
+        producer = self.mux.producer
+        write = self.t.write
+
+        def pausing_write(data):
+            write(data)
+            if len(self.t.heads) == 2:
+                producer.pauseProducing()
+
+        self.t.write = pausing_write
+        self.send(1, chunks.MSG_VIDEO, 'a' * 300)
+        self.send(2, chunks.MSG_VIDEO, 'b' * 100)
+        self.assertEquals(len(self.t.heads), 2)
+        self.assertEquals(producer.queued(), 2)
+
+        producer.resumeProducing()
+        # the interrupted message continued, taking turns with the next
+        a, b = self.t.cs_ids()[0], self.t.cs_ids()[3]
+        self.assertNotEquals(a, b)
+        self.assertEquals(self.t.cs_ids(), [a, a, a, b])
+        self.assertEquals(self.demux(), [(1, 9, 'a' * 300),
+                                         (2, 9, 'b' * 100)])
+
+    def test_written(self):
+        written = []
+
+        def send(ms_id, body):
+            # the number of chunks written before the last one
+            done = lambda: written.append((ms_id, len(self.t.heads)))
+            self.mux.sendMessage(0, chunks.MSG_VIDEO, ms_id, VecBuf([body]),
+                                 written=done)
+
+        send(1, 'a' * 10)
+        self.assertEquals(written, [(1, 0)])
+
+        self.mux.producer.pauseProducing()
+        send(1, 'a' * 300)
+        send(2, 'b' * 200)
+        self.assertEquals(written, [(1, 0)])
+
+        # chunks interleaved: a, b, a, b, a
+        self.mux.producer.resumeProducing()
+        self.assertEquals(written, [(1, 0), (2, 4), (1, 5)])
@@ -0,0 +1,145 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from zope.interface import implements
+
+from twisted.trial import unittest
+
+from twimp import chunks
+from twimp.client import ClientStream, SimpleAppClientProtocol
+from twimp.helpers import vb
+from twimp.interfaces import IThrottledSource
+
+from test.helpers import StringTransport, unvb
+
+
+V_HEADER = '\x17\x00'
+V_KEY = '\x17\x01'
+V_INTER = '\x27\x01'
+A_FRAME = '\xaf\x01'
+
+
+class FakeMuxer(object):
+    def __init__(self):
+        self.messages = []
+        self.producer = chunks.SimpleChunkProducer(None)
+
+    def sendMessage(self, ts, type_, ms_id, data):
+        self.messages.append((ts, type_, ms_id, unvb(data)))
+
+
+class FakeSource(object):
+    implements(IThrottledSource)
+
+    def __init__(self):
+        self.throttled = False
+        self.dropped = []
+
+    def connect(self, stream):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def throttle(self):
+        self.throttled = True
+
+    def unthrottle(self):
+        self.throttled = False
+
+    def frames_dropped(self, count, latency):
+        self.dropped.append((count, latency))
+
+
+class TestClientStreamFlowControl(unittest.TestCase):
+    def setUp(self):
+        self.proto = SimpleAppClientProtocol()
+        self.proto.transport = StringTransport()
+        self.proto.muxer = self.mux = FakeMuxer()
+
+        self.source = FakeSource()
+        self.stream = ClientStream(self.proto, 1)
+        self.stream.latency_target = 0.1
+        self.stream._source = self.source
+        self.proto.add_writing_stream(self.stream)
+
+    def sent(self):
+        return [(m[0], m[3]) for m in self.mux.messages]
+
+    def test_producer(self):
+        self.assertTrue(self.proto.transport.producer is self.proto)
+        self.stream._stop_writing()
+        self.assertEquals(self.proto.transport.producer, None)
+
+    def test_queue_while_paused(self):
+        s = self.stream
+        s.write_video(0, vb(V_KEY))
+        self.proto.pauseProducing()
+        self.assertTrue(self.source.throttled)
+        s.write_audio(20, vb(A_FRAME))
+        s.write_video(40, vb(V_INTER))
+        self.assertEquals(len(self.mux.messages), 1)
+        self.assertEquals(s.write_stats(),
+                          dict(queued=2, latency=0.02, dropped=0))
+
+        self.proto.resumeProducing()
+        self.assertFalse(self.source.throttled)
+        self.assertEquals(self.sent(), [(0, V_KEY), (20, A_FRAME),
+                                        (40, V_INTER)])
+
+    def test_drop_inter_video_first(self):
+        s = self.stream
+        self.proto.pauseProducing()
+        s.write_video(0, vb(V_HEADER))
+        s.write_video(0, vb(V_KEY))
+        for ts in (40, 80):
+            s.write_audio(ts - 20, vb(A_FRAME))
+            s.write_video(ts, vb(V_INTER))
+        s.write_audio(100, vb(A_FRAME))
+        s.write_video(120, vb(V_INTER))
+
+        self.assertEquals(s.dropped, 3)
+        self.assertEquals(self.source.dropped, [(3, 0.1)])
+        # no more inter frames until a keyframe
+        s.write_video(160, vb(V_INTER))
+        self.assertEquals(s.dropped, 4)
+
+        self.proto.resumeProducing()
+        s.write_video(200, vb(V_KEY))
+        s.write_video(240, vb(V_INTER))
+        self.assertEquals(self.sent(),
+                          [(0, V_HEADER), (0, V_KEY), (20, A_FRAME),
+                           (60, A_FRAME), (100, A_FRAME), (200, V_KEY),
+                           (240, V_INTER)])
+
+    def test_drop_oldest(self):
+        s = self.stream
+        self.proto.pauseProducing()
+        s.write_video(0, vb(V_HEADER))
+        for ts in range(0, 200, 20):
+            s.write_audio(ts, vb(A_FRAME))
+
+        # the header kept, the oldest audio dropped to fit the target
+        self.assertEquals(s.queued_latency(), 0.1)
+        self.proto.resumeProducing()
+        self.assertEquals(self.sent(),
+                          [(0, V_HEADER)] +
+                          [(ts, A_FRAME) for ts in range(80, 200, 20)])
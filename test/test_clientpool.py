@@ -0,0 +1,151 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import time
+
+from twisted.internet import defer, error, reactor
+from twisted.trial import unittest
+
+from twimp.clientpool import ClientConnectionPool
+from twimp.server import inmemory
+from twimp.server.appserver import URLDispatchingServerFactory
+from twimp.scripts.simple_live_server import urls
+
+from test.helpers import wait_for
+
+
+class NullSink(object):
+    def connect(self, stream):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class TestClientConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.origin = inmemory.IMServer()
+        factory = URLDispatchingServerFactory(time.time(), self.origin, urls)
+
+        self.conns = []
+        build = factory.buildProtocol
+
+        def build_protocol(addr):
+            p = build(addr)
+            self.conns.append(p)
+            return p
+
+        factory.buildProtocol = build_protocol
+
+        self.port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.url = 'rtmp://127.0.0.1:%d/live' % (self.port.getHost().port,)
+
+        self.pool = ClientConnectionPool(idle_timeout=0.05)
+        self.addCleanup(self.disconnected)
+
+    def disconnected(self):
+        self.pool.close()
+        return wait_for(lambda: all(p.transport.disconnected
+                                    for p in self.conns))
+
+    def test_shared(self):
+        d = defer.gatherResults([self.pool.open_stream(self.url),
+                                 self.pool.open_stream(self.url)])
+
+        def opened((s1, s2)):
+            self.assertEquals(len(self.conns), 1)
+            self.assertTrue(s1.protocol is s2.protocol)
+            self.assertNotEquals(s1.id, s2.id)
+
+            self.pool.close_stream(s1)
+            self.assertTrue(s1.closed)
+            self.pool.close_stream(s2)
+            self.assertEquals(self.pool.connections(), 1)
+            return wait_for(lambda: self.pool.connections() == 0)
+
+        d.addCallback(opened)
+        d.addCallback(lambda _: wait_for(
+                lambda: self.conns[0].transport.disconnected))
+        return d
+
+    def test_per_app(self):
+        d = defer.gatherResults([self.pool.open_stream(self.url),
+                                 self.pool.open_stream(self.url + '2')])
+        d.addCallback(lambda _: self.assertEquals(len(self.conns), 2))
+        return d
+
+    def test_reopen_while_idle(self):
+        d = self.pool.open_stream(self.url)
+
+        def opened(s):
+            self.pool.close_stream(s)
+            return self.pool.open_stream(self.url)
+
+        d.addCallback(opened)
+        d.addCallback(lambda _: self.assertEquals(len(self.conns), 1))
+        return d
+
+    def test_lost(self):
+        lost = []
+        d = self.pool.open_stream(self.url, lost.append)
+
+        def opened(s):
+            self.conns[0].transport.loseConnection()
+            return wait_for(lambda: lost)
+
+        def check(_):
+            self.assertEquals(self.pool.connections(), 0)
+            lost[0].trap(error.ConnectionDone)
+
+        d.addCallback(opened)
+        d.addCallback(check)
+        return d
+
+    def test_connect_failed(self):
+        d = self.port.stopListening()
+        d.addCallback(lambda _: self.pool.open_stream(self.url))
+        d = self.assertFailure(d, error.ConnectionRefusedError)
+        d.addCallback(lambda _: self.assertEquals(self.pool.connections(),
+                                                  0))
+        return d
+
+    def test_close_stops_playing(self):
+        d = self.origin.open('live', mode='l')
+
+        def published(sg):
+            self.addCleanup(self.origin.close, sg)
+            return self.pool.open_stream(self.url)
+
+        def opened(s):
+            self.stream = s
+            return s.play('live', NullSink())
+
+        def playing(_):
+            app = self.conns[0]._app
+            self.assertEquals(len(app._sessions), 1)
+            self.pool.close_stream(self.stream, force=True)
+            return wait_for(lambda: not app._sessions)
+
+        d.addCallback(published)
+        d.addCallback(opened)
+        d.addCallback(playing)
+        return d
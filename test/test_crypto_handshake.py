@@ -13,6 +13,8 @@
 #   limitations under the License.
 
 
+from hashlib import sha256
+import hmac
 import struct
 import time
 
@@ -39,6 +41,18 @@ class TestHandshakeProtocol(GeneratorWrapperProtocol):
         self.handshake_status = 'fail'
 
 
+class TestHMAC(unittest.TestCase):
+    def test_prepared_keys(self):
+        data = 'abcdefgh' * 192
+        for key in (chandshake._fms_key, chandshake._full_fp_key, 'other'):
+            expected = hmac.new(key, data, sha256).digest()
+            self.assertEquals(chandshake._hmac(key, data), expected)
+            # the prepared state doesn't get modified
+            self.assertEquals(chandshake._hmac(key, buffer(data, 0, 100),
+                                               buffer(data, 100)),
+                              expected)
+
+
 class TestHandshaker(unittest.TestCase):
     protocol_version = 3
     handshake_length = 1536
@@ -58,6 +72,12 @@ class TestHandshaker(unittest.TestCase):
             client_compat_version = (0, 0, 0, 0)
         return self._test_complete_exchange(GeneratedHandshaker)
 
+    def test_complete_exchange_reusing_padding(self):
+        class GeneratedHandshaker(CryptoHandshaker):
+            reuse_padding = True
+        self._test_complete_exchange(GeneratedHandshaker)
+        return self._test_complete_exchange(GeneratedHandshaker)
+
     def test_complete_exchange_with_cli_ver_too_low(self):
         # here a class imitating a client whose version is lower than
         # the earlies one supporting crypted handshakes, but still
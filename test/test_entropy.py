@@ -0,0 +1,72 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from twisted.python import threadable
+from twisted.trial import unittest
+
+from twimp.entropy import EntropyPool
+
+
+class TestEntropyPool(unittest.TestCase):
+    def setUp(self):
+        # (not registered before the reactor first runs)
+        self.patch(threadable, 'isInIOThread', lambda: True)
+        self.pool = EntropyPool(size=1024)
+
+    def test_slices(self):
+        p = self.pool
+        a, b = p.get(100), p.get(100)
+        self.assertEquals((len(a), len(b)), (100, 100))
+        self.assertNotEquals(a, b)
+        self.assertEquals(p.available(), 824)
+        self.assertEquals(p.refills, 1)
+
+    def test_background_refill(self):
+        p = self.pool
+        p.get(700)
+        self.assertIdentical(p._refilling, None)
+        p.get(100)
+        # below the low water mark, the next pool read in a thread
+        d = p._refilling
+        self.assertNotIdentical(d, None)
+
+        def refilled(_):
+            # still using up the current one
+            self.assertEquals((p.refills, p.available()), (1, 224))
+            self.assertEquals(len(p.get(200)), 200)
+            self.assertIdentical(p._refilling, None)
+            self.assertEquals(len(p.get(100)), 100)
+            self.assertEquals((p.refills, p.available()), (2, 924))
+
+        d.addCallback(refilled)
+        return d
+
+    def test_exhausted(self):
+        p = self.pool
+        p.get(1000)
+        d = p._refilling
+        # not waiting for the next pool
+        self.assertEquals(len(p.get(100)), 100)
+        self.assertEquals((p.refills, p.available()), (2, 924))
+        self.assertEquals(len(p.get(2000)), 2000)
+        self.assertEquals(p.available(), 924)
+        return d
+
+    def test_shared(self):
+        p = self.pool
+        a = p.shared(100)
+        self.assertEquals(p.shared(100), a)
+        self.assertNotEquals(p.shared(50), a[:50])
+        self.assertNotEquals(p.get(100), a)
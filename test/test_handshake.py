@@ -15,15 +15,19 @@
 
 # from cStringIO import StringIO
 import struct
+import threading
 import time
 
+from twisted.internet import defer
 from twisted.python import failure
 from twisted.trial import unittest
 
+from twimp.crypto.handshake import CryptoHandshaker
 from twimp.handshake import Handshaker, HandshakeFailedError
+from twimp.handshake import HandshakeWorkers
 from twimp.utils import GeneratorWrapperProtocol
 
-from helpers import StringTransport
+from helpers import StringTransport, wait_for
 
 
 class TestHandshakeProtocol(GeneratorWrapperProtocol):
@@ -354,3 +358,62 @@ class TestHandshaker(unittest.TestCase):
         self.assertEquals(p.handshake_status, 'ok')
 
     # TODO: write client failure cases
+
+
+class TestHandshakeWorkers(unittest.TestCase):
+    def setUp(self):
+        self.workers = HandshakeWorkers(threads=2, max_in_flight=1)
+        self.addCleanup(self.workers.stop)
+
+    @defer.inlineCallbacks
+    def test_complete_exchange(self):
+        tcli = StringTransport()
+        tsrv = StringTransport()
+
+        p_cli = TestHandshakeProtocol()
+        p_srv = TestHandshakeProtocol()
+
+        now = time.time()
+        hs_cli = CryptoHandshaker(p_cli, now - 0.001, is_client=True)
+        hs_srv = CryptoHandshaker(p_srv, now - 0.042)
+        hs_cli.workers = hs_srv.workers = self.workers
+
+        p_srv.init_handler(hs_srv.gen_handler())
+        p_cli.init_handler(hs_cli.gen_handler(), do_init=False)
+        p_srv.makeConnection(tsrv)
+        p_cli.makeConnection(tcli)
+        p_cli.init_handler()
+
+        self.assertIdentical(p_srv.dataReceived(tcli.value()), None)
+        tcli.clear()
+        # waiting for the worker thread
+        self.assertEquals(tsrv.value(), '')
+        yield wait_for(lambda: len(tsrv.value()) == 1 + 1536 * 2)
+
+        self.assertIdentical(p_cli.dataReceived(tsrv.value()), None)
+        tsrv.clear()
+        yield wait_for(lambda: p_cli.handshake_status == 'ok')
+
+        self.assertIdentical(p_srv.dataReceived(tcli.value()), None)
+        yield wait_for(lambda: p_srv.handshake_status == 'ok')
+        self.assertFalse(tsrv.disconnecting, 'disconnecting')
+
+    @defer.inlineCallbacks
+    def test_in_flight(self):
+        w = self.workers
+        release = threading.Event()
+
+        d1 = w.run(release.wait)
+        d2 = w.run(lambda: 'second')
+        d3 = w.run(lambda: 'third')
+        self.assertEquals((w.in_flight, w.queued()), (1, 2))
+
+        # cancelled while queued, never run
+        d2.cancel()
+        self.assertEquals(w.queued(), 1)
+        yield self.assertFailure(d2, defer.CancelledError)
+
+        release.set()
+        yield d1
+        self.assertEquals((yield d3), 'third')
+        self.assertEquals((w.in_flight, w.queued()), (0, 0))
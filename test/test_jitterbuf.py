@@ -0,0 +1,126 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from twimp.chunks import MSG_AUDIO, MSG_VIDEO
+from twimp.helpers import vb
+from twimp.jitterbuf import JitterBuffer
+
+from test.helpers import unvb
+
+
+V_HEADER = '\x17\x00'
+V_KEY = '\x17\x01'
+V_INTER = '\x27\x01'
+A_FRAME = '\xaf\x01'
+
+
+class TestJitterBuffer(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.jb = JitterBuffer(delay=0.1, max_frames=4, reactor=self.clock)
+        self.got = []
+        self.jb.set_output(lambda ts, type_, data:
+                               self.got.append((ts, type_, unvb(data))))
+
+    def push(self, ts, type_, data):
+        self.jb.push(ts, type_, vb(data))
+
+    def test_delay_and_spacing(self):
+        self.push(0, MSG_VIDEO, V_KEY)
+        self.push(40, MSG_VIDEO, V_INTER)
+        self.assertEquals(self.got, [])
+        self.assertEquals(self.jb.stats()['frames'], 2)
+        self.assertEquals(self.jb.stats()['span'], 40)
+
+        self.clock.advance(0.1)
+        self.assertEquals(self.got, [(0, MSG_VIDEO, V_KEY)])
+        self.clock.advance(0.04)
+        self.assertEquals(len(self.got), 2)
+        self.assertEquals(self.jb.stats()['delivered'], 2)
+
+    def test_reordering(self):
+        self.push(0, MSG_VIDEO, V_KEY)
+        self.push(40, MSG_VIDEO, V_INTER)
+        self.push(20, MSG_AUDIO, A_FRAME)
+        self.clock.advance(1)
+        self.assertEquals([f[0] for f in self.got], [0, 20, 40])
+
+    def test_late(self):
+        self.push(0, MSG_VIDEO, V_KEY)
+        self.clock.advance(0.5)
+        # due 0.14s, arrived at 0.5s
+        self.push(40, MSG_VIDEO, V_INTER)
+        self.assertEquals(self.jb.stats()['late'], 1)
+        self.clock.advance(0)
+        self.assertEquals(len(self.got), 2)
+
+        # older than the video already delivered: dropped
+        self.push(20, MSG_VIDEO, V_INTER)
+        stats = self.jb.stats()
+        self.assertEquals((stats['late'], stats['dropped']), (2, 1))
+
+        # audio lagging behind the video, still delivered
+        self.push(20, MSG_AUDIO, A_FRAME)
+        self.clock.advance(0)
+        self.assertEquals(self.got[-1], (20, MSG_AUDIO, A_FRAME))
+        stats = self.jb.stats()
+        self.assertEquals((stats['late'], stats['dropped']), (3, 1))
+
+    def test_overflow_to_keyframe(self):
+        self.push(0, MSG_VIDEO, V_HEADER)
+        self.push(0, MSG_VIDEO, V_KEY)
+        self.push(40, MSG_VIDEO, V_INTER)
+        self.push(80, MSG_VIDEO, V_KEY)
+        self.push(120, MSG_VIDEO, V_INTER)
+        # header kept, dropped up to the next keyframe, delivering now
+        self.assertEquals(self.jb.stats()['dropped'], 2)
+        self.clock.advance(0)
+        self.assertEquals(self.got, [(0, MSG_VIDEO, V_HEADER),
+                                     (80, MSG_VIDEO, V_KEY)])
+
+    def test_overflow_no_keyframe(self):
+        self.push(0, MSG_VIDEO, V_HEADER)
+        self.push(0, MSG_VIDEO, V_KEY)
+        for ts in (40, 80, 120):
+            self.push(ts, MSG_VIDEO, V_INTER)
+        self.assertEquals(self.jb.stats()['dropped'], 4)
+        self.push(160, MSG_VIDEO, V_INTER)
+        self.push(200, MSG_VIDEO, V_KEY)
+        self.assertEquals(self.jb.stats()['dropped'], 5)
+        self.clock.advance(0)
+        self.assertEquals([f[0] for f in self.got], [0, 200])
+
+    def test_overflow_skip_to_keyframe(self):
+        self.push(0, MSG_VIDEO, V_KEY)
+        for ts in (40, 80, 120, 160):
+            self.push(ts, MSG_VIDEO, V_INTER)
+        self.assertEquals(self.jb.stats()['frames'], 0)
+
+        self.push(200, MSG_VIDEO, V_INTER)
+        self.push(220, MSG_AUDIO, A_FRAME)
+        self.push(240, MSG_VIDEO, V_KEY)
+        self.assertEquals(self.jb.stats()['dropped'], 6)
+        self.clock.advance(1)
+        self.assertEquals([f[0] for f in self.got], [220, 240])
+
+    def test_stop(self):
+        self.push(0, MSG_VIDEO, V_KEY)
+        self.jb.stop()
+        self.clock.advance(1)
+        self.assertEquals(self.got, [])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
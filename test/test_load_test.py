@@ -0,0 +1,82 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import time
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+
+from twimp.scripts import load_test
+from twimp.scripts.simple_live_server import urls
+from twimp.server import inmemory
+from twimp.server.appserver import URLDispatchingServerFactory
+
+from test.helpers import wait_for
+
+
+class TestSummarize(unittest.TestCase):
+    def test_summarize(self):
+        self.assertEquals(load_test.summarize([]), dict(count=0))
+        s = load_test.summarize(range(100, 0, -1))
+        self.assertEquals((s['count'], s['min'], s['max']), (100, 1, 100))
+        self.assertEquals((s['p50'], s['p90']), (51, 91))
+        self.assertEquals(s['mean'], 50.5)
+
+
+class TestLoadRun(unittest.TestCase):
+    def setUp(self):
+        factory = URLDispatchingServerFactory(time.time(),
+                                              inmemory.IMServer(), urls)
+        self.conns = []
+        build = factory.buildProtocol
+
+        def build_protocol(addr):
+            p = build(addr)
+            self.conns.append(p)
+            return p
+
+        factory.buildProtocol = build_protocol
+
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.url = 'rtmp://127.0.0.1:%d/live' % (port.getHost().port,)
+
+    def disconnected(self):
+        return wait_for(lambda: all(p.transport.disconnected
+                                    for p in self.conns))
+
+    def test_run(self):
+        d = defer.Deferred()
+        load = load_test.LoadRun(self.url, players=3, duration=0.5,
+                                 connect_rate=1000.0, realtime=False)
+        load.done = d.callback
+        load.start()
+
+        def done(results):
+            for key in ('url', 'params', 'started', 'elapsed', 'clients',
+                        'connected', 'failed', 'tcp_connect_ms',
+                        'handshake_ms', 'connect_ms', 'first_frame_ms',
+                        'receive_kbps', 'frames', 'cpu_percent'):
+                self.assertIn(key, results)
+            self.assertEquals(results['clients'], 4)
+            self.assertEquals(results['connected'], 4)
+            self.assertEquals(results['failed'], 0)
+            self.assertEquals(results['first_frame_ms']['count'], 3)
+            self.assertTrue(results['frames']['received'] > 0)
+            self.assertEquals(results['frames']['lost'], 0)
+            return self.disconnected()
+
+        d.addCallback(done)
+        return d
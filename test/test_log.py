@@ -0,0 +1,96 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import logging
+
+from twisted.trial import unittest
+
+from twimp import log
+
+
+class _Handler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestLevelFlags(unittest.TestCase):
+    def setUp(self):
+        self.logger = log.get_logger('test-flags')
+        self.addCleanup(self.logger.setLevel, logging.NOTSET)
+        self.addCleanup(log.update_flags)
+
+    def test_set_levels(self):
+        flags = log.get_flags('test-flags')
+        self.assertIdentical(log.get_flags('test-flags'), flags)
+
+        log.set_levels('test-flags:debug')
+        self.assertTrue(flags.debug)
+        self.assertTrue(flags.info)
+
+        log.set_levels('test-flags:warning')
+        self.assertFalse(flags.debug)
+        self.assertFalse(flags.info)
+
+    def test_update(self):
+        flags = log.get_flags('test-flags')
+        self.logger.setLevel(logging.INFO)
+        # only noticed when asked to
+        self.assertFalse(flags.info)
+        log.update_flags()
+        self.assertTrue(flags.info)
+        self.assertFalse(flags.debug)
+
+
+class TestRateLimitedLogger(unittest.TestCase):
+    def setUp(self):
+        self.logger = log.get_logger('test-ratelimit')
+        self.logger.setLevel(logging.DEBUG)
+        self.handler = _Handler()
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+        self.addCleanup(self.logger.setLevel, logging.NOTSET)
+
+        self.now = 0.0
+        self.rl = log.RateLimitedLogger(self.logger, rate=2, burst=3)
+        self.rl.clock = lambda: self.now
+
+    def test_limit(self):
+        for i in range(5):
+            self.rl.debug('frame %d', i)
+        self.assertEquals(self.handler.messages,
+                          ['frame 0', 'frame 1', 'frame 2'])
+        self.assertEquals(self.rl.suppressed, 2)
+
+        self.now += 0.5
+        self.rl.debug('frame %d', 5)
+        self.assertEquals(self.handler.messages[-1],
+                          'frame 5 (2 similar messages suppressed)')
+        self.assertEquals(self.rl.suppressed, 0)
+
+        self.rl.debug('frame %d', 6)
+        self.assertEquals(len(self.handler.messages), 4)
+
+    def test_disabled(self):
+        self.logger.setLevel(logging.INFO)
+        for i in range(5):
+            self.rl.debug('frame %d', i)
+        self.assertEquals(self.handler.messages, [])
+        self.assertEquals(self.rl.suppressed, 0)
+        self.rl.info('info')
+        self.assertEquals(self.handler.messages, ['info'])
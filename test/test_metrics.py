@@ -0,0 +1,112 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from twisted.trial import unittest
+
+from twimp import chunks
+from twimp.chunks import Muxer
+from twimp.metrics import MetricsRegistry
+from twimp.proto import BaseFactory
+
+from twimp.helpers import vb
+from test.helpers import StringTransport
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+        self.factory = BaseFactory(0)
+        self.factory.metrics = self.metrics
+        self.transport = StringTransport()
+        self.p = self.factory.buildProtocol(None)
+        self.p.makeConnection(self.transport)
+
+    def test_connection(self):
+        self.assertEquals(self.metrics.connections(), 1)
+        self.p.dataReceived('\x03')
+        self.p.handshakeSucceeded(0, 0)
+        self.p.muxer.sendMessage(0, chunks.MSG_VIDEO, 1, vb('abcd'))
+        self.p.muxer.sendMessage(0, chunks.MSG_VIDEO, 1, vb('ef'))
+
+        c, = self.metrics.snapshot()['connections']
+        self.assertEquals(c['bytes_in'], 1)
+        self.assertEquals(c['bytes_out'], 6)
+        self.assertEquals(c['messages_out'], 2)
+        self.assertEquals(c['by_type_out'], {'video': 2})
+        self.assertEquals(c['queued'], 0)
+        self.assertNotEquals(c['handshake_time'], None)
+
+        self.p.connectionLost()
+        self.assertEquals(self.metrics.connections(), 0)
+        total = self.metrics.snapshot()['total']
+        self.assertEquals(total['connections'], 1)
+        self.assertEquals(total['bytes_in'], 1)
+        self.assertEquals(total['bytes_out'], 6)
+
+    def test_messages_in(self):
+        self.p.handshakeSucceeded(0, 0)
+        t = StringTransport()
+        mux = Muxer(t)
+        mux.sendMessage(0, chunks.MSG_AUDIO, 1, vb('x' * 200))
+        mux.sendMessage(0, chunks.MSG_VIDEO, 1, vb('y' * 10))
+        self.p.dataReceived(t.value())
+
+        demuxer = self.p._demuxer
+        self.assertEquals(demuxer.bytes_received, 210)
+        c, = self.metrics.snapshot()['connections']
+        self.assertEquals(c['messages_in'], 2)
+        self.assertEquals(c['by_type_in'], {'audio': 1, 'video': 1})
+        self.assertEquals(c['bytes_in'], len(t.value()))
+
+    def test_sessions(self):
+        m = self.metrics
+        pub = m.open_session('publish', 'a', self.p)
+        play = m.open_session('play', 'a', self.p)
+        pub.count_frame(10)
+        pub.count_frame(20)
+        pub.dropped += 1
+        play.count_frame(10)
+
+        snap = m.snapshot()
+        self.assertEquals(snap['streams'],
+                          {'a': dict(publishers=1, players=1, frames_in=2,
+                                     frames_out=1, bytes_in=30, bytes_out=10,
+                                     dropped=1)})
+        c, = snap['connections']
+        self.assertEquals(len(c['sessions']), 2)
+        self.assertNotEquals(c['sessions'][0]['time_to_first_frame'], None)
+
+        play.close()
+        snap = m.snapshot()
+        self.assertEquals(snap['streams']['a']['players'], 0)
+        self.assertEquals(snap['total']['frames'], 3)
+
+        # the sessions left get closed with the connection
+        self.p.connectionLost()
+        snap = m.snapshot()
+        self.assertEquals(snap['streams'], {})
+        self.assertEquals(snap['total']['sessions'], 2)
+        self.assertEquals(snap['total']['frames'], 3)
+        self.assertEquals(snap['total']['dropped'], 1)
+
+    def test_prometheus(self):
+        s = self.metrics.open_session('publish', 'a"b', self.p)
+        s.count_frame(5)
+        text = self.metrics.prometheus()
+        lines = text.splitlines()
+        self.assertIn('# TYPE twimp_connections gauge', lines)
+        self.assertIn('twimp_connections 1', lines)
+        self.assertIn('twimp_frames_total 1', lines)
+        self.assertIn('twimp_stream_bytes_in{stream="a\\"b"} 5', lines)
@@ -0,0 +1,115 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from twimp import chunks
+from twimp.chunks import Muxer
+from twimp.profiling import Histogram, Profiler, default_probes
+
+from twimp.helpers import vb
+from test.helpers import StringTransport
+
+# the modules of the default probes, imported before trial changes
+# the working directory
+for _probe in default_probes:
+    __import__(_probe[0])
+
+
+class _Probed(object):
+    def __init__(self):
+        self.d = defer.Deferred()
+
+    def call_sync(self, x):
+        return x * 2
+
+    def call_deferred(self):
+        return self.d
+
+    def other(self):
+        pass
+
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets(self):
+        h = Histogram()
+        h.record(0.001)
+        h.record(0.00101)
+        h.record(0.002)
+        h.record(0)
+        self.assertEquals(h.count, 4)
+        self.assertEquals(sum(h.counts), 4)
+        self.assertEquals(h.counts[0], 1)
+        # the same bucket
+        self.assertEquals(len([c for c in h.counts if c]), 3)
+
+    def test_percentiles(self):
+        h = Histogram()
+        self.assertEquals(h.percentile(50), None)
+        for i in range(99):
+            h.record(0.001)
+        h.record(0.5)
+        # within a quarter of a doubling
+        p50 = h.percentile(50)
+        self.assertTrue(0.001 <= p50 < 0.00125, p50)
+        self.assertTrue(0.001 <= h.percentile(99) < 0.00125)
+        self.assertEquals(h.percentile(100), 0.5)
+        self.assertEquals(h.summary()['max'], 0.5)
+
+    def test_out_of_range(self):
+        h = Histogram()
+        h.record(1e6)
+        self.assertEquals(h.counts[-1], 1)
+        self.assertEquals(h.percentile(50), 1e6)
+
+
+class TestProfiler(unittest.TestCase):
+    def test_enable_disable(self):
+        orig = Muxer.__dict__['sendMessage']
+        p = Profiler()
+        p.enable()
+        self.assertTrue(p.enabled())
+        try:
+            self.assertNotIdentical(Muxer.__dict__['sendMessage'], orig)
+            Muxer(StringTransport()).sendMessage(0, chunks.MSG_VIDEO, 1,
+                                                 vb('abc'))
+        finally:
+            p.disable()
+        self.assertFalse(p.enabled())
+        self.assertIdentical(Muxer.__dict__['sendMessage'], orig)
+        self.assertEquals(p.report()['mux.send']['count'], 1)
+
+    def test_prefix_deferred(self):
+        p = Profiler([('test.test_profiling', '_Probed', 'call_*',
+                       'probed.%s', True)])
+        p.enable()
+        try:
+            o = _Probed()
+            self.assertEquals(o.call_sync(2), 4)
+            d = o.call_deferred()
+            o.other()
+        finally:
+            p.disable()
+
+        self.assertEquals(sorted(p.report()),
+                          ['probed.deferred', 'probed.sync'])
+        self.assertEquals(p.histograms['probed.deferred.deferred'].count, 0)
+        d.callback(None)
+        self.assertEquals(p.histograms['probed.deferred.deferred'].count, 1)
+
+        lines = p.format_report().splitlines()
+        self.assertEquals(len(lines), 4)
+        self.assertTrue(lines[1].startswith('probed.deferred '))
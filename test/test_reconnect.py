@@ -0,0 +1,240 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import time
+
+from twisted.internet import reactor, task
+from twisted.trial import unittest
+
+from twimp import chunks
+from twimp.chunks import MSG_AUDIO, MSG_DATA, MSG_VIDEO
+from twimp.client import ClientStream, SimpleAppClientProtocol
+from twimp.helpers import vb
+from twimp.reconnect import ResumableSource, ReconnectingPublishFactory
+from twimp.server import inmemory
+from twimp.server.appserver import URLDispatchingServerFactory
+from twimp.scripts.simple_live_server import urls
+from twimp.sources import SyntheticSource
+
+from test.helpers import StringTransport, unvb, wait_for
+
+
+META = '\x02\x00\x0aonMetaData'
+V_HEADER = '\x17\x00'
+V_KEY = '\x17\x01'
+V_INTER = '\x27\x01'
+A_HEADER = '\xaf\x00'
+A_FRAME = '\xaf\x01'
+
+
+class FakeStream(object):
+    def __init__(self):
+        self.written = []
+
+    def write_meta(self, ts, data):
+        self.written.append((ts, MSG_DATA, unvb(data)))
+
+    def write_audio(self, ts, data):
+        self.written.append((ts, MSG_AUDIO, unvb(data)))
+
+    def write_video(self, ts, data):
+        self.written.append((ts, MSG_VIDEO, unvb(data)))
+
+
+class FakeSource(object):
+    def __init__(self):
+        self.stream = None
+        self.started = 0
+
+    def connect(self, stream):
+        self.stream = stream
+
+    def disconnect(self):
+        self.stream = None
+
+    def start(self):
+        self.started += 1
+
+    def stop(self):
+        pass
+
+
+class TestResumableSource(unittest.TestCase):
+    def setUp(self):
+        self.source = FakeSource()
+        self.rs = ResumableSource(self.source, max_held=0.2)
+
+    def attach(self):
+        stream = FakeStream()
+        self.rs.connect(stream)
+        self.rs.start()
+        return stream
+
+    def detach(self):
+        self.rs.stop()
+        self.rs.disconnect()
+
+    def write(self, ts, type_, data):
+        w = {MSG_DATA: self.rs.write_meta, MSG_AUDIO: self.rs.write_audio,
+             MSG_VIDEO: self.rs.write_video}[type_]
+        w(ts, vb(data))
+
+    def test_resume(self):
+        s1 = self.attach()
+        for f in [(0, MSG_DATA, META), (0, MSG_VIDEO, V_HEADER),
+                  (0, MSG_AUDIO, A_HEADER), (0, MSG_VIDEO, V_KEY),
+                  (40, MSG_VIDEO, V_INTER)]:
+            self.write(*f)
+        self.assertEquals(len(s1.written), 5)
+        self.detach()
+
+        self.write(80, MSG_VIDEO, V_INTER)
+        self.write(90, MSG_AUDIO, A_FRAME)
+        # trimmed to the latest keyframe
+        self.write(120, MSG_VIDEO, V_KEY)
+        self.write(130, MSG_AUDIO, A_FRAME)
+        self.assertEquals((self.rs.held(), self.rs.dropped), (2, 2))
+
+        s2 = self.attach()
+        self.write(160, MSG_VIDEO, V_INTER)
+        self.assertEquals(self.source.started, 1)
+        self.assertEquals(s2.written,
+                          [(120, MSG_DATA, META), (120, MSG_VIDEO, V_HEADER),
+                           (120, MSG_AUDIO, A_HEADER), (120, MSG_VIDEO, V_KEY),
+                           (130, MSG_AUDIO, A_FRAME),
+                           (160, MSG_VIDEO, V_INTER)])
+        self.assertEquals(self.rs.resumed, 1)
+
+    def test_monotonic(self):
+        self.attach()
+        self.write(0, MSG_VIDEO, V_KEY)
+        self.write(1000, MSG_VIDEO, V_INTER)
+        self.detach()
+
+        # the source starting over
+        self.write(0, MSG_VIDEO, V_KEY)
+        s2 = self.attach()
+        self.write(40, MSG_VIDEO, V_INTER)
+        self.assertEquals([f[0] for f in s2.written], [1000, 1040])
+
+    def test_bounded(self):
+        self.attach()
+        self.write(0, MSG_VIDEO, V_KEY)
+        self.detach()
+
+        self.write(40, MSG_VIDEO, V_INTER)
+        for ts in range(20, 300, 40):
+            self.write(ts, MSG_AUDIO, A_FRAME)
+        self.write(80, MSG_VIDEO, V_INTER)
+        # the video lost, skipped until the next keyframe
+        self.write(320, MSG_VIDEO, V_INTER)
+        self.write(340, MSG_VIDEO, V_KEY)
+
+        s2 = self.attach()
+        self.assertEquals([f[:2] for f in s2.written],
+                          [(340, MSG_VIDEO)])
+
+        self.rs.close()
+        self.assertEquals(self.source.stream, None)
+
+
+class FakeMuxer(object):
+    def __init__(self):
+        self.messages = []
+        self.producer = chunks.SimpleChunkProducer(None)
+
+    def sendMessage(self, ts, type_, ms_id, data):
+        self.messages.append((ts, type_, ms_id))
+
+
+class TestThrottled(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.source = SyntheticSource(realtime=False, reactor=self.clock)
+        self.rs = ResumableSource(self.source)
+        self.addCleanup(self.rs.close)
+
+    def publish(self):
+        proto = SimpleAppClientProtocol()
+        proto.transport = StringTransport()
+        proto.muxer = FakeMuxer()
+        stream = ClientStream(proto, 1)
+        stream._start_writing(None, self.rs, None)
+        return proto, stream
+
+    def test_connection_lost_while_congested(self):
+        proto, stream = self.publish()
+        proto.pauseProducing()
+        self.assertTrue(self.source._paused)
+
+        # the connection dropping before the stream got to resume
+        stream._force_cleanup()
+        self.assertFalse(self.source._paused)
+        # the source keeps writing, frames held for the next stream
+        self.assertTrue(self.rs.held() > 0)
+
+        proto, stream = self.publish()
+        self.assertFalse(self.source._paused)
+        self.assertTrue(len(proto.muxer.messages) > 0)
+
+
+class TestReconnectingPublishFactory(unittest.TestCase):
+    def setUp(self):
+        self.origin = inmemory.IMServer()
+        factory = URLDispatchingServerFactory(time.time(), self.origin, urls)
+
+        self.conns = []
+        build = factory.buildProtocol
+
+        def build_protocol(addr):
+            p = build(addr)
+            self.conns.append(p)
+            return p
+
+        factory.buildProtocol = build_protocol
+
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.port = port.getHost().port
+
+    def disconnected(self):
+        self.factory.stop()
+        return wait_for(lambda: all(p.transport.disconnected
+                                    for p in self.conns))
+
+    def test_reconnect(self):
+        url = 'rtmp://127.0.0.1:%d/live' % (self.port,)
+        source = SyntheticSource(framerate=50, keyframe_interval=0.1)
+        self.factory = ReconnectingPublishFactory(url, dict(fpad=False),
+                                                  'live', source)
+        self.factory.initialDelay = 0.01
+        self.addCleanup(self.disconnected)
+        reactor.connectTCP('127.0.0.1', self.port, self.factory)
+
+        def published(_):
+            self.conns[0].transport.loseConnection()
+            return wait_for(lambda: self.factory.sessions == 2)
+
+        def republished(_):
+            self.assertEquals(len(self.conns), 2)
+            self.assertEquals(self.factory.source.resumed, 1)
+            # the origin got the stream again
+            return self.origin.open('live')
+
+        d = wait_for(lambda: self.factory.sessions == 1)
+        d.addCallback(published)
+        d.addCallback(republished)
+        d.addCallback(self.origin.close)
+        return d
@@ -0,0 +1,165 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import time
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from twimp import chunks
+from twimp.capture import IN, OUT
+from twimp.handshake import Handshaker
+from twimp.helpers import vb
+from twimp.proto import DispatchProtocol
+from twimp.replay import SessionReplay, replay_handshaker
+
+from test.helpers import StringTransport
+from test.test_proto import TestFactory
+
+
+class _Protocol(DispatchProtocol):
+    def __init__(self):
+        DispatchProtocol.__init__(self)
+        self.data = []
+        self.succeeded = False
+        self.lost = None
+
+    def handshakeSucceeded(self, init_ts, hs_delay):
+        self.succeeded = True
+        DispatchProtocol.handshakeSucceeded(self, init_ts, hs_delay)
+
+    def doData(self, type_, ts, ms_id, body):
+        self.data.append((type_, ts, body.read(len(body))[:]))
+
+    def connectionLost(self, reason):
+        self.lost = reason
+        DispatchProtocol.connectionLost(self, reason)
+
+
+def _client_records(frames):
+    """Records of a client session, as captured by the server: the
+    handshake (the response not matching what the replaying server
+    sends) and the frames."""
+    hs = Handshaker(None, time.time(), is_client=True)
+    records = [(IN, 0.0, '\x03' + hs.generate_request()),
+               (OUT, 0.001, 'x' * (1 + 1536 + 1536)),
+               (IN, 0.002, 'y' * 1536)]
+
+    t = StringTransport()
+    m = chunks.Muxer(t)
+    for ts, data in frames:
+        m.sendMessage(ts, chunks.MSG_VIDEO, 1, vb(data))
+        records.append((IN, ts / 1000.0, t.value()))
+        t.clear()
+    return records
+
+
+def _make_protocol():
+    factory = TestFactory()
+    factory.init_time = time.time()
+    p = _Protocol()
+    p.factory = factory
+    return p
+
+
+class TestSessionReplay(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_max_speed(self):
+        frames = [(i * 40, 'frame %d' % i) for i in range(10)]
+        p = _make_protocol()
+        r = SessionReplay(_client_records(frames), p, reactor=self.clock)
+        r.batch = 4
+        results = []
+        r.start().addCallback(results.append)
+
+        self.assertTrue(p.succeeded)
+        self.assertEquals(r.records, 4)
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.clock.advance(0)
+
+        self.assertEquals([(ts, data) for _t, ts, data in p.data], frames)
+        stats = results[0]
+        self.assertEquals(stats['records'], 12)
+        self.assertEquals(stats['bytes_out'], 1 + 1536 + 1536)
+        self.assertEquals(stats['error'], None)
+        self.assertFalse(stats['closed'])
+        self.assertTrue(p.lost is not None)
+
+    def test_realtime(self):
+        frames = [(1000, 'a'), (2000, 'b')]
+        p = _make_protocol()
+        r = SessionReplay(_client_records(frames), p, realtime=True,
+                          reactor=self.clock)
+        results = []
+        r.start().addCallback(results.append)
+
+        self.clock.advance(0.5)
+        self.assertEquals(p.data, [])
+        self.clock.advance(0.5)
+        self.assertEquals([data for _t, _ts, data in p.data], ['a'])
+        self.assertEquals(results, [])
+        self.clock.advance(1)
+        self.assertEquals([data for _t, _ts, data in p.data], ['a', 'b'])
+        self.assertEquals(results[0]['elapsed'], 2.0)
+        self.assertEquals(results[0]['offset'], 2.0)
+
+    def test_response(self):
+        records = _client_records([(0, 'a')])
+        # more captured output than the protocol sends
+        records[1] = (OUT, 0.001, 'x' * (1 + 1536 + 1536 + 10))
+        p = _make_protocol()
+        r = SessionReplay(records, p, reactor=self.clock)
+        r.response_timeout = 2.0
+        results = []
+        r.start().addCallback(results.append)
+
+        self.assertFalse(p.succeeded)
+        self.clock.advance(1.0)
+        self.assertFalse(p.succeeded)
+        self.clock.advance(1.0)
+        self.assertTrue(p.succeeded)
+        self.assertEquals([data for _t, _ts, data in p.data], ['a'])
+        self.assertEquals(results[0]['waits'], 1)
+        self.assertEquals(results[0]['timeouts'], 1)
+
+    def test_failed(self):
+        p = _make_protocol()
+        records = [(IN, 0.0, '\x06' + 'x' * 1536)]
+        r = SessionReplay(records, p, reactor=self.clock)
+        results = []
+        r.start().addCallback(results.append)
+
+        self.assertFalse(p.succeeded)
+        self.assertTrue(results[0]['error'])
+        self.assertTrue(r.transport.disconnecting)
+
+    def test_stop(self):
+        p = _make_protocol()
+        r = SessionReplay(_client_records([(1000, 'a')]), p, realtime=True,
+                          reactor=self.clock)
+        results = []
+        r.start().addCallback(results.append)
+        r.stop()
+        # (the handshake response comes 2ms later)
+        self.assertEquals(results[0]['records'], 1)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_handshaker(self):
+        cls = replay_handshaker(Handshaker)
+        self.assertIdentical(replay_handshaker(Handshaker), cls)
+        self.assertTrue(cls(None, 0).verify_response('a' * 1536, 'b' * 1536))
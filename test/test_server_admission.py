@@ -0,0 +1,96 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from twisted.internet import address, task
+from twisted.trial import unittest
+
+from twimp.proto import BaseFactory
+from twimp.server.admission import AdmissionControl
+
+from test.helpers import StringTransport
+
+
+def addr(host, port=1234):
+    return address.IPv4Address('TCP', host, port)
+
+
+class TestAdmissionControl(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_connections(self):
+        ac = AdmissionControl(max_connections=2, reactor=self.clock)
+        a, b = object(), object()
+        self.assertTrue(ac.admit(addr('10.0.0.1')))
+        ac.opened(a)
+        self.assertTrue(ac.admit(addr('10.0.0.2')))
+        ac.opened(b)
+        self.assertFalse(ac.admit(addr('10.0.0.3')))
+        ac.closed(a)
+        ac.closed(a)
+        self.assertEquals(ac.connections(), 1)
+        self.assertTrue(ac.admit(addr('10.0.0.3')))
+        self.assertEquals(ac.rejected['connections'], 1)
+
+    def test_handshakes(self):
+        ac = AdmissionControl(max_handshakes=1, reactor=self.clock)
+        a = object()
+        ac.opened(a)
+        self.assertFalse(ac.admit(addr('10.0.0.1')))
+        ac.handshake_done(a)
+        self.assertEquals((ac.connections(), ac.handshakes()), (1, 0))
+        self.assertTrue(ac.admit(addr('10.0.0.1')))
+
+    def test_rate(self):
+        ac = AdmissionControl(rate=2, burst=3, reactor=self.clock)
+        results = [ac.admit(addr('10.0.0.1')) for _ in range(4)]
+        self.assertEquals(results, [True, True, True, False])
+        # other addresses have their own buckets
+        self.assertTrue(ac.admit(addr('10.0.0.2')))
+
+        self.clock.advance(0.5)
+        self.assertEquals([ac.admit(addr('10.0.0.1')) for _ in range(2)],
+                          [True, False])
+        self.assertEquals(ac.rejected['rate'], 2)
+
+    def test_prune(self):
+        ac = AdmissionControl(rate=10, burst=1, reactor=self.clock)
+        for i in range(1024):
+            ac.admit(addr('10.0.%d.%d' % (i // 256, i % 256)))
+        self.assertEquals(len(ac._buckets), 1024)
+        # the buckets get full again, and forgotten
+        self.clock.advance(0.1)
+        ac.admit(addr('10.1.0.0'))
+        self.assertEquals(len(ac._buckets), 1)
+
+
+class TestFactoryAdmission(unittest.TestCase):
+    def test_refused(self):
+        f = BaseFactory(0)
+        f.admission = AdmissionControl(max_connections=1,
+                                       reactor=task.Clock())
+
+        p = f.buildProtocol(addr('10.0.0.1'))
+        self.assertNotIdentical(p, None)
+        self.assertIdentical(f.buildProtocol(addr('10.0.0.2')), None)
+
+        p.makeConnection(StringTransport())
+        self.assertEquals(f.admission.handshakes(), 1)
+        p.handshakeSucceeded(0, 0)
+        self.assertEquals(f.admission.handshakes(), 0)
+
+        p.connectionLost()
+        self.assertEquals(f.admission.connections(), 0)
+        self.assertNotIdentical(f.buildProtocol(addr('10.0.0.2')), None)
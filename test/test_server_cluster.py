@@ -0,0 +1,269 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+import socket
+import threading
+
+from twisted.internet import defer, protocol
+from twisted.trial import unittest
+
+from twimp.server import cluster, errors, inmemory
+from twimp.server.controllers import TYPE_AUDIO, TYPE_VIDEO
+
+from test.helpers import unvb, wait_for
+
+
+class TestStreamRegistry(unittest.TestCase):
+    def setUp(self):
+        path = self.mktemp()
+        self.r0 = cluster.StreamRegistry(path, 0)
+        self.r1 = cluster.StreamRegistry(path, 1)
+
+    def test_claim_lookup_release(self):
+        self.assertEquals(self.r1.lookup(None, 'a'), None)
+        self.assertTrue(self.r0.claim(None, 'a'))
+        self.assertEquals(self.r1.lookup(None, 'a'), 0)
+        self.assertEquals(self.r1.lookup('ns', 'a'), None)
+
+        self.assertFalse(self.r1.claim(None, 'a'))
+
+        # only the owner can release
+        self.r1.release(None, 'a')
+        self.assertEquals(self.r1.lookup(None, 'a'), 0)
+        self.r0.release(None, 'a')
+        self.assertEquals(self.r1.lookup(None, 'a'), None)
+        self.assertTrue(self.r1.claim(None, 'a'))
+
+    def test_names(self):
+        self.assertTrue(self.r0.claim(None, '../x/y'))
+        self.assertEquals(os.listdir(self.r0.path), ['@..%2Fx%2Fy'])
+
+    def test_stale_entry(self):
+        # an entry left by a dead process
+        f = open(self.r0.entry_path(None, 'a'), 'w')
+        f.write('3 %d\n' % (2 ** 22 + 1,))
+        f.close()
+
+        self.assertEquals(self.r1.lookup(None, 'a'), None)
+        self.assertTrue(self.r1.claim(None, 'a'))
+        self.assertEquals(self.r0.lookup(None, 'a'), 1)
+
+    def test_stale_entry_race(self):
+        f = open(self.r0.entry_path(None, 'a'), 'w')
+        f.write('3 %d\n' % (2 ** 22 + 1,))
+        f.close()
+
+        # r1 taking the entry over while r0 is about to
+        lock = self.r0._lock
+        def racing_lock():
+            self.assertTrue(self.r1.claim(None, 'a'))
+            return lock()
+        self.r0._lock = racing_lock
+
+        self.assertFalse(self.r0.claim(None, 'a'))
+        self.assertEquals(self.r0.lookup(None, 'a'), 1)
+        self.assertEquals(sorted(os.listdir(self.r0.path)), ['.lock', '@a'])
+
+
+class TestListenReuseport(unittest.TestCase):
+    def test_shared_port(self):
+        f = protocol.ServerFactory()
+        f.protocol = protocol.Protocol
+
+        p1 = cluster.listen_reuseport(0, f, interface='127.0.0.1')
+        self.addCleanup(p1.stopListening)
+        port = p1.getHost().port
+
+        p2 = cluster.listen_reuseport(port, f, interface='127.0.0.1')
+        self.addCleanup(p2.stopListening)
+        self.assertEquals(p2.getHost().port, port)
+
+        s = p1.socket
+        self.assertTrue(s.getsockopt(socket.SOL_SOCKET,
+                                     cluster.SO_REUSEPORT))
+
+
+video_frames = [(0, 1, '.1'), (40, 2, '.'), (80, 2, '.'), (120, 1, '.2')]
+audio_frames = [(0, 1, 'a'), (23, 1, 'b')]
+
+
+class TestClusterServer(unittest.TestCase):
+    def setUp(self):
+        run_dir = self.mktemp()
+        os.makedirs(run_dir)
+        self.workers = []
+        for i in range(2):
+            c = cluster.ClusterServer(inmemory.IMServer(), run_dir, i)
+            c.start()
+            self.addCleanup(c.stop)
+            self.workers.append(c)
+
+    def publish(self, c, name='live'):
+        d = c.open(name, mode='l')
+
+        def opened(sg):
+            self.addCleanup(self.unpublish, c, sg)
+            self.tracks = {}
+            d = sg.set_meta({'x': 1})
+            for type_, frames in ((TYPE_VIDEO, video_frames),
+                                  (TYPE_AUDIO, audio_frames)):
+                d.addCallback(lambda _: sg.make_stream())
+                d.addCallback(made, type_, frames)
+            d.addCallback(lambda _: sg)
+            return d
+
+        def made(s, type_, frames):
+            self.tracks[type_] = s
+            d = s.set_params({'type': type_})
+            d.addCallback(lambda _: s.set_buffering(grpos_range=3000))
+            d.addCallback(lambda _: s.write_headers('h' + type_[0]))
+            for f in frames:
+                d.addCallback(lambda _, f=f: s.write(*f))
+            return d
+
+        d.addCallback(opened)
+        return d
+
+    def unpublish(self, c, sg):
+        if sg in c._published:
+            return c.close(sg)
+
+    def test_publish_claims(self):
+        c0, c1 = self.workers
+        d = self.publish(c0)
+        d.addCallback(lambda _: c1.open('live', mode='l'))
+        d = self.assertFailure(d, errors.StreamExistsError)
+        d.addCallback(lambda _: self.assertEquals(
+                c1.registry.lookup(None, 'live'), 0))
+        return d
+
+    def test_claim_in_thread(self):
+        c0 = self.workers[0]
+        registry_claim = c0.registry.claim
+        threads = []
+
+        def claim(namespace, name):
+            threads.append(threading.currentThread())
+            return registry_claim(namespace, name)
+        c0.registry.claim = claim
+
+        d = c0.open('live', mode='l')
+        d.addCallback(c0.close)
+        d.addCallback(lambda _: self.assertNotIdentical(
+                threads[0], threading.currentThread()))
+        return d
+
+    def test_release_on_close(self):
+        c0, c1 = self.workers
+        d = c0.open('live', mode='l')
+        d.addCallback(c0.close)
+        d.addCallback(lambda _: self.assertEquals(
+                c1.registry.lookup(None, 'live'), None))
+        return d
+
+    def test_local_open(self):
+        c0, c1 = self.workers
+        d = self.publish(c0)
+        d.addCallback(lambda _: c0.open('live'))
+        d.addCallback(lambda sg: self.assertIsInstance(
+                sg, inmemory.IMStreamGroup))
+        d.addCallback(lambda _: self.assertEquals(c0._mirrors, {}))
+        return d
+
+    def test_not_found(self):
+        d = self.workers[1].open('nothing')
+        return self.assertFailure(d, errors.StreamNotFoundError)
+
+    def test_relay(self):
+        c0, c1 = self.workers
+        got = []
+
+        def collector(name):
+            return lambda gp, flags, data: got.append((name, gp, flags,
+                                                       unvb(data)))
+
+        d = self.publish(c0)
+        d.addCallback(lambda _: c1.open('live'))
+
+        def opened(rsg):
+            self.rsg = rsg
+            self.assertEquals(len(c1._mirrors), 1)
+            d = rsg.meta()
+            d.addCallback(self.assertEquals, {'x': 1})
+            d.addCallback(lambda _: rsg.streams_by_params(
+                    {'type': TYPE_VIDEO}))
+            return d
+
+        def got_video(streams):
+            v, = streams
+            headers = []
+            v.read_headers(lambda *f: headers.append(unvb(f[2])))
+            self.assertEquals(headers, ['hv'])
+
+            # preroll, then live
+            d = v.subscribe(collector('v'), preroll_grpos_range=3000)
+            d.addCallback(lambda _: self.assertEquals(
+                    got, [('v',) + f for f in video_frames]))
+            d.addCallback(lambda _: self.tracks[TYPE_VIDEO].write(160, 2,
+                                                                  'x'))
+            d.addCallback(lambda _: wait_for(lambda: len(got) == 5))
+            d.addCallback(lambda _: self.assertEquals(got[-1],
+                                                      ('v', 160, 2, 'x')))
+            return d
+
+        def closed(_result):
+            return wait_for(lambda: not c0.origin.links)
+
+        d.addCallback(opened)
+        d.addCallback(got_video)
+        d.addCallback(lambda _: c1.close(self.rsg))
+        d.addCallback(lambda _: self.assertEquals(c1._mirrors, {}))
+        d.addCallback(closed)
+        return d
+
+    def test_relay_shared(self):
+        c0, c1 = self.workers
+        d = self.publish(c0)
+        d.addCallback(lambda _: defer.gatherResults([c1.open('live'),
+                                                     c1.open('live')]))
+
+        def opened((sg1, sg2)):
+            self.assertEquals(len(c1._mirrors), 1)
+            self.assertEquals(sum(len(l) for l in c0.origin.links.values()),
+                              1)
+            c1.close(sg1)
+            self.assertEquals(len(c1._mirrors), 1)
+            c1.close(sg2)
+            self.assertEquals(len(c1._mirrors), 0)
+            return wait_for(lambda: not c0.origin.links)
+
+        d.addCallback(opened)
+        return d
+
+    def test_publisher_gone(self):
+        c0, c1 = self.workers
+        d = self.publish(c0)
+
+        def published(sg):
+            d = c1.open('live')
+            d.addCallback(lambda rsg: c0.close(sg))
+            return d
+
+        d.addCallback(published)
+        d.addCallback(lambda _: wait_for(lambda: not c1._mirrors))
+        d.addCallback(lambda _: c1.open('live'))
+        d = self.assertFailure(d, errors.StreamNotFoundError)
+        return d
@@ -0,0 +1,198 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import time
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+
+from twimp import chunks
+from twimp.helpers import vb
+from twimp.server import edge, errors, inmemory
+from twimp.server.appserver import URLDispatchingServerFactory
+from twimp.server.controllers import TYPE_AUDIO, TYPE_VIDEO
+from twimp.scripts.simple_live_server import urls
+
+from test.helpers import unvb, wait_for
+
+
+video_headers = '\x17\x00\x00\x00\x00hv'
+video_frames = [(0, 1, '\x17\x01\x00\x00\x00k0'),
+                (40, 2, '\x27\x01\x00\x00\x00i1'),
+                (80, 2, '\x27\x01\x00\x00\x00i2')]
+audio_headers = '\xaf\x00ha'
+audio_frames = [(0, 1, '\xaf\x01a0'), (23, 1, '\xaf\x01a1')]
+
+
+class TestMetaTrackTypes(unittest.TestCase):
+    def test_types(self):
+        self.assertEquals(edge.meta_track_types({}), set())
+        self.assertEquals(edge.meta_track_types({'videocodecid': 7,
+                                                 'hasAudio': True}),
+                          set([chunks.MSG_VIDEO, chunks.MSG_AUDIO]))
+        self.assertEquals(edge.meta_track_types({'hasVideo': False}), set())
+
+
+class TestEdgeServer(unittest.TestCase):
+    def setUp(self):
+        self.origin = inmemory.IMServer()
+        factory = URLDispatchingServerFactory(time.time(), self.origin, urls)
+
+        # keep track of the origin connections, to wait for them to go
+        self.conns = []
+        build = factory.buildProtocol
+
+        def build_protocol(addr):
+            p = build(addr)
+            self.conns.append(p)
+            return p
+
+        factory.buildProtocol = build_protocol
+
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+
+        url = 'rtmp://127.0.0.1:%d/live' % (port.getHost().port,)
+        self.edge = edge.EdgeServer(inmemory.IMServer(), url)
+        self.edge.idle_timeout = 0.05
+        self.edge.pool.idle_timeout = 0.05
+        self.addCleanup(self.disconnected)
+
+    def disconnected(self):
+        for pull in self.edge._pulls.values():
+            pull.close()
+        self.edge.pool.close()
+        return wait_for(lambda: all(p.transport.disconnected
+                                    for p in self.conns))
+
+    def publish(self, name='live'):
+        d = self.origin.open(name, mode='l')
+
+        def opened(sg):
+            self.addCleanup(self.origin.close, sg)
+            d = sg.set_meta({'videocodecid': 7, 'audiocodecid': 10})
+            for type_, headers, frames in ((TYPE_VIDEO, video_headers,
+                                            video_frames),
+                                           (TYPE_AUDIO, audio_headers,
+                                            audio_frames)):
+                d.addCallback(lambda _: sg.make_stream())
+                d.addCallback(made, type_, headers, frames)
+            return d
+
+        def made(s, type_, headers, frames):
+            d = s.set_params({'type': type_})
+            d.addCallback(lambda _: s.set_buffering(grpos_range=3000))
+            d.addCallback(lambda _: s.write_headers(vb(headers)))
+            for gp, flags, data in frames:
+                d.addCallback(lambda _, f=(gp, flags, vb(data)): s.write(*f))
+            return d
+
+        d.addCallback(opened)
+        return d
+
+    def test_not_found(self):
+        d = self.edge.open('nothing')
+        d = self.assertFailure(d, errors.StreamNotFoundError)
+        d.addCallback(lambda _: self.assertEquals(self.edge._pulls, {}))
+        return d
+
+    def test_local(self):
+        d = self.edge.open('live', mode='l')
+        d.addCallback(lambda sg: self.edge.open('live'))
+        d.addCallback(lambda _: self.assertEquals(self.edge._pulls, {}))
+        return d
+
+    def test_pull(self):
+        d = self.publish()
+        d.addCallback(lambda _: self.edge.open('live'))
+
+        def opened(sg):
+            self.rsg = sg
+            self.assertEquals(len(self.edge._pulls), 1)
+            d = sg.meta()
+            d.addCallback(lambda meta: self.assertEquals(
+                    meta['videocodecid'], 7))
+            d.addCallback(lambda _: sg.streams_by_params(
+                    {'type': TYPE_VIDEO}))
+            return d
+
+        def got_video(streams):
+            v, = streams
+            headers = []
+            v.read_headers(lambda *f: headers.append(unvb(f[2])))
+            self.assertEquals(headers, [video_headers])
+
+            got = []
+            d = v.subscribe(lambda *f: got.append(unvb(f[2])),
+                            preroll_grpos_range=3000)
+            d.addCallback(lambda _: self.assertEquals(
+                    got, [f[2] for f in video_frames]))
+            return d
+
+        d.addCallback(opened)
+        d.addCallback(got_video)
+        return d
+
+    def test_shared_and_idle(self):
+        d = self.publish()
+        d.addCallback(lambda _: defer.gatherResults([
+                    self.edge.open('live'), self.edge.open('live')]))
+
+        def opened((sg1, sg2)):
+            self.assertEquals(len(self.conns), 1)
+            self.edge.close(sg1)
+            self.edge.close(sg2)
+            # kept for a while, then closed
+            self.assertEquals(len(self.edge._pulls), 1)
+            return wait_for(lambda: not self.edge._pulls)
+
+        d.addCallback(opened)
+        d.addCallback(lambda _: wait_for(
+                lambda: self.conns[0].transport.disconnected))
+        return d
+
+    def test_reopen_while_idle(self):
+        d = self.publish()
+        d.addCallback(lambda _: self.edge.open('live'))
+
+        def opened(sg):
+            pull = self.edge._pulls.values()[0]
+            self.edge.close(sg)
+            d = self.edge.open('live')
+            d.addCallback(lambda _: self.assertTrue(
+                    self.edge._pulls.values()[0] is pull))
+            d.addCallback(lambda _: self.assertEquals(pull._idle_call,
+                                                      None))
+            return d
+
+        d.addCallback(opened)
+        return d
+
+    def test_shared_connection(self):
+        d = self.publish('one')
+        d.addCallback(lambda _: self.publish('two'))
+        d.addCallback(lambda _: defer.gatherResults([
+                    self.edge.open('one'), self.edge.open('two')]))
+
+        def opened((sg1, sg2)):
+            # two upstream sessions, over a single connection
+            self.assertEquals(len(self.edge._pulls), 2)
+            self.assertEquals(len(self.conns), 1)
+            self.edge.close(sg1)
+            self.edge.close(sg2)
+            return wait_for(lambda: self.conns[0].transport.disconnected)
+
+        d.addCallback(opened)
+        return d
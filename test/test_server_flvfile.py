@@ -0,0 +1,311 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from twimp import amf0
+from twimp import flv
+from twimp.server import errors, interfaces, flvfile
+from twimp.server.controllers import TYPE_AUDIO, TYPE_VIDEO
+from twimp.vecbuf import flatten
+
+from test.helpers import unvb
+
+
+avc_header = '\x17\x00\x00\x00\x00config'
+aac_header = '\xaf\x00\x12\x10'
+
+# (tag type, timestamp, data)
+tags = [(flv.TAG_VIDEO, 0, avc_header),
+        (flv.TAG_AUDIO, 0, aac_header),
+        (flv.TAG_VIDEO, 0, '\x17\x01k0'),
+        (flv.TAG_AUDIO, 0, '\xaf\x01a0'),
+        (flv.TAG_AUDIO, 23, '\xaf\x01a1'),
+        (flv.TAG_VIDEO, 40, '\x27\x01i1'),
+        (flv.TAG_AUDIO, 46, '\xaf\x01a2'),
+        (flv.TAG_VIDEO, 80, '\x27\x01i2'),
+        (flv.TAG_VIDEO, 120, '\x17\x01k3'),
+        (flv.TAG_AUDIO, 130, '\xaf\x01a3'),
+        (flv.TAG_VIDEO, 160, '\x27\x01i4')]
+
+video_frames = [(0, 1, '\x17\x01k0'), (40, 2, '\x27\x01i1'),
+                (80, 2, '\x27\x01i2'), (120, 1, '\x17\x01k3'),
+                (160, 2, '\x27\x01i4')]
+
+audio_frames = [(0, 1, '\xaf\x01a0'), (23, 1, '\xaf\x01a1'),
+                (46, 1, '\xaf\x01a2'), (130, 1, '\xaf\x01a3')]
+
+
+def write_flv(path, tags=tags, meta=None):
+    out = [flv.encode_file_header()]
+    if meta is not None:
+        vb = amf0.encode('onMetaData', meta)
+        out.extend(flv.encode_tag(flv.TAG_DATA, 0,
+                                  flatten(vb.read_seq(len(vb)))))
+    for type_, ts, data in tags:
+        out.extend(flv.encode_tag(type_, ts, data))
+    f = open(path, 'wb')
+    f.write(''.join(out))
+    f.close()
+
+
+class TestFLVFileServer(unittest.TestCase):
+    def setUp(self):
+        self.root = self.mktemp()
+        os.makedirs(os.path.join(self.root, 'ns'))
+        write_flv(os.path.join(self.root, 'clip.flv'),
+                  meta={'duration': 0.2, 'videocodecid': 7})
+        write_flv(os.path.join(self.root, 'ns', 'other.flv'))
+
+        self.server = flvfile.FLVFileServer(self.root,
+                                            namespaces=[None, 'ns'])
+        # tiny blocks, so that tags end up crossing block boundaries
+        self.server.block_size = 16
+        self.clock = self.server.clock = task.Clock()
+
+    def open_tracks(self, name='clip', namespace=None):
+        d = self.server.open(name, namespace=namespace)
+
+        def opened(sg):
+            self.addCleanup(self.server.close, sg)
+            d = sg.streams_by_params({'type': TYPE_VIDEO})
+            d.addCallback(lambda v: (sg, v[0]))
+            d.addCallback(lambda (sg, v): sg.streams_by_params(
+                    {'type': TYPE_AUDIO}).addCallback(
+                    lambda a: (sg, v, a[0])))
+            return d
+
+        d.addCallback(opened)
+        return d
+
+    def read_all(self, s):
+        stored = []
+        s.read(lambda *f: stored.append((f[0], f[1], unvb(f[2]))), None,
+               frames=999)
+        return stored
+
+    def test_interfaces(self):
+        d = self.open_tracks()
+
+        def opened((sg, v, a)):
+            self.assertTrue(interfaces.IStreamGroup.providedBy(sg))
+            self.assertTrue(interfaces.IStream.providedBy(v))
+
+        d.addCallback(opened)
+        return d
+
+    def test_index(self):
+        d = self.open_tracks()
+
+        def opened((sg, v, a)):
+            self.assertEquals(self.read_all(v), video_frames)
+            self.assertEquals(self.read_all(a), audio_frames)
+
+            headers = []
+            v.read_headers(lambda *f: headers.append(unvb(f[2])))
+            a.read_headers(lambda *f: headers.append(unvb(f[2])))
+            self.assertEquals(headers, [avc_header, aac_header])
+
+            return sg.meta()
+
+        d.addCallback(opened)
+        d.addCallback(self.assertEquals,
+                      {'duration': 0.2, 'videocodecid': 7})
+        return d
+
+    def test_non_aac_audio_header(self):
+        write_flv(os.path.join(self.root, 'mp3.flv'),
+                  [(flv.TAG_AUDIO, 0, '\x2fa0'),
+                   (flv.TAG_AUDIO, 26, '\x2fa1')])
+        d = self.server.open('mp3')
+        d.addCallback(lambda sg: (self.addCleanup(self.server.close, sg),
+                                  sg.streams())[1])
+
+        def got_streams(streams):
+            self.assertEquals(len(streams), 1)
+            headers = []
+            streams[0].read_headers(lambda *f: headers.append(unvb(f[2])))
+            self.assertEquals(headers, ['\x2f'])
+
+        d.addCallback(got_streams)
+        return d
+
+    def test_index_shared(self):
+        d = self.server.open('clip')
+
+        def opened(sg1):
+            d = self.server.open('flv:clip.flv')
+            d.addCallback(lambda sg2: (sg1, sg2))
+            return d
+
+        def both((sg1, sg2)):
+            self.assertIdentical(sg1._g, sg2._g)
+            self.server.close(sg1)
+            self.server.close(sg2)
+
+            d = self.server.open('clip')
+            d.addCallback(lambda sg3: self.assertIdentical(sg3._g, sg1._g))
+            return d
+
+        d.addCallback(opened)
+        d.addCallback(both)
+        return d
+
+    def test_changed_file_reindexed(self):
+        d = self.server.open('clip')
+
+        def opened(sg1):
+            self.server.close(sg1)
+            path = os.path.join(self.root, 'clip.flv')
+            write_flv(path, tags[:3])
+            os.utime(path, (0, 0))
+
+            d = self.server.open('clip')
+            d.addCallback(lambda sg2: (sg1, sg2))
+            return d
+
+        def reopened((sg1, sg2)):
+            self.assertNotIdentical(sg1._g, sg2._g)
+            self.assertEquals(len(sg2._g.streams), 2)
+            self.assertEquals(len(sg2._g.streams[0].grpos), 1)
+
+        d.addCallback(opened)
+        d.addCallback(reopened)
+        return d
+
+    def test_cache_pruned(self):
+        self.server.cache_size = 0
+        d = self.server.open('clip')
+
+        def opened(sg):
+            self.assertEquals(len(self.server._files), 1)
+            self.server.close(sg)
+            self.assertEquals(len(self.server._files), 0)
+
+        d.addCallback(opened)
+        return d
+
+    def test_pseek(self):
+        d = self.open_tracks()
+
+        def opened((sg, v, a)):
+            d = v.pseek(100, flag_mask=-1)
+            d.addCallback(self.assertEquals, 0)
+            d.addCallback(lambda _: v.pseek(100, flag_mask=1))
+            d.addCallback(self.assertEquals, 120)
+            d.addCallback(lambda _: self.read_all(v))
+            d.addCallback(self.assertEquals, video_frames[3:])
+            return d
+
+        d.addCallback(opened)
+        return d
+
+    def test_group_seek(self):
+        d = self.open_tracks()
+
+        def opened((sg, v, a)):
+            d = sg.seek(140)
+            d.addCallback(lambda _: self.assertEquals(self.read_all(v),
+                                                      video_frames[3:]))
+            d.addCallback(lambda _: self.assertEquals(self.read_all(a),
+                                                      audio_frames[3:]))
+            return d
+
+        d.addCallback(opened)
+        return d
+
+    def test_subscribe_paced(self):
+        d = self.open_tracks()
+        stored = []
+
+        def callback(grpos, flags, data):
+            stored.append((grpos, unvb(data)[2:]))
+
+        def opened((sg, v, a)):
+            d = v.subscribe(callback, preroll_grpos_range=50)
+            d.addCallback(lambda _: a.subscribe(callback))
+            d.addCallback(lambda subscription: (sg, v, a, subscription))
+            return d
+
+        def subscribed((sg, v, a, subscription)):
+            # preroll goes out right away, on both tracks
+            self.assertEquals(stored, [(0, 'k0'), (40, 'i1'),
+                                       (0, 'a0'), (23, 'a1'), (46, 'a2')])
+            del stored[:]
+
+            a.unsubscribe(subscription)
+            self.clock.advance(0.05)
+            self.assertEquals(stored, [])
+            self.clock.advance(0.05)
+            self.assertEquals(stored, [(80, 'i2'), (120, 'k3')])
+
+            self.clock.pump([0.1] * 3)
+            self.assertEquals(stored, [(80, 'i2'), (120, 'k3'), (160, 'i4')])
+            self.assertEquals(self.clock.getDelayedCalls(), [])
+
+        d.addCallback(opened)
+        d.addCallback(subscribed)
+        return d
+
+    def test_close_stops_playing(self):
+        d = self.server.open('clip')
+
+        def opened(sg):
+            d = sg.streams()
+            d.addCallback(lambda streams: streams[0].subscribe(
+                    lambda *a: None))
+            d.addCallback(lambda _: self.server.close(sg))
+            return d
+
+        d.addCallback(opened)
+        d.addCallback(lambda _: self.assertEquals(
+                self.clock.getDelayedCalls(), []))
+        return d
+
+    def test_namespace(self):
+        d = self.open_tracks('other', namespace='ns')
+        d.addCallback(lambda (sg, v, a): self.read_all(v))
+        d.addCallback(self.assertEquals, video_frames)
+        return d
+
+    def test_open_errors(self):
+        d = self.server.open('missing')
+        d = self.assertFailure(d, errors.StreamNotFoundError)
+        d.addCallback(lambda _: self.server.open('../clip', namespace='ns'))
+        d = self.assertFailure(d, errors.StreamNotFoundError)
+        d.addCallback(lambda _: self.server.open('ns'))
+        d = self.assertFailure(d, errors.StreamNotFoundError)
+        d.addCallback(lambda _: self.server.open('clip', namespace='nope'))
+        d = self.assertFailure(d, errors.NamespaceNotFoundError)
+        return d
+
+    def test_read_only(self):
+        self.assertRaises(NotImplementedError, self.server.open, 'x', 'w')
+
+        d = self.server.open('clip')
+
+        def opened(sg):
+            self.addCleanup(self.server.close, sg)
+            d = sg.make_stream()
+            d = self.assertFailure(d, errors.StreamReadOnlyError)
+            d.addCallback(lambda _: self.server.delete(sg))
+            d = self.assertFailure(d, errors.StreamReadOnlyError)
+            return d
+
+        d.addCallback(opened)
+        return d
@@ -1033,6 +1033,29 @@ class TestIMLiveStream(unittest.TestCase):
         return d
 
 
+    def test_write_now(self):
+        ls = inmemory.IMLiveStream(inmemory.IMServerStream())
+        self.assertTrue(interfaces.ISyncStream.providedBy(ls))
+        ls.set_buffering(frames=2)
+
+        stored = []
+        ls.subscribe(lambda *f: stored.append(f))
+
+        self.assertEquals(ls.write_headers_now('h'), None)
+        for f in [(0, 1, '.1'), (5, 2, '.'), (10, 2, '.')]:
+            self.assertEquals(ls.write_now(*f), None)
+        # the subscribers got notified right away
+        self.assertEquals(stored, [(0, 1, '.1'), (5, 2, '.'), (10, 2, '.')])
+
+        headers, frames = [], []
+        ls.read_headers(lambda *f: headers.append(f))
+        self.assertEquals(headers, [(0, 0, 'h')])
+        d = ls.subscribe(lambda *f: frames.append(f), preroll_frames=2)
+        d.addCallback(lambda _: self.assertEquals(frames, [(5, 2, '.'),
+                                                           (10, 2, '.')]))
+        return d
+
+
 class TestIMStreamGroup(unittest.TestCase):
     def setUp(self):
         s1 = inmemory.IMServerStream()
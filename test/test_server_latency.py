@@ -0,0 +1,122 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from twisted.trial import unittest
+
+from twimp.server import inmemory
+from twimp.server.latency import FrameTracer
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestFrameTracer(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        self.tracer = FrameTracer(sample=3, worst=2)
+        self.tracer.clock = self.clock
+
+    def test_sampling(self):
+        t = self.tracer
+        self.assertEquals([t.begin('a') for i in range(6)],
+                          [False, False, True, False, False, True])
+        self.assertEquals(t.current, ('a', 0.0))
+        t.end()
+        self.assertEquals(t.current, None)
+        # counted separately, per stream
+        self.assertEquals([t.begin('b') for i in range(3)],
+                          [False, False, True])
+
+    def _trace(self, name, latencies):
+        t = self.tracer
+        t.sample = 1
+        start = self.clock.now
+        self.assertTrue(t.begin(name))
+        for subscriber, latency in latencies:
+            self.clock.now = start + latency
+            t.delivered(subscriber)
+        t.end()
+
+    def test_delivered(self):
+        self._trace('a', [('x', 0.001), ('y', 0.002), ('z', 0.004)])
+        self._trace('a', [('x', 0.010), ('y', 0.0015), ('z', 0.003)])
+
+        r = self.tracer.report()['a']
+        self.assertEquals(r['count'], 6)
+        self.assertAlmostEqual(r['max'], 0.010)
+        self.assertEquals([w['subscriber'] for w in r['worst']], ['x', 'z'])
+        x = r['worst'][0]
+        self.assertEquals(x['count'], 2)
+        self.assertAlmostEqual(x['last'], 0.010)
+
+    def test_forget(self):
+        self._trace('a', [('x', 0.001), ('y', 0.002)])
+        self.tracer.forget('y')
+        r = self.tracer.report()['a']
+        self.assertEquals([w['subscriber'] for w in r['worst']], ['x'])
+        # the stream percentiles are kept
+        self.assertEquals(r['count'], 2)
+
+    def test_live_stream(self):
+        t = self.tracer
+        t.sample = 1
+        s = inmemory.IMLiveStream(inmemory.IMServerStream())
+
+        def subscriber(grpos, flags, data):
+            self.clock.now += 0.005
+            if t.current is not None:
+                t.delivered('x')
+        s.subscribe(subscriber)
+
+        traced = t.begin('a')
+        s.write(0, 1, 'data')
+        t.end()
+        s.write(1, 1, 'data')
+
+        self.assertTrue(traced)
+        r = t.report()['a']
+        self.assertEquals(r['count'], 1)
+        self.assertAlmostEqual(r['max'], 0.005)
+        self.assertEquals(len(t.format_report().splitlines()), 3)
+
+    def test_delivery(self):
+        t = self.tracer
+        t.sample = 1
+        self.assertEquals(t.delivery('x'), None)
+
+        # timed from the message being received
+        t.received()
+        self.clock.now = 0.002
+        self.assertTrue(t.begin('a'))
+        written = t.delivery('x')
+        t.end()
+        self.assertEquals(t.report(), {})
+
+        # e.g. queued in the chunk producer
+        self.clock.now = 0.010
+        written()
+        r = t.report()['a']
+        self.assertEquals(r['count'], 1)
+        self.assertAlmostEqual(r['max'], 0.010)
+
+        # received() only applies to the next frame
+        self.assertTrue(t.begin('a'))
+        self.assertEquals(t.current, ('a', 0.010))
+        t.end()
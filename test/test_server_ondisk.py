@@ -0,0 +1,356 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+
+from twisted.trial import unittest
+
+from twimp import flv
+from twimp.server import errors, interfaces, ondisk
+from twimp.server.controllers import TYPE_VIDEO
+from twimp.vecbuf import flatten
+
+from test.helpers import unvb
+
+
+def undata(data):
+    # unflushed frames come back the way they were written
+    if isinstance(data, str):
+        return data
+    return unvb(data)
+
+
+frames = [(0, 1, '.1'), (5, 2, '.'), (10, 2, '.'), (15, 2, '.'),
+          (20, 1, '.2'), (25, 2, '.'), (30, 2, '.'), (35, 2, '.'),
+          (40, 1, '!!')]
+
+
+class TestDServer(unittest.TestCase):
+    def setUp(self):
+        self.root = self.mktemp()
+        self.server = ondisk.DServer(self.root, namespaces=[None, 'ns'])
+
+    def record(self, name='rec', frames=frames, mode='w', server=None):
+        """Write frames into a single stream group, return (group, stream)
+        """
+        server = server or self.server
+        box = []
+
+        def opened(sg):
+            box.append(sg)
+            d = sg.set_meta(dict(comment='recorded'))
+            d.addCallback(lambda _: sg.make_stream())
+            return d
+
+        def made(s):
+            box.append(s)
+            d = s.set_params({'type': TYPE_VIDEO})
+            d.addCallback(lambda _: s.write_headers('hdrs'))
+            for f in frames:
+                d.addCallback(lambda _, f=f: s.write(*f))
+            d.addCallback(lambda _: tuple(box))
+            return d
+
+        d = server.open(name, mode=mode)
+        d.addCallback(opened)
+        d.addCallback(made)
+        return d
+
+    def read_all(self, s):
+        stored = []
+        def read_callback(grpos, flags, data):
+            stored.append((grpos, flags, undata(data)))
+        task, d = s.read(read_callback, None, frames=999)
+        d.addCallback(lambda _: stored)
+        return d
+
+    def reopen(self, name='rec'):
+        server = ondisk.DServer(self.root, namespaces=[None, 'ns'])
+        d = server.open(name)
+        d.addCallback(lambda sg: sg.streams())
+        d.addCallback(lambda streams: streams[0])
+        return d
+
+    def test_interfaces(self):
+        d = self.record()
+
+        def recorded((sg, s)):
+            self.assertTrue(interfaces.IStreamGroup.providedBy(sg))
+            self.assertTrue(interfaces.ILiveStream.providedBy(s))
+            # writes go to the disk, asynchronously
+            self.assertFalse(interfaces.ISyncStream.providedBy(s))
+            return self.server.close(sg)
+
+        d.addCallback(recorded)
+        return d
+
+    def test_write_read_same_server(self):
+        d = self.record()
+
+        def recorded((sg, s)):
+            d = self.server.open('rec')
+
+            def opened(rsg):
+                d = rsg.streams()
+                d.addCallback(lambda streams: self.read_all(streams[0]))
+                d.addCallback(self.assertEquals, frames)
+                d.addCallback(lambda _: self.server.close(rsg))
+                return d
+
+            d.addCallback(opened)
+            d.addCallback(lambda _: self.server.close(sg))
+            return d
+
+        d.addCallback(recorded)
+        return d
+
+    def test_write_reopen_read(self):
+        d = self.record()
+        d.addCallback(lambda (sg, s): self.server.close(sg))
+        d.addCallback(lambda _: self.reopen())
+
+        def reopened(s):
+            d = self.read_all(s)
+            d.addCallback(self.assertEquals, frames)
+
+            d.addCallback(lambda _: s.params())
+            d.addCallback(self.assertEquals, {'type': TYPE_VIDEO})
+
+            stored = []
+            d.addCallback(lambda _: s.read_headers(
+                    lambda *f: stored.append((f[0], f[1], undata(f[2])))))
+            d.addCallback(lambda _: self.assertEquals(stored,
+                                                      [(0, 0, 'hdrs')]))
+            return d
+
+        d.addCallback(reopened)
+        return d
+
+    def test_group_meta_persisted(self):
+        d = self.record()
+        d.addCallback(lambda (sg, s): self.server.close(sg))
+
+        def reopen(_result):
+            server = ondisk.DServer(self.root)
+            return server.open('rec')
+
+        d.addCallback(reopen)
+        d.addCallback(lambda sg: sg.meta())
+        d.addCallback(self.assertEquals, {'comment': 'recorded'})
+        return d
+
+    def test_data_is_mapped(self):
+        d = self.record()
+        d.addCallback(lambda (sg, s): self.server.close(sg))
+        d.addCallback(lambda _: self.reopen())
+
+        def reopened(s):
+            stored = []
+            s.read(lambda *f: stored.append(f[2]), None, frames=1)
+            data = stored[0]
+            self.assertEquals(flatten(data.peek_seq(len(data))), '.1')
+            # a view into the mapping, not a copy
+            self.assertIsInstance(data.peek_seq(len(data))[0], buffer)
+
+        d.addCallback(reopened)
+        return d
+
+    def test_segments_are_flv(self):
+        d = self.record()
+        d.addCallback(lambda (sg, s): self.server.close(sg))
+
+        def check(_result):
+            path = os.path.join(self.server.group_path(None, 'rec'), '0',
+                                '00000000.flv')
+            data = open(path, 'rb').read()
+            version, flags, offset = flv.decode_file_header(data)
+            self.assertEquals(flags, flv.FLAG_VIDEO)
+            tags = []
+            while offset < len(data):
+                type_, size, ts = flv.decode_tag_header(data, offset)
+                offset += flv.TAG_HEADER_SIZE
+                tags.append((ts, data[offset:offset+size]))
+                offset += size + flv.TAG_TRAILER_SIZE
+                self.assertEquals(type_, flv.TAG_VIDEO)
+            self.assertEquals(tags, [(f[0], f[2]) for f in frames])
+
+        d.addCallback(check)
+        return d
+
+    def test_segment_rollover(self):
+        self.server.segment_size = 40
+        d = self.record()
+        d.addCallback(lambda (sg, s): self.server.close(sg))
+
+        def check(_result):
+            path = os.path.join(self.server.group_path(None, 'rec'), '0')
+            segments = [n for n in os.listdir(path) if n.endswith('.flv')]
+            self.assertTrue(len(segments) > 1)
+
+        d.addCallback(check)
+        d.addCallback(lambda _: self.reopen())
+        d.addCallback(self.read_all)
+        d.addCallback(self.assertEquals, frames)
+        return d
+
+    def test_seek_pseek(self):
+        d = self.record()
+        d.addCallback(lambda (sg, s): self.server.close(sg))
+        d.addCallback(lambda _: self.reopen())
+
+        def reopened(s):
+            stored = []
+            def read_callback(grpos, flags, data):
+                stored.append((grpos, flags, undata(data)))
+
+            d = s.seek(12)
+            d.addCallback(self.assertEquals, 12)
+            d.addCallback(lambda _: s.read(read_callback, None, frames=1)[1])
+            d.addCallback(lambda _: self.assertEquals(stored, [(15, 2, '.')]))
+
+            d.addCallback(lambda _: s.pseek(27, flag_mask=-1))
+            d.addCallback(self.assertEquals, 20)
+            d.addCallback(lambda _: s.pseek(27, flag_mask=1))
+            d.addCallback(self.assertEquals, 40)
+            d.addCallback(lambda _: s.pseek(-2, whence=2, flag_mask=-2))
+            d.addCallback(self.assertEquals, 35)
+
+            d.addCallback(lambda _: stored.__delslice__(0, len(stored)))
+            d.addCallback(lambda _: s.seek(None, frames=-2, whence=2))
+            d.addCallback(lambda _: s.read(read_callback, 100)[1])
+            d.addCallback(lambda _: self.assertEquals(stored,
+                                                      [(35, 2, '.'),
+                                                       (40, 1, '!!')]))
+            return d
+
+        d.addCallback(reopened)
+        return d
+
+    def test_subscribe_preroll_and_live(self):
+        d = self.record(frames=frames[:6])
+
+        def recorded((sg, s)):
+            stored = []
+            def callback(grpos, flags, data):
+                stored.append((grpos, flags, undata(data)))
+
+            d = s.subscribe(callback, preroll_grpos_range=7, flag_mask=-1)
+            d.addCallback(lambda _: self.assertEquals(stored, frames[4:6]))
+            for f in frames[6:]:
+                d.addCallback(lambda _, f=f: s.write(*f))
+            d.addCallback(lambda _: self.assertEquals(stored, frames[4:]))
+            d.addCallback(lambda _: self.server.close(sg))
+            return d
+
+        d.addCallback(recorded)
+        return d
+
+    def test_append(self):
+        more = [(45, 2, '.'), (50, 1, '.3')]
+
+        d = self.record()
+        d.addCallback(lambda (sg, s): self.server.close(sg))
+
+        def append(_result):
+            d = self.server.open('rec', mode='a')
+            def opened(sg):
+                d = sg.streams()
+                d.addCallback(lambda streams: streams[0])
+                for f in more:
+                    d.addCallback(lambda s, f=f: s.write(*f).addCallback(
+                            lambda _: s))
+                d.addCallback(lambda _: self.server.close(sg))
+                return d
+            d.addCallback(opened)
+            return d
+
+        d.addCallback(append)
+        d.addCallback(lambda _: self.reopen())
+        d.addCallback(self.read_all)
+        d.addCallback(self.assertEquals, frames + more)
+        return d
+
+    def test_truncated_index(self):
+        d = self.record()
+        d.addCallback(lambda (sg, s): self.server.close(sg))
+
+        def damage(_result):
+            path = os.path.join(self.server.group_path(None, 'rec'), '0',
+                                'index')
+            f = open(path, 'ab')
+            f.write('\0' * 7)
+            f.close()
+
+        d.addCallback(damage)
+        d.addCallback(lambda _: self.reopen())
+        d.addCallback(self.read_all)
+        d.addCallback(self.assertEquals, frames)
+        return d
+
+    def test_read_only(self):
+        d = self.record()
+
+        def recorded((sg, s)):
+            d = self.server.open('rec')
+
+            def opened(rsg):
+                d = rsg.streams()
+                d.addCallback(lambda streams: streams[0].write(99, 1, 'x'))
+                d = self.assertFailure(d, errors.StreamReadOnlyError)
+                d.addCallback(lambda _: self.server.close(rsg))
+                return d
+
+            d.addCallback(opened)
+            d.addCallback(lambda _: self.server.close(sg))
+            return d
+
+        d.addCallback(recorded)
+        return d
+
+    def test_open_errors(self):
+        d = self.server.open('missing')
+        d = self.assertFailure(d, errors.StreamNotFoundError)
+
+        d.addCallback(lambda _: self.server.open('rec', namespace='nope'))
+        d = self.assertFailure(d, errors.NamespaceNotFoundError)
+
+        d.addCallback(lambda _: self.record())
+
+        def recorded((sg, s)):
+            d = self.server.open('rec', mode='w')
+            d = self.assertFailure(d, errors.StreamExistsError)
+            d.addCallback(lambda _: self.server.open('rec', mode='a'))
+            d = self.assertFailure(d, errors.StreamExistsError)
+            d.addCallback(lambda _: self.server.close(sg))
+            return d
+
+        d.addCallback(recorded)
+        return d
+
+    def test_open_unsupported_mode(self):
+        self.assertRaises(NotImplementedError, self.server.open, 'rec', 'l')
+
+    def test_delete(self):
+        d = self.record()
+        d.addCallback(lambda (sg, s): self.server.delete(sg))
+        d.addCallback(lambda _: self.assertFalse(
+                os.path.exists(self.server.group_path(None, 'rec'))))
+        d.addCallback(lambda _: self.server.open('rec'))
+        d = self.assertFailure(d, errors.StreamNotFoundError)
+        return d
+
+    def test_names_stay_inside_root(self):
+        path = self.server.group_path('ns', '../../x')
+        self.assertEquals(os.path.dirname(os.path.dirname(path)), self.root)
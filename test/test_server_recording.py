@@ -0,0 +1,286 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+
+from twisted.trial import unittest
+
+from twimp import flv
+from twimp.server import errors, interfaces, inmemory, flvfile, recording
+from twimp.server.controllers import TYPE_AUDIO, TYPE_VIDEO
+
+from test.helpers import unvb
+
+
+avc_header = '\x17\x00\x00\x00\x00config'
+
+video_frames = [(1000, 1, '\x17\x01k0'), (1040, 2, '\x27\x01i1'),
+                (1080, 2, '\x27\x01i2'), (1120, 1, '\x17\x01k3'),
+                (1160, 2, '\x27\x01i4')]
+
+audio_frames = [(1000, 1, '\xaf\x01a0'), (1023, 1, '\xaf\x01a1')]
+
+
+class TestRecordingServer(unittest.TestCase):
+    def setUp(self):
+        self.root = self.mktemp()
+        self.inner = inmemory.IMServer()
+        self.server = recording.RecordingServer(self.inner, self.root)
+
+    def publish(self, name='rec', video=video_frames, audio=audio_frames):
+        """Do what RTMPRecorder does, return the open group.
+        """
+        box = []
+
+        def opened(sg):
+            box.append(sg)
+            d = sg.set_meta({'videocodecid': 7.0})
+            d.addCallback(lambda _: sg.make_stream())
+            d.addCallback(made, TYPE_VIDEO, avc_header, video)
+            d.addCallback(lambda _: sg.make_stream())
+            d.addCallback(made, TYPE_AUDIO, None, audio)
+            d.addCallback(lambda _: box[0])
+            return d
+
+        def made(s, type_, header, frames):
+            d = s.set_params({'type': type_})
+            d.addCallback(lambda _: s.set_buffering(grpos_range=3000))
+            if header:
+                d.addCallback(lambda _: s.write_headers(header))
+            for f in frames:
+                d.addCallback(lambda _, f=f: s.write(*f))
+            return d
+
+        d = self.server.open(name, mode='l')
+        d.addCallback(opened)
+        return d
+
+    def play(self, name='rec'):
+        server = flvfile.FLVFileServer(self.root)
+        d = server.open(name)
+
+        def opened(sg):
+            self.addCleanup(server.close, sg)
+            d = sg.streams()
+            d.addCallback(lambda streams: (sg, streams))
+            return d
+
+        d.addCallback(opened)
+        return d
+
+    def read_all(self, s):
+        stored = []
+        s.read(lambda *f: stored.append((f[0], f[1], unvb(f[2]))), None,
+               frames=999)
+        return stored
+
+    def rebased(self, frames):
+        return [(gp - 1000, flags, data) for (gp, flags, data) in frames]
+
+    def test_interfaces(self):
+        d = self.publish()
+
+        def published(sg):
+            self.assertTrue(interfaces.IStreamGroup.providedBy(sg))
+            return self.server.close(sg)
+
+        d.addCallback(published)
+        return d
+
+    def test_passthrough(self):
+        d = self.publish()
+
+        def published(sg):
+            d = self.inner.open('rec')
+            d.addCallback(lambda isg: isg.streams())
+            d.addCallback(lambda streams: self.assertEquals(len(streams), 2))
+            d.addCallback(lambda _: self.server.close(sg))
+            return d
+
+        d.addCallback(published)
+        # closing the recording closes the wrapped group, too
+        d.addCallback(lambda _: self.inner.open('rec'))
+        d = self.assertFailure(d, errors.StreamNotFoundError)
+        return d
+
+    def test_not_recording_other_modes(self):
+        d = self.publish()
+
+        def published(sg):
+            self.addCleanup(self.server.close, sg)
+            return self.server.open('rec')
+
+        d.addCallback(published)
+        d.addCallback(lambda sg: self.assertIsInstance(sg,
+                                                       inmemory.IMStreamGroup))
+        return d
+
+    def test_recorded_file(self):
+        d = self.publish()
+
+        def published(sg):
+            path = os.path.join(self.root, 'rec.flv')
+            self.assertFalse(os.path.exists(path))
+            d = self.server.close(sg)
+            d.addCallback(lambda _: path)
+            return d
+
+        def closed(path):
+            self.assertFalse(os.path.exists(path + '.part'))
+            data = open(path, 'rb').read()
+            self.assertEquals(flv.decode_file_header(data)[1],
+                              flv.FLAG_AUDIO | flv.FLAG_VIDEO)
+            return self.play()
+
+        def played((sg, streams)):
+            video, audio = streams
+            self.assertEquals(self.read_all(video),
+                              self.rebased(video_frames))
+            self.assertEquals(self.read_all(audio),
+                              self.rebased(audio_frames))
+
+            headers = []
+            video.read_headers(lambda *f: headers.append(unvb(f[2])))
+            self.assertEquals(headers, [avc_header])
+
+            return sg.meta()
+
+        def got_meta(meta):
+            self.assertEquals(meta['videocodecid'], 7)
+            self.assertEquals(meta['duration'], 0.16)
+            self.assertEquals(meta['hasAudio'], True)
+            self.assertEquals(meta['filesize'],
+                              os.stat(os.path.join(self.root,
+                                                   'rec.flv')).st_size)
+            self.assertEquals(meta['keyframes']['times'], [0, 0.12])
+            self.check_positions(meta['keyframes']['filepositions'],
+                                 ['\x17\x01k0', '\x17\x01k3'])
+
+        d.addCallback(published)
+        d.addCallback(closed)
+        d.addCallback(played)
+        d.addCallback(got_meta)
+        return d
+
+    def check_positions(self, positions, expected):
+        data = open(os.path.join(self.root, 'rec.flv'), 'rb').read()
+        found = []
+        for p in positions:
+            _type, size, _ts = flv.decode_tag_header(data, int(p))
+            start = int(p) + flv.TAG_HEADER_SIZE
+            found.append(data[start:start + size])
+        self.assertEquals(found, expected)
+
+    def test_metadata_outgrowing_reserve(self):
+        self.server.meta_reserve = 64
+        many = [(1000 + i * 40, 1, '\x17\x01k%d' % i) for i in range(50)]
+        d = self.publish(video=many, audio=[])
+        d.addCallback(self.server.close)
+        d.addCallback(lambda _: self.play())
+
+        def played((sg, streams)):
+            self.assertEquals(self.read_all(streams[0]), self.rebased(many))
+            return sg.meta()
+
+        def got_meta(meta):
+            self.assertEquals(meta['hasAudio'], False)
+            self.assertEquals(len(meta['keyframes']['times']), 50)
+            self.check_positions(meta['keyframes']['filepositions'],
+                                 [f[2] for f in many])
+            self.assertFalse(os.path.exists(os.path.join(self.root,
+                                                         'rec.flv.tmp')))
+
+        d.addCallback(played)
+        d.addCallback(got_meta)
+        return d
+
+    def test_long_recording(self):
+        self.server.meta_reserve = 1024
+        many = [(1000 + i * 40, 1, '\x17\x01k%d' % i) for i in range(500)]
+        d = self.publish(video=many, audio=[])
+        d.addCallback(self.server.close)
+        d.addCallback(lambda _: self.play())
+
+        def played((sg, streams)):
+            self.assertEquals(self.read_all(streams[0]), self.rebased(many))
+            return sg.meta()
+
+        def got_meta(meta):
+            # not rewritten: the metadata still fills the reserved space
+            data = open(os.path.join(self.root, 'rec.flv'), 'rb').read()
+            _type, size, _ts = flv.decode_tag_header(data,
+                                                     flv.FILE_HEADER_SIZE)
+            self.assertEquals(size, 1024)
+
+            times = meta['keyframes']['times']
+            self.assertTrue(10 < len(times) < 500)
+            self.assertEquals(times[0], 0)
+            kept = [int(round(t * 1000)) // 40 for t in times]
+            self.check_positions(meta['keyframes']['filepositions'],
+                                 [many[i][2] for i in kept])
+
+        d.addCallback(played)
+        d.addCallback(got_meta)
+        return d
+
+    def test_no_keyframe_index(self):
+        self.server.keyframe_index = False
+        d = self.publish()
+        d.addCallback(self.server.close)
+        d.addCallback(lambda _: self.play())
+        d.addCallback(lambda (sg, streams): sg.meta())
+        d.addCallback(lambda meta: self.assertNotIn('keyframes', meta))
+        return d
+
+    def test_dropping_when_full(self):
+        d = self.server.open('rec', mode='l')
+
+        def opened(sg):
+            self.sg = sg
+            return sg.make_stream()
+
+        def made(s):
+            writer = self.sg.recording.writer
+            d = s.set_params({'type': TYPE_VIDEO})
+            d.addCallback(lambda _: s.write(*video_frames[0]))
+            # the disk falling behind...
+            d.addCallback(lambda _: setattr(writer, 'max_pending', 0))
+            d.addCallback(lambda _: s.write(*video_frames[1]))
+            # ... and catching up
+            d.addCallback(lambda _: setattr(writer, 'max_pending', None))
+            for f in video_frames[2:]:
+                d.addCallback(lambda _, f=f: s.write(*f))
+            d.addCallback(lambda _: self.assertEquals(
+                    self.sg.recording.dropped, 2))
+            d.addCallback(lambda _: self.server.close(self.sg))
+            return d
+
+        d.addCallback(opened)
+        d.addCallback(made)
+        d.addCallback(lambda _: self.play())
+        d.addCallback(lambda (sg, streams): self.read_all(streams[0]))
+        d.addCallback(self.assertEquals,
+                      self.rebased([video_frames[0]] + video_frames[3:]))
+        return d
+
+    def test_invalid_name_not_recorded(self):
+        d = self.server.open('../rec', mode='l')
+
+        def opened(sg):
+            self.assertIsInstance(sg, inmemory.IMLiveStreamGroup)
+            return self.server.close(sg)
+
+        d.addCallback(opened)
+        return d
@@ -0,0 +1,364 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from twimp.helpers import vb
+from twimp.server import errors, interfaces, shmring
+from twimp.server.controllers import TYPE_AUDIO, TYPE_VIDEO
+
+from test.helpers import unvb
+
+
+class TestFrameRing(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.ring = shmring.create_ring(self.path, 4, 16, 64)
+
+    def test_append_read(self):
+        self.assertEquals(self.ring.append(1, 40, 2, 'abc'), 0)
+        self.assertEquals(self.ring.append(0, 0, 1, buffer('xdefx', 1, 3)),
+                          1)
+
+        reader = shmring.open_ring(self.path)
+        self.assertEquals(reader.head(), 2)
+        stream, grpos, flags, data = reader.frame(0)
+        self.assertEquals((stream, grpos, flags), (1, 40, 2))
+        self.assertIsInstance(data, buffer)
+        self.assertEquals(str(data), 'abc')
+        self.assertEquals(str(reader.frame(1)[3]), 'def')
+        self.assertEquals(reader.frame(2), None)
+
+    def test_overwriting(self):
+        for i in range(5):
+            self.ring.append(0, i, 0, '%d' % i)
+        # out of slots
+        self.assertEquals(self.ring.frame(0), None)
+        self.assertEquals(str(self.ring.frame(1)[3]), '1')
+
+        # out of data space: 6 bytes more wrap over the first 6 bytes
+        self.ring.append(0, 5, 0, 'xxxxxx')
+        self.assertEquals(self.ring.frame(1), None)
+        self.assertEquals(str(self.ring.frame(4)[3]), '4')
+
+        self.ring.append(0, 6, 0, 'y' * 10)
+        self.assertEquals(self.ring.frame(4), None)
+        self.assertEquals(str(self.ring.frame(6)[3]), 'y' * 10)
+
+    def test_too_large(self):
+        self.assertRaises(errors.FrameTooLargeError, self.ring.append,
+                          0, 0, 0, 'x' * 17)
+        self.assertRaises(errors.FrameTooLargeError, self.ring.set_info,
+                          'x' * 61)
+
+    def test_info(self):
+        self.assertEquals(self.ring.info(), (0, ''))
+        self.ring.set_info('meta')
+        self.assertEquals(shmring.open_ring(self.path).info(), (2, 'meta'))
+
+    def test_exclusive(self):
+        self.assertRaises(OSError, shmring.create_ring, self.path,
+                          4, 16, 64)
+        # the temporary file is gone, too
+        self.assertEquals(os.listdir(os.path.dirname(self.path)),
+                          [os.path.basename(self.path)])
+
+    def test_close(self):
+        reader = shmring.open_ring(self.path)
+        self.assertTrue(reader.alive())
+        self.ring.close()
+        self.assertFalse(reader.alive())
+        self.assertFalse(os.path.exists(self.path))
+
+
+video_frames = [(0, 1, 'k0'), (40, 2, 'i1'), (80, 2, 'i2'), (120, 1, 'k3'),
+                (160, 2, 'i4')]
+audio_frames = [(0, 1, 'a0'), (23, 1, 'a1')]
+
+
+class TestRingServer(unittest.TestCase):
+    def setUp(self):
+        root = self.mktemp()
+        self.clock = task.Clock()
+        self.server = shmring.RingServer(root, reactor=self.clock)
+        # another process, sharing the same root
+        self.other = shmring.RingServer(root, reactor=self.clock)
+
+    def open(self, server, name='live', mode='r'):
+        d = server.open(name, mode=mode)
+        d.addCallback(self._opened, server)
+        return d
+
+    def _opened(self, sg, server):
+        self.addCleanup(server.close, sg)
+        return sg
+
+    def publish(self, name='live'):
+        d = self.open(self.server, name, mode='l')
+
+        def opened(sg):
+            self.sg = sg
+            d = sg.set_meta({'x': 1})
+            d.addCallback(lambda _: sg.make_stream())
+            d.addCallback(made, TYPE_VIDEO, video_frames)
+            d.addCallback(lambda _: sg.make_stream())
+            d.addCallback(made, TYPE_AUDIO, audio_frames)
+            d.addCallback(lambda _: sg)
+            return d
+
+        def made(s, type_, frames):
+            d = s.set_params({'type': type_})
+            d.addCallback(lambda _: s.write_headers('h' + type_[0]))
+            for f in frames:
+                d.addCallback(lambda _, f=f: s.write(*f))
+            return d
+
+        d.addCallback(opened)
+        return d
+
+    def reader_streams(self, server):
+        d = self.open(server)
+
+        def opened(sg):
+            self.reader = sg
+            return sg.streams()
+
+        d.addCallback(opened)
+        return d
+
+    def test_interfaces(self):
+        d = self.publish()
+
+        def published(sg):
+            self.assertTrue(interfaces.IStreamGroup.providedBy(sg))
+            d = sg.streams()
+            d.addCallback(lambda streams: self.assertTrue(
+                    interfaces.ILiveStream.providedBy(streams[0])))
+            return d
+
+        d.addCallback(published)
+        return d
+
+    def test_exists(self):
+        d = self.publish()
+        d.addCallback(lambda _: self.other.open('live', mode='l'))
+        d = self.assertFailure(d, errors.StreamExistsError)
+        return d
+
+    def test_not_found(self):
+        d = self.other.open('live')
+        return self.assertFailure(d, errors.StreamNotFoundError)
+
+    def test_stale_ring_replaced(self):
+        root = self.server.root
+        os.makedirs(root)
+        ring = shmring.create_ring(self.server.ring_path(None, 'live'),
+                                   4, 16, 64)
+        self.patch(shmring, '_pid_alive', lambda pid: pid != 2 ** 22 + 1)
+        # as if the writer died: its pid in the file is gone
+        ring._map.seek(0)
+        ring._map.write(shmring._s_file_header.pack(
+                shmring._MAGIC, 4, 16, 64, 2 ** 22 + 1))
+
+        d = self.other.open('live')
+        d = self.assertFailure(d, errors.StreamNotFoundError)
+        d.addCallback(lambda _: self.publish())
+        return d
+
+    def test_remote_read(self):
+        got = []
+        d = self.publish()
+        d.addCallback(lambda _: self.reader_streams(self.other))
+
+        def streams(streams):
+            video, audio = streams
+            self.assertEquals([s._s.params['type'] for s in streams],
+                              [TYPE_VIDEO, TYPE_AUDIO])
+
+            headers = []
+            video.read_headers(lambda *f: headers.append(unvb(f[2])))
+            self.assertEquals(headers, ['hv'])
+
+            d = video.subscribe(lambda *f: got.append((f[0], f[1],
+                                                       unvb(f[2]))),
+                                preroll_grpos_range=100, flag_mask=-1)
+            d.addCallback(lambda _: self.assertEquals(got,
+                                                      video_frames[:]))
+            d.addCallback(lambda _: self.reader.meta())
+            d.addCallback(self.assertEquals, {'x': 1})
+            d.addCallback(lambda _: self.sg.streams())
+            d.addCallback(lambda streams: streams[0].write(200, 2, 'i5'))
+            return d
+
+        def written(_result):
+            # nothing until polled
+            self.assertEquals(len(got), 5)
+            self.clock.advance(self.other.poll_interval)
+            self.assertEquals(got[-1], (200, 2, 'i5'))
+
+        d.addCallback(streams)
+        d.addCallback(written)
+        return d
+
+    def test_preroll(self):
+        got = []
+        d = self.publish()
+        d.addCallback(lambda _: self.reader_streams(self.other))
+
+        def streams(streams):
+            video = streams[0]
+            collect = lambda *f: got.append(unvb(f[2]))
+            d = video.subscribe(collect, preroll_grpos_range=50,
+                                flag_mask=-1)
+            d.addCallback(lambda _: self.assertEquals(got, ['k3', 'i4']))
+            d.addCallback(lambda _: video.find_frame_backward(
+                    0, frames=2, flag_mask=1))
+            # frame numbers are common to all the streams of the group
+            d.addCallback(self.assertEquals, 3)
+            d.addCallback(lambda _: video.frame_to_grpos(3))
+            d.addCallback(self.assertEquals, 120)
+            d.addCallback(lambda _: streams[1].frame_to_grpos(3))
+            d = self.assertFailure(d, errors.InvalidFrameNumber)
+            return d
+
+        d.addCallback(streams)
+        return d
+
+    def test_local_read(self):
+        got = []
+        d = self.publish()
+        d.addCallback(lambda _: self.reader_streams(self.server))
+
+        def streams(streams):
+            d = streams[1].subscribe(lambda *f: got.append(unvb(f[2])))
+            d.addCallback(lambda _: self.sg.streams())
+            d.addCallback(lambda streams: streams[1].write(46, 1, vb('a2')))
+            # no polling needed
+            d.addCallback(lambda _: self.assertEquals(got, ['a2']))
+            return d
+
+        d.addCallback(streams)
+        return d
+
+    def test_read_only(self):
+        d = self.publish()
+        d.addCallback(lambda _: self.reader_streams(self.other))
+        d.addCallback(lambda streams: streams[0].write(200, 2, 'x'))
+        d = self.assertFailure(d, errors.StreamReadOnlyError)
+        d.addCallback(lambda _: self.reader.make_stream())
+        d = self.assertFailure(d, errors.StreamReadOnlyError)
+        return d
+
+    def test_write_now(self):
+        got = []
+        d = self.publish()
+        d.addCallback(lambda _: self.reader_streams(self.other))
+
+        def streams(streams):
+            self.assertTrue(interfaces.ISyncStream.providedBy(streams[0]))
+            self.assertRaises(errors.StreamReadOnlyError,
+                              streams[0].write_now, 200, 2, 'x')
+            d = streams[0].subscribe(lambda *f: got.append(unvb(f[2])))
+            d.addCallback(lambda _: self.sg.streams())
+            return d
+
+        def write(streams):
+            self.assertEquals(streams[0].write_now(200, 1, 'v2'), None)
+            self.clock.advance(self.other.poll_interval)
+            self.assertEquals(got, ['v2'])
+
+        d.addCallback(streams)
+        d.addCallback(write)
+        return d
+
+    def test_lagging_reader(self):
+        self.server.slots = 4
+        got = []
+        d = self.publish()
+        d.addCallback(lambda _: self.reader_streams(self.other))
+
+        def streams(streams):
+            d = streams[0].subscribe(lambda *f: got.append(unvb(f[2])))
+            d.addCallback(lambda _: self.sg.streams())
+            return d
+
+        def write(streams):
+            video = streams[0]
+            for i, flags in enumerate([2, 2, 2, 2, 1, 2]):
+                video.write(200 + i * 40, flags, 'f%d' % i)
+            self.clock.advance(self.other.poll_interval)
+            # the ring lapped the reader: wait for the keyframe
+            self.assertEquals(got, ['f4', 'f5'])
+
+        d.addCallback(streams)
+        d.addCallback(write)
+        return d
+
+    def test_holding_frames(self):
+        self.server.data_size = 64
+        held = []
+        d = self.publish()
+        d.addCallback(lambda _: self.reader_streams(self.other))
+
+        def streams(streams):
+            # preroll, and live
+            d = streams[0].subscribe(lambda *f: held.append(f[2]),
+                                     preroll_frames=1)
+            d.addCallback(lambda _: self.sg.streams())
+            return d
+
+        def write(streams):
+            streams[0].write(200, 1, 'live' * 4)
+            self.clock.advance(self.other.poll_interval)
+            self.assertEquals(len(held), 2)
+            # the writer wrapping around the ring a few times
+            for i in range(10):
+                streams[0].write(240 + i * 40, 2, '%02d' % i * 8)
+            self.assertEquals([unvb(data) for data in held[:2]],
+                              [video_frames[-1][2], 'live' * 4])
+
+        d.addCallback(streams)
+        d.addCallback(write)
+        return d
+
+    def test_new_streams_seen(self):
+        d = self.publish()
+        d.addCallback(lambda _: self.reader_streams(self.other))
+        d.addCallback(lambda _: self.sg.make_stream())
+        d.addCallback(lambda s: s.set_params({'type': 'other'}))
+        d.addCallback(lambda _: self.clock.advance(self.other.poll_interval))
+        d.addCallback(lambda _: self.reader.streams_by_params(
+                {'type': 'other'}))
+        d.addCallback(lambda streams: self.assertEquals(len(streams), 1))
+        return d
+
+    def test_writer_closed(self):
+        d = self.publish()
+        d.addCallback(lambda _: self.reader_streams(self.other))
+
+        def closed(_result):
+            self.assertFalse(os.path.exists(
+                    self.server.ring_path(None, 'live')))
+            self.clock.advance(self.other.poll_interval)
+            self.assertTrue(self.reader._g.ended)
+            return self.other.open('live')
+
+        d.addCallback(lambda _: self.server.close(self.sg))
+        d.addCallback(closed)
+        d = self.assertFailure(d, errors.StreamNotFoundError)
+        return d
@@ -0,0 +1,52 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from twimp.metrics import MetricsRegistry
+from twimp.profiling import Profiler
+from twimp.server.stats import StatsResource
+from twimp.utils import json
+
+
+class TestStatsResource(unittest.TestCase):
+    def setUp(self):
+        self.profiler = Profiler([])
+        self.root = StatsResource(MetricsRegistry(), self.profiler)
+
+    def render(self, path):
+        request = DummyRequest([path])
+        child = self.root.getChildWithDefault(path, request)
+        return request, child.render(request)
+
+    def test_json(self):
+        request, body = self.render('stats')
+        data = json.loads(body)
+        self.assertEquals(data['connections'], [])
+        self.assertEquals(data['total']['connections'], 0)
+        self.assertEquals(request.responseHeaders.getRawHeaders(
+                'content-type'), ['application/json'])
+
+    def test_prometheus(self):
+        request, body = self.render('metrics')
+        self.assertIn('twimp_connections 0\n', body)
+
+    def test_profile(self):
+        self.profiler.histogram('a').record(0.001)
+        request, body = self.render('profile')
+        data = json.loads(body)
+        self.assertEquals(data.keys(), ['a'])
+        self.assertEquals(data['a']['count'], 1)
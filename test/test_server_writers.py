@@ -0,0 +1,127 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+
+from twisted.trial import unittest
+
+from twimp.server import writers
+
+
+class TestThreadedFileWriter(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(self.mktemp(), 'sub', 'file')
+        self.syncs = []
+        self.patch(writers.os, 'fsync', self.syncs.append)
+
+    def make_writer(self, **kw):
+        w = writers.ThreadedFileWriter(self.path, make_dirs=True, **kw)
+        self.addCleanup(w.close)
+        return w
+
+    def test_write_flush(self):
+        w = self.make_writer()
+        w.write('abc')
+        w.write_seq(['de', buffer('xfx', 1, 1)])
+        self.assertEquals(w.queued, 6)
+
+        d = w.flush()
+        d.addCallback(lambda _: self.assertEquals(w.written, 6))
+        d.addCallback(lambda _: w.close())
+        d.addCallback(lambda _: self.assertEquals(open(self.path).read(),
+                                                  'abcdef'))
+        return d
+
+    def test_closed(self):
+        w = self.make_writer()
+        d = w.close()
+        d.addCallback(lambda _: self.assertRaises(writers.WriterClosedError,
+                                                  w.write, 'x'))
+        return d
+
+    def test_is_full(self):
+        w = self.make_writer()
+        w.max_pending = 4
+        w.write('abc')
+        self.assertFalse(w.is_full())
+        w.write('d')
+        self.assertTrue(w.is_full())
+        self.assertEquals(w.pending(), 4)
+
+        d = w.flush()
+        d.addCallback(lambda _: self.assertFalse(w.is_full()))
+        return d
+
+    def test_no_fsync(self):
+        w = self.make_writer()
+        w.write('abc')
+        d = w.close()
+        d.addCallback(lambda _: self.assertEquals(len(self.syncs), 0))
+        return d
+
+    def test_fsync_on_close(self):
+        w = self.make_writer(fsync='close')
+        w.write('abc')
+        d = w.flush()
+        d.addCallback(lambda _: self.assertEquals(len(self.syncs), 0))
+        d.addCallback(lambda _: w.close())
+        d.addCallback(lambda _: self.assertEquals(len(self.syncs), 1))
+        return d
+
+    def test_fsync_batch(self):
+        w = self.make_writer(fsync='batch')
+        w.write('abc')
+        d = w.flush()
+        d.addCallback(lambda _: w.write('def'))
+        d.addCallback(lambda _: w.flush())
+        d.addCallback(lambda _: self.assertEquals(len(self.syncs), 2))
+        return d
+
+    def test_fsync_interval(self):
+        w = self.make_writer(fsync=3600)
+        w.write('abc')
+        d = w.flush()
+        d.addCallback(lambda _: w.write('def'))
+        d.addCallback(lambda _: w.flush())
+        # synced once, with the first batch, and then on close
+        d.addCallback(lambda _: self.assertEquals(len(self.syncs), 1))
+        d.addCallback(lambda _: w.close())
+        d.addCallback(lambda _: self.assertEquals(len(self.syncs), 2))
+        return d
+
+    def test_failed(self):
+        w = self.make_writer()
+
+        def write_batch(bufs):
+            writers.ThreadedFileWriter.write_batch(w, bufs)
+            raise IOError('disk full')
+        w.write_batch = write_batch
+
+        w.write('abc')
+        d = w.flush()
+        self.assertFailure(d, IOError)
+
+        def failed(_):
+            f = w._f
+            self.assertRaises(IOError, w.write, 'x')
+            self.assertEquals(w.queued, 3)
+            d = w.close()
+            self.assertFailure(d, IOError)
+            d.addCallback(lambda _: self.assertTrue(f.closed))
+            d.addCallback(lambda _: self.assertEquals(w._f, None))
+            return d
+
+        d.addCallback(failed)
+        return d
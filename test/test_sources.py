@@ -0,0 +1,259 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from twimp import chunks
+from twimp import flv
+from twimp import sources
+from twimp.helpers import vb
+from twimp.sources import PacedSource, SyntheticSource, synthetic_seq
+from twimp.sources import FLVFileSource, FLVIndex, open_index, release_index
+from twimp.vecbuf import flatten
+
+from test.helpers import StringTransport, wait_for
+
+
+class FakeProtocol(object):
+    def __init__(self):
+        self.transport = StringTransport()
+
+
+class FakeStream(object):
+    def __init__(self):
+        self.protocol = FakeProtocol()
+        self.written = []
+
+    def write_meta(self, ts, data):
+        self.written.append((chunks.MSG_DATA, ts, data))
+
+    def write_audio(self, ts, data):
+        self.written.append((chunks.MSG_AUDIO, ts, data))
+
+    def write_video(self, ts, data):
+        self.written.append((chunks.MSG_VIDEO, ts, data))
+
+
+class ListSource(PacedSource):
+    def __init__(self, frames, **kw):
+        PacedSource.__init__(self, **kw)
+        self._frames = list(frames)
+        self.finished = False
+
+    def next_frame(self):
+        if self._frames:
+            return self._frames.pop(0)
+
+    def ended(self):
+        self.finished = True
+
+
+class TestPacedSource(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stream = FakeStream()
+
+    def start(self, source):
+        source.connect(self.stream)
+        source.start()
+        self.addCleanup(source.stop)
+        return source
+
+    def test_realtime(self):
+        frames = [(chunks.MSG_VIDEO, ts, vb('x')) for ts in (100, 140, 180)]
+        s = self.start(ListSource(frames, reactor=self.clock))
+        self.assertEquals(len(self.stream.written), 1)
+        self.clock.advance(0.04)
+        self.assertEquals(len(self.stream.written), 2)
+        self.assertFalse(s.finished)
+        self.clock.advance(0.04)
+        self.assertEquals([f[1] for f in self.stream.written],
+                          [100, 140, 180])
+        self.assertTrue(s.finished)
+        self.assertEquals((s.frames, s.bytes), (3, 3))
+
+    def test_max_rate(self):
+        frames = [(chunks.MSG_AUDIO, ts, vb('x')) for ts in range(10)]
+        s = ListSource(frames, realtime=False, reactor=self.clock)
+        s.batch = 4
+        self.start(s)
+        self.assertEquals(len(self.stream.written), 4)
+
+        s.throttle()
+        self.clock.advance(0)
+        self.assertEquals(len(self.stream.written), 4)
+        s.unthrottle()
+        self.assertEquals(len(self.stream.written), 8)
+        self.clock.advance(0)
+        self.assertTrue(s.finished)
+
+    def test_realtime_not_throttled(self):
+        frames = [(chunks.MSG_VIDEO, ts, vb('x')) for ts in (0, 40)]
+        s = self.start(ListSource(frames, reactor=self.clock))
+        s.throttle()
+        self.clock.advance(0.04)
+        self.assertEquals(len(self.stream.written), 2)
+
+
+class TestSyntheticSource(unittest.TestCase):
+    def test_frames(self):
+        s = SyntheticSource(framerate=10, video_bitrate=80,
+                            keyframe_interval=0.2, audio_bitrate=0,
+                            audio=False)
+        frames = [s.next_frame() for _ in range(5)]
+
+        # meta and the video header, then the frames
+        self.assertEquals([f[0] for f in frames],
+                          [chunks.MSG_DATA] + [chunks.MSG_VIDEO] * 4)
+        self.assertEquals([synthetic_seq(*f[::2]) for f in frames[1:]],
+                          [None, 1, 2, 3])
+        self.assertEquals([f[1] for f in frames[2:]], [0, 100, 200])
+        # 80kbit/s at 10fps: 1000 bytes of payload, keyframes every
+        # second frame
+        self.assertEquals(len(frames[2][2]), 5 + 1000)
+        self.assertEquals([f[2].peek(1)[:] for f in frames[2:]],
+                          ['\x17', '\x27', '\x17'])
+
+    def test_audio_interleaved(self):
+        s = SyntheticSource(framerate=10)
+        frames = [s.next_frame() for _ in range(12)][3:]
+        ts = [f[1] for f in frames]
+        self.assertEquals(ts, sorted(ts))
+        self.assertTrue(chunks.MSG_AUDIO in [f[0] for f in frames])
+
+
+class TestFLVFileSource(unittest.TestCase):
+    tags = [(flv.TAG_DATA, 0, flv.encode_meta({'duration': 0.08})),
+            (flv.TAG_VIDEO, 0, '\x17\x00\x00\x00\x00hv'),
+            (flv.TAG_VIDEO, 0, '\x17\x01\x00\x00\x00k0'),
+            (flv.TAG_AUDIO, 20, '\x2fa1'),
+            (flv.TAG_VIDEO, 40, '\x27\x01\x00\x00\x00i1')]
+
+    def setUp(self):
+        self.path = self.mktemp()
+        f = open(self.path, 'wb')
+        f.write(flv.encode_file_header())
+        for t in self.tags:
+            f.write(flatten(flv.encode_tag(*t)))
+        # a truncated tag at the end
+        f.write(flv.encode_tag_header(flv.TAG_VIDEO, 80, 100))
+        f.close()
+
+    def test_index(self):
+        index = FLVIndex(self.path)
+        self.addCleanup(index.close)
+        self.assertEquals([t[:2] + t[4:] for t in index.tags],
+                          [(chunks.MSG_DATA, 0, False),
+                           (chunks.MSG_VIDEO, 0, True),
+                           (chunks.MSG_VIDEO, 0, False),
+                           (chunks.MSG_AUDIO, 20, False),
+                           (chunks.MSG_VIDEO, 40, False)])
+        self.assertEquals(str(index.data(3)), '\x2fa1')
+
+    def test_once(self):
+        s = FLVFileSource(self.path)
+        frames = []
+        while True:
+            frame = s.next_frame()
+            if frame is None:
+                break
+            frames.append((frame[0], frame[1],
+                           frame[2].peek(len(frame[2]))[:]))
+        self.assertEquals([f[1:] for f in frames],
+                          [(t[1], t[2]) for t in self.tags])
+
+    def test_loop(self):
+        s = FLVFileSource(FLVIndex(self.path), loop=True)
+        frames = [s.next_frame() for _ in range(10)]
+        # no meta nor headers the second time, timestamps continued
+        self.assertEquals([f[1] for f in frames],
+                          [0, 0, 0, 20, 40, 60, 80, 100, 120, 140])
+        self.assertEquals(frames[5][2].peek(7)[:], '\x17\x01\x00\x00\x00k0')
+        self.assertEquals(s.passes, 2)
+
+    def test_open_index(self):
+        def opened(index):
+            self.assertEquals(len(index.tags), 5)
+            d = open_index(self.path)
+            d.addCallback(self.assertIdentical, index)
+            d.addCallback(lambda _: changed(index))
+            return d
+
+        def changed(index):
+            f = open(self.path, 'ab')
+            f.write('x' * 100)
+            f.close()
+            d = open_index(self.path)
+            d.addCallback(self.assertNotIdentical, index)
+            return d
+
+        # opened concurrently, indexed once
+        d1, d2 = open_index(self.path), open_index(self.path)
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(lambda (i1, i2): self.assertIdentical(i1, i2) or i1)
+        d.addCallback(opened)
+        return d
+
+    def test_release_index(self):
+        self.patch(sources, 'index_cache_size', 0)
+
+        def opened(index):
+            self.assertEquals(index.refs, 1)
+            f = open(self.path, 'ab')
+            f.write('x' * 100)
+            f.close()
+            d = open_index(self.path)
+            d.addCallback(changed, index)
+            return d
+
+        def changed(new, old):
+            # replaced, but still used
+            self.assertNotIdentical(old._map, None)
+            release_index(old)
+            self.assertIdentical(old._map, None)
+            # not used anymore, not cached
+            release_index(new)
+            self.assertIdentical(new._map, None)
+            self.assertFalse(self.path in sources._indexes)
+
+        d = open_index(self.path)
+        d.addCallback(opened)
+        return d
+
+    def test_start_indexing(self):
+        stream = FakeStream()
+        s = FLVFileSource(self.path, realtime=False)
+        s.connect(stream)
+        s.start()
+        self.addCleanup(s.stop)
+        # indexed in a thread
+        self.assertIdentical(s.index, None)
+        self.assertEquals(stream.written, [])
+
+        def written(_):
+            self.assertEquals(
+                [(f[1], f[2].peek(len(f[2]))[:]) for f in stream.written],
+                [(t[1], t[2]) for t in self.tags])
+            index = s.index
+            self.assertEquals(index.refs, 1)
+            s.stop()
+            s.disconnect()
+            self.assertIdentical(s.index, None)
+            self.assertEquals(index.refs, 0)
+
+        d = wait_for(lambda: len(stream.written) == len(self.tags))
+        d.addCallback(written)
+        return d
@@ -0,0 +1,149 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from twimp.proto import BaseFactory
+from twimp.timeouts import ConnectionTimeouts, TimerWheel
+
+from test.helpers import StringTransport
+
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = TimerWheel(1.0, self.clock)
+        self.calls = []
+
+    def test_slots(self):
+        w = self.wheel
+        w.schedule(0.5, self.calls.append, 'a')
+        w.schedule(0.9, self.calls.append, 'b')
+        w.schedule(2.5, self.calls.append, 'c')
+        # a single reactor call, at the end of the earliest slot
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(0.9)
+        self.assertEquals(self.calls, [])
+        self.clock.advance(0.1)
+        self.assertEquals(self.calls, ['a', 'b'])
+        self.clock.advance(2)
+        self.assertEquals(self.calls, ['a', 'b', 'c'])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_earlier_slot(self):
+        w = self.wheel
+        w.schedule(5, self.calls.append, 'late')
+        w.schedule(1, self.calls.append, 'early')
+        self.clock.advance(1)
+        self.assertEquals(self.calls, ['early'])
+        self.clock.advance(4)
+        self.assertEquals(self.calls, ['early', 'late'])
+
+    def test_cancel(self):
+        w = self.wheel
+        t = w.schedule(1, self.calls.append, 'a')
+        w.schedule(1, self.calls.append, 'b')
+        t.cancel()
+        self.assertEquals(w.pending(), 1)
+        self.clock.advance(1)
+        self.assertEquals(self.calls, ['b'])
+        self.assertEquals(w.pending(), 0)
+
+
+class FakeProtocol(object):
+    def __init__(self):
+        self.data = 0
+        self.timed_out = []
+        self.phases = []
+
+    def activity(self):
+        return self.data
+
+    def set_timeout_phase(self, phase):
+        self.phases.append(phase)
+
+    def timedOut(self, phase):
+        self.timed_out.append(phase)
+
+
+class TestConnectionTimeouts(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_phase(self):
+        t = ConnectionTimeouts(reactor=self.clock, handshake=2, connect=None)
+        p = FakeProtocol()
+        self.assertIdentical(t.start(p, 'connect'), None)
+        t.start(p, 'handshake')
+        self.clock.advance(2)
+        self.assertEquals(p.timed_out, ['handshake'])
+        self.assertEquals(t.timed_out['handshake'], 1)
+
+    def test_idle(self):
+        t = ConnectionTimeouts(reactor=self.clock, idle=5)
+        p = FakeProtocol()
+        t.start(p, 'idle')
+        p.data += 1
+        self.clock.advance(5)
+        # some data flowed meanwhile, timing restarted
+        self.assertEquals((p.timed_out, p.phases), ([], ['idle']))
+
+        t.start(p, 'idle')
+        self.clock.advance(5)
+        self.assertEquals(p.timed_out, ['idle'])
+
+    def test_unknown_phase(self):
+        self.assertRaises(TypeError, ConnectionTimeouts, reactor=self.clock,
+                          play=1)
+
+
+class TestProtocolTimeouts(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = BaseFactory(0)
+        self.factory.timeouts = ConnectionTimeouts(reactor=self.clock,
+                                                   handshake=3, connect=5,
+                                                   idle=2)
+        self.transport = StringTransport()
+        self.p = self.factory.buildProtocol(None)
+        self.p.makeConnection(self.transport)
+
+    def test_handshake(self):
+        self.clock.advance(3)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_connect(self):
+        self.p.handshakeSucceeded(0, 0)
+        self.clock.advance(3)
+        self.assertFalse(self.transport.disconnecting)
+        self.clock.advance(2)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_idle(self):
+        self.p.set_timeout_phase('idle')
+        self.clock.advance(1)
+        self.p.dataReceived('\x03')
+        self.clock.advance(1)
+        self.assertFalse(self.transport.disconnecting)
+        self.clock.advance(2)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_lost(self):
+        self.p.connectionLost()
+        self.clock.advance(3)
+        self.assertFalse(self.transport.disconnecting)
+        self.assertEquals(self.factory.timeouts.wheel.pending(), 0)
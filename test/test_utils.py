@@ -13,6 +13,7 @@
 #   limitations under the License.
 
 
+from twisted.internet import defer
 from twisted.trial import unittest
 
 from twimp.utils import GeneratorWrapperProtocol, FrameSorter
@@ -107,6 +108,85 @@ class TestGeneratorWrapperProtocol(unittest.TestCase):
 
         self.assertEquals(self.pop_messages(), ['a', 'bb', 'ccc'])
 
+    def test_waiting(self):
+        t = StringTransport()
+        p = GeneratorWrapperProtocol()
+        d = defer.Deferred()
+
+        def _waiting_gen_handler():
+            s = yield 1
+            self.messages.append(s.read(1)[:])
+            self.messages.append((yield d))
+            s = yield 2
+            self.messages.append(s.read(2)[:])
+
+        p.init_handler(_waiting_gen_handler())
+        p.makeConnection(t)
+
+        p.dataReceived('ab')
+        p.dataReceived('c')
+        self.assertEquals(self.pop_messages(), ['a'])
+
+        d.callback('result')
+        self.assertEquals(self.pop_messages(), ['result', 'bc'])
+
+    def test_waiting_changing(self):
+        t = StringTransport()
+        p = GeneratorWrapperProtocol()
+        d = defer.Deferred()
+
+        def _12_gen_handler():
+            for n in (1, 2):
+                s = yield n
+                self.messages.append(s.read(n)[:])
+
+        def _waiting_gen_handler():
+            s = yield 1
+            self.messages.append(s.read(1)[:])
+            self.messages.append((yield d))
+            p.init_handler(_12_gen_handler())
+
+        p.init_handler(_waiting_gen_handler())
+        p.makeConnection(t)
+
+        p.dataReceived('abcc')
+        d.callback('result')
+        self.assertEquals(self.pop_messages(), ['a', 'result', 'b', 'cc'])
+
+    def test_waiting_failed(self):
+        t = StringTransport()
+        p = GeneratorWrapperProtocol()
+        d = defer.Deferred()
+
+        def _waiting_gen_handler():
+            yield 1
+            yield d
+
+        p.init_handler(_waiting_gen_handler())
+        p.makeConnection(t)
+        p.dataReceived('a')
+
+        d.errback(ValueError('failed'))
+        self.assertTrue(t.disconnecting)
+
+    def test_waiting_lost(self):
+        t = StringTransport()
+        p = GeneratorWrapperProtocol()
+        d = defer.Deferred()
+
+        def _waiting_gen_handler():
+            yield 1
+            yield d
+            self.messages.append('resumed')
+
+        p.init_handler(_waiting_gen_handler())
+        p.makeConnection(t)
+        p.dataReceived('a')
+
+        p.connectionLost()
+        self.assertTrue(d.called)
+        self.assertEquals(self.pop_messages(), [])
+
     def test_changing_123(self):
         t = StringTransport()
         p = GeneratorWrapperProtocol()
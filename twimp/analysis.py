@@ -0,0 +1,472 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Aggregate statistics of the messages of a chunk stream (e.g. of a
+captured session, see twimp.scripts.demux_file): the message types,
+the chunk size changes and, per audio/video stream, the bitrate over
+time, keyframe intervals, timestamp gaps and jumps and the codecs.
+
+Nothing gets decoded beyond the chunk headers and the first byte of
+the audio/video messages (see ChunkScanner), to get through the
+captures fast.
+"""
+
+from twimp import const
+from twimp.chunks import DEFAULT_CHUNK_SIZE, ChunkStreamParseError
+from twimp.metrics import type_names
+from twimp.primitives import _s_time_size_type, _s_time
+from twimp.primitives import _s_ulong_b, _s_ulong_l, _s_ushort_l
+
+LOG_CATEGORY = 'analysis'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+video_codec_names = {1: 'JPEG', 2: 'H.263', 3: 'Screen Video', 4: 'VP6',
+                     5: 'VP6 Alpha', 6: 'Screen Video 2', 7: 'H.264'}
+audio_codec_names = {0: 'PCM', 1: 'ADPCM', 2: 'MP3', 3: 'PCM(<)',
+                     4: 'Nellymoser 16k', 5: 'Nellymoser 8k',
+                     6: 'Nellymoser', 7: 'A-law', 8: 'u-law', 10: 'AAC',
+                     11: 'Speex', 14: 'MP3 8k', 15: 'Device audio'}
+
+_RTMP_AUDIO, _RTMP_VIDEO = const.RTMP_AUDIO, const.RTMP_VIDEO
+
+_VIDEO_KEYFRAME = 1
+
+# bytes of the message header, by header format
+_head_sizes = [11, 7, 3, 0]
+
+# gaps and jumps listed in the report, per stream
+max_listed = 20
+
+
+class _MinMax(object):
+    __slots__ = ('count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def summary(self):
+        return dict(count=self.count, min=self.min, max=self.max,
+                    mean=float(self.total) / self.count
+                    if self.count else None)
+
+
+class StreamStats(object):
+    """Statistics of the audio or the video messages of a single message
+    stream.
+
+    @param interval: the bitrate is computed over intervals of that
+                     many milliseconds
+    @param gap: timestamp differences (between consecutive messages)
+                greater than that many milliseconds count as gaps
+    """
+
+    def __init__(self, ms_id, type_, interval=1000, gap=1000):
+        self.ms_id = ms_id
+        self.type = type_
+        self.interval = interval
+        self.gap = gap
+
+        self.messages = 0
+        self.bytes = 0
+        self.first_time = None
+        self.last_time = None
+
+        # { interval number => bytes }
+        self.buckets = {}
+        # { codec id => messages }
+        self.codecs = {}
+        self.keyframes = 0
+        self._last_keyframe = None
+        self.keyframe_intervals = _MinMax()
+        self.deltas = _MinMax()
+        # (time, delta) lists, and the total counts
+        self.gaps = []
+        self.gap_count = 0
+        self.jumps = []
+        self.jump_count = 0
+
+    def add(self, time, size, first_byte):
+        self.messages += 1
+        self.bytes += size
+
+        last = self.last_time
+        if last is None:
+            self.first_time = time
+        else:
+            delta = time - last
+            self.deltas.add(delta)
+            if delta < 0:
+                self.jump_count += 1
+                if len(self.jumps) < max_listed:
+                    self.jumps.append((time, delta))
+            elif delta > self.gap:
+                self.gap_count += 1
+                if len(self.gaps) < max_listed:
+                    self.gaps.append((time, delta))
+        self.last_time = time
+
+        n = time // self.interval
+        self.buckets[n] = self.buckets.get(n, 0) + size
+
+        if first_byte is not None:
+            if self.type == _RTMP_VIDEO:
+                codec = first_byte & 0x0f
+                if first_byte >> 4 == _VIDEO_KEYFRAME:
+                    self.keyframes += 1
+                    if self._last_keyframe is not None:
+                        self.keyframe_intervals.add(time -
+                                                    self._last_keyframe)
+                    self._last_keyframe = time
+            else:
+                codec = first_byte >> 4
+            self.codecs[codec] = self.codecs.get(codec, 0) + 1
+
+    def duration(self):
+        if self.first_time is None:
+            return 0
+        return self.last_time - self.first_time
+
+    def bitrate(self):
+        """Return the bitrate over time: [(start time in ms, kbit/s)],
+        for all the intervals from the first to the last message."""
+        if not self.buckets:
+            return []
+        start, end = min(self.buckets), max(self.buckets)
+        get = self.buckets.get
+        return [(n * self.interval, get(n, 0) * 8.0 / self.interval)
+                for n in xrange(start, end + 1)]
+
+    def codec_names(self):
+        names = (video_codec_names if self.type == _RTMP_VIDEO
+                 else audio_codec_names)
+        return dict((names.get(c, str(c)), count)
+                    for c, count in self.codecs.items())
+
+    def report(self):
+        duration = self.duration()
+        rates = [kbps for _t, kbps in self.bitrate()]
+        r = dict(ms_id=self.ms_id, type=type_names[self.type],
+                 messages=self.messages, bytes=self.bytes,
+                 first_time=self.first_time, last_time=self.last_time,
+                 kbps=(self.bytes * 8.0 / duration if duration > 0
+                       else None),
+                 max_kbps=max(rates) if rates else None,
+                 min_kbps=min(rates) if rates else None,
+                 codecs=self.codec_names(),
+                 deltas=self.deltas.summary(),
+                 gaps=dict(count=self.gap_count, first=self.gaps),
+                 jumps=dict(count=self.jump_count, first=self.jumps))
+        if self.type == _RTMP_VIDEO:
+            r['keyframes'] = self.keyframes
+            r['keyframe_intervals'] = self.keyframe_intervals.summary()
+        return r
+
+
+class SessionAnalyzer(object):
+    """Collects the statistics of all the messages of a chunk stream."""
+
+    def __init__(self, interval=1000, gap=1000):
+        self.interval = interval
+        self.gap = gap
+
+        self.messages = 0
+        self.bytes = 0
+        # per RTMP message type
+        self.type_counts = [0] * 256
+        self.type_bytes = [0] * 256
+        # { (ms_id, RTMP type) => StreamStats }
+        self.streams = {}
+        # (messages before, new chunk size)
+        self.chunk_sizes = []
+
+    def message(self, type_, size, ms_id, time, first_byte):
+        """Count a message; first_byte is the first byte of the body of
+        audio/video messages (None if empty)."""
+        self.messages += 1
+        self.bytes += size
+        self.type_counts[type_] += 1
+        self.type_bytes[type_] += size
+
+        if type_ == _RTMP_AUDIO or type_ == _RTMP_VIDEO:
+            key = ms_id, type_
+            s = self.streams.get(key)
+            if s is None:
+                s = self.streams[key] = StreamStats(ms_id, type_,
+                                                    self.interval, self.gap)
+            s.add(time, size, first_byte)
+
+    def chunk_size_changed(self, size):
+        self.chunk_sizes.append((self.messages, size))
+
+    def report(self):
+        types = dict((type_names.get(t, str(t)),
+                      dict(messages=c, bytes=self.type_bytes[t]))
+                     for t, c in enumerate(self.type_counts) if c)
+        return dict(messages=self.messages, bytes=self.bytes, types=types,
+                    chunk_sizes=self.chunk_sizes,
+                    streams=[s.report()
+                             for _k, s in sorted(self.streams.items())])
+
+    def format_report(self):
+        """Return the report as (printable) tables."""
+        r = self.report()
+        lines = ['%-16s %10s %14s' % ('type', 'messages', 'bytes')]
+        for name, t in sorted(r['types'].items()):
+            lines.append('%-16s %10d %14d' % (name, t['messages'],
+                                              t['bytes']))
+        lines.append('%-16s %10d %14d' % ('total', r['messages'],
+                                          r['bytes']))
+
+        lines.append('')
+        lines.append('chunk sizes: %s' %
+                     (', '.join('%d (after %d messages)' % (size, n)
+                                for n, size in r['chunk_sizes'])
+                      or 'default'))
+
+        for s in r['streams']:
+            lines.append('')
+            lines.append('stream %d %s: %d messages, %d bytes, %s' %
+                         (s['ms_id'], s['type'], s['messages'], s['bytes'],
+                          ', '.join('%s: %d' % c
+                                    for c in sorted(s['codecs'].items()))))
+            lines.append('  time %s - %s ms, kbit/s: %s avg, %s min,'
+                         ' %s max' % (s['first_time'], s['last_time'],
+                                      _fmt(s['kbps']), _fmt(s['min_kbps']),
+                                      _fmt(s['max_kbps'])))
+            d = s['deltas']
+            lines.append('  timestamp deltas: %s min, %s mean, %s max;'
+                         ' %d gaps > %d ms, %d jumps back' %
+                         (d['min'], _fmt(d['mean']), d['max'],
+                          s['gaps']['count'], self.gap,
+                          s['jumps']['count']))
+            for name in ('gaps', 'jumps'):
+                if s[name]['first']:
+                    lines.append('    %s at: %s' % (name, ', '.join(
+                                '%d (%+d)' % g for g in s[name]['first'])))
+            if 'keyframes' in s:
+                k = s['keyframe_intervals']
+                lines.append('  keyframes: %d, intervals: %s min, %s mean,'
+                             ' %s max ms' % (s['keyframes'], k['min'],
+                                             _fmt(k['mean']), k['max']))
+        return '\n'.join(lines)
+
+    def write_csv(self, f):
+        """Write the bitrate over time of all the streams, as CSV."""
+        import csv
+
+        w = csv.writer(f)
+        w.writerow(['ms_id', 'type', 'time_ms', 'kbps'])
+        for (ms_id, type_), s in sorted(self.streams.items()):
+            for t, kbps in s.bitrate():
+                w.writerow([ms_id, type_names[type_], t, '%.3f' % kbps])
+
+
+def _fmt(value):
+    if value is None:
+        return '-'
+    return '%.1f' % value
+
+
+class _ChunkStream(object):
+    __slots__ = ('abs_time', 'time', 'size', 'type', 'ms_id', 'left',
+                 'first')
+
+    def __init__(self):
+        self.left = 0
+
+
+class ChunkScanner(object):
+    """A minimal demuxer, for analyzing: parses just the chunk headers
+    (following the chunk size changes and aborts), skipping over the
+    message bodies - only the first byte of each message is read, or
+    the payload of the control messages it needs.
+
+    Follows the Demuxer in the interpretation of the headers, passing
+    the complete messages to analyzer: analyzer.message(type, size,
+    ms_id, time, first_byte).
+    """
+
+    # max bytes of a chunk header and the bytes peeked at in the body
+    _max_head = 1 + 2 + 11 + 4 + 4
+
+    def __init__(self, analyzer):
+        self.analyzer = analyzer
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+        # { cs_id => _ChunkStream }
+        self._streams = {}
+        # unparsed bytes, and bytes to skip, at the end of the last block
+        self._tail = ''
+        self._skip = 0
+        self.bytes_scanned = 0
+
+    def feed(self, data):
+        self.bytes_scanned += len(data)
+        if self._skip:
+            if self._skip >= len(data):
+                self._skip -= len(data)
+                return
+            data, self._skip = buffer(data, self._skip), 0
+        if self._tail:
+            data = self._tail + str(data)
+            self._tail = ''
+        pos = self._scan(data, False)
+        if pos < len(data):
+            self._tail = str(buffer(data, pos))
+
+    def finish(self):
+        """Parse what is left of the data.
+
+        @return: the number of bytes that didn't make a complete chunk
+                 header, or that the body of the last chunk is short of
+        """
+        if self._tail:
+            data, self._tail = self._tail, ''
+            pos = self._scan(data, True)
+            return len(data) - pos + self._skip
+        return self._skip
+
+    def _scan(self, buf, final):
+        streams = self._streams
+        message = self.analyzer.message
+        unpack_tst = _s_time_size_type.unpack_from
+        unpack_time = _s_time.unpack_from
+        chunk_size = self.chunk_size
+        end = len(buf)
+        safe_end = end - self._max_head
+        pos = 0
+
+        while pos < end:
+            if pos > safe_end and not final:
+                break
+
+            b = ord(buf[pos])
+            fmt, cs_id = b >> 6, b & 0x3f
+            p = pos + 1
+            if cs_id == 0:
+                if p + 1 > end:
+                    break
+                cs_id = ord(buf[p]) + 64
+                p += 1
+            elif cs_id == 1:
+                if p + 2 > end:
+                    break
+                cs_id = _s_ushort_l.unpack_from(buf, p)[0] + 64
+                p += 2
+
+            if p + _head_sizes[fmt] > end:
+                break
+            m_time = m_size = m_type = m_ms_id = None
+            if fmt == 0 or fmt == 1:
+                t1, m_time, s1, m_size, m_type = unpack_tst(buf, p)
+                m_time += t1 << 8
+                m_size += s1 << 8
+                if fmt == 0:
+                    m_ms_id, = _s_ulong_l.unpack_from(buf, p + 7)
+            elif fmt == 2:
+                t1, m_time = unpack_time(buf, p)
+                m_time += t1 << 8
+            p += _head_sizes[fmt]
+
+            st = streams.get(cs_id)
+            if (m_time == 0xffffff or
+                m_time is None and st is not None and st.time >= 0xffffff):
+                if p + 4 > end:
+                    break
+                m_time, = _s_ulong_b.unpack_from(buf, p)
+                p += 4
+
+            new = st is None or st.left == 0
+            if new:
+                if fmt != 0:
+                    if st is None:
+                        raise ChunkStreamParseError(
+                            'relative header with no previous one, chunk'
+                            ' stream %d' % cs_id)
+                    if m_time is None:
+                        m_time = st.time
+                    m_time_abs = st.abs_time + m_time
+                    if m_size is None:
+                        m_size, m_type = st.size, st.type
+                    m_ms_id = st.ms_id
+                else:
+                    m_time_abs = m_time
+                    if st is None:
+                        st = streams[cs_id] = _ChunkStream()
+                st.abs_time, st.time = m_time_abs, m_time
+                st.size, st.type, st.ms_id = m_size, m_type, m_ms_id
+                st.left = m_size
+                st.first = None
+
+            n = min(st.left, chunk_size)
+            if new and n:
+                # peeking at the body
+                if st.type == _RTMP_AUDIO or st.type == _RTMP_VIDEO:
+                    if p + 1 > end:
+                        break
+                    st.first = ord(buf[p])
+                elif (cs_id == 2 and 0 < st.type < 3 and st.ms_id == 0
+                      and n >= 4):
+                    if p + 4 > end:
+                        break
+                    st.first, = _s_ulong_b.unpack_from(buf, p)
+
+            st.left -= n
+            pos = p + n
+
+            if st.left == 0:
+                message(st.type, st.size, st.ms_id, st.abs_time, st.first)
+                if cs_id == 2 and st.ms_id == 0 and st.first is not None:
+                    if st.type == 1:
+                        chunk_size = self.chunk_size = st.first
+                        self.analyzer.chunk_size_changed(chunk_size)
+                    elif st.type == 2:
+                        aborted = streams.get(st.first)
+                        if aborted is not None:
+                            aborted.left = 0
+
+        if pos > end:
+            self._skip = pos - end
+            return end
+        return pos
+
+
+def analyze(blocks, analyzer=None):
+    """Analyze the chunk stream in blocks (an iterable of strings or
+    buffers).
+
+    @return: the SessionAnalyzer
+    """
+    if analyzer is None:
+        analyzer = SessionAnalyzer()
+    scanner = ChunkScanner(analyzer)
+    for data in blocks:
+        scanner.feed(data)
+    left = scanner.finish()
+    if left:
+        log.info('data ends with an incomplete chunk (%d bytes)', left)
+    return analyzer
@@ -0,0 +1,202 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+
+"""Capturing the raw bytes of sessions - both directions, timestamped -
+into compact files, for parsing or replaying them later (see
+twimp.replay).
+
+A capture file is a header followed by records, one per chunk of
+data received or sent:
+
+  header: magic, version, side (client/server), start time (double)
+  record: direction (in/out), microseconds since the previous record,
+          data size, data
+"""
+
+import os
+import struct
+import time
+
+LOG_CATEGORY = 'capture'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+MAGIC = 'TWCAP'
+VERSION = 1
+
+SERVER, CLIENT = 0, 1
+IN, OUT = 0, 1
+
+_s_file_header = struct.Struct('>5sBBd')
+_s_record = struct.Struct('>BLL')
+
+
+class CaptureError(ValueError):
+    """Not a (supported) capture file"""
+
+
+class SessionCapture(object):
+    """Writes the data received and sent by a single connection into the
+    (open) file f."""
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, f, is_client=False):
+        self.f = f
+        self.is_client = is_client
+        self.started = self.clock()
+        # microseconds since started, of the last record
+        self._last = 0
+
+        f.write(_s_file_header.pack(MAGIC, VERSION,
+                                    CLIENT if is_client else SERVER,
+                                    self.started))
+
+    def _header(self, direction, size):
+        now = int((self.clock() - self.started) * 1000000)
+        delta, self._last = max(0, now - self._last), now
+        self.f.write(_s_record.pack(direction, min(delta, 0xffffffff),
+                                    size))
+
+    def received(self, data):
+        self._header(IN, len(data))
+        self.f.write(data)
+
+    def sent(self, data):
+        self._header(OUT, len(data))
+        self.f.write(data)
+
+    def sent_sequence(self, seq):
+        self._header(OUT, sum(len(data) for data in seq))
+        for data in seq:
+            self.f.write(data)
+
+    def close(self):
+        self.f.close()
+
+
+def capture_transport(transport, capture):
+    """Make the writes to the transport get captured too (until the
+    write and writeSequence attributes get deleted from it)."""
+    orig_write = transport.write
+    orig_writeSequence = transport.writeSequence
+    # (some transports implement writeSequence() with write())
+    in_sequence = []
+
+    def write(data):
+        if not in_sequence:
+            capture.sent(data)
+        return orig_write(data)
+
+    def writeSequence(seq):
+        capture.sent_sequence(seq)
+        in_sequence.append(True)
+        try:
+            return orig_writeSequence(seq)
+        finally:
+            in_sequence.pop()
+
+    transport.write = write
+    transport.writeSequence = writeSequence
+
+
+def read_capture(f):
+    """Read the capture from the (open) file f.
+
+    @return: (is_client, start time, iterator of (direction, seconds
+             since start, data) records)
+    """
+    header = f.read(_s_file_header.size)
+    if len(header) < _s_file_header.size:
+        raise CaptureError('truncated header')
+    magic, version, side, started = _s_file_header.unpack(header)
+    if magic != MAGIC:
+        raise CaptureError('not a capture file')
+    if version != VERSION:
+        raise CaptureError('unsupported version: %d' % version)
+
+    def records():
+        offset = 0
+        size = _s_record.size
+        while True:
+            header = f.read(size)
+            if len(header) < size:
+                # (a truncated record ends the capture)
+                break
+            direction, delta, length = _s_record.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+            offset += delta
+            yield direction, offset / 1000000.0, data
+
+    return side == CLIENT, started, records()
+
+
+def is_capture(f):
+    """Return whether the (open, seekable) file f is a capture file."""
+    pos = f.tell()
+    magic = f.read(len(MAGIC))
+    f.seek(pos)
+    return magic == MAGIC
+
+
+class SessionCapturer(object):
+    """Captures the sessions of (one of every sample) connections into
+    files in directory, up to max_sessions of them (if not None).
+
+    Meant for setting as the capture attribute of a factory (see
+    IBaseFactory).
+    """
+
+    sample = 1
+    max_sessions = None
+
+    def __init__(self, directory, sample=None, max_sessions=None):
+        self.directory = directory
+        if sample is not None:
+            self.sample = sample
+        if max_sessions is not None:
+            self.max_sessions = max_sessions
+
+        self._seen = 0
+        self.captured = 0
+
+    def open(self, protocol):
+        """Return the SessionCapture for the protocol just connected, or
+        None if it is not to be captured."""
+        self._seen += 1
+        if self._seen < self.sample:
+            return None
+        self._seen = 0
+        if (self.max_sessions is not None and
+            self.captured >= self.max_sessions):
+            return None
+
+        self.captured += 1
+        peer = protocol.transport.getPeer()
+        name = '%d-%d-%s-%s.twcap' % (time.time(), self.captured,
+                                      getattr(peer, 'host', 'peer'),
+                                      getattr(peer, 'port', 0))
+        path = os.path.join(self.directory, name)
+        try:
+            f = open(path, 'wb')
+        except (IOError, OSError), e:
+            log.warning("can't capture into %r: %s", path, e)
+            return None
+        log.info('capturing %r', path)
+        return SessionCapture(f, protocol.is_client)
@@ -12,6 +12,8 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import bisect
+from collections import deque
 
 from primitives import _s_time_size_type, _s_time, _s_set_bw
 from primitives import _s_ulong_l, _s_ulong_b, _s_uchar, _s_ushort, _s_ushort_l
@@ -89,6 +91,10 @@ class Demuxer(object):
         self.msg_map = {}
         self.protocol = protocol
 
+        # counters of the messages received: { RTMP type => count }
+        self.received_by_type = [0] * 256
+        self.bytes_received = 0
+
         # handlers: {type => (verify_size, cnv_size, cnv_func, pass_rest,
         #                     handler_func)}
         # TODO: should some of those be handled directly by a higer layer?...
@@ -240,6 +246,9 @@ class Demuxer(object):
                 self.chstr_map.pop(h.cs_id, None)
                 self.msg_map[h.cs_id] = h
 
+                self.received_by_type[h.type] += 1
+                self.bytes_received += h.size
+
                 if h.cs_id == 2 and 0 < h.type < 8 and h.ms_id == 0:
                     self.controlMessageReceived(h, vecbuf.VecBuf(accbody))
                 else:
@@ -361,7 +370,8 @@ class SimpleChunkProducer(object):
         # not registering ourselves as a streaming producer, since we
         # don't implement that interface properly...
 
-    def queue_chunker(self, priority, chunker):
+    def queue_chunker(self, priority, chunker, cs_id=None, ms_id=None,
+                      ordered=False):
         # write all chunks immediately (effectively ignores priority)
         for chunk_head, chunk_body in chunker:
             self.transport.write(chunk_head)
@@ -371,6 +381,10 @@ class SimpleChunkProducer(object):
         # a noop in this simple implementation
         pass
 
+    def queued(self):
+        # nothing ever queued here
+        return 0
+
     # IPushProducer interface
     def pauseProducing(self):
         pass
@@ -382,6 +396,152 @@ class SimpleChunkProducer(object):
         pass
 
 
+class InterleavingChunkProducer(object):
+    """A chunk producer, for use with the Muxer class, writing chunks
+    immediately while the transport keeps up.
+
+    When paused, the chunkers get queued per chunk stream, and on
+    resuming the chunks of different chunk streams are written
+    interleaved (round-robin, higher priority streams first), so that
+    large messages don't hold back the messages of other streams.
+
+    Within a message stream, only audio and video get reordered: an
+    ordered message (a command, say) is written after the messages of
+    its stream queued before it, and before the ones queued after it.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self._paused = False
+
+        # { cs_id => deque of chunkers }
+        self._queued = {}
+        # { priority => deque of cs_ids, in the order of their turns }
+        self._rounds = {}
+        self._priorities = []
+        # { cs_id => (priority, ms_id, ordered) }, of the queued ones
+        self._chunk_streams = {}
+        # { ms_id => set of queued cs_ids }
+        self._streams = {}
+
+    def _write_chunk(self, chunker):
+        try:
+            chunk_head, chunk_body = chunker.next()
+        except StopIteration:
+            return False
+        self.transport.write(chunk_head)
+        self.transport.writeSequence(chunk_body)
+        return True
+
+    def queue_chunker(self, priority, chunker, cs_id=None, ms_id=None,
+                      ordered=False):
+        if not self._paused and not self._queued:
+            while self._write_chunk(chunker):
+                if self._paused:
+                    break
+            else:
+                return
+
+        if ms_id:
+            self._keep_order(cs_id, ms_id, ordered)
+
+        q = self._queued.get(cs_id)
+        if q is None:
+            q = self._queued[cs_id] = deque()
+            rnd = self._rounds.get(priority)
+            if rnd is None:
+                rnd = self._rounds[priority] = deque()
+                bisect.insort(self._priorities, priority)
+            rnd.append(cs_id)
+            self._chunk_streams[cs_id] = (priority, ms_id, ordered)
+            if ms_id:
+                self._streams.setdefault(ms_id, set()).add(cs_id)
+        q.append(chunker)
+
+    def _keep_order(self, cs_id, ms_id, ordered):
+        # whatever of the stream, on other chunk streams, could end up
+        # written after the new message (or the other way round) gets
+        # written out first, paused or not
+        for other in list(self._streams.get(ms_id, ())):
+            if other != cs_id and (ordered or
+                                   self._chunk_streams[other][2]):
+                self._flush(other)
+
+    def _flush(self, cs_id):
+        for chunker in self._queued[cs_id]:
+            while self._write_chunk(chunker):
+                pass
+        priority = self._chunk_streams[cs_id][0]
+        self._rounds[priority].remove(cs_id)
+        self._forget(cs_id)
+
+    def _forget(self, cs_id):
+        del self._queued[cs_id]
+        _priority, ms_id, _ordered = self._chunk_streams.pop(cs_id)
+        if ms_id:
+            cs_ids = self._streams[ms_id]
+            cs_ids.discard(cs_id)
+            if not cs_ids:
+                del self._streams[ms_id]
+
+    def _drain(self, max_priority=None):
+        for priority in self._priorities:
+            if max_priority is not None and priority > max_priority:
+                break
+
+            rnd = self._rounds[priority]
+            while rnd:
+                if self._paused and max_priority is None:
+                    return
+                cs_id = rnd.popleft()
+                q = self._queued[cs_id]
+                if not self._write_chunk(q[0]):
+                    # done with the message, on to the next one
+                    q.popleft()
+                    if not q:
+                        self._forget(cs_id)
+                        continue
+                rnd.append(cs_id)
+
+    def queued(self):
+        """Return the number of messages (possibly partially written)
+        waiting to be written.
+        """
+        return sum(len(q) for q in self._queued.values())
+
+    def sync(self, priority):
+        # write out everything of at least the given priority, paused
+        # or not
+        self._drain(priority)
+
+    # IPushProducer interface
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._drain()
+
+    def stopProducing(self):
+        self._paused = True
+        self._queued.clear()
+        self._rounds.clear()
+        self._priorities = []
+        self._chunk_streams.clear()
+        self._streams.clear()
+
+
+def _notify_written(chunker, body, written):
+    """Pass the chunks of body on, calling written() when the producer
+    takes the last one (to write it out right away, since producers
+    only ever pull chunks to write them).
+    """
+    for chunk in chunker:
+        if not len(body):
+            written()
+        yield chunk
+
+
 (AMF_v0, AMF_v3) = range(2)
 
 (PROTO_SET_CHUNK_SIZE, PROTO_ABORT_MESSAGE, PROTO_ACK, PROTO_USER_CONTROL,
@@ -427,6 +587,11 @@ class Muxer(object):
         self._chunker = self.chunker_class()
         self.producer = self.chunk_producer_class(transport)
 
+        # counters of the messages sent: { RTMP type => count }
+        self.sent_by_type = [0] * 256
+        self.messages_sent = 0
+        self.bytes_sent = 0
+
         self._precompute_dispatch(self.AMF_ver)
 
     def _precompute_dispatch(self, amf_ver):
@@ -458,7 +623,8 @@ class Muxer(object):
         # now it should be safe to change the chunk size
         self._chunker.set_chunk_size(new_chunk_size)
 
-    def sendMessage(self, time, type_, ms_id, body, absolute=False):
+    def sendMessage(self, time, type_, ms_id, body, absolute=False,
+                    written=None):
         """Build and send binary representation of message.
 
         @param time: absolute time of the message, in milliseconds, in
@@ -471,8 +637,13 @@ class Muxer(object):
 
         @param body: the payload of the message
         @type body:  VecBuf
+
+        @param written: if given, called (with no arguments) as the
+                        last chunk of the message gets written out
         """
         size = len(body)
+        self.messages_sent += 1
+        self.bytes_sent += size
 
         # first: priority based on (abstracted) message type
         priority = 0x10
@@ -482,6 +653,7 @@ class Muxer(object):
         # second: get the actual message type, depending on the
         # negotiated AMF version
         msg_type = self._type_dispatch[type_]
+        self.sent_by_type[msg_type] += 1
 
         # third, figure out cs_id
         cs_id = None
@@ -534,6 +706,13 @@ class Muxer(object):
                                             msg_type, ms_id)
             time = new_time
 
-        self.producer.queue_chunker(priority,
-                                    self._chunker(cs_id, raw_header, body,
-                                                  time))
+        chunker = self._chunker(cs_id, raw_header, body, time)
+        if written is not None:
+            chunker = _notify_written(chunker, body, written)
+        # only audio and video may get ahead of the stream's messages
+        ordered = type_ not in (MSG_AUDIO, MSG_VIDEO)
+        self.producer.queue_chunker(priority, chunker, cs_id, ms_id, ordered)
+
+
+class InterleavingMuxer(Muxer):
+    chunk_producer_class = InterleavingChunkProducer
@@ -15,25 +15,33 @@
 
 import logging
 import time
+from collections import deque
 
-from twisted.internet import protocol
+from zope.interface import implements
+
+from twisted.internet import interfaces, protocol
 from twisted.internet.protocol import ClientFactory
-from twisted.internet import reactor, defer
+from twisted.internet import defer
 from twisted.python.failure import Failure
 
 from twimp import amf0
 from twimp import chunks
+from twimp import const
 from twimp.error import UnexpectedStatusError, CommandResultError
 from twimp.error import ClientConnectError
 from twimp.primitives import _s_ulong_b as _s_ulong
 from twimp.dispatch import CallDispatchProtocol, CallDispatchFactory
 from twimp.urls import parse_rtmp_url
+from twimp.interfaces import IThrottledSource
 
-from twimp.helpers import vb, ignore_disconnect_eb
+from twimp.helpers import vb, ignore_disconnect_eb, frame_info
 
 LOG_CATEGORY = 'client'
 import twimp.log
 log = twimp.log.get_logger(LOG_CATEGORY)
+log_flags = twimp.log.get_flags(LOG_CATEGORY)
+# for the per-frame events
+frame_log = twimp.log.RateLimitedLogger(log)
 
 
 CLIENT_VERSION = 'TwiMMF/1.0 (compatible; FMSc/1.0)'
@@ -61,12 +69,27 @@ class BaseClientFactory(CallDispatchFactory, ClientFactory):
 #   -> factory.clientConnectionLost()
 
 
+rtmp_to_internal_types = {
+    const.RTMP_AUDIO: chunks.MSG_AUDIO,
+    const.RTMP_VIDEO: chunks.MSG_VIDEO,
+    }
+
+
 class SimpleAppClientProtocol(BaseClientProtocol):
+    implements(interfaces.IPushProducer)
+
     def __init__(self):
         BaseClientProtocol.__init__(self)
 
         self._app = None
 
+        self._data_routes = {}
+        self._meta_routes = {}
+        self._status_routes = {}
+
+        self._writing_streams = []
+        self._write_paused = False
+
     def handshakeSucceeded(self, init_ts, hs_delay):
         BaseClientProtocol.handshakeSucceeded(self, init_ts, hs_delay)
         self._init_connect()
@@ -140,6 +163,86 @@ class SimpleAppClientProtocol(BaseClientProtocol):
 
         BaseClientProtocol.connectionLost(self, reason)
 
+    ##
+    # routing of messages of the (playing) streams
+    #
+
+    def _set_route_messages(self, ms_id, callback, table):
+        if callback:
+            table[ms_id] = callback
+        else:
+            table.pop(ms_id, None)
+
+    def route_data_messages(self, ms_id, callback):
+        self._set_route_messages(ms_id, callback, self._data_routes)
+
+    def route_meta_messages(self, ms_id, callback):
+        self._set_route_messages(ms_id, callback, self._meta_routes)
+
+    def route_status_messages(self, ms_id, callback):
+        self._set_route_messages(ms_id, callback, self._status_routes)
+
+    def doMeta(self, ts, ms_id, args):
+        handler = self._meta_routes.get(ms_id)
+        if handler:
+            handler(ts, args)
+
+    def doData(self, type_, ts, ms_id, body):
+        handler = self._data_routes.get(ms_id)
+        if handler:
+            handler(ts, rtmp_to_internal_types[type_], body)
+
+    def unhandledOnStatus(self, ts, ms_id, info):
+        handler = self._status_routes.get(ms_id)
+        if handler:
+            handler(ts, info)
+        else:
+            BaseClientProtocol.unhandledOnStatus(self, ts, ms_id, info)
+
+    ##
+    # flow control of the (publishing) streams and the muxer: the
+    # transport pauses us when its buffer fills up
+    #
+
+    def add_writing_stream(self, stream):
+        if not self._writing_streams and self.transport.producer is None:
+            self.transport.registerProducer(self, True)
+        self._writing_streams.append(stream)
+        if self._write_paused:
+            stream.pause_writing()
+
+    def remove_writing_stream(self, stream):
+        if stream in self._writing_streams:
+            self._writing_streams.remove(stream)
+        if (not self._writing_streams and self.transport and
+            self.transport.producer is self):
+            self.transport.unregisterProducer()
+            if self._write_paused:
+                self._write_paused = False
+                self.muxer.producer.resumeProducing()
+
+    def pauseProducing(self):
+        self._write_paused = True
+        self.muxer.producer.pauseProducing()
+        for s in self._writing_streams[:]:
+            s.pause_writing()
+
+    def resumeProducing(self):
+        self._write_paused = False
+        self.muxer.producer.resumeProducing()
+
+        # taking turns in flushing their queues
+        streams = self._writing_streams
+        if len(streams) > 1:
+            streams.append(streams.pop(0))
+        for s in streams[:]:
+            if self._write_paused:
+                break
+            s.resume_writing()
+
+    def stopProducing(self):
+        pass
+
     ##
     # implementation of some common methods servers might want to call
     #
@@ -229,23 +332,38 @@ class InvalidStreamState(ValueError):
 (STREAM_STATE_PUBLISHING, STREAM_STATE_PLAYING) = range(1, 3)
 
 class ClientStream(object):
+    # seconds of media the stream may hold back while the connection is
+    # congested, before dropping frames
+    latency_target = 1.0
+
     def __init__(self, protocol, ms_id):
         self.protocol = protocol
         self.id = ms_id
 
+        self._write_paused = False
+        self._write_queue = deque()
+        self._skip_video = False
+        self._throttled = False
+        self.dropped = 0
+
         self._source = None
         self._sink = None
+        self._status_callback = None
+        self._play_d = None
+        self._jitter = None
 
         self._state = None
         self._fcpublished = None
         self.closed = False
 
     def publish(self, name, source, mode='live', chunk_size=None,
-                fcpublish='no'):
+                fcpublish='no', latency_target=None):
         if self._state is not None:
             raise InvalidStreamState('requested publish in state %r' %
                                      (self._state,))
         self._state = STREAM_STATE_PUBLISHING
+        if latency_target is not None:
+            self.latency_target = latency_target
 
         def do_publish(_result):
             # mode ignored for now...
@@ -283,6 +401,7 @@ class ClientStream(object):
 
         self._source = source
         source.connect(self)
+        self.protocol.add_writing_stream(self)
         source.start()
 
     def _fcpublish_failed(self, failure):
@@ -314,8 +433,100 @@ class ClientStream(object):
         sm(0, chunks.PROTO_SET_CHUNK_SIZE, 0, vb(_s_ulong.pack(new_size)))
         self.protocol.muxer.set_chunk_size(new_size)
 
-    def play(self, receiver):
-        raise NotImplementedError()
+    def play(self, name, sink, start=-2, jitter=None):
+        """Play the stream name, passing the messages received to sink.
+
+        The sink gets connected and started (when it should call
+        set_listeners()) before requesting the play.
+
+        @param jitter: optional L{twimp.jitterbuf.JitterBuffer} to
+                       pass the audio/video messages through
+        @return: Deferred, fired once the server reports playing started
+        """
+        if self._state is not None:
+            raise InvalidStreamState('requested play in state %r' %
+                                     (self._state,))
+        self._state = STREAM_STATE_PLAYING
+
+        self._jitter = jitter
+        self._sink = sink
+        sink.connect(self)
+        sink.start()
+
+        self._play_d = d = defer.Deferred()
+        self.protocol.route_status_messages(self.id, self._play_status)
+        call_d = self.protocol.callRemote(self.id, 'play', None, name, start)
+        call_d.addErrback(self._play_call_failed)
+        return d
+
+    def _play_status(self, ts, info):
+        d = self._play_d
+        if d is not None:
+            if getattr(info, 'code', None) == 'NetStream.Play.Start':
+                self._play_d = None
+                d.callback(info)
+            elif getattr(info, 'level', None) == 'error':
+                self._play_failed(UnexpectedStatusError(info))
+                return
+
+        if self._status_callback:
+            self._status_callback(ts, info)
+
+    def _play_call_failed(self, failure):
+        # servers don't always answer the play call, but if they do
+        # with an error, we're not playing
+        if self._play_d is not None:
+            self._play_failed(failure)
+        else:
+            log.debug('play call failed: %r', failure.value)
+
+    def _play_failed(self, reason):
+        d, self._play_d = self._play_d, None
+        self._stop_sink()
+        self._state = None
+        log.info('play failed: %r', reason)
+        d.errback(reason)
+
+    def _stop_sink(self):
+        if self.protocol:
+            self.protocol.route_status_messages(self.id, None)
+        if self._sink:
+            self._sink.stop()
+            self._sink.disconnect()
+            self._sink = None
+        self.unset_listeners()
+        if self._jitter:
+            self._jitter.stop()
+            self._jitter = None
+
+    def set_listeners(self, data_callback=None, meta_callback=None,
+                      status_callback=None):
+        """Set callbacks for messages received while playing:
+        data_callback(ts, type_, data), meta_callback(ts, args) and
+        status_callback(ts, info).
+        """
+        if self._jitter:
+            self._jitter.set_output(data_callback)
+            if data_callback:
+                data_callback = self._jitter.push
+        if self.protocol:
+            self.protocol.route_data_messages(self.id, data_callback)
+            self.protocol.route_meta_messages(self.id, meta_callback)
+        self._status_callback = status_callback
+
+    def unset_listeners(self):
+        self.set_listeners()
+
+    def stop_playing(self):
+        if self._state != STREAM_STATE_PLAYING:
+            raise InvalidStreamState('requested stop play in state %r' %
+                                     (self._state,))
+
+        self._play_d = None
+        self._stop_sink()
+        self._state = None
+        self.protocol.signalRemote(self.id, 'closeStream', None)
+        return defer.succeed(None)
 
     def _failed_unpublishing(self, failure):
         log.info('failed unpublishing - Huh?!')
@@ -332,6 +543,7 @@ class ClientStream(object):
             return None
 
         def do_stop(_result):
+            self._stop_writing()
             self._source.stop()
             self._source.disconnect()
             self._source = None
@@ -370,13 +582,12 @@ class ClientStream(object):
 
     def _force_cleanup(self):
         if self._source:
+            self._stop_writing()
             self._source.stop()
             self._source.disconnect()
             self._source = None
         if self._sink:
-            self._sink.stop()
-            self._sink.disconnect()
-            self._sink = None
+            self._stop_sink()
         self._state = None
 
     def close(self, force=False):
@@ -390,13 +601,112 @@ class ClientStream(object):
         self.closed = True
 
     def write_meta(self, ts, data):
-        self.protocol.muxer.sendMessage(ts, chunks.MSG_DATA, self.id, data)
+        self._write(ts, chunks.MSG_DATA, data)
 
     def write_audio(self, ts, data):
-        self.protocol.muxer.sendMessage(ts, chunks.MSG_AUDIO, self.id, data)
+        self._write(ts, chunks.MSG_AUDIO, data)
 
     def write_video(self, ts, data):
-        self.protocol.muxer.sendMessage(ts, chunks.MSG_VIDEO, self.id, data)
+        self._write(ts, chunks.MSG_VIDEO, data)
+
+    ##
+    # writing with flow control: while the connection is congested the
+    # frames are queued, and if the queue grows beyond latency_target
+    # worth of media, dropped - non-key video first
+
+    def _write(self, ts, type_, data):
+        is_header, is_key = False, True
+        if type_ != chunks.MSG_DATA:
+            is_header, is_key = frame_info(type_, data)
+
+        if type_ == chunks.MSG_VIDEO and not is_header:
+            if self._skip_video:
+                if not is_key:
+                    self._dropped(1)
+                    return
+                self._skip_video = False
+
+        if self._write_paused or self._write_queue:
+            self._write_queue.append((ts, type_, data, is_header, is_key))
+            self._trim_queue()
+        else:
+            self.protocol.muxer.sendMessage(ts, type_, self.id, data)
+
+    def queued_latency(self):
+        """Return the span (in seconds) of the media held back, not
+        counting headers and meta data kept at the front.
+        """
+        q = self._write_queue
+        for f in q:
+            if not (f[3] or f[1] == chunks.MSG_DATA):
+                return (q[-1][0] - f[0]) / 1000.0
+        return 0.0
+
+    def write_stats(self):
+        return dict(queued=len(self._write_queue),
+                    latency=self.queued_latency(), dropped=self.dropped)
+
+    def _trim_queue(self):
+        if self.queued_latency() <= self.latency_target:
+            return
+
+        q = self._write_queue
+        count = len(q)
+
+        # non-key video first - the video can only restart with a
+        # keyframe then
+        q = deque(f for f in q
+                  if f[1] != chunks.MSG_VIDEO or f[3] or f[4])
+        self._write_queue = q
+        if len(q) < count:
+            self._skip_video = True
+
+        # then the oldest frames, if needed, except headers and meta
+        kept = []
+        while q and self.queued_latency() > self.latency_target:
+            f = q.popleft()
+            if f[3] or f[1] == chunks.MSG_DATA:
+                kept.append(f)
+        q.extendleft(reversed(kept))
+
+        self._dropped(count - len(q))
+
+    def _dropped(self, count):
+        if not count:
+            return
+        self.dropped += count
+        if log_flags.debug:
+            frame_log.debug('stream %r: dropped %d frames', self.id, count)
+        if IThrottledSource.providedBy(self._source):
+            self._source.frames_dropped(count, self.queued_latency())
+
+    def pause_writing(self):
+        self._write_paused = True
+        if not self._throttled:
+            self._throttled = True
+            if IThrottledSource.providedBy(self._source):
+                self._source.throttle()
+
+    def resume_writing(self):
+        self._write_paused = False
+        q = self._write_queue
+        send = self.protocol.muxer.sendMessage
+        while q and not self._write_paused:
+            ts, type_, data, _is_header, _is_key = q.popleft()
+            send(ts, type_, self.id, data)
+
+        if not q and not self._write_paused and self._throttled:
+            self._throttled = False
+            if IThrottledSource.providedBy(self._source):
+                self._source.unthrottle()
+
+    def _stop_writing(self):
+        if self.protocol:
+            self.protocol.remove_writing_stream(self)
+        self._write_queue.clear()
+        self._write_paused = False
+        self._skip_video = False
+        self._throttled = False
 
 
 class BaseClientApp(object):
@@ -458,6 +768,8 @@ class BaseClientApp(object):
 
 
 def connect_client_factory(url, factoryFactory, *args, **kwargs):
+    from twisted.internet import reactor
+
     connect_params = dict(fpad=False) # no proxy, direct tcp/rtmp connection
     scheme, host, port, app = parse_rtmp_url(url)
 
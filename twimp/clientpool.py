@@ -0,0 +1,256 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Pooled client connections: many publish/play streams sharing a single
+connection per (host, app), instead of connecting once per stream.
+"""
+
+from twisted.internet import defer
+
+from twimp import chunks
+from twimp.client import BaseClientApp, SimpleAppClientFactory
+from twimp.client import SimpleAppClientProtocol
+from twimp.error import ClientConnectError
+from twimp.urls import parse_rtmp_url
+
+LOG_CATEGORY = 'clientpool'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class PooledClientProtocol(SimpleAppClientProtocol):
+    # interleaving the chunks of the streams when congested
+    muxer_class = chunks.InterleavingMuxer
+
+
+class _PoolApp(BaseClientApp):
+    def __init__(self, protocol, conn):
+        BaseClientApp.__init__(self, protocol)
+        self.conn = conn
+
+    def connectionMade(self, info):
+        self.conn.app_connected(self)
+
+    def connectionLost(self, reason):
+        self.conn.lost(reason)
+
+    def connectionFailed(self, reason):
+        self.conn.lost(reason)
+
+
+class _PoolClientFactory(SimpleAppClientFactory):
+    protocol = PooledClientProtocol
+
+    def __init__(self, url, connect_params, conn):
+        SimpleAppClientFactory.__init__(self, url, connect_params,
+                                        _PoolApp, conn)
+        self.conn = conn
+
+    def clientConnectionFailed(self, connector, reason):
+        self.conn.lost(reason)
+
+    def clientConnectionLost(self, connector, reason):
+        self.conn.lost(reason)
+
+
+class _PooledConnection(object):
+    def __init__(self, pool, key, url):
+        self.pool = pool
+        self.key = key
+        self.url = url
+
+        self.app = None
+        self.closed = False
+        self._lost = False
+        # { stream => lost callback }
+        self.streams = {}
+        self._waiting = []
+        self._creating = 0
+        self._idle_call = None
+
+    def open_stream(self, lost_callback):
+        self._cancel_idle()
+
+        d = defer.Deferred()
+        if self.app is not None:
+            self._create(d, lost_callback)
+        else:
+            self._waiting.append((d, lost_callback))
+        return d
+
+    def _create(self, d, lost_callback):
+        def created(stream):
+            self._creating -= 1
+            if self.closed:
+                stream.close(force=True)
+                raise ClientConnectError('connection to %r lost' %
+                                         (self.url,))
+            self.streams[stream] = lost_callback
+            return stream
+
+        def failed(failure):
+            self._creating -= 1
+            self._check_idle()
+            return failure
+
+        self._creating += 1
+        cd = self.app.createStream()
+        cd.addCallbacks(created, failed)
+        cd.chainDeferred(d)
+
+    def close_stream(self, stream, force=False):
+        self.streams.pop(stream, None)
+        if self.app is not None and self.app.connected:
+            self.app.closeStream(stream, force)
+        elif not stream.closed:
+            stream.close(force=True)
+        self._check_idle()
+
+    def app_connected(self, app):
+        self.app = app
+        if self.closed:
+            app.disconnect()
+            return
+
+        waiting, self._waiting = self._waiting, []
+        for d, lost_callback in waiting:
+            self._create(d, lost_callback)
+        self._check_idle()
+
+    def _check_idle(self):
+        if (self.closed or self.streams or self._waiting or
+            self._creating or self._idle_call is not None):
+            return
+        self._idle_call = self.pool.reactor.callLater(self.pool.idle_timeout,
+                                                      self._idle)
+
+    def _cancel_idle(self):
+        if self._idle_call is not None:
+            if self._idle_call.active():
+                self._idle_call.cancel()
+            self._idle_call = None
+
+    def _idle(self):
+        self._idle_call = None
+        log.debug('connection to %r idle, closing', self.url)
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._cancel_idle()
+        self.pool._conn_closed(self)
+        if self.app is not None and self.app.connected:
+            self.app.disconnect()
+
+    def lost(self, reason):
+        if self._lost:
+            return
+        self._lost = True
+        if not self.closed:
+            log.info('connection to %r lost: %s', self.url,
+                     getattr(reason, 'value', reason))
+            self.close()
+        self.app = None
+
+        waiting, self._waiting = self._waiting, []
+        for d, _lost_callback in waiting:
+            d.errback(reason)
+
+        streams, self.streams = self.streams, {}
+        for stream, lost_callback in streams.items():
+            if not stream.closed:
+                stream.close(force=True)
+            if lost_callback:
+                lost_callback(reason)
+
+
+class ClientConnectionPool(object):
+    """Hands out client streams over shared connections, one per (host,
+    app), connecting on demand.
+
+    Connections without any streams get closed after idle_timeout
+    seconds.
+    """
+
+    idle_timeout = 30.0
+
+    def __init__(self, connect_params=None, idle_timeout=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+        if connect_params is None:
+            connect_params = dict(fpad=False)
+        self.connect_params = connect_params
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+
+        # _conns: { (scheme, host, port, app) => _PooledConnection }
+        self._conns = {}
+        # _streams: { stream => _PooledConnection }
+        self._streams = {}
+
+    def open_stream(self, url, lost_callback=None):
+        """Create a stream on the connection to url (of the form
+        rtmp://host[:port]/app), connecting first if needed.
+
+        @param lost_callback: called with the reason if the connection
+                              gets lost while the stream is open
+
+        @return: a Deferred firing with the ClientStream
+        """
+        key = parse_rtmp_url(url)
+        conn = self._conns.get(key)
+        if conn is None:
+            log.debug('connecting to %r', url)
+            conn = self._conns[key] = _PooledConnection(self, key, url)
+            self.connect(url, conn)
+
+        def opened(stream):
+            self._streams[stream] = conn
+            return stream
+
+        d = conn.open_stream(lost_callback)
+        d.addCallback(opened)
+        return d
+
+    def connect(self, url, conn):
+        scheme, host, port, app = parse_rtmp_url(url)
+        factory = _PoolClientFactory(url, self.connect_params, conn)
+        self.reactor.connectTCP(host, port, factory)
+
+    def close_stream(self, stream, force=False):
+        """Close (and delete) a stream opened with open_stream()."""
+        conn = self._streams.pop(stream, None)
+        if conn is not None:
+            conn.close_stream(stream, force)
+
+    def _conn_closed(self, conn):
+        if self._conns.get(conn.key) is conn:
+            del self._conns[conn.key]
+        for stream, c in self._streams.items():
+            if c is conn:
+                del self._streams[stream]
+
+    def connections(self):
+        """Return the number of connections open (or opening)."""
+        return len(self._conns)
+
+    def close(self):
+        """Close all the connections."""
+        for conn in self._conns.values():
+            conn.close()
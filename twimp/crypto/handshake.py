@@ -15,7 +15,6 @@
 
 from hashlib import sha256
 import hmac
-import random
 import struct
 
 from twimp.handshake import Handshaker
@@ -28,10 +27,6 @@ import twimp.log
 log = twimp.log.get_logger(LOG_CATEGORY)
 
 
-def _hmac(key, msg, digestmod=sha256):
-    return hmac.new(key, msg, digestmod).digest()
-
-
 # most constants defined in this module were caught floating around
 # the net...
 _shared_key_suffix = ('f0eec24a8068bee82e00d0d1029e7e57'
@@ -43,6 +38,21 @@ _full_fms_key = _fms_key + _shared_key_suffix
 _fp_key = 'Genuine Adobe Flash Player 001'
 _full_fp_key = _fp_key + _shared_key_suffix
 
+# HMAC states with the static keys already processed, to be copied
+_prepared_hmacs = dict((key, hmac.new(key, digestmod=sha256))
+                       for key in (_fms_key, _full_fms_key,
+                                   _fp_key, _full_fp_key))
+
+def _hmac(key, *parts):
+    h = _prepared_hmacs.get(key)
+    if h is None:
+        h = hmac.new(key, digestmod=sha256)
+    else:
+        h = h.copy()
+    for part in parts:
+        h.update(part)
+    return h.digest()
+
 
 def _make_offset_extractor(pos, count, mod, shift):
     return (lambda data: sum(map(ord, data[pos:pos+count])) % mod + shift)
@@ -74,12 +84,6 @@ NO_VERSION = (0, 0, 0, 0)
 
 _s_ts_ver = struct.Struct('>LBBBB')
 
-def generate_random_bytes(count):
-    n = random.getrandbits(count * 8)
-    fmt = '%%0%dx' % (count * 2)
-    return (fmt % n).decode('hex')
-
-
 class CryptoHandshaker(Handshaker):
     server_compat_version = DEFAULT_SERVER_COMPAT_VERSION
     client_compat_version = DEFAULT_CLIENT_COMPAT_VERSION
@@ -138,7 +142,7 @@ class CryptoHandshaker(Handshaker):
 
         # calculate digest
         key = self.select_other_key_short() # assuming we're the server
-        digest = _hmac(key, data[:offset] + data[offset+32:])
+        digest = _hmac(key, buffer(data, 0, offset), buffer(data, offset + 32))
 
         return buffer(data, offset, 32) == buffer(digest)
 
@@ -186,7 +190,7 @@ class CryptoHandshaker(Handshaker):
     def generate_base_request(self):
         return (_s_ts_ver.pack(ms_time(self.epoch_time()),
                                *self.compat_version) +
-                generate_random_bytes(self.packet_bytes - 8))
+                self.random_padding(self.packet_bytes - 8))
 
     def generate_request(self, context=None):
         base_request = self.generate_base_request()
@@ -231,7 +235,7 @@ class CryptoHandshaker(Handshaker):
         digest_key = _hmac(key, req_digest)
 
         # prepare response
-        response = generate_random_bytes(self.packet_bytes - 32)
+        response = self.random_padding(self.packet_bytes - 32)
 
         # calculate response digest and append it to the response
         digest = _hmac(digest_key, response)
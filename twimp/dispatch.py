@@ -18,7 +18,7 @@ import logging
 import time
 
 from twisted.internet import protocol
-from twisted.internet import defer, reactor
+from twisted.internet import defer
 from twisted.python import failure
 
 from twimp import amf0
@@ -33,13 +33,16 @@ from twimp.utils import ms_time_wrapped
 LOG_CATEGORY = 'dispatch'
 import twimp.log
 log = twimp.log.get_logger(LOG_CATEGORY)
+log_flags = twimp.log.get_flags(LOG_CATEGORY)
 
 
 # defer.Deferred.debug = 1
 
 
 class CancellableCallQueue(object):
-    def __init__(self, reactor=reactor):
+    def __init__(self, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
         self.reactor = reactor
         self.pending = {}
         self._next_key = 0
@@ -323,7 +326,8 @@ class CallDispatchProtocol(EventDispatchProtocol):
         log.debug('remote call aborted: %s', failure.value)
 
     def _remote_handler_cb(self, result, ms_id, trans_id):
-        # log.debug('remote call result: %r', result)
+        if log_flags.debug:
+            log.debug('remote call result: %r', result)
         if not isinstance(result, (tuple, list)):
             result = (result,)
 
@@ -0,0 +1,145 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Random bytes for the handshake padding, handed out in slices of a
+large pre-generated pool.
+"""
+
+import os
+import threading
+
+from twisted.python import threadable
+
+from twimp.utils import run_in_thread
+
+LOG_CATEGORY = 'entropy'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class EntropyPool(object):
+    """A pool of size bytes from os.urandom(), handed out in slices.
+
+    Once less than low_water bytes remain the next pool gets read in a
+    thread (of threadpool, or of the reactor if None), while the
+    current one keeps being used up, or right away if it runs out
+    before that. Safe to use from other threads, too.
+    """
+
+    size = 256 * 1024
+    low_water = 64 * 1024
+
+    def __init__(self, size=None, threadpool=None, reactor=None):
+        # resolved only when needed, not to install the default
+        # reactor at import time
+        self._reactor = reactor
+        self.threadpool = threadpool
+        if size is not None:
+            self.size = size
+            self.low_water = min(self.low_water, size // 4)
+
+        self._lock = threading.Lock()
+        self._pool = ''
+        self._pos = 0
+        # the next pool, once read
+        self._spare = None
+        self._refilling = None
+        # { count => block }
+        self._shared = {}
+
+        self.refills = 0
+
+    def _get_reactor(self):
+        if self._reactor is None:
+            from twisted.internet import reactor
+            self._reactor = reactor
+        return self._reactor
+
+    def available(self):
+        """Return the number of bytes left in the pool."""
+        return len(self._pool) - self._pos
+
+    def refill(self):
+        self._lock.acquire()
+        try:
+            self._fill()
+        finally:
+            self._lock.release()
+
+    def _fill(self):
+        self._pool = os.urandom(self.size)
+        self._pos = 0
+        self.refills += 1
+
+    def _schedule_refill(self):
+        if self._refilling is None:
+            d = self._refilling = run_in_thread(self._get_reactor(),
+                                                self.threadpool,
+                                                os.urandom, self.size)
+            d.addCallbacks(self._refilled, self._refill_failed)
+
+    def _refilled(self, data):
+        self._refilling = None
+        self._lock.acquire()
+        try:
+            self._spare = data
+        finally:
+            self._lock.release()
+
+    def _refill_failed(self, failure):
+        self._refilling = None
+        log.warning("couldn't refill the entropy pool: %s",
+                    failure.getErrorMessage())
+
+    def get(self, count):
+        """Return count random bytes, not handed out before."""
+        if count > self.size:
+            return os.urandom(count)
+
+        self._lock.acquire()
+        try:
+            pos = self._pos
+            if pos + count > len(self._pool):
+                if self._spare is not None:
+                    self._pool, self._spare = self._spare, None
+                    self.refills += 1
+                else:
+                    if self._pool:
+                        log.debug('entropy pool exhausted, refilling now')
+                    self._fill()
+                pos = 0
+
+            end = self._pos = pos + count
+            data = self._pool[pos:end]
+            low = (self._spare is None and
+                   len(self._pool) - end < self.low_water)
+        finally:
+            self._lock.release()
+
+        if low and threadable.isInIOThread():
+            # (other threads leave it to the reactor thread)
+            self._schedule_refill()
+        return data
+
+    def shared(self, count):
+        """Return count random bytes, the same every time (for the
+        given count)."""
+        block = self._shared.get(count)
+        if block is None:
+            block = self._shared.setdefault(count, self.get(count))
+        return block
+
+
+pool = EntropyPool()
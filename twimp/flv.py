@@ -0,0 +1,200 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+import struct
+
+from twimp import amf0
+from twimp import chunks
+from twimp.primitives import _s_ulong_b
+from twimp.vecbuf import flatten
+
+LOG_CATEGORY = 'flv'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class FLVError(ValueError):
+    pass
+
+
+TAG_AUDIO = 0x08
+TAG_VIDEO = 0x09
+TAG_DATA = 0x12
+
+FLAG_AUDIO = 0x04
+FLAG_VIDEO = 0x01
+
+FILE_HEADER_SIZE = 9 + 4        # header + PreviousTagSize0
+TAG_HEADER_SIZE = 11
+TAG_TRAILER_SIZE = 4
+
+msg_to_tag_types = {
+    chunks.MSG_AUDIO: TAG_AUDIO,
+    chunks.MSG_VIDEO: TAG_VIDEO,
+    chunks.MSG_DATA: TAG_DATA,
+    }
+
+tag_to_msg_types = dict((v, k) for (k, v) in msg_to_tag_types.items())
+
+
+# signature, version, flags, header size, PreviousTagSize0
+_s_file_header = struct.Struct('>3sBBLL')
+
+# type, 24-bit data size split into 2+1 bytes, 24-bit timestamp split
+# into 2+1 bytes, timestamp extension byte, 24-bit stream id (always 0)
+# split into 2+1 bytes
+_s_tag_header = struct.Struct('>BHBHBBHB')
+
+
+def encode_file_header(audio=True, video=True, version=1):
+    flags = (FLAG_AUDIO if audio else 0) | (FLAG_VIDEO if video else 0)
+    return _s_file_header.pack('FLV', version, flags, 9, 0)
+
+def decode_file_header(data, offset=0):
+    """Parse the FLV file header.
+
+    @return: (version, flags, offset of the first tag header)
+    """
+    if len(data) - offset < FILE_HEADER_SIZE:
+        raise FLVError('not enough data for FLV header')
+
+    sig, version, flags, size, _prev = _s_file_header.unpack_from(data,
+                                                                  offset)
+    if sig != 'FLV':
+        raise FLVError('not an FLV file')
+    if size < 9:
+        raise FLVError('invalid FLV header size: %d' % (size,))
+
+    return version, flags, offset + size + 4
+
+def encode_tag_header(type_, ts, size):
+    return _s_tag_header.pack(type_, (size >> 8) & 0xffff, size & 0xff,
+                              (ts >> 8) & 0xffff, ts & 0xff,
+                              (ts >> 24) & 0xff, 0, 0)
+
+def decode_tag_header(data, offset=0):
+    """Parse an FLV tag header.
+
+    @return: (tag type, data size, timestamp)
+    """
+    (type_, size_1, size_2, ts_1, ts_2, ts_ext,
+     _sid_1, _sid_2) = _s_tag_header.unpack_from(data, offset)
+
+    return (type_ & 0x1f, (size_1 << 8) | size_2,
+            (ts_ext << 24) | (ts_1 << 8) | ts_2)
+
+def encode_tag_trailer(size):
+    """Return the PreviousTagSize field for a tag with size bytes of data.
+    """
+    return _s_ulong_b.pack(TAG_HEADER_SIZE + size)
+
+def encode_tag(type_, ts, data):
+    """Serialize a complete tag, header to trailer, as a list of
+    strings and/or buffers.
+
+    @type data: str or VecBuf
+    """
+    if isinstance(data, (str, buffer)):
+        size, seq = len(data), [data]
+    else:
+        size = len(data)
+        seq = data.peek_seq(size)
+
+    return ([encode_tag_header(type_, ts, size)] + seq +
+            [encode_tag_trailer(size)])
+
+
+# metadata key used to fill space reserved for metadata in a file
+META_PADDING_KEY = 'padding'
+
+def encode_meta(meta, size=None):
+    """Encode onMetaData script tag data, padded to exactly size bytes
+    if given.
+
+    @return: the encoded data, or None if it doesn't fit in size
+    """
+    meta = dict(meta)
+    if size is not None:
+        meta[META_PADDING_KEY] = ''
+    vb = amf0.encode('onMetaData', meta)
+    data = flatten(vb.read_seq(len(vb)))
+    if size is None:
+        return data
+
+    pad = size - len(data)
+    if pad < 0:
+        return None
+    meta[META_PADDING_KEY] = ' ' * pad
+    vb = amf0.encode('onMetaData', meta)
+    return flatten(vb.read_seq(len(vb)))
+
+
+def is_video_keyframe(first_byte):
+    return (first_byte >> 4) == 1
+
+def is_sequence_header(type_, data, offset=0):
+    """Check whether tag data holds a sequence header (AAC audio config
+    or AVC decoder configuration record).
+    """
+    if len(data) - offset < 2:
+        return False
+
+    b0, b1 = ord(data[offset]), ord(data[offset + 1])
+    if type_ == TAG_VIDEO:
+        return b0 & 0x0f == 7 and b0 >> 4 == 1 and b1 == 0
+    elif type_ == TAG_AUDIO:
+        return b0 >> 4 == 10 and b1 == 0
+    return False
+
+
+def scan_tags(f, block_size=1024 * 1024, head_size=2):
+    """Scan an FLV file, in large sequential reads, picking up tag
+    headers only.
+
+    Yields (tag offset, type, ts, data offset, data size, head) per
+    tag, head being the first head_size bytes of the data (by default
+    enough to tell frame types apart). Stops at the first truncated
+    tag. Tag data can be read from f between iterations.
+    """
+    file_size = os.fstat(f.fileno()).st_size
+
+    f.seek(0)
+    buf, buf_start = f.read(block_size), 0
+    _version, _flags, pos = decode_file_header(buf)
+
+    need = TAG_HEADER_SIZE + head_size
+
+    while pos + TAG_HEADER_SIZE <= file_size:
+        if pos + need > buf_start + len(buf):
+            f.seek(pos)
+            buf, buf_start = f.read(block_size), pos
+
+        i = pos - buf_start
+        type_, size, ts = decode_tag_header(buf, i)
+        offset = pos + TAG_HEADER_SIZE
+        if offset + size > file_size:
+            log.warning('%r: truncated tag at %d', f.name, pos)
+            break
+
+        i += TAG_HEADER_SIZE
+        yield pos, type_, ts, offset, size, buf[i:i + min(size, head_size)]
+        pos = offset + size + TAG_TRAILER_SIZE
+
+
+__all__ = ['FLVError', 'TAG_AUDIO', 'TAG_VIDEO', 'TAG_DATA',
+           'encode_file_header', 'decode_file_header',
+           'encode_tag_header', 'decode_tag_header', 'encode_tag_trailer',
+           'encode_tag', 'encode_meta', 'scan_tags']
@@ -13,29 +13,116 @@
 #   limitations under the License.
 
 
-import random
+from collections import deque
 import struct
 import time
 
+from twisted.internet import defer, threads
 from twisted.internet.error import ConnectError
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
 
+from entropy import pool as entropy_pool
 from primitives import _s_uchar
 from primitives import _s_ulong_b as _s_ulong
 from utils import ms_time
 
+LOG_CATEGORY = 'handshake'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
 
 _s_ts_simpver = struct.Struct('>LL')
 
 def generate_random_bytes(count):
-    n = random.getrandbits(count * 8)
-    fmt = '%%0%dx' % (count * 2)
-    return (fmt % n).decode('hex')
+    return entropy_pool.get(count)
 
 
 class HandshakeFailedError(ConnectError):
     """Handshake failed"""
 
 
+class HandshakeWorkers(object):
+    """Runs the handshake computations in a pool of threads, off the
+    reactor thread, with at most max_in_flight of them submitted at
+    once - the rest wait in a queue (and get dropped from it when their
+    connections go away first).
+    """
+
+    threads = 4
+    max_in_flight = 32
+
+    def __init__(self, threads=None, max_in_flight=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+        if threads is not None:
+            self.threads = threads
+        if max_in_flight is not None:
+            self.max_in_flight = max_in_flight
+
+        self.threadpool = ThreadPool(1, self.threads, name='twimp-handshake')
+        self._shutdown_id = None
+        # (deferred, f, args)
+        self._queue = deque()
+        self.in_flight = 0
+
+    def queued(self):
+        """Return the number of computations waiting for a thread."""
+        return len(self._queue)
+
+    def run(self, f, *args):
+        """Call f(*args) in one of the threads.
+
+        @return: a Deferred firing with the result
+        """
+        d = defer.Deferred(self._cancel)
+        self._queue.append((d, f, args))
+        self._next()
+        return d
+
+    def _cancel(self, d):
+        for job in self._queue:
+            if job[0] is d:
+                self._queue.remove(job)
+                break
+
+    def _next(self):
+        queue = self._queue
+        while queue and self.in_flight < self.max_in_flight:
+            d, f, args = queue.popleft()
+            self.in_flight += 1
+            self.start()
+            td = threads.deferToThreadPool(self.reactor, self.threadpool,
+                                           f, *args)
+            td.addBoth(self._done, d)
+
+    def _done(self, result, d):
+        self.in_flight -= 1
+        if not d.called:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        self._next()
+
+    def start(self):
+        if self._shutdown_id is None:
+            self.threadpool.start()
+            self._shutdown_id = self.reactor.addSystemEventTrigger(
+                'during', 'shutdown', self._stop)
+
+    def _stop(self):
+        self._shutdown_id = None
+        self.threadpool.stop()
+
+    def stop(self):
+        if self._shutdown_id is not None:
+            self.reactor.removeSystemEventTrigger(self._shutdown_id)
+            self._stop()
+
+
 class Handshaker(object):
     """The handshake protocol.
 
@@ -52,6 +139,14 @@ class Handshaker(object):
     packet_bytes = 1536
     protocol_version = 3
 
+    # the padding is only echoed back (or digested), no secrets derived
+    # from it - the same random bytes can be sent in every handshake
+    reuse_padding = False
+
+    # a HandshakeWorkers instance, for running the (crypto) computations
+    # off the reactor thread
+    workers = None
+
     def __init__(self, protocol, epoch_base, is_client=False):
         self.epoch = epoch_base
         self.version_packet = _s_uchar.pack(self.protocol_version)
@@ -68,12 +163,28 @@ class Handshaker(object):
         raise HandshakeFailedError(string=msg)
 
 
+    def compute(self, f, *args):
+        """Return f(*args), or a Deferred firing with it when run by the
+        workers."""
+        if self.workers is None:
+            return f(*args)
+        return self.workers.run(f, *args)
+
+    def generate_server_packets(self, request):
+        return (self.generate_request(context=request),
+                self.generate_response(request))
+
     def version_supported(self, version):
         return version == self.protocol_version
 
+    def random_padding(self, count):
+        if self.reuse_padding:
+            return entropy_pool.shared(count)
+        return entropy_pool.get(count)
+
     def generate_request(self, context=None):
         return (_s_ts_simpver.pack(ms_time(self.epoch_time()), 0) +
-                generate_random_bytes(self.packet_bytes - 8))
+                self.random_padding(self.packet_bytes - 8))
 
     def generate_response(self, request):
         return (buffer(request, 0, 4) +
@@ -105,12 +216,19 @@ class Handshaker(object):
 
         hs_other = s.read(self.packet_bytes)
 
-        if not self.is_client:
+        if self.is_client:
+            response = self.compute(self.generate_response, hs_other)
+            if isinstance(response, defer.Deferred):
+                response = yield response
+        else:
+            packets = self.compute(self.generate_server_packets, hs_other)
+            if isinstance(packets, defer.Deferred):
+                packets = yield packets
+            hs_mine, response = packets
             ts_init = time.time()
-            hs_mine = self.generate_request(context=hs_other)
             p.transport.writeSequence((self.version_packet, hs_mine))
 
-        p.transport.write(self.generate_response(hs_other))
+        p.transport.write(response)
 
         # and now, the handshake response
         s = yield self.packet_bytes
@@ -118,7 +236,10 @@ class Handshaker(object):
         hs_response = buffer(s.read(self.packet_bytes))
         ts_received_back = time.time()
 
-        if not self.verify_response(hs_mine, hs_response):
+        verified = self.compute(self.verify_response, hs_mine, hs_response)
+        if isinstance(verified, defer.Deferred):
+            verified = yield verified
+        if not verified:
             self.defaultHandshakeFailed('response verification failed')
             return
 
@@ -17,6 +17,8 @@ import math
 
 from twisted.internet import error
 
+from twimp import chunks
+from twimp.primitives import _s_uchar, _s_double_uchar
 from twimp.vecbuf import VecBuf
 
 
@@ -50,6 +52,26 @@ def vb_clone(vb):
     # TODO: add this functionality to the vecbuf/VecBuf itself
     return VecBuf(vb.peek_seq(len(vb)))
 
+def frame_info(type_, data):
+    """Return (is_header, is_keyframe) for an audio or video message."""
+    bytes = len(data)
+    if bytes < 1:
+        return False, False
+
+    if bytes > 1:
+        first, second = _s_double_uchar.unpack(data.peek(2))
+    else:
+        first, second = _s_uchar.unpack(data.peek(1))[0], None
+
+    if type_ == chunks.MSG_VIDEO:
+        frame_type, codec_id = first >> 4, first & 0x0f
+        if codec_id == 7 and second == 0:
+            return True, False
+        return False, frame_type == 1
+
+    # audio: there are headers only for AAC, all frames are "keyframes"
+    return (first >> 4) == 10 and second == 0, True
+
 
 ##
 # note: the following mixins shold be used carefully, or not at all
@@ -26,7 +26,7 @@ class IClientStream(Interface):
     def set_chunk_size(size):
         pass
 
-    def play(self, sink):
+    def play(name, sink, start=-2, jitter=None):
         pass
 
     def stop_publishing():
@@ -62,6 +62,33 @@ class IMediaSource(Interface):
         pass
 
 
+class IThrottledSource(IMediaSource):
+    # the connection can't keep up, slow down if possible
+    def throttle():
+        pass
+
+    def unthrottle():
+        pass
+
+    # frames written by the source got dropped, latency in seconds
+    def frames_dropped(count, latency):
+        pass
+
+
+class IMediaSink(Interface):
+    def connect(stream):
+        pass
+
+    def disconnect():
+        pass
+
+    def start():
+        pass
+
+    def stop():
+        pass
+
+
 class IClientApp(Interface):
     ##
     # event notification, "entry points" for custom apps
@@ -108,6 +135,26 @@ class IBaseFactory(Interface):
         'Time reference point for all connections made by this factory. '
         'A float, in seconds, as in time.time().')
 
+    handshake_workers = Attribute(
+        'A twimp.handshake.HandshakeWorkers instance, for running the '
+        'handshakes of the connections off the reactor thread, or None.')
+
+    admission = Attribute(
+        'A twimp.server.admission.AdmissionControl instance, deciding '
+        'which new connections to accept, or None.')
+
+    timeouts = Attribute(
+        'A twimp.timeouts.ConnectionTimeouts instance, for closing the '
+        'connections stalled in any phase, or None.')
+
+    metrics = Attribute(
+        'A twimp.metrics.MetricsRegistry instance, collecting the '
+        'counters of the connections and streams, or None.')
+
+    capture = Attribute(
+        'A twimp.capture.SessionCapturer instance, capturing the data '
+        'of (some of) the connections into files, or None.')
+
 
 class IAppClientFactory(IBaseFactory):
     def get_connect_params():
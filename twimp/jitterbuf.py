@@ -0,0 +1,184 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Receive-side buffering of played streams, smoothing out the delivery
+of the messages (re-timed on their timestamps).
+"""
+
+import heapq
+
+from twimp import chunks
+from twimp.helpers import frame_info
+
+LOG_CATEGORY = 'jitterbuf'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class JitterBuffer(object):
+    """A bounded buffer of (ts, type_, data) messages, delivering them
+    to the output delay seconds later than the first one arrived,
+    spaced out according to their timestamps.
+
+    When more than max_frames messages are held the buffer drops
+    everything up to the next video keyframe (or up to the next
+    keyframe received, if none is held), catching up on the delivery.
+    Headers are never dropped.
+    """
+
+    def __init__(self, delay=0.5, max_frames=500, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+        self.delay = delay
+        self.max_frames = max_frames
+
+        self._output = None
+        # a heap of (ts, seq, type_, data, is_header, is_key)
+        self._frames = []
+        self._seq = 0
+        self._base = None
+        # { type_ => ts of the last frame delivered }
+        self._last_ts = {}
+        self._call = None
+        self._has_video = False
+        self._skip_video = False
+
+        self.late = 0
+        self.dropped = 0
+        self.delivered = 0
+
+    def set_output(self, callback):
+        self._output = callback
+
+    def stats(self):
+        """Return the buffer occupancy (frames, and the time span in ms
+        of the frames held) and counters of frames delivered, late and
+        dropped.
+        """
+        frames = self._frames
+        span = 0
+        if frames:
+            span = max(frames)[0] - frames[0][0]
+        return dict(frames=len(frames), span=span, delivered=self.delivered,
+                    late=self.late, dropped=self.dropped)
+
+    def _deadline(self, ts):
+        base_ts, base_time = self._base
+        return base_time + (ts - base_ts) / 1000.0 + self.delay
+
+    def push(self, ts, type_, data):
+        now = self.reactor.seconds()
+        is_header, is_key = frame_info(type_, data)
+
+        if type_ == chunks.MSG_VIDEO and not is_header:
+            self._has_video = True
+            if self._skip_video:
+                if not is_key:
+                    self.dropped += 1
+                    return
+                # restarting after an overflow, due now
+                self._skip_video = False
+                self._base = (ts, now - self.delay)
+
+        if self._base is None:
+            self._base = (ts, now)
+
+        last_ts = self._last_ts.get(type_)
+        if not is_header and last_ts is not None and ts < last_ts:
+            # behind what's already been delivered (of the same type,
+            # audio and video may be interleaved loosely), too late
+            self.late += 1
+            self.dropped += 1
+            return
+
+        if self._deadline(ts) < now:
+            self.late += 1
+
+        self._seq += 1
+        heapq.heappush(self._frames, (ts, self._seq, type_, data,
+                                      is_header, is_key))
+
+        if len(self._frames) > self.max_frames:
+            self._overflow(now)
+
+        self._schedule(now)
+
+    def _overflow(self, now):
+        frames = sorted(self._frames)
+        keep = []
+        head = True
+        for i, f in enumerate(frames):
+            if f[4]:
+                keep.append(f)
+                continue
+            if not head and f[5] and (f[2] == chunks.MSG_VIDEO or
+                                      not self._has_video):
+                rest = frames[i:]
+                break
+            head = False
+        else:
+            # no keyframe to restart with, yet
+            rest = []
+            if self._has_video:
+                self._skip_video = True
+
+        dropped = len(frames) - len(rest) - len(keep)
+        self.dropped += dropped
+        log.debug('jitter buffer overflow, dropped %d frames', dropped)
+
+        # sorted, so a heap already
+        self._frames = keep + rest
+        if rest or keep:
+            # catching up: the (re)start frames are due now
+            self._base = ((rest or keep)[0][0], now - self.delay)
+        else:
+            self._base = None
+
+    def _schedule(self, now):
+        if not self._frames:
+            return
+
+        when = max(0, self._deadline(self._frames[0][0]) - now)
+        if self._call is not None:
+            if self._call.getTime() <= now + when:
+                return
+            self._call.cancel()
+        self._call = self.reactor.callLater(when, self._deliver)
+
+    def _deliver(self):
+        self._call = None
+        now = self.reactor.seconds()
+        frames = self._frames
+
+        while frames and self._deadline(frames[0][0]) <= now:
+            ts, _seq, type_, data, is_header, is_key = heapq.heappop(frames)
+            if not is_header:
+                self._last_ts[type_] = ts
+            self.delivered += 1
+            if self._output:
+                self._output(ts, type_, data)
+
+        self._schedule(now)
+
+    def stop(self):
+        """Cancel the delivery, and drop any frames held."""
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        self._frames = []
+        self._base = None
+        self._last_ts = {}
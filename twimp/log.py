@@ -14,6 +14,7 @@
 
 
 import logging
+import time
 
 
 LOG_CATEGORY = 'twimp'
@@ -24,6 +25,8 @@ TWISTED_CATEGORY = '%s.twisted' % LOG_CATEGORY
 LOG_ENV_VAR = 'TWIMP_DEBUG'
 
 _logger = None
+# { category => LevelFlags }
+_flags = {}
 
 
 def _ensure_main_logger():
@@ -55,6 +58,99 @@ def get_logger(subname=None):
     return logger
 
 
+class LevelFlags(object):
+    """Cached flags telling whether a logger is enabled for the levels
+    of interest, for the hot paths to check before doing any logging
+    work at all:
+
+        if log_flags.debug:
+            log.debug('frame: %d bytes', len(data))
+
+    The flags get updated by set_levels() (and by update_flags(), to
+    be called after setting the levels any other way).
+    """
+
+    __slots__ = ('logger', 'debug', 'info')
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.update()
+
+    def update(self):
+        self.debug = self.logger.isEnabledFor(logging.DEBUG)
+        self.info = self.logger.isEnabledFor(logging.INFO)
+
+
+def get_flags(subname=None):
+    """Return the LevelFlags of the logger get_logger(subname)."""
+    flags = _flags.get(subname)
+    if flags is None:
+        flags = _flags[subname] = LevelFlags(get_logger(subname))
+    return flags
+
+
+def update_flags():
+    for flags in _flags.values():
+        flags.update()
+
+
+class RateLimitedLogger(object):
+    """Passes at most rate messages per second (in bursts of up to
+    burst) on to logger, for logging per-frame events: the messages
+    over the limit are only counted, and the count gets appended to
+    the next message passed.
+    """
+
+    rate = 1.0
+    burst = 10
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, logger, rate=None, burst=None):
+        self.logger = logger
+        if rate is not None:
+            self.rate = rate
+        if burst is not None:
+            self.burst = burst
+
+        self._tokens = self.burst
+        self._time = None
+        self.suppressed = 0
+
+    def log(self, level, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+
+        now = self.clock()
+        tokens = self._tokens
+        if self._time is not None:
+            tokens = min(self.burst, tokens + (now - self._time) * self.rate)
+        self._time = now
+        if tokens < 1:
+            self._tokens = tokens
+            self.suppressed += 1
+            return
+        self._tokens = tokens - 1
+
+        if self.suppressed:
+            msg += ' (%d similar messages suppressed)'
+            args += (self.suppressed,)
+            self.suppressed = 0
+        self.logger.log(level, msg, *args)
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(logging.ERROR, msg, *args)
+
+
 labels_to_levels = {
     'all': 1,
     'debug': logging.DEBUG,
@@ -88,6 +184,7 @@ def set_levels(levels_string):
         cat, level = _parse_level(s)
         logger = get_logger(cat)
         logger.setLevel(level)
+    update_flags()
 
 
 def set_levels_from_env(varname=LOG_ENV_VAR):
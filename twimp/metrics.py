@@ -0,0 +1,234 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Counters of the connections and of the streams played/published over
+them, for monitoring a server.
+
+The counting itself is left to the protocols, muxers, demuxers and
+controllers (plain integer fields), the registry only keeps track of
+them and reads them when asked for a snapshot.
+"""
+
+import time
+
+from twimp import const
+
+LOG_CATEGORY = 'metrics'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+# { RTMP message type => name }
+type_names = dict((getattr(const, n), n[len('RTMP_'):].lower())
+                  for n in dir(const) if n.startswith('RTMP_'))
+
+
+def _by_type(counts):
+    return dict((type_names.get(t, str(t)), c)
+                for t, c in enumerate(counts) if c)
+
+
+class SessionMetrics(object):
+    """Counters of a single stream played or published (kind) over a
+    connection."""
+
+    __slots__ = ('kind', 'name', 'protocol', 'registry', 'started',
+                 'first_frame', 'frames', 'bytes', 'dropped')
+
+    def __init__(self, kind, name, protocol, registry=None):
+        self.kind = kind
+        self.name = name
+        self.protocol = protocol
+        self.registry = registry
+
+        self.started = time.time()
+        # seconds from starting to the first frame
+        self.first_frame = None
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    def count_frame(self, size):
+        if self.first_frame is None:
+            self.first_frame = time.time() - self.started
+        self.frames += 1
+        self.bytes += size
+
+    def close(self):
+        if self.registry is not None:
+            self.registry.session_closed(self)
+            self.registry = None
+
+    def snapshot(self):
+        return dict(kind=self.kind, name=self.name, frames=self.frames,
+                    bytes=self.bytes, dropped=self.dropped,
+                    time_to_first_frame=self.first_frame)
+
+
+class MetricsRegistry(object):
+    """Keeps track of the connections of a factory (see
+    BaseFactory.metrics) and of their sessions (streams played and
+    published), summing up their counters per connection, per stream
+    and in total.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        # { protocol => [SessionMetrics, ...] }
+        self._conns = {}
+
+        # the counters of the connections and sessions closed
+        self.closed = dict(connections=0, sessions=0, bytes_in=0,
+                           bytes_out=0, messages_in=0, messages_out=0,
+                           frames=0, dropped=0)
+
+    def connection_opened(self, protocol):
+        self._conns[protocol] = []
+
+    def connection_closed(self, protocol):
+        sessions = self._conns.pop(protocol, None)
+        if sessions is None:
+            return
+        for s in list(sessions):
+            s.close()
+
+        c = self._conn_counters(protocol)
+        closed = self.closed
+        closed['connections'] += 1
+        for key in ('bytes_in', 'bytes_out', 'messages_in', 'messages_out'):
+            closed[key] += c[key]
+
+    def open_session(self, kind, name, protocol):
+        """Start counting a stream played ('play') or published
+        ('publish') as name over the connection of protocol.
+
+        @return: the SessionMetrics, to be closed when done
+        """
+        s = SessionMetrics(kind, name, protocol, self)
+        sessions = self._conns.get(protocol)
+        if sessions is not None:
+            sessions.append(s)
+        else:
+            # not tracking the connection, nothing to add it to
+            s.registry = None
+        return s
+
+    def session_closed(self, session):
+        sessions = self._conns.get(session.protocol)
+        if sessions is not None and session in sessions:
+            sessions.remove(session)
+        closed = self.closed
+        closed['sessions'] += 1
+        closed['frames'] += session.frames
+        closed['dropped'] += session.dropped
+
+    def connections(self):
+        """Return the number of connections open."""
+        return len(self._conns)
+
+    def _conn_counters(self, protocol):
+        c = dict(bytes_in=protocol.bytes_in, bytes_out=0, messages_in=0,
+                 messages_out=0, queued=0,
+                 handshake_time=getattr(protocol, 'handshake_time', None))
+        demuxer = getattr(protocol, '_demuxer', None)
+        if demuxer is not None:
+            c['messages_in'] = sum(demuxer.received_by_type)
+            c['by_type_in'] = _by_type(demuxer.received_by_type)
+        muxer = getattr(protocol, 'muxer', None)
+        if muxer is not None:
+            c['bytes_out'] = muxer.bytes_sent
+            c['messages_out'] = muxer.messages_sent
+            c['by_type_out'] = _by_type(muxer.sent_by_type)
+            c['queued'] = muxer.producer.queued()
+        return c
+
+    def snapshot(self):
+        """Return all the counters, as a dict of (JSON-able) values."""
+        now = time.time()
+        conns = []
+        streams = {}
+        total = dict(self.closed)
+        total['connections'] += len(self._conns)
+
+        for protocol, sessions in self._conns.items():
+            c = self._conn_counters(protocol)
+            peer = protocol.transport and protocol.transport.getPeer()
+            c['peer'] = getattr(peer, 'host', None)
+            c['age'] = now - (getattr(protocol, 'connected_at', None) or now)
+            c['sessions'] = [s.snapshot() for s in sessions]
+            conns.append(c)
+
+            for key in ('bytes_in', 'bytes_out', 'messages_in',
+                        'messages_out'):
+                total[key] += c[key]
+
+            for s in sessions:
+                total['sessions'] += 1
+                total['frames'] += s.frames
+                total['dropped'] += s.dropped
+
+                st = streams.get(s.name)
+                if st is None:
+                    st = streams[s.name] = dict(publishers=0, players=0,
+                                                frames_in=0, frames_out=0,
+                                                bytes_in=0, bytes_out=0,
+                                                dropped=0)
+                if s.kind == 'publish':
+                    st['publishers'] += 1
+                    st['frames_in'] += s.frames
+                    st['bytes_in'] += s.bytes
+                else:
+                    st['players'] += 1
+                    st['frames_out'] += s.frames
+                    st['bytes_out'] += s.bytes
+                st['dropped'] += s.dropped
+
+        return dict(uptime=now - self.started, total=total,
+                    connections=conns, streams=streams)
+
+    def prometheus(self, prefix='twimp_'):
+        """Return the counters in the Prometheus text format."""
+        snap = self.snapshot()
+        lines = []
+
+        def metric(name, type_, values):
+            name = prefix + name
+            lines.append('# TYPE %s %s' % (name, type_))
+            for labels, value in values:
+                if value is None:
+                    continue
+                if labels:
+                    labels = '{%s}' % ','.join('%s="%s"' % (k, _escape(v))
+                                               for k, v in labels)
+                lines.append('%s%s %s' % (name, labels or '', value))
+
+        total = snap['total']
+        metric('uptime_seconds', 'gauge', [((), snap['uptime'])])
+        metric('connections', 'gauge', [((), len(snap['connections']))])
+        for key in sorted(total):
+            metric(key + '_total', 'counter', [((), total[key])])
+
+        streams = sorted(snap['streams'].items())
+        for key in ('publishers', 'players', 'frames_in', 'frames_out',
+                    'bytes_in', 'bytes_out', 'dropped'):
+            metric('stream_' + key, 'gauge',
+                   [((('stream', name),), st[key]) for name, st in streams])
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
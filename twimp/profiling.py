@@ -0,0 +1,223 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Timing the hot paths (demuxing, dispatching, AMF decoding, command
+handlers, stream fan-out, muxing) into latency histograms.
+
+The probes are wrappers installed over the methods timed only while
+profiling is enabled - when it's not, the original methods run, at no
+cost at all.
+"""
+
+import math
+import sys
+import time
+
+from twisted.internet import defer
+
+LOG_CATEGORY = 'profiling'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class Histogram(object):
+    """Counts durations in fixed, log-scale buckets: subdivisions
+    buckets per doubling, from 1 microsecond up to about 2 minutes
+    (longer durations land in the last bucket).
+    """
+
+    subdivisions = 4
+    octaves = 28
+    unit = 1e-6
+
+    def __init__(self):
+        self.counts = [0] * (self.subdivisions * self.octaves)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+        # seconds / unit = m * 2 ** e, 0.5 <= m < 1
+        m, e = math.frexp(seconds / self.unit)
+        i = e * self.subdivisions + int((m - 0.5) * 2 * self.subdivisions)
+        if i < 0:
+            i = 0
+        elif i >= len(self.counts):
+            i = len(self.counts) - 1
+        self.counts[i] += 1
+
+    def bucket_limit(self, i):
+        """Return the upper limit of bucket i, in seconds."""
+        e, j = divmod(i, self.subdivisions)
+        m = 0.5 + 0.5 * (j + 1) / self.subdivisions
+        return math.ldexp(m, e) * self.unit
+
+    def percentile(self, p):
+        """Return the (upper limit of the bucket of the) duration p
+        percent of the recorded ones don't exceed, or None if nothing
+        was recorded."""
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        last = len(self.counts) - 1
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                if i == last:
+                    break
+                return min(self.bucket_limit(i), self.max)
+        return self.max
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        s = dict(count=self.count, max=self.max,
+                 mean=self.count and self.total / self.count or None)
+        for p in percentiles:
+            s['p%s' % (p,)] = self.percentile(p)
+        return s
+
+
+# the default probes: (module, class or None, attribute, histogram
+# name, timing the Deferred returned); an attribute ending in '*'
+# selects all the methods (of the class) with that prefix, and the
+# histogram name gets the rest of the method name filled in
+default_probes = [
+    ('twimp.utils', 'GeneratorWrapperProtocol', 'dataReceived',
+     'protocol.data', False),
+    ('twimp.chunks', 'Demuxer', 'controlMessageReceived',
+     'demux.control', False),
+    ('twimp.proto', 'DispatchProtocol', 'messageReceived',
+     'dispatch.message', False),
+    ('twimp.amf0', None, 'decode', 'amf0.decode', False),
+    ('twimp.dispatch', 'CommandDispatchProtocol', '_handler_wrapper',
+     'dispatch.command', False),
+    ('twimp.dispatch', 'CallDispatchProtocol', 'unknownCommandType',
+     'dispatch.call', False),
+    ('twimp.server.appserver', 'AppDispatchServerProtocol', 'remote_*',
+     'remote.%s', True),
+    ('twimp.server.inmemory', 'IMStream', 'notify_write_listeners',
+     'imstream.notify', False),
+    ('twimp.chunks', 'Muxer', 'sendMessage', 'mux.send', False),
+    ]
+
+
+class Profiler(object):
+    """Installs the probes (see default_probes) when enabled, each
+    timing the calls into its own Histogram.
+
+    Only a single profiler should be enabled at a time.
+    """
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, probes=None):
+        if probes is None:
+            probes = default_probes
+        self.probes = probes
+        # { name => Histogram }
+        self.histograms = {}
+        # [(owner, attribute, original), ...]
+        self._installed = []
+
+    def histogram(self, name):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        return h
+
+    def enabled(self):
+        return bool(self._installed)
+
+    def enable(self):
+        if self._installed:
+            return
+        for module, cls, attr, name, deferred in self.probes:
+            __import__(module)
+            owner = sys.modules[module]
+            if cls is not None:
+                owner = getattr(owner, cls)
+            if attr.endswith('*'):
+                prefix = attr[:-1]
+                for a in sorted(vars(owner)):
+                    if a.startswith(prefix):
+                        self._install(owner, a, name % (a[len(prefix):],),
+                                      deferred)
+            else:
+                self._install(owner, attr, name, deferred)
+        log.info('profiling enabled (%d probes)', len(self._installed))
+
+    def disable(self):
+        while self._installed:
+            owner, attr, orig = self._installed.pop()
+            setattr(owner, attr, orig)
+
+    def _install(self, owner, attr, name, deferred):
+        orig = vars(owner)[attr]
+        if deferred:
+            wrapper = self._wrap_deferred(orig, self.histogram(name),
+                                          self.histogram(name + '.deferred'))
+        else:
+            wrapper = self._wrap(orig, self.histogram(name))
+        setattr(owner, attr, wrapper)
+        self._installed.append((owner, attr, orig))
+
+    def _wrap(self, f, h):
+        clock = self.clock
+        def wrapper(*args, **kw):
+            start = clock()
+            try:
+                return f(*args, **kw)
+            finally:
+                h.record(clock() - start)
+        wrapper.__name__ = f.__name__
+        return wrapper
+
+    def _wrap_deferred(self, f, h, dh):
+        clock = self.clock
+        def fired(result, start):
+            dh.record(clock() - start)
+            return result
+        def wrapper(*args, **kw):
+            start = clock()
+            try:
+                result = f(*args, **kw)
+            finally:
+                h.record(clock() - start)
+            if isinstance(result, defer.Deferred):
+                result.addBoth(fired, start)
+            return result
+        wrapper.__name__ = f.__name__
+        return wrapper
+
+    def report(self):
+        """Return the summaries of the histograms: { name => dict }."""
+        return dict((name, h.summary())
+                    for name, h in self.histograms.items() if h.count)
+
+    def format_report(self):
+        """Return the report as a (printable) table, times in
+        milliseconds."""
+        cols = ('p50', 'p90', 'p99', 'p99.9', 'max')
+        lines = ['%-32s %9s' % ('probe', 'count') +
+                 ''.join(' %9s' % c for c in cols)]
+        for name, s in sorted(self.report().items()):
+            lines.append('%-32s %9d' % (name, s['count']) +
+                         ''.join(' %9.3f' % (s[c] * 1000) for c in cols))
+        return '\n'.join(lines)
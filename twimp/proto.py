@@ -14,12 +14,14 @@
 
 
 import struct
+import time
 
 from twisted.internet import protocol
 from twisted.internet.protocol import Factory
 
 from twimp import amf0
 from twimp import chunks
+from twimp.capture import capture_transport
 from twimp import const
 from twimp.chunks import Demuxer, Muxer
 from twimp.error import ProtocolContractError
@@ -65,8 +67,16 @@ class BaseProtocol(GeneratorWrapperProtocol):
         self._demuxer = None
         self.muxer = None
 
+        self._timeout = None
+        self.connected_at = None
+        self.handshake_time = None
+
     def buildHandshaker(self, protocol, init_time, is_client):
-        return self.handshaker_class(protocol, init_time, is_client=is_client)
+        hs = self.handshaker_class(protocol, init_time, is_client=is_client)
+        workers = getattr(self.factory, 'handshake_workers', None)
+        if workers is not None:
+            hs.workers = workers
+        return hs
 
     def buildDemuxer(self, protocol):
         return self.demuxer_class(protocol)
@@ -87,15 +97,41 @@ class BaseProtocol(GeneratorWrapperProtocol):
 
     def connectionMade(self):
         self.orig_writeSequence = _fix_writeSequence(self.transport)
+        capture = getattr(self.factory, 'capture', None)
+        if capture is not None:
+            self.capture = capture.open(self)
+            if self.capture is not None:
+                capture_transport(self.transport, self.capture)
+        self.connected_at = time.time()
+        metrics = getattr(self.factory, 'metrics', None)
+        if metrics is not None:
+            metrics.connection_opened(self)
         # start handshake "mode"
+        self.set_timeout_phase('handshake')
         self._init_handshaker()
 
     def connectionLost(self, reason=protocol.connectionDone):
+        if self.capture is not None:
+            del self.transport.write
+            self.capture.close()
+            self.capture = None
         del self.transport.writeSequence
         del self.orig_writeSequence
+        self.set_timeout_phase(None)
+        admission = getattr(self.factory, 'admission', None)
+        if admission is not None:
+            admission.closed(self)
+        metrics = getattr(self.factory, 'metrics', None)
+        if metrics is not None:
+            metrics.connection_closed(self)
         GeneratorWrapperProtocol.connectionLost(self, reason)
 
     def handshakeSucceeded(self, init_ts, hs_delay):
+        admission = getattr(self.factory, 'admission', None)
+        if admission is not None:
+            admission.handshake_done(self)
+        self.handshake_time = time.time() - self.connected_at
+        self.set_timeout_phase('connect')
         # switch to chunks "mode"
         self.session_init_time = self.factory.init_time + init_ts
         self._init_muxers()
@@ -104,6 +140,29 @@ class BaseProtocol(GeneratorWrapperProtocol):
         # this is called _directly before_ connectionLost()
         pass
 
+    def set_timeout_phase(self, phase):
+        """(Re)start timing out the connection in phase (one of
+        ConnectionTimeouts.phases), or stop it if phase is None."""
+        if self._timeout is not None:
+            self._timeout.cancel()
+            self._timeout = None
+        timeouts = getattr(self.factory, 'timeouts', None)
+        if timeouts is not None and phase is not None:
+            self._timeout = timeouts.start(self, phase)
+
+    def activity(self):
+        """Return the amount of data received and sent, so far."""
+        sent = 0
+        if self.muxer is not None:
+            sent = self.muxer.messages_sent
+        return self.bytes_in, sent
+
+    def timedOut(self, phase):
+        self._timeout = None
+        log.info('connection timed out (%s)', phase)
+        # not waiting for the peer to read what was sent before
+        self.transport.abortConnection()
+
     def messageReceived(self, header, body):
         # print header, _ellip(body.read(len(body)).encode('hex'))
         pass
@@ -112,9 +171,31 @@ class BaseProtocol(GeneratorWrapperProtocol):
 class BaseFactory(Factory):
     protocol = BaseProtocol
 
+    handshake_workers = None
+    # an AdmissionControl instance (see twimp.server.admission),
+    # refusing new connections when overloaded
+    admission = None
+    # a ConnectionTimeouts instance (see twimp.timeouts)
+    timeouts = None
+    # a MetricsRegistry instance (see twimp.metrics)
+    metrics = None
+    # a SessionCapturer instance (see twimp.capture), capturing the
+    # sessions of the connections it selects
+    capture = None
+
     def __init__(self, init_time):
         self.init_time = init_time
 
+    def buildProtocol(self, addr):
+        admission = self.admission
+        if admission is not None and not admission.admit(addr):
+            # closing the socket right away
+            return None
+        p = Factory.buildProtocol(self, addr)
+        if admission is not None:
+            admission.opened(p)
+        return p
+
 
 _s_uctrl_single = struct.Struct('>HL')
 
@@ -273,10 +354,6 @@ class DispatchProtocol(BaseProtocol):
     def doData(self, type_, ts, ms_id, body):
         pass
 
-    def connectionLost(self, reason=protocol.connectionDone):
-        self._cc_queue.cancel_all()
-        BaseProtocol.connectionLost(self, reason)
-
 
 class DispatchFactory(BaseFactory):
     protocol = DispatchProtocol
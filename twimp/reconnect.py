@@ -0,0 +1,312 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Publishing that survives losing the connection: the media source
+keeps running while the client reconnects and publishes again, and the
+new session resumes where the previous one stopped.
+"""
+
+from collections import deque
+
+from zope.interface import implements
+
+from twisted.internet.protocol import ReconnectingClientFactory
+
+from twimp import chunks
+from twimp.client import BaseClientApp, SimpleAppClientFactory
+from twimp.helpers import frame_info, vb_clone
+from twimp.interfaces import IThrottledSource
+
+LOG_CATEGORY = 'reconnect'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class ResumableSource(object):
+    """Wraps a media source for publishing over successive client
+    streams, one after another.
+
+    The wrapped source is started once and keeps writing while there
+    is no stream to write to; the frames are held meanwhile (from the
+    latest video keyframe, up to max_held seconds of media). Each new
+    stream gets the meta data and the sequence headers first, then the
+    frames held, with timestamps continuing from the previous stream.
+    """
+    implements(IThrottledSource)
+
+    # seconds of media held while disconnected, at most
+    max_held = 5.0
+
+    def __init__(self, source, max_held=None):
+        self.source = source
+        if max_held is not None:
+            self.max_held = max_held
+
+        self._stream = None
+        self._live = False
+        self._started = False
+        # whether the wrapped source was throttled by the stream
+        self._throttled = False
+
+        self._meta = None
+        # { msg type => sequence header }
+        self._headers = {}
+        # frames written while disconnected: (ts, type_, data, is_key)
+        self._held = deque()
+        self._skip_video = False
+
+        # added to the source timestamps, to keep them monotonic
+        self._offset = 0
+        self._last_ts = None
+        self._last_src_ts = 0
+
+        self.resumed = 0
+        self.dropped = 0
+
+    ##
+    # IMediaSource, for the client streams
+
+    def connect(self, stream):
+        self._stream = stream
+
+    def disconnect(self):
+        self._stream = None
+        self._live = False
+        self.unthrottle()
+
+    def start(self):
+        self._live = True
+        if not self._started:
+            self._started = True
+            self.source.connect(self)
+            self.source.start()
+        else:
+            self._resume()
+
+    def stop(self):
+        # the stream is going away, the source keeps running (and
+        # won't get unthrottled by that stream anymore)
+        self._live = False
+        self.unthrottle()
+
+    def close(self):
+        """Stop and disconnect the wrapped source."""
+        self._live = False
+        self._stream = None
+        self._held.clear()
+        if self._started:
+            self._started = False
+            self.source.stop()
+            self.source.disconnect()
+
+    def throttle(self):
+        if not self._throttled:
+            self._throttled = True
+            if IThrottledSource.providedBy(self.source):
+                self.source.throttle()
+
+    def unthrottle(self):
+        if self._throttled:
+            self._throttled = False
+            if IThrottledSource.providedBy(self.source):
+                self.source.unthrottle()
+
+    def frames_dropped(self, count, latency):
+        if IThrottledSource.providedBy(self.source):
+            self.source.frames_dropped(count, latency)
+
+    def held(self):
+        """Return the number of frames held, waiting for a stream."""
+        return len(self._held)
+
+    ##
+    # the stream, for the wrapped source
+
+    def write_meta(self, ts, data):
+        self._write(ts, chunks.MSG_DATA, data)
+
+    def write_audio(self, ts, data):
+        self._write(ts, chunks.MSG_AUDIO, data)
+
+    def write_video(self, ts, data):
+        self._write(ts, chunks.MSG_VIDEO, data)
+
+    def _write(self, ts, type_, data):
+        self._last_src_ts = ts
+        if type_ == chunks.MSG_DATA:
+            self._meta = vb_clone(data)
+            is_header, is_key = True, True
+        else:
+            is_header, is_key = frame_info(type_, data)
+            if is_header:
+                self._headers[type_] = vb_clone(data)
+
+        if type_ == chunks.MSG_VIDEO and not is_header:
+            if self._skip_video:
+                if not is_key:
+                    self.dropped += 1
+                    return
+                self._skip_video = False
+
+        if self._live:
+            self._send(ts, type_, data)
+        elif not is_header:
+            # headers and meta data get replayed anyway
+            self._hold(ts, type_, data, is_key)
+
+    def _send(self, ts, type_, data):
+        ts += self._offset
+        if self._last_ts is None or ts > self._last_ts:
+            self._last_ts = ts
+
+        s = self._stream
+        if type_ == chunks.MSG_VIDEO:
+            s.write_video(ts, data)
+        elif type_ == chunks.MSG_AUDIO:
+            s.write_audio(ts, data)
+        else:
+            s.write_meta(ts, data)
+
+    def _hold(self, ts, type_, data, is_key):
+        held = self._held
+        if type_ == chunks.MSG_VIDEO and is_key:
+            # only the frames from the latest keyframe on are of use
+            self.dropped += len(held)
+            held.clear()
+        held.append((ts, type_, data, is_key))
+
+        limit = self.max_held * 1000
+        if held[-1][0] - held[0][0] <= limit:
+            return
+
+        video_lost = False
+        while held[-1][0] - held[0][0] > limit:
+            f = held.popleft()
+            self.dropped += 1
+            if f[1] == chunks.MSG_VIDEO:
+                video_lost = True
+
+        if video_lost:
+            # no video until the next keyframe
+            self._skip_video = True
+            kept = deque(f for f in held if f[1] != chunks.MSG_VIDEO)
+            self.dropped += len(held) - len(kept)
+            self._held = kept
+
+    def _resume(self):
+        self.resumed += 1
+        held, self._held = self._held, deque()
+
+        start_ts = self._last_src_ts
+        if held:
+            start_ts = held[0][0]
+        last_ts = self._last_ts
+        if last_ts is not None and start_ts + self._offset < last_ts:
+            self._offset = last_ts - start_ts
+
+        log.debug('resuming at %d, replaying %d frames',
+                  start_ts + self._offset, len(held))
+
+        if self._meta is not None:
+            self._send(start_ts, chunks.MSG_DATA, vb_clone(self._meta))
+        for type_ in (chunks.MSG_VIDEO, chunks.MSG_AUDIO):
+            header = self._headers.get(type_)
+            if header is not None:
+                self._send(start_ts, type_, vb_clone(header))
+
+        while held and self._live:
+            ts, type_, data, _is_key = held.popleft()
+            self._send(ts, type_, data)
+
+
+class ResumingPublishApp(BaseClientApp):
+    def __init__(self, protocol, factory):
+        BaseClientApp.__init__(self, protocol)
+        self.factory = factory
+        self._stream = None
+
+    def connectionMade(self, info):
+        self.factory.app = self
+        d = self.createStream()
+        d.addCallback(self._publish)
+        d.addCallbacks(self._published, self._publish_failed)
+
+    def _publish(self, stream):
+        self._stream = stream
+        f = self.factory
+        return stream.publish(f.name, f.source, **f.publish_kwargs)
+
+    def _published(self, _result):
+        self.factory.published()
+
+    def _publish_failed(self, failure):
+        log.info('publishing %r failed: %s', self.factory.name,
+                 failure.value)
+        if self.connected:
+            self.disconnect()
+
+    def connectionLost(self, reason):
+        if self._stream:
+            self.closeStream(self._stream, force=True)
+            self._stream = None
+        if self.factory.app is self:
+            self.factory.app = None
+
+    def connectionFailed(self, reason):
+        log.info("couldn't connect: %s", reason.getErrorMessage())
+
+
+class ReconnectingPublishFactory(SimpleAppClientFactory,
+                                 ReconnectingClientFactory):
+    """Publishes source as name, reconnecting (with a growing delay)
+    and publishing again whenever the connection gets lost, until
+    stop() is called.
+
+    Extra keyword arguments are passed to ClientStream.publish().
+    """
+
+    initialDelay = 0.1
+    maxDelay = 10.0
+
+    app_class = ResumingPublishApp
+
+    def __init__(self, url, connect_params, name, source, max_held=None,
+                 **publish_kwargs):
+        SimpleAppClientFactory.__init__(self, url, connect_params,
+                                        self.app_class, self)
+        self.name = name
+        self.source = ResumableSource(source, max_held)
+        self.publish_kwargs = publish_kwargs
+        self.app = None
+        self.sessions = 0
+
+    def published(self):
+        self.sessions += 1
+        self.resetDelay()
+        log.info('publishing %r (session %d)', self.name, self.sessions)
+
+    def clientConnectionLost(self, connector, reason):
+        if self.continueTrying:
+            log.info('connection lost (%s), reconnecting',
+                     reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionLost(self, connector,
+                                                       reason)
+
+    def stop(self):
+        """Stop reconnecting and publishing, disconnecting."""
+        self.stopTrying()
+        if self.app is not None and self.app.connected:
+            self.app.disconnect()
+        self.source.close()
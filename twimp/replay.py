@@ -0,0 +1,261 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+
+"""Replaying captured sessions (see twimp.capture): the data received
+in a session gets fed to a new protocol of the same side, connected to
+a fake transport - either at the original pace, or as fast as the
+protocol takes it.
+
+The handshake can't be replayed exactly: the protocol generates its own
+random handshake packet, which the captured response of the peer
+doesn't match - the verification of that response gets skipped (see
+replay_handshaker()).
+"""
+
+from twisted.internet import address, defer, protocol
+from twisted.python import failure
+
+from twimp.capture import IN
+
+LOG_CATEGORY = 'replay'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class ReplayTransport(object):
+    """A transport writing nowhere, only counting the data written."""
+
+    disconnecting = False
+    producer = None
+
+    def __init__(self, peer=None, host=None):
+        self.peer = peer or address.IPv4Address('TCP', '127.0.0.1', 0)
+        self.host = host or address.IPv4Address('TCP', '127.0.0.1', 0)
+        self.bytes_out = 0
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes_out += len(data)
+
+    def writeSequence(self, seq):
+        self.writes += 1
+        for data in seq:
+            self.bytes_out += len(data)
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+    def abortConnection(self):
+        self.disconnecting = True
+
+    def getPeer(self):
+        return self.peer
+
+    def getHost(self):
+        return self.host
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def setTcpNoDelay(self, enabled):
+        pass
+
+
+_handshakers = {}
+
+def replay_handshaker(cls):
+    """Return a subclass of the handshaker class cls, accepting any
+    response to its handshake packet."""
+    handshaker = _handshakers.get(cls)
+    if handshaker is None:
+        class ReplayHandshaker(cls):
+            def verify_response(self, request, response):
+                return True
+        handshaker = _handshakers[cls] = ReplayHandshaker
+    return handshaker
+
+
+class SessionReplay(object):
+    """Feeds the data received in the records of a captured session
+    (see twimp.capture.read_capture()) to protocol, not connected yet.
+
+    Data the peer sent after receiving some of the captured output
+    (e.g. the commands following the handshake) is held back until
+    the protocol sends as much - and, at the end, the replay waits for
+    all of the output captured - or until the protocol sends nothing
+    for response_timeout seconds.
+    """
+
+    # records fed at once, before letting the reactor run, when not
+    # replaying in real time
+    batch = 64
+
+    response_timeout = 1.0
+    # seconds between checking whether the protocol responded
+    poll_interval = 0.001
+
+    def __init__(self, records, protocol, realtime=False, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+        self.protocol = protocol
+        self.realtime = realtime
+        self.transport = ReplayTransport()
+
+        self._records = iter(records)
+        # captured output so far
+        self._sent = 0
+        # how much less than captured the protocol sent, when it timed
+        # out responding
+        self._behind = 0
+        # (time, bytes sent) when last waiting for the protocol
+        self._waiting = None
+        self._pending = None
+        self._call = None
+        self._t0 = None
+        self._d = None
+
+        self.records = 0
+        self.bytes_in = 0
+        # time offset of the last record fed, in the captured session
+        self.offset = 0.0
+        # records held back waiting for a response, and the responses
+        # that timed out
+        self.waits = 0
+        self.timeouts = 0
+
+    def start(self):
+        """Connect the protocol and start feeding it.
+
+        @return: a Deferred firing with the stats of the replay (see
+                 stats()), once all the data got fed or the protocol
+                 closed the connection
+        """
+        d = self._d = defer.Deferred()
+        self._t0 = self.reactor.seconds()
+
+        p = self.protocol
+        p.handshaker_class = replay_handshaker(p.handshaker_class)
+        p.makeConnection(self.transport)
+
+        self._tick()
+        return d
+
+    def stop(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if self._d is not None:
+            self._finish(None)
+
+    def _next_inbound(self):
+        for direction, offset, data in self._records:
+            if direction == IN:
+                return offset, self._sent, data
+            self._sent += len(data)
+        return None
+
+    def _wait_response(self, sent):
+        missing = sent - self._behind - self.transport.bytes_out
+        if missing <= 0:
+            self._waiting = None
+            return False
+
+        now = self.reactor.seconds()
+        if self._waiting is None:
+            self._waiting = now, self.transport.bytes_out
+            self.waits += 1
+        elif self._waiting[1] < self.transport.bytes_out:
+            # still sending
+            self._waiting = now, self.transport.bytes_out
+        elif now - self._waiting[0] >= self.response_timeout:
+            log.debug('no response, %d bytes missing', missing)
+            self._waiting = None
+            self._behind += missing
+            self.timeouts += 1
+            return False
+        return True
+
+    def _tick(self):
+        self._call = None
+        fed = 0
+        while not self.transport.disconnecting:
+            if self._pending is None:
+                self._pending = self._next_inbound()
+                if self._pending is None:
+                    if self._wait_response(self._sent):
+                        self._call = self.reactor.callLater(
+                            self.poll_interval, self._tick)
+                        return
+                    break
+
+            offset, sent, data = self._pending
+            if self._wait_response(sent):
+                self._call = self.reactor.callLater(self.poll_interval,
+                                                    self._tick)
+                return
+            if self.realtime:
+                delay = self._t0 + offset - self.reactor.seconds()
+                if delay > 0:
+                    self._call = self.reactor.callLater(delay, self._tick)
+                    return
+            elif fed >= self.batch:
+                self._call = self.reactor.callLater(0, self._tick)
+                return
+
+            self._pending = None
+            fed += 1
+            self.records += 1
+            self.bytes_in += len(data)
+            self.offset = offset
+
+            ret = self.protocol.dataReceived(data)
+            if ret:
+                self._finish(ret)
+                return
+
+        self._finish(None)
+
+    def stats(self):
+        """Return the counters of the replay so far."""
+        return dict(records=self.records, bytes_in=self.bytes_in,
+                    bytes_out=self.transport.bytes_out,
+                    elapsed=self.reactor.seconds() - self._t0,
+                    offset=self.offset, waits=self.waits,
+                    timeouts=self.timeouts)
+
+    def _finish(self, reason):
+        d, self._d = self._d, None
+        stats = self.stats()
+        stats['closed'] = self.transport.disconnecting
+        stats['error'] = None
+
+        if reason is None:
+            reason = protocol.connectionDone
+        else:
+            if not isinstance(reason, failure.Failure):
+                reason = failure.Failure(reason)
+            stats['error'] = str(reason.value)
+            log.info('replay failed: %s', reason.value)
+        self.transport.disconnecting = True
+        self.protocol.connectionLost(reason)
+
+        d.callback(stats)
@@ -13,23 +13,21 @@
 #   limitations under the License.
 
 
+import mmap
 import struct
 
+from twimp.analysis import SessionAnalyzer, analyze
+from twimp.analysis import audio_codec_names, video_codec_names
+from twimp.capture import IN, is_capture, read_capture
 from twimp.chunks import Demuxer
 from twimp.helpers import PrintMsgDemuxerMixin
 from twimp.proto import DispatchProtocol
 
 
-_v_codec_ids = {1: 'JPEG', 2: 'H.263', 3: 'Screen Video', 4: 'VP6',
-                5: 'VP6 Alpha', 6: 'Screen Video 2', 7: 'H.264'}
 _v_frame_types = {1: 'keyframe', 2: 'interframe', 3: 'disposable interfame',
                   4: 'generated keyframe', 5: 'info frame'}
 _h264_types = {0: 'sequence header', 1: 'NAL unit', 2: 'end of sequence'}
 
-_a_codec_ids = {0: 'PCM', 1: 'ADPCM', 2: 'MP3', 3: 'PCM(<)',
-                4: 'Nellymoser 16k', 5: 'Nellymoser 8k', 6: 'Nellymoser',
-                7: 'A-law', 8: 'u-law', 10: 'AAC', 11: 'Speex', 14: 'MP3 8k',
-                15: 'Device audio'}
 
 class PrintMsgProtocol(DispatchProtocol):
     def messageReceived(self, header, body):
@@ -50,7 +48,8 @@ class PrintMsgProtocol(DispatchProtocol):
         if type_ == 0x09:
             ft_codec, h264_type = struct.unpack('BB', body.peek(2))
             frame_type, codec_id = ft_codec >> 4, ft_codec & 0x0f
-            print _v_codec_ids.get(codec_id, '(unknown: %02x)' % codec_id), \
+            print video_codec_names.get(codec_id,
+                                        '(unknown: %02x)' % codec_id), \
                 _v_frame_types.get(frame_type, '(unknown: %02x)' % frame_type),
 
             if codec_id == 7 and frame_type != 5:
@@ -60,7 +59,8 @@ class PrintMsgProtocol(DispatchProtocol):
             print body.peek(len(body)).encode('hex')
         elif type_ == 0x08:
             codec_id = struct.unpack('B', body.peek(1))[0] >> 4
-            print _a_codec_ids.get(codec_id, '(unknown: %02x)' % codec_id), \
+            print audio_codec_names.get(codec_id,
+                                        '(unknown: %02x)' % codec_id), \
                 '\t',
             print body.peek(len(body)).encode('hex')
         else:
@@ -69,26 +69,137 @@ class PrintMsgProtocol(DispatchProtocol):
 
 
 
-def main(f, block=4096):
-    # skip the handshakes for now
-    f.read(1 + 1536 + 1536)
+# the handshake packets of the peer, preceding the chunk stream
+handshake_size = 1 + 1536 + 1536
 
-    class _Demuxer(PrintMsgDemuxerMixin, Demuxer):
-        pass
 
-    p = PrintMsgProtocol()
-    p.init_handler(_Demuxer(p).gen_handler())
+def read_blocks(f, block=4096):
+    """Yield the data received from the peer, from a capture file (see
+    twimp.capture) or a raw dump of it (f can also be a mmap)."""
+    if is_capture(f):
+        _is_client, _started, records = read_capture(f)
+        for direction, _offset, data in records:
+            if direction == IN:
+                yield data
+        return
+
+    if isinstance(f, mmap.mmap):
+        # (no copying)
+        for offset in xrange(f.tell(), len(f), block):
+            yield buffer(f, offset, block)
+        return
 
     while True:
         data = f.read(block)
         if not data:
             break
+        yield data
+
+
+def skip_handshake(blocks):
+    skip = handshake_size
+    for data in blocks:
+        if skip:
+            data, skip = data[skip:], max(0, skip - len(data))
+            if not data:
+                continue
+        yield data
+
+
+def print_messages(f, block=4096):
+    class _Demuxer(PrintMsgDemuxerMixin, Demuxer):
+        pass
+
+    p = PrintMsgProtocol()
+    p.init_handler(_Demuxer(p).gen_handler())
+
+    # skip the handshakes for now
+    for data in skip_handshake(read_blocks(f, block)):
         ret = p.dataReceived(data)
         if ret:
             raise ret
 
 
+def analyze_file(f, interval=1000, gap=1000, block=1 << 20):
+    """Return the SessionAnalyzer of the (mapped into memory) file f."""
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        analyzer = SessionAnalyzer(interval, gap)
+        return analyze(skip_handshake(read_blocks(m, block)), analyzer)
+    finally:
+        m.close()
+
+
+def _output(path):
+    import sys
+
+    if path == '-':
+        return sys.stdout
+    return open(path, 'wb')
+
+
+def main(argv):
+    import optparse
+    import os
+    import sys
+    import time
+
+    from twimp.utils import json
+
+    usage = '%prog [options] FILE'
+    epilog = ('FILE is a capture (see twimp.capture) or a raw dump of the'
+              ' data received from the peer. By default all the messages'
+              ' get printed.')
+    parser = optparse.OptionParser(usage=usage, epilog=epilog)
+
+    parser.add_option('-a', '--analyze', action='store_true',
+                      dest='analyze', default=False,
+                      help=('print the statistics of the messages and the'
+                            ' media streams, instead of the messages'))
+    parser.add_option('-j', '--json', action='store', dest='json',
+                      metavar='FILE',
+                      help=('write the statistics as JSON to FILE (- for'
+                            ' stdout)'))
+    parser.add_option('-c', '--csv', action='store', dest='csv',
+                      metavar='FILE',
+                      help=('write the bitrate over time of the media'
+                            ' streams as CSV to FILE (- for stdout)'))
+    parser.add_option('-i', '--interval', action='store', type='int',
+                      dest='interval', default=1000, metavar='MS',
+                      help=('compute the bitrate over MS milliseconds'
+                            ' (default: %default)'))
+    parser.add_option('-g', '--gap', action='store', type='int',
+                      dest='gap', default=1000, metavar='MS',
+                      help=('count timestamp differences over MS'
+                            ' milliseconds as gaps (default: %default)'))
+
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('No file specified.')
+
+    f = open(args[0], 'rb')
+    if not (options.analyze or options.json or options.csv):
+        print_messages(f)
+        return
+
+    start = time.time()
+    analyzer = analyze_file(f, options.interval, options.gap)
+    elapsed = time.time() - start
+    size = os.fstat(f.fileno()).st_size
+    sys.stderr.write('analyzed %d bytes in %.3fs (%.1f MB/s)\n' %
+                     (size, elapsed, size / elapsed / 1e6 if elapsed else 0))
+
+    if options.analyze:
+        print analyzer.format_report()
+    if options.json:
+        out = _output(options.json)
+        json.dump(analyzer.report(), out, indent=2, sort_keys=True)
+        out.write('\n')
+    if options.csv:
+        analyzer.write_csv(_output(options.csv))
+
+
 if __name__ == '__main__':
     import sys
 
-    main(file(sys.argv[1]))
+    main(sys.argv[1:])
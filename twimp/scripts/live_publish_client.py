@@ -15,17 +15,24 @@
 
 import struct
 
-from twisted.internet import glib2reactor
-glib2reactor.install()
+try:
+    from twisted.internet import glib2reactor
+    glib2reactor.install()
+except ImportError:
+    # no glib (headless hosts?) - only publishing FLV files will work
+    pass
 from twisted.internet import reactor
 
 # not importing gst here, we want to parse command line options ourselves
 # import gst
+gst = None
 
 from twimp import amf0
 from twimp.client import BaseClientApp, SimpleAppClientFactory
 from twimp.client import connect_client_factory
 from twimp.primitives import _s_uchar
+from twimp.reconnect import ReconnectingPublishFactory
+from twimp.sources import FLVFileSource
 from twimp.vecbuf import VecBuf
 
 from twimp.helpers import ellip
@@ -550,6 +557,13 @@ class NewGstSource(object):
             self.pipeline.set_state(gst.STATE_NULL)
 
 
+class FLVSource(FLVFileSource):
+    def ended(self):
+        FLVFileSource.ended(self)
+        log.info("end of file, quitting")
+        reactor.stop()
+
+
 class SimplePublishingApp(BaseClientApp):
     def __init__(self, protocol, publish_source, publish_name='livestream'):
         BaseClientApp.__init__(self, protocol)
@@ -606,16 +620,25 @@ def run(url, stream_name='livestream', audio_codec=None, video_codec=None,
         audio_bitrate=64, video_bitrate=400, samplerate=44100,
         framerate=Fraction('15/1'), channels=1,
         width=320, height=240, keyframe_interval=5.0, view=False,
-        view_window=None):
-    src = NewGstSource(audio_bitrate, video_bitrate,
-                       samplerate, channels, framerate, width, height,
-                       keyframe_interval, audio_codec=audio_codec,
-                       video_codec=video_codec, view=view,
-                       view_window=view_window)
-    f = connect_client_factory(url, OneTimeAppFactory,
-                               SimplePublishingApp,
-                               src,
-                               stream_name)
+        view_window=None, flv_path=None, loop=False, realtime=True,
+        reconnect=False):
+    if flv_path:
+        src = FLVSource(flv_path, loop=loop, realtime=realtime)
+    else:
+        src = NewGstSource(audio_bitrate, video_bitrate,
+                           samplerate, channels, framerate, width, height,
+                           keyframe_interval, audio_codec=audio_codec,
+                           video_codec=video_codec, view=view,
+                           view_window=view_window)
+    if reconnect:
+        # keep publishing over new connections when the old ones break
+        f = connect_client_factory(url, ReconnectingPublishFactory,
+                                   stream_name, src)
+    else:
+        f = connect_client_factory(url, OneTimeAppFactory,
+                                   SimplePublishingApp,
+                                   src,
+                                   stream_name)
     reactor.run()
 
 
@@ -691,6 +714,21 @@ def main(argv):
     parser.add_option('-w', '--view', action='store_true', dest='view',
                       help='view what is being published',
                       default=False)
+    parser.add_option('-F', '--flv', action='store', dest='flv',
+                      metavar='FILE',
+                      help=('publish the contents of an FLV file instead'
+                            ' (no encoding, GStreamer not needed)'))
+    parser.add_option('-l', '--loop', action='store_true', dest='loop',
+                      default=False,
+                      help='publish the FLV file in a loop')
+    parser.add_option('-M', '--max-rate', action='store_false',
+                      dest='realtime', default=True,
+                      help=('publish the FLV file as fast as possible, not'
+                            ' in real-time'))
+    parser.add_option('-C', '--reconnect', action='store_true',
+                      dest='reconnect', default=False,
+                      help=('reconnect and resume publishing when the'
+                            ' connection gets lost'))
 
     options, args = parser.parse_args(argv)
 
@@ -705,7 +743,11 @@ def main(argv):
     audio_codec = audio_codecs.get(options.acodec, None)
     video_codec = video_codecs.get(options.vcodec, None)
 
-    if video_codec is None and audio_codec is None:
+    if options.flv:
+        audio_codec = video_codec = None
+    elif gst is None:
+        parser.error('GStreamer not available, only --flv will work.')
+    elif video_codec is None and audio_codec is None:
         parser.error("Can't disable both audio and video.")
 
     twimp.log.set_levels_from_env()
@@ -717,11 +759,16 @@ def main(argv):
         audio_bitrate=options.arate, video_bitrate=options.vrate,
         samplerate=options.srate, framerate=options.frate,
         channels=options.channels, width=options.width, height=options.height,
-        keyframe_interval=options.keyint, view=options.view)
+        keyframe_interval=options.keyint, view=options.view,
+        flv_path=options.flv, loop=options.loop, realtime=options.realtime,
+        reconnect=options.reconnect)
 
 
 if __name__ == '__main__':
     import sys
     args, sys.argv[:] = sys.argv[:], sys.argv[0:1]
-    import gst
+    try:
+        import gst
+    except ImportError:
+        gst = None
     main(args)
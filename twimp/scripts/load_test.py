@@ -0,0 +1,548 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Load testing RTMP servers: publishing and playing many streams over
+many concurrent client connections, from a single process.
+
+Results are written as a JSON document, for comparing runs.
+"""
+
+import os
+import time
+
+from twisted.internet import error, task
+
+from twimp.client import BaseClientApp, SimpleAppClientFactory
+from twimp.client import SimpleAppClientProtocol
+from twimp.sources import FLVFileSource, open_index
+from twimp.sources import SyntheticSource, synthetic_seq
+from twimp.urls import parse_rtmp_url
+
+LOG_CATEGORY = 'loadtest'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+def install_reactor():
+    """Install the epoll reactor, if available - thousands of
+    connections are beyond select().
+
+    @return: whether installed
+    """
+    try:
+        from twisted.internet import epollreactor
+    except ImportError:
+        log.warning('epoll not available, using the default reactor')
+        return False
+    try:
+        epollreactor.install()
+    except error.ReactorAlreadyInstalledError:
+        from twisted.internet import reactor
+        log.warning('not using epoll: %s already installed',
+                    reactor.__class__.__name__)
+        return False
+    return True
+
+
+def summarize(values):
+    """Return basic statistics of values: count, min, mean, max and a
+    few percentiles.
+    """
+    if not values:
+        return dict(count=0)
+
+    values = sorted(values)
+    n = len(values)
+
+    def pct(p):
+        return values[min(n - 1, int(n * p / 100.0))]
+
+    return dict(count=n, min=values[0], mean=sum(values) / float(n),
+                p50=pct(50), p90=pct(90), p99=pct(99), max=values[-1])
+
+
+def process_cpu_time(pid):
+    """Return the user + system CPU time (in seconds) used by the
+    process pid so far, or None if not available (needs /proc).
+    """
+    try:
+        f = open('/proc/%d/stat' % (pid,))
+        try:
+            stat = f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+
+    # skip past the command name, it may contain spaces
+    fields = stat[stat.rindex(')') + 2:].split()
+    utime, stime = int(fields[11]), int(fields[12])
+    return (utime + stime) / float(os.sysconf('SC_CLK_TCK'))
+
+
+class Client(object):
+    """Timings and counters of a single client connection."""
+
+    def __init__(self, kind, name, count_lost=True):
+        self.kind = kind
+        self.name = name
+        self.count_lost = count_lost
+
+        self.started = time.time()
+        self.tcp_connected = None
+        self.handshaked = None
+        self.connected = None
+        self.play_started = None
+        self.first_frame = None
+        self.last_frame = None
+        self.failed = None
+
+        self.frames = 0
+        self.bytes = 0
+        self.lost = 0
+        self._next_seq = {}
+
+    def frame_received(self, type_, data):
+        now = time.time()
+        if self.first_frame is None:
+            self.first_frame = now
+        self.last_frame = now
+        self.frames += 1
+        self.bytes += len(data)
+
+        if not self.count_lost:
+            return
+
+        seq = synthetic_seq(type_, data)
+        if seq is not None:
+            expected = self._next_seq.get(type_)
+            if expected is not None and seq > expected:
+                self.lost += seq - expected
+            self._next_seq[type_] = seq + 1
+
+    def fail(self, reason):
+        if self.failed is None:
+            self.failed = str(reason)
+
+
+class LoadClientProtocol(SimpleAppClientProtocol):
+    def connectionMade(self):
+        self.factory.client.tcp_connected = time.time()
+        SimpleAppClientProtocol.connectionMade(self)
+
+    def handshakeSucceeded(self, init_ts, hs_delay):
+        self.factory.client.handshaked = time.time()
+        SimpleAppClientProtocol.handshakeSucceeded(self, init_ts, hs_delay)
+
+
+class LoadClientFactory(SimpleAppClientFactory):
+    protocol = LoadClientProtocol
+
+    def __init__(self, url, connect_params, client, app_factory, *args):
+        SimpleAppClientFactory.__init__(self, url, connect_params,
+                                        app_factory, client, *args)
+        self.client = client
+
+    def clientConnectionFailed(self, connector, reason):
+        self.client.fail(reason.getErrorMessage())
+
+    def clientConnectionLost(self, connector, reason):
+        if self.client.connected is None:
+            self.client.fail(reason.getErrorMessage())
+
+
+class PlayerSink(object):
+    def __init__(self, client):
+        self.client = client
+        self._stream = None
+
+    def connect(self, stream):
+        self._stream = stream
+
+    def disconnect(self):
+        self._stream = None
+
+    def start(self):
+        self._stream.set_listeners(data_callback=self.on_data)
+
+    def stop(self):
+        self._stream.unset_listeners()
+
+    def on_data(self, ts, type_, data):
+        self.client.frame_received(type_, data)
+
+
+class LoadApp(BaseClientApp):
+    def __init__(self, protocol, client, run):
+        BaseClientApp.__init__(self, protocol)
+        self.client = client
+        self.run = run
+        self.stream = None
+
+    def connectionMade(self, info):
+        self.client.connected = time.time()
+        self.run.clients_connected.append(self)
+        d = self.createStream()
+        d.addCallback(self.stream_created)
+        d.addErrback(self.failed)
+
+    def stream_created(self, stream):
+        self.stream = stream
+
+    def failed(self, failure):
+        log.info('%s %r failed: %s', self.client.kind, self.client.name,
+                 failure.getErrorMessage())
+        self.client.fail(failure.getErrorMessage())
+        self.disconnect()
+
+    def connectionLost(self, reason):
+        if self.stream:
+            self.closeStream(self.stream, force=True)
+            self.stream = None
+
+    def connectionFailed(self, reason):
+        self.client.fail(reason.getErrorMessage())
+
+
+class PublisherApp(LoadApp):
+    def stream_created(self, stream):
+        LoadApp.stream_created(self, stream)
+        self.source = self.run.make_source()
+        d = stream.publish(self.client.name, self.source)
+        d.addCallback(lambda _: self.run.publisher_started(self))
+        return d
+
+
+class PlayerApp(LoadApp):
+    def stream_created(self, stream):
+        LoadApp.stream_created(self, stream)
+        d = stream.play(self.client.name, PlayerSink(self.client))
+        d.addCallback(self.playing)
+        return d
+
+    def playing(self, _info):
+        self.client.play_started = time.time()
+
+
+class LoadRun(object):
+    # seconds to wait for all the publishers, before starting players
+    publish_timeout = 10.0
+
+    def __init__(self, url, stream_name='load', publishers=1, players=100,
+                 duration=30.0, connect_rate=100.0, source_args=None,
+                 realtime=True, server_pid=None, flv_path=None,
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+        self.url = url
+        self.stream_name = stream_name
+        self.publishers = publishers
+        self.players = players
+        self.duration = duration
+        self.connect_rate = connect_rate
+        self.source_args = source_args or {}
+        self.realtime = realtime
+        self.server_pid = server_pid
+
+        # all the publishers share a single index of the file, built
+        # on start()
+        self.flv_path = flv_path
+        self.flv_index = None
+
+        self.clients = []
+        self.clients_connected = []
+        self._published = 0
+        self._to_connect = None
+        self._ramp = None
+        self._publish_timeout = None
+
+    def make_source(self):
+        if self.flv_index:
+            return FLVFileSource(self.flv_index, loop=True,
+                                 realtime=self.realtime)
+        return SyntheticSource(realtime=self.realtime, **self.source_args)
+
+    def connect(self, kind, name, app_factory):
+        # frame loss can only be told for the synthetic frames
+        client = Client(kind, name, count_lost=not self.flv_path)
+        self.clients.append(client)
+
+        scheme, host, port, app = parse_rtmp_url(self.url)
+        f = LoadClientFactory(self.url, dict(fpad=False), client,
+                              app_factory, self)
+        self.reactor.connectTCP(host, port, f)
+
+    def stream_names(self):
+        return ['%s-%d' % (self.stream_name, i)
+                for i in range(self.publishers)]
+
+    def start(self):
+        if self.flv_path and self.flv_index is None:
+            d = open_index(self.flv_path, self.reactor)
+            d.addCallbacks(self._indexed, self._index_failed)
+            return
+
+        self.t_start = time.time()
+        self.cpu_start = self._cpu_times()
+
+        if self.publishers:
+            for name in self.stream_names():
+                self.connect('publisher', name, PublisherApp)
+            # don't wait forever for the ones failing
+            self._publish_timeout = self.reactor.callLater(
+                self.publish_timeout, self._start_players)
+        else:
+            self._start_players()
+
+    def _indexed(self, index):
+        self.flv_index = index
+        self.start()
+
+    def _index_failed(self, failure):
+        log.error("couldn't index %r: %s", self.flv_path,
+                  failure.getErrorMessage())
+        self.t_start = time.time()
+        self.cpu_start = self._cpu_times()
+        self.finish()
+
+    def publisher_started(self, app):
+        self._published += 1
+        if self._published == self.publishers:
+            self._start_players()
+
+    def _start_players(self):
+        if self._to_connect is not None:
+            return
+        if self._publish_timeout and self._publish_timeout.active():
+            self._publish_timeout.cancel()
+
+        names = self.stream_names() or [self.stream_name]
+        self._to_connect = [names[i % len(names)]
+                            for i in range(self.players)]
+
+        # connecting in batches, at most every 10ms
+        interval = max(0.01, 1.0 / self.connect_rate)
+        self._ramp = task.LoopingCall(self._connect_batch,
+                                      int(self.connect_rate * interval))
+        self._ramp.clock = self.reactor
+        self._ramp.start(interval)
+        self.reactor.callLater(self.duration, self.finish)
+
+    def _connect_batch(self, count):
+        batch, self._to_connect = (self._to_connect[:count],
+                                   self._to_connect[count:])
+        for name in batch:
+            self.connect('player', name, PlayerApp)
+        if not self._to_connect:
+            self._ramp.stop()
+
+    def _cpu_times(self):
+        server = None
+        if self.server_pid:
+            server = process_cpu_time(self.server_pid)
+        own = os.times()
+        return server, own[0] + own[1], time.time()
+
+    def finish(self):
+        if self._ramp and self._ramp.running:
+            self._ramp.stop()
+        cpu_end = self._cpu_times()
+        results = self.results(self.cpu_start, cpu_end)
+
+        for app in self.clients_connected:
+            if app.connected:
+                app.disconnect()
+
+        self.done(results)
+
+    def done(self, results):
+        pass
+
+    def results(self, cpu_start, cpu_end):
+        elapsed = cpu_end[2] - cpu_start[2]
+        ms = lambda t1, t0: (t1 - t0) * 1000.0
+
+        def timing(clients, attr_end, attr_start='started'):
+            return summarize([ms(getattr(c, attr_end),
+                                 getattr(c, attr_start))
+                              for c in clients
+                              if getattr(c, attr_end) is not None])
+
+        players = [c for c in self.clients if c.kind == 'player']
+        receiving = [c for c in players if c.first_frame is not None]
+        now = cpu_end[2]
+
+        cpu = dict(client=None, server=None)
+        if elapsed > 0:
+            cpu['client'] = (cpu_end[1] - cpu_start[1]) * 100.0 / elapsed
+            if cpu_start[0] is not None and cpu_end[0] is not None:
+                cpu['server'] = ((cpu_end[0] - cpu_start[0]) * 100.0 /
+                                 elapsed)
+
+        frames = sum(c.frames for c in players)
+        lost = sum(c.lost for c in players)
+
+        return dict(
+            url=self.url,
+            params=dict(publishers=self.publishers, players=self.players,
+                        duration=self.duration,
+                        connect_rate=self.connect_rate,
+                        realtime=self.realtime,
+                        source=self.flv_path or self.source_args),
+            started=self.t_start,
+            elapsed=elapsed,
+            clients=len(self.clients),
+            connected=len([c for c in self.clients
+                           if c.connected is not None]),
+            failed=len([c for c in self.clients if c.failed is not None]),
+            tcp_connect_ms=timing(self.clients, 'tcp_connected'),
+            handshake_ms=timing(self.clients, 'handshaked',
+                                'tcp_connected'),
+            connect_ms=timing(self.clients, 'connected'),
+            first_frame_ms=timing(players, 'first_frame'),
+            receive_kbps=summarize([c.bytes * 8 / 1000.0 /
+                                    (now - c.first_frame)
+                                    for c in receiving
+                                    if now > c.first_frame]),
+            frames=dict(received=frames, lost=lost,
+                        loss_ratio=(float(lost) / (frames + lost)
+                                    if frames + lost else 0.0)),
+            cpu_percent=cpu,
+            )
+
+
+def run(url, output=None, **kw):
+    import sys
+
+    from twisted.internet import reactor
+
+    from twimp.utils import json
+
+    def done(results):
+        data = json.dumps(results, indent=2, sort_keys=True)
+        if output:
+            f = open(output, 'w')
+            f.write(data + '\n')
+            f.close()
+        else:
+            sys.stdout.write(data + '\n')
+        reactor.stop()
+
+    load = LoadRun(url, **kw)
+    load.done = done
+    reactor.callWhenRunning(load.start)
+    reactor.run()
+
+
+def raise_fd_limit():
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except ValueError:
+            pass
+
+
+def main(argv):
+    import optparse
+
+    install_reactor()
+
+    usage = '%prog [options] URL'
+    epilog = ('URL should be of the form: rtmp://host[:port]/app. '
+              'Publishers publish streams named NAME-0 .. NAME-(N-1), '
+              'players are spread evenly over them.')
+    parser = optparse.OptionParser(usage=usage, epilog=epilog)
+
+    parser.add_option('-p', '--players', action='store', type='int',
+                      dest='players', default=100,
+                      help='number of players (default: %default)')
+    parser.add_option('-P', '--publishers', action='store', type='int',
+                      dest='publishers', default=1,
+                      help=('number of publishers, 0 to play already'
+                            ' published NAME (default: %default)'))
+    parser.add_option('-n', '--name', action='store', dest='name',
+                      default='load',
+                      help='stream name (prefix) (default: %default)')
+    parser.add_option('-t', '--duration', action='store', type='float',
+                      dest='duration', default=30.0,
+                      help=('seconds to run, after starting the players'
+                            ' (default: %default)'))
+    parser.add_option('-c', '--connect-rate', action='store', type='float',
+                      dest='connect_rate', default=100.0,
+                      help=('players connecting per second (default:'
+                            ' %default)'))
+    parser.add_option('-R', '--video-bitrate', action='store',
+                      type='float', dest='vrate', default=400.0,
+                      help='video bitrate in kbit/s (default: %default)')
+    parser.add_option('-r', '--audio-bitrate', action='store',
+                      type='float', dest='arate', default=64.0,
+                      help=('audio bitrate in kbit/s, 0 for no audio'
+                            ' (default: %default)'))
+    parser.add_option('-f', '--frame-rate', action='store', type='float',
+                      dest='frate', default=25.0,
+                      help='video frame rate (default: %default)')
+    parser.add_option('-F', '--flv', action='store', dest='flv',
+                      metavar='FILE',
+                      help=('publish (in a loop) the contents of an FLV'
+                            ' file, instead of synthetic frames'))
+    parser.add_option('-m', '--max-rate', action='store_false',
+                      dest='realtime', default=True,
+                      help=('publish as fast as the server accepts, not'
+                            ' in real-time'))
+    parser.add_option('-s', '--server-pid', action='store', type='int',
+                      dest='server_pid',
+                      help='pid of a local server, to report its CPU usage')
+    parser.add_option('-o', '--output', action='store', dest='output',
+                      metavar='FILE',
+                      help='write the results to FILE (default: stdout)')
+    parser.add_option('-d', '--debug', action='store', dest='debug',
+                      help=('comma separated list of "[CATEGORY:]LEVEL" log'
+                            ' level specifiers'),
+                      metavar='LEVELS')
+
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('No server URL specified.')
+
+    twimp.log.set_levels_from_env()
+    if options.debug:
+        twimp.log.set_levels(options.debug)
+    twimp.log.hook_twisted()
+
+    raise_fd_limit()
+
+    source_args = dict(framerate=options.frate,
+                       video_bitrate=options.vrate,
+                       audio_bitrate=options.arate,
+                       audio=options.arate > 0)
+
+    run(args[0], output=options.output, stream_name=options.name,
+        publishers=options.publishers, players=options.players,
+        duration=options.duration, connect_rate=options.connect_rate,
+        source_args=source_args, realtime=options.realtime,
+        server_pid=options.server_pid, flv_path=options.flv)
+
+
+if __name__ == '__main__':
+    import sys
+
+    main(sys.argv[1:])
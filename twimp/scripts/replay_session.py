@@ -0,0 +1,165 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Replays sessions captured with the capture facility (see
+twimp.capture, simple_live_server --capture) into fresh protocols with
+fake transports: sessions captured by a server into a server running
+the simple live server apps, in this process, ones captured by a
+client into a client protocol. Reports the replay timings as JSON.
+"""
+
+import time
+
+from twisted.internet import defer, reactor
+
+from twimp.capture import read_capture
+from twimp.client import BaseClientApp, SimpleAppClientFactory
+from twimp.replay import SessionReplay
+from twimp.scripts import simple_live_server
+from twimp.server import inmemory
+from twimp.server.appserver import URLDispatchingServerFactory
+
+import twimp.log
+
+
+def server_factory():
+    server = inmemory.IMServer([None, '1', '2'])
+    return URLDispatchingServerFactory(time.time(), server,
+                                       simple_live_server.urls)
+
+
+def client_factory():
+    # (the server responses are replayed, whatever the client sends)
+    return SimpleAppClientFactory('rtmp://localhost/replay', {},
+                                  BaseClientApp)
+
+
+class ReplayRun(object):
+    """Replays each of the files copies times, all of them at once."""
+
+    def __init__(self, paths, copies=1, realtime=False):
+        self.paths = paths
+        self.copies = copies
+        self.realtime = realtime
+
+        self._server_factory = None
+        self._client_factory = None
+        self._replays = []
+        self.results = []
+
+    def _factory(self, is_client):
+        if is_client:
+            if self._client_factory is None:
+                self._client_factory = client_factory()
+            return self._client_factory
+        if self._server_factory is None:
+            self._server_factory = server_factory()
+        return self._server_factory
+
+    def start(self):
+        self.t_start = time.time()
+        ds = []
+        for path in self.paths:
+            for i in range(self.copies):
+                f = open(path, 'rb')
+                is_client, started, records = read_capture(f)
+                factory = self._factory(is_client)
+                replay = SessionReplay(records, factory.buildProtocol(None),
+                                       realtime=self.realtime)
+                d = replay.start()
+                d.addCallback(self._replayed, path, f)
+                ds.append(d)
+        return defer.DeferredList(ds).addCallback(self._done)
+
+    def _replayed(self, stats, path, f):
+        f.close()
+        stats['file'] = path
+        self.results.append(stats)
+
+    def _done(self, _result):
+        elapsed = time.time() - self.t_start
+        bytes_in = sum(r['bytes_in'] for r in self.results)
+        return dict(files=len(self.paths), copies=self.copies,
+                    realtime=self.realtime, elapsed=elapsed,
+                    bytes_in=bytes_in,
+                    bytes_out=sum(r['bytes_out'] for r in self.results),
+                    failed=len([r for r in self.results if r['error']]),
+                    mbytes_per_second=(bytes_in / elapsed / 1e6
+                                       if elapsed > 0 else None),
+                    sessions=self.results)
+
+
+def run(paths, output=None, **kw):
+    import sys
+
+    from twimp.utils import json
+
+    def done(results):
+        data = json.dumps(results, indent=2, sort_keys=True)
+        if output:
+            f = open(output, 'w')
+            f.write(data + '\n')
+            f.close()
+        else:
+            sys.stdout.write(data + '\n')
+        reactor.stop()
+
+    def start():
+        replay = ReplayRun(paths, **kw)
+        replay.start().addCallback(done)
+
+    reactor.callWhenRunning(start)
+    reactor.run()
+
+
+def main(argv):
+    import optparse
+
+    usage = '%prog [options] FILE [FILE ...]'
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option('-r', '--realtime', action='store_true',
+                      dest='realtime', default=False,
+                      help=('replay at the pace the data was captured'
+                            ' (default: as fast as possible)'))
+    parser.add_option('-n', '--copies', action='store', type='int',
+                      dest='copies', default=1, metavar='N',
+                      help=('replay N copies of each session at once'
+                            ' (default: %default)'))
+    parser.add_option('-o', '--output', action='store', dest='output',
+                      metavar='FILE',
+                      help='write the results to FILE (default: stdout)')
+    parser.add_option('-d', '--debug', action='store', dest='debug',
+                      help=('comma separated list of "[CATEGORY:]LEVEL" log'
+                            ' level specifiers'),
+                      metavar='LEVELS')
+
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error('No capture files specified.')
+
+    twimp.log.set_levels_from_env()
+    if options.debug:
+        twimp.log.set_levels(options.debug)
+    twimp.log.hook_twisted()
+
+    run(args, output=options.output, copies=options.copies,
+        realtime=options.realtime)
+
+
+if __name__ == '__main__':
+    import sys
+
+    main(sys.argv[1:])
@@ -16,10 +16,18 @@
 from twisted.internet import reactor, error
 
 from twimp.amf0 import Object
+from twimp.capture import SessionCapturer
 from twimp.error import CallResultError, InvalidAppError
+from twimp.handshake import HandshakeWorkers
+from twimp.metrics import MetricsRegistry
+from twimp.profiling import Profiler
+from twimp.server.admission import AdmissionControl
 from twimp.server.appserver import URLDispatchingServerFactory, make_urls
 from twimp.server.controllers import RTMPPlayer, RTMPRecorder
-from twimp.server import inmemory
+from twimp.server.latency import FrameTracer
+from twimp.server import cluster, edge, inmemory, recording
+from twimp.server.stats import listen_stats
+from twimp.timeouts import ConnectionTimeouts
 
 LOG_CATEGORY = 'livesrv'
 import twimp.log
@@ -35,14 +43,16 @@ SERVER_VERSION = (1, 0, 0, 0)
 class SimplePublishPlayApp(object):
     # implements(IServerApp)
 
-    sg = None
-    ctrl = None
     ns = None
 
     def __init__(self, protocol, server):
         self.protocol = protocol
         self.server = server
 
+        # many streams may be played/published over the connection:
+        # { net stream id => (streamgroup, controller) }
+        self._sessions = {}
+
     def connect(self, request, req_opts):
         log.info('connect(%r, %r)', request, req_opts)
 
@@ -70,11 +80,11 @@ class SimplePublishPlayApp(object):
         log.info('opening stream %r', stream_name)
 
         def got_streamgroup(streamgroup):
-            self.sg = streamgroup
             log.debug('starting playing %r', streamgroup)
 
-            self.ctrl = c = RTMPPlayer(streamgroup)
-            c.connect(net_stream)
+            c = RTMPPlayer(streamgroup)
+            self._start_session(net_stream, streamgroup, c, 'play',
+                                stream_name)
 
             log.debug('calling c.start()...')
             d = c.start()
@@ -96,10 +106,9 @@ class SimplePublishPlayApp(object):
             raise CallResultError('only live streams for now')
 
         def got_streamgroup(streamgroup):
-            self.sg = streamgroup
-
-            self.ctrl = r = RTMPRecorder(streamgroup)
-            r.connect(net_stream)
+            r = RTMPRecorder(streamgroup)
+            self._start_session(net_stream, streamgroup, r, 'publish',
+                                stream_name)
 
             d = r.start()
             return d
@@ -120,17 +129,52 @@ class SimplePublishPlayApp(object):
         d.addCallback(got_streamgroup)
         return d
 
-    def connectionLost(self, reason):
-        log.info('app connection lost: %r (%r)', reason, self.sg)
+    def _start_session(self, net_stream, streamgroup, ctrl, kind, name):
+        # a stream played/published again replaces the old session
+        self._stop_session(net_stream.id)
+        self._sessions[net_stream.id] = streamgroup, ctrl
+        if self.ns:
+            name = '%s/%s' % (self.ns, name)
+        metrics = self.protocol.factory.metrics
+        if metrics is not None:
+            ctrl.metrics = metrics.open_session(kind, name, self.protocol)
+        tracer = self.protocol.factory.tracer
+        if tracer is not None:
+            peer = self.protocol.transport.getPeer()
+            ctrl.tracer = tracer
+            ctrl.trace_name = name
+            ctrl.trace_label = '%s:%s/%d' % (getattr(peer, 'host', None),
+                                             getattr(peer, 'port', None),
+                                             net_stream.id)
+        ctrl.connect(net_stream)
+
+    def _stop_session(self, ms_id):
+        session = self._sessions.pop(ms_id, None)
+        if session is None:
+            return
+
+        sg, ctrl = session
+        ctrl.stop()
+        ctrl.disconnect()
+        if ctrl.metrics is not None:
+            ctrl.metrics.close()
+        if ctrl.tracer is not None:
+            ctrl.tracer.forget(ctrl.trace_label)
+        self.server.close(sg)
+
+    def remote_closeStream(self, ts, net_stream, *args):
+        log.info('closing stream %r', net_stream.id)
+        self._stop_session(net_stream.id)
+
+    def stream_deleted(self, net_stream):
+        self._stop_session(net_stream.id)
 
-        if self.ctrl:
-            self.ctrl.stop()
-            self.ctrl.disconnect()
-            self.ctrl = None
+    def connectionLost(self, reason):
+        log.info('app connection lost: %r (%r)', reason,
+                 [s[0] for s in self._sessions.values()])
 
-        if self.sg:
-            sg, self.sg = self.sg, None
-            self.server.close(sg)
+        for ms_id in self._sessions.keys():
+            self._stop_session(ms_id)
 
 
 # _very_ simple example of how url/url-params can be used for authentication
@@ -154,18 +198,75 @@ urls = make_urls(
     )
 
 
-def run(main_port=1935, *other_ports):
+def run(main_port=1935, *other_ports, **kw):
     import time
     # enabling a couple of namespaces, for the use of the parametrized app
     namespaces = [None, '1', '2']
-    factory = URLDispatchingServerFactory(time.time(),
-                                          inmemory.IMServer(namespaces),
-                                          urls)
+    server = inmemory.IMServer(namespaces)
+
+    record_dir = kw.get('record_dir')
+    if record_dir:
+        # record every published stream into an FLV file
+        server = recording.RecordingServer(server, record_dir)
+
+    listen = reactor.listenTCP
+    worker_id = kw.get('worker_id')
+    if worker_id is not None:
+        # one of many worker processes, sharing ports and streams
+        server = cluster.ClusterServer(server, kw['run_dir'], worker_id,
+                                       namespaces)
+        server.start()
+        listen = cluster.listen_reuseport
+
+    origin = kw.get('origin')
+    if origin:
+        # an edge: streams not published here get pulled from the origin
+        server = edge.EdgeServer(server, origin, namespaces)
+
+    factory = URLDispatchingServerFactory(time.time(), server, urls)
+    handshake_threads = kw.get('handshake_threads')
+    if handshake_threads:
+        # keep the crypto handshakes off the reactor thread
+        factory.handshake_workers = HandshakeWorkers(handshake_threads)
+    limits = kw.get('limits')
+    if limits:
+        # refuse new connections beyond the limits
+        factory.admission = AdmissionControl(**limits)
+    timeouts = kw.get('timeouts')
+    if timeouts is not None:
+        # close the connections stalled in any phase
+        factory.timeouts = ConnectionTimeouts(**timeouts)
+    profiler = None
+    if kw.get('profile'):
+        # time the hot paths, dumping the percentiles when done
+        profiler = Profiler()
+        profiler.enable()
+        reactor.addSystemEventTrigger('after', 'shutdown', _dump_report,
+                                      profiler, worker_id)
+    trace_sample = kw.get('trace_sample')
+    if trace_sample:
+        # trace one of every trace_sample frames through the server
+        factory.tracer = FrameTracer(trace_sample)
+        reactor.addSystemEventTrigger('after', 'shutdown', _dump_report,
+                                      factory.tracer, worker_id)
+    capture_dir = kw.get('capture_dir')
+    if capture_dir:
+        # capture the raw sessions, for replaying them later
+        factory.capture = SessionCapturer(capture_dir,
+                                          kw.get('capture_sample'))
+    stats_port = kw.get('stats_port')
+    if stats_port:
+        # count everything, and serve the counters over HTTP
+        if worker_id is not None:
+            # (each worker counts its own connections)
+            stats_port += worker_id
+        factory.metrics = MetricsRegistry()
+        listen_stats(stats_port, factory.metrics, profiler, factory.tracer)
 
     listening_any = False
     for port in (main_port,) + other_ports:
         try:
-            reactor.listenTCP(port, factory)
+            listen(port, factory)
             listening_any = True
         except error.CannotListenError, e:
             log.warn(e)
@@ -176,6 +277,24 @@ def run(main_port=1935, *other_ports):
         reactor.run()
 
 
+def _dump_report(reporter, worker_id=None):
+    import sys
+
+    if worker_id is not None:
+        sys.stderr.write('worker %d:\n' % (worker_id,))
+    sys.stderr.write(reporter.format_report() + '\n')
+
+
+def run_workers(count, argv, run_dir):
+    import sys
+
+    argv = ([sys.executable, '-m', 'twimp.scripts.simple_live_server'] +
+            argv + ['--run-dir', run_dir, '--worker-id'])
+    pool = cluster.WorkerPool(argv, count)
+    reactor.callWhenRunning(pool.start)
+    reactor.run()
+
+
 def main(argv):
     import optparse
 
@@ -191,15 +310,136 @@ def main(argv):
     parser.add_option('-v', '--verbose', action='store_const', const='info',
                       dest='debug',
                       help='equvalent to "-d info"')
+    parser.add_option('-r', '--record', action='store', dest='record_dir',
+                      metavar='DIR',
+                      help='record published streams into FLV files in DIR')
+    parser.add_option('-o', '--origin', action='store', dest='origin',
+                      metavar='URL',
+                      help=('pull streams not published locally from the'
+                            ' origin server at URL (rtmp://host[:port]/app)'))
+    parser.add_option('-w', '--workers', action='store', type='int',
+                      dest='workers', default=1, metavar='N',
+                      help='run N worker processes, sharing the ports')
+    parser.add_option('-H', '--handshake-threads', action='store',
+                      type='int', dest='handshake_threads', metavar='N',
+                      help=('compute the handshakes in N threads, off the'
+                            ' main (reactor) thread'))
+    parser.add_option('--max-connections', action='store', type='int',
+                      dest='max_connections', metavar='N',
+                      help='refuse connections beyond N')
+    parser.add_option('--max-handshakes', action='store', type='int',
+                      dest='max_handshakes', metavar='N',
+                      help=('refuse connections while N others are'
+                            ' handshaking'))
+    parser.add_option('--connect-rate', action='store', type='float',
+                      dest='rate', metavar='RATE',
+                      help=('refuse more than RATE connections per second'
+                            ' (in bursts of 10) from any address'))
+    parser.add_option('-T', '--timeouts', action='store', dest='timeouts',
+                      metavar='SPEC',
+                      help=('close stalled connections: SPEC is "default"'
+                            ' or a comma separated list of "PHASE:SECONDS"'
+                            ' (phases: %s)'
+                            % ', '.join(ConnectionTimeouts.phases)))
+    parser.add_option('-S', '--stats-port', action='store', type='int',
+                      dest='stats_port', metavar='PORT',
+                      help=('serve the connection and stream counters over'
+                            ' HTTP on PORT (at /stats as JSON, at /metrics'
+                            ' for Prometheus); with many workers, worker N'
+                            ' serves on PORT + N'))
+    parser.add_option('-P', '--profile', action='store_true',
+                      dest='profile', default=False,
+                      help=('time the hot paths, printing the latency'
+                            ' percentiles on exit (and serving them at'
+                            ' /profile, with --stats-port)'))
+    parser.add_option('-L', '--trace-latency', action='store', type='int',
+                      dest='trace_sample', metavar='N',
+                      help=('trace one of every N frames from the'
+                            ' publishers to the players, printing the'
+                            ' latency percentiles on exit (and serving them'
+                            ' at /latency, with --stats-port)'))
+    parser.add_option('-C', '--capture', action='store', dest='capture_dir',
+                      metavar='DIR',
+                      help=('capture the data of the connections into'
+                            ' files in DIR, for replaying them with'
+                            ' twimp.scripts.replay_session'))
+    parser.add_option('--capture-sample', action='store', type='int',
+                      dest='capture_sample', metavar='N',
+                      help='capture only one of every N connections')
+    parser.add_option('--run-dir', action='store', dest='run_dir',
+                      metavar='DIR',
+                      help=('directory for the workers to share (stream'
+                            ' registry, sockets), best on tmpfs'))
+    parser.add_option('--worker-id', action='store', type='int',
+                      dest='worker_id', help=optparse.SUPPRESS_HELP)
 
     options, args = parser.parse_args(argv)
+    if options.worker_id is not None and not options.run_dir:
+        parser.error('--worker-id requires --run-dir')
 
     twimp.log.set_levels_from_env()
     if options.debug:
         twimp.log.set_levels(options.debug)
     twimp.log.hook_twisted()
 
-    run(*map(int, args))
+    timeouts = None
+    if options.timeouts:
+        timeouts = {}
+        if options.timeouts != 'default':
+            try:
+                for spec in options.timeouts.split(','):
+                    phase, seconds = spec.split(':')
+                    if phase not in ConnectionTimeouts.phases:
+                        raise ValueError(phase)
+                    timeouts[phase] = float(seconds)
+            except ValueError:
+                parser.error('Invalid timeouts: %r' % options.timeouts)
+
+    if options.workers > 1 and options.worker_id is None:
+        run_dir = options.run_dir
+        if not run_dir:
+            import tempfile
+            run_dir = tempfile.mkdtemp(prefix='twimp-')
+        worker_argv = list(args)
+        if options.debug:
+            worker_argv += ['-d', options.debug]
+        if options.record_dir:
+            worker_argv += ['-r', options.record_dir]
+        if options.origin:
+            worker_argv += ['-o', options.origin]
+        if options.handshake_threads:
+            worker_argv += ['-H', str(options.handshake_threads)]
+        # (the limits apply to each of the workers)
+        for opt, value in (('--max-connections', options.max_connections),
+                           ('--max-handshakes', options.max_handshakes),
+                           ('--connect-rate', options.rate)):
+            if value is not None:
+                worker_argv += [opt, str(value)]
+        if options.timeouts:
+            worker_argv += ['-T', options.timeouts]
+        if options.stats_port:
+            worker_argv += ['-S', str(options.stats_port)]
+        if options.profile:
+            worker_argv += ['-P']
+        if options.trace_sample:
+            worker_argv += ['-L', str(options.trace_sample)]
+        if options.capture_dir:
+            worker_argv += ['-C', options.capture_dir]
+        if options.capture_sample:
+            worker_argv += ['--capture-sample', str(options.capture_sample)]
+        run_workers(options.workers, worker_argv, run_dir)
+        return
+
+    limits = dict((name, getattr(options, name))
+                  for name in ('max_connections', 'max_handshakes', 'rate')
+                  if getattr(options, name) is not None)
+    run(*map(int, args), record_dir=options.record_dir,
+        worker_id=options.worker_id, run_dir=options.run_dir,
+        origin=options.origin, handshake_threads=options.handshake_threads,
+        limits=limits, timeouts=timeouts, stats_port=options.stats_port,
+        profile=options.profile, trace_sample=options.trace_sample,
+        capture_dir=options.capture_dir,
+        capture_sample=options.capture_sample)
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,131 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Admission control: refusing new connections when overloaded, right
+after accepting the sockets - before any handshake work is done.
+"""
+
+LOG_CATEGORY = 'admission'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class AdmissionControl(object):
+    """Limits the connections of a server factory (see
+    BaseFactory.admission): the number of connections, the number of
+    them still handshaking, and the rate of new connections from any
+    single address (a token bucket per address: rate connections per
+    second, in bursts of up to burst).
+
+    Limits left as None are not enforced.
+    """
+
+    max_connections = None
+    max_handshakes = None
+    rate = None
+    burst = 10
+
+    def __init__(self, max_connections=None, max_handshakes=None,
+                 rate=None, burst=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if max_handshakes is not None:
+            self.max_handshakes = max_handshakes
+        if rate is not None:
+            self.rate = rate
+        if burst is not None:
+            self.burst = burst
+
+        self._conns = set()
+        self._handshaking = set()
+        # { host => (tokens, time) }
+        self._buckets = {}
+        self._prune_at = 1024
+
+        # { reason => count }
+        self.rejected = dict(connections=0, handshakes=0, rate=0)
+
+    def connections(self):
+        """Return the number of connections admitted and still open."""
+        return len(self._conns)
+
+    def handshakes(self):
+        """Return the number of connections admitted and still
+        handshaking."""
+        return len(self._handshaking)
+
+    def admit(self, addr):
+        """Return whether to accept a new connection from addr."""
+        if (self.max_connections is not None and
+            len(self._conns) >= self.max_connections):
+            return self._reject('connections', addr)
+        if (self.max_handshakes is not None and
+            len(self._handshaking) >= self.max_handshakes):
+            return self._reject('handshakes', addr)
+        if self.rate is not None and not self._take_token(addr):
+            return self._reject('rate', addr)
+        return True
+
+    def _reject(self, reason, addr):
+        self.rejected[reason] += 1
+        log.debug('refusing connection from %s (%s)',
+                  getattr(addr, 'host', addr), reason)
+        return False
+
+    def _take_token(self, addr):
+        host = getattr(addr, 'host', None)
+        now = self.reactor.seconds()
+        buckets = self._buckets
+
+        bucket = buckets.get(host)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+        if tokens < 1:
+            buckets[host] = (tokens, now)
+            return False
+        buckets[host] = (tokens - 1, now)
+
+        if len(buckets) > self._prune_at:
+            self._prune(now)
+        return True
+
+    def _prune(self, now):
+        # full buckets are as good as none
+        burst, rate = self.burst, self.rate
+        for host, (tokens, t) in self._buckets.items():
+            if tokens + (now - t) * rate >= burst:
+                del self._buckets[host]
+        self._prune_at = max(1024, 2 * len(self._buckets))
+
+    ##
+    # called by the protocols admitted
+
+    def opened(self, protocol):
+        self._conns.add(protocol)
+        self._handshaking.add(protocol)
+
+    def handshake_done(self, protocol):
+        self._handshaking.discard(protocol)
+
+    def closed(self, protocol):
+        self._conns.discard(protocol)
+        self._handshaking.discard(protocol)
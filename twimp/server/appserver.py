@@ -68,8 +68,9 @@ class NetStream(object):
                        p.route_mute_messages):
             method(self.id, None)
 
-    def send(self, ts, type_, data):
-        return self.protocol.muxer.sendMessage(ts, type_, self.id, data)
+    def send(self, ts, type_, data, written=None):
+        return self.protocol.muxer.sendMessage(ts, type_, self.id, data,
+                                               written=written)
 
     def asend(self, ts, type_, *args):
         # AMF-encode args and send using our stream_id
@@ -175,6 +176,8 @@ class AppDispatchServerProtocol(CDP):
         self._nsmgr = NetStreamManager()
 
         self._connected = False
+        # the factory's FrameTracer, if any
+        self._tracer = None
 
         self._data_routes = {}
         self._meta_routes = {}
@@ -184,6 +187,7 @@ class AppDispatchServerProtocol(CDP):
     def handshakeSucceeded(self, init_ts, hs_delay):
         CDP.handshakeSucceeded(self, init_ts, hs_delay)
         self.transport.setTcpNoDelay(1)
+        self._tracer = getattr(self.factory, 'tracer', None)
 
     def connectionLost(self, reason=protocol.connectionDone):
         if self._app:           # check self._connected ?
@@ -235,6 +239,7 @@ class AppDispatchServerProtocol(CDP):
 
     def _connect_succeeded(self, result):
         self._connected = True
+        self.set_timeout_phase('command')
 
         sm = self.muxer.sendMessage
         sm(0, chunks.PROTO_WINDOW_SIZE, 0, vb('002625a0'.decode('hex')))
@@ -255,6 +260,19 @@ class AppDispatchServerProtocol(CDP):
 
         return None, s.id
 
+    @check_connected_remote
+    def remote_deleteStream(self, ts, ms_id, _none, stream_id):
+        ns = self._nsmgr.get_stream(int(stream_id))
+        if not ns:
+            return
+
+        log.info('deleting message stream: %r', ns.id)
+        handler_m = getattr(self._app, 'stream_deleted', None)
+        if handler_m:
+            handler_m(ns)
+        ns.close()
+        self._nsmgr.del_stream(ns.id)
+
     @check_connected_remote
     def remote_play(self, ts, ms_id, *args):
         return self._call_play(ms_id, args)
@@ -276,6 +294,7 @@ class AppDispatchServerProtocol(CDP):
 
         def play_cb(result):
             log.debug('play handler done')
+            self.set_timeout_phase('idle')
             return result
 
         d = defer.maybeDeferred(self._app.play, ns, *args[1:])
@@ -287,7 +306,12 @@ class AppDispatchServerProtocol(CDP):
         if not ns:
             raise CallResultError('invalid stream %r' % (ms_id,))
 
+        def publish_cb(result):
+            self.set_timeout_phase('idle')
+            return result
+
         d = defer.maybeDeferred(self._app.publish, ns, *args[1:])
+        d.addCallback(publish_cb)
         return d
 
     def _set_route_messages(self, ms_id, callback, table):
@@ -322,6 +346,8 @@ class AppDispatchServerProtocol(CDP):
         handler = self._data_routes.get(ms_id)
 
         if handler:
+            if self._tracer is not None:
+                self._tracer.received()
             handler(ts, msg_type, body)
         elif not self._connected:
             self._fail('not connected')
@@ -352,6 +378,9 @@ class AppDispatchServerProtocol(CDP):
 class AppDispatchServerFactory(EventDispatchFactory):
     protocol = AppDispatchServerProtocol
     server = None
+    # a FrameTracer instance (see twimp.server.latency), for the apps
+    # to trace the latency of the live streams with
+    tracer = None
 
     def __init__(self, init_time, server):
         EventDispatchFactory.__init__(self, init_time)
@@ -0,0 +1,719 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Running a server in multiple worker processes.
+
+All the workers accept connections on the same port (SO_REUSEPORT).
+A stream published in one worker gets registered as owned by it, in a
+registry shared by the workers - a directory (preferably on tmpfs)
+with an entry per stream. Play requests for streams published in other
+workers are served from local mirrors, fed over a Unix socket link
+from the owning worker with (grpos, flags, data) frames and headers.
+"""
+
+import errno
+import fcntl
+import os
+import socket
+import struct
+import sys
+import urllib
+
+from zope.interface import implements
+
+from twisted.internet import defer, protocol
+from twisted.protocols import basic
+
+from twimp import amf0
+from twimp import chunks
+from twimp.primitives import _s_ulong_b
+from twimp.server.interfaces import IStreamServer
+from twimp.server.controllers import DefaultCachePolicy, frame_writer
+from twimp.server.controllers import TYPE_AUDIO, TYPE_VIDEO
+from twimp.server.errors import StreamExistsError, StreamNotFoundError
+from twimp.server import inmemory
+from twimp.utils import run_in_thread
+from twimp.vecbuf import VecBuf, semiflatten
+
+LOG_CATEGORY = 'cluster'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+# not always exported by the socket module, the value is Linux-specific
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+def listen_reuseport(port, factory, interface='', backlog=50, reactor=None):
+    """Like reactor.listenTCP(), but with SO_REUSEPORT set on the
+    listening socket, so that many processes can listen on the same
+    port, connections getting spread between them by the kernel.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        s.bind((interface, port))
+        s.listen(backlog)
+        s.setblocking(False)
+        return reactor.adoptStreamPort(s.fileno(), socket.AF_INET, factory)
+    finally:
+        # the reactor has its own copy of the descriptor by now
+        s.close()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class StreamRegistry(object):
+    """Maps published streams to the workers owning them.
+
+    An entry is a file named after the stream, holding the owner's
+    worker id and pid - created exclusively (and complete, hard linked
+    from a temporary file), so at most one worker can own a stream at a
+    time. Entries left over by dead processes are taken over, replaced
+    while holding a lock on the registry, after checking they're still
+    stale.
+
+    claim() may block on the lock (held by another worker), so it's
+    best called in a thread.
+    """
+    def __init__(self, path, worker_id):
+        self.path = path
+        self.worker_id = worker_id
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def entry_path(self, namespace, name):
+        return os.path.join(self.path, '%s@%s' % (
+                urllib.quote(namespace or '', safe=''),
+                urllib.quote(name, safe='')))
+
+    def _read(self, path):
+        try:
+            f = open(path, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        try:
+            worker_id, pid = map(int, data.split())
+        except ValueError:
+            # not fully written yet, or garbage
+            return None
+        return worker_id, pid
+
+    def _lock(self):
+        fd = os.open(os.path.join(self.path, '.lock'),
+                     os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except:
+            os.close(fd)
+            raise
+        return fd
+
+    def _unlock(self, fd):
+        os.close(fd)
+
+    def claim(self, namespace, name):
+        """
+        @return: True if claimed, False if owned by some other worker
+        """
+        path = self.entry_path(namespace, name)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        f = open(tmp_path, 'wb')
+        try:
+            f.write('%d %d\n' % (self.worker_id, os.getpid()))
+        finally:
+            f.close()
+
+        try:
+            try:
+                os.link(tmp_path, path)
+                return True
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            lock = self._lock()
+            try:
+                # the other workers might have been faster
+                owner = self._read(path)
+                if owner is not None and _pid_alive(owner[1]):
+                    return False
+                log.info('taking over stale registry entry %r', path)
+                os.rename(tmp_path, path)
+                return True
+            finally:
+                self._unlock(lock)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def release(self, namespace, name):
+        path = self.entry_path(namespace, name)
+        owner = self._read(path)
+        if owner is not None and owner == (self.worker_id, os.getpid()):
+            os.unlink(path)
+
+    def lookup(self, namespace, name):
+        """
+        @return: id of the worker owning the stream, or None
+        """
+        owner = self._read(self.entry_path(namespace, name))
+        if owner is None or not _pid_alive(owner[1]):
+            return None
+        return owner[0]
+
+
+# relay link message types
+MSG_OPEN = 1        # AMF0: namespace, name
+MSG_GROUP = 2       # AMF0: group meta, [stream params, ...]
+MSG_HEADER = 3      # stream header data
+MSG_FRAME = 4       # stream frame data
+MSG_READY = 5       # headers and preroll frames sent, live from now on
+MSG_END = 6         # the stream is gone
+MSG_ERROR = 7       # AMF0: error message
+
+# every message: message type, stream index, grpos, flags + data
+_s_msg_header = struct.Struct('>BBqL')
+
+_msg_types = {TYPE_AUDIO: chunks.MSG_AUDIO,
+              TYPE_VIDEO: chunks.MSG_VIDEO}
+
+
+class RelayProtocol(basic.Int32StringReceiver):
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def send_msg(self, type_, stream=0, grpos=0, flags=0, data=''):
+        if isinstance(data, (str, buffer)):
+            size, seq = len(data), [data]
+        else:
+            size = len(data)
+            seq = data.peek_seq(size)
+
+        header = _s_msg_header.pack(type_, stream, grpos, flags)
+        self.transport.writeSequence(
+            semiflatten([_s_ulong_b.pack(len(header) + size), header] + seq))
+
+    def send_values(self, type_, *values):
+        self.send_msg(type_, data=amf0.encode(*values))
+
+    def stringReceived(self, s):
+        type_, stream, grpos, flags = _s_msg_header.unpack_from(s)
+        data = buffer(s, _s_msg_header.size)
+        self.msgReceived(type_, stream, grpos, flags, data)
+
+    def msgReceived(self, type_, stream, grpos, flags, data):
+        pass
+
+    def lengthLimitExceeded(self, length):
+        log.error('relay message too long: %d', length)
+        self.transport.loseConnection()
+
+
+def _decode_values(data):
+    return amf0.decode(VecBuf([data]))
+
+
+class RelayOriginProtocol(RelayProtocol):
+    """Serves a single locally published stream group to a mirror in
+    another worker.
+    """
+    def __init__(self):
+        self.key = None
+        self.sg = None
+        self._subscriptions = []
+        self._closed = False
+
+    def msgReceived(self, type_, stream, grpos, flags, data):
+        if type_ != MSG_OPEN or self.key is not None:
+            log.warning('unexpected relay message: %r', type_)
+            self.transport.loseConnection()
+            return
+
+        namespace, name = _decode_values(data)
+        self.key = (namespace, name)
+        self.factory.links.setdefault(self.key, set()).add(self)
+
+        d = self.factory.server.open(name, namespace=namespace)
+        d.addCallback(self._opened)
+        d.addErrback(self._failed)
+
+    def _opened(self, sg):
+        self.sg = sg
+        if self._closed:
+            return self.factory.server.close(sg)
+
+        d = sg.streams()
+        d.addCallback(self._got_streams)
+        return d
+
+    def _got_streams(self, streams):
+        dl = defer.DeferredList([s.params() for s in streams],
+                                fireOnOneErrback=1, consumeErrors=1)
+        dl.addCallback(lambda results: [r[1] for r in results])
+        dl.addCallback(lambda params: self.sg.meta().addCallback(
+                lambda meta: self._start(streams, params, meta)))
+        return dl
+
+    def _start(self, streams, params, meta):
+        if self._closed:
+            return
+
+        self.send_values(MSG_GROUP, meta, params)
+
+        types = [_msg_types.get(p.get('type')) for p in params]
+        preroll = self.factory.cache_policy(meta, types)
+
+        def sender(type_, i):
+            def send(grpos, flags, data):
+                self.send_msg(type_, i, grpos, flags, data)
+            return send
+
+        ds = []
+        for i, (s, p) in enumerate(zip(streams, preroll)):
+            s.read_headers(sender(MSG_HEADER, i))
+            grpos_range, frames, flag_mask = p or (0, 0, 0)
+            d = s.subscribe(sender(MSG_FRAME, i),
+                            preroll_grpos_range=grpos_range or 0,
+                            preroll_frames=frames or 0, flag_mask=flag_mask)
+            d.addCallback(lambda subscr, s=s:
+                              self._subscriptions.append((s, subscr)))
+            ds.append(d)
+
+        def subscribed(_result):
+            if not self._closed:
+                self.send_msg(MSG_READY)
+
+        d = defer.DeferredList(ds, fireOnOneErrback=1, consumeErrors=1)
+        d.addCallback(subscribed)
+        return d
+
+    def _failed(self, failure):
+        log.info('relaying %r failed: %s', self.key, failure.value)
+        if not self._closed:
+            self.send_values(MSG_ERROR, str(failure.value))
+            self.transport.loseConnection()
+
+    def end(self):
+        self.send_msg(MSG_END)
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self._closed = True
+        links = self.factory.links.get(self.key)
+        if links:
+            links.discard(self)
+            if not links:
+                del self.factory.links[self.key]
+
+        for s, subscr in self._subscriptions:
+            s.unsubscribe(subscr)
+        self._subscriptions = []
+
+        if self.sg is not None:
+            sg, self.sg = self.sg, None
+            self.factory.server.close(sg)
+
+
+class RelayOriginFactory(protocol.ServerFactory):
+    protocol = RelayOriginProtocol
+
+    def __init__(self, server, cache_policy):
+        self.server = server
+        self.cache_policy = cache_policy
+        # links: { (namespace, name) => set([RelayOriginProtocol, ...]) }
+        self.links = {}
+
+    def stream_closed(self, namespace, name):
+        for p in list(self.links.get((namespace, name), ())):
+            p.end()
+
+
+class RelayMirrorProtocol(RelayProtocol):
+    def connectionMade(self):
+        self.factory.mirror.link_made(self)
+
+    def msgReceived(self, type_, stream, grpos, flags, data):
+        self.factory.mirror.msg_received(type_, stream, grpos, flags, data)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.factory.mirror.link_lost(reason)
+
+
+class RelayMirrorFactory(protocol.ClientFactory):
+    protocol = RelayMirrorProtocol
+
+    def __init__(self, mirror):
+        self.mirror = mirror
+
+    def clientConnectionFailed(self, connector, reason):
+        self.mirror.link_lost(reason)
+
+
+class _Mirror(object):
+    """A local, in-memory copy of a stream group published in another
+    worker, shared by all the local readers of the stream.
+    """
+    def __init__(self, cluster, namespace, name, owner):
+        self.cluster = cluster
+        self.namespace = namespace
+        self.name = name
+        self.owner = owner
+
+        self.refs = 0
+        self.link = None
+        self.sg = None
+        self.streams = None
+        self._writers = None
+        self.ready = False
+        self.closed = False
+        self._waiting = []
+
+    def connect(self):
+        c = self.cluster
+        c.reactor.connectUNIX(c.socket_path(self.owner),
+                              RelayMirrorFactory(self))
+
+    def open(self):
+        d = defer.Deferred()
+        if self.ready:
+            self._open_reader(d)
+        else:
+            self._waiting.append(d)
+        return d
+
+    def _open_reader(self, d):
+        rd = self.cluster.mirror_server.open(self.name,
+                                             namespace=self.namespace)
+        rd.addCallback(self._attach)
+        rd.chainDeferred(d)
+
+    def _attach(self, sg):
+        self.refs += 1
+        self.cluster._readers[sg] = self
+        return sg
+
+    def detach(self):
+        self.refs -= 1
+        if self.refs <= 0:
+            self.close()
+
+    def link_made(self, link):
+        if self.closed:
+            link.transport.loseConnection()
+            return
+        self.link = link
+        link.send_values(MSG_OPEN, self.namespace, self.name)
+
+    def msg_received(self, type_, stream, grpos, flags, data):
+        if self.streams is None and type_ in (MSG_FRAME, MSG_HEADER,
+                                              MSG_READY):
+            # setting up failed
+            return
+
+        if type_ == MSG_FRAME:
+            self._writers[stream](grpos, flags, VecBuf([data]))
+        elif type_ == MSG_HEADER:
+            self.streams[stream].write_headers(VecBuf([data[:]]), grpos,
+                                               flags)
+        elif type_ == MSG_READY:
+            self.ready = True
+            waiting, self._waiting = self._waiting, []
+            for w in waiting:
+                self._open_reader(w)
+        elif type_ == MSG_GROUP:
+            meta, params = _decode_values(data)
+            d = self._setup(dict(meta), [dict(p) for p in params])
+            d.addErrback(self._setup_failed)
+        elif type_ == MSG_END:
+            self.close()
+        elif type_ == MSG_ERROR:
+            message, = _decode_values(data)
+            self.close(StreamNotFoundError(message))
+
+    def _setup(self, meta, params):
+        server = self.cluster.mirror_server
+        d = server.open(self.name, mode='l', namespace=self.namespace)
+
+        def opened(sg):
+            self.sg = sg
+            return sg.set_meta(meta)
+
+        def make_streams(_result):
+            streams = []
+            d = defer.succeed(None)
+            for p in params:
+                d.addCallback(lambda _: self.sg.make_stream())
+                d.addCallback(lambda s, p=p: s.set_params(p).addCallback(
+                        lambda _: streams.append(s)))
+            d.addCallback(lambda _: streams)
+            return d
+
+        def set_buffering(streams):
+            types = [_msg_types.get(p.get('type')) for p in params]
+            cache = self.cluster.cache_policy(meta, types)
+            ds = [s.set_buffering(grpos_range=c[0], frames=c[1],
+                                  flag_mask=c[2])
+                  for (s, c) in zip(streams, cache) if c]
+            d = defer.DeferredList(ds, fireOnOneErrback=1, consumeErrors=1)
+            d.addCallback(lambda _: streams)
+            return d
+
+        def ready(streams):
+            self._writers = [frame_writer(s) for s in streams]
+            self.streams = streams
+
+        d.addCallback(opened)
+        d.addCallback(make_streams)
+        d.addCallback(set_buffering)
+        d.addCallback(ready)
+        return d
+
+    def _setup_failed(self, failure):
+        log.error('setting up mirror of %r failed: %s', self.name,
+                  failure.value)
+        self.close(failure.value)
+
+    def link_lost(self, reason):
+        self.link = None
+        if not self.closed:
+            self.close(StreamNotFoundError('Unknown stream %r' % self.name))
+
+    def close(self, error=None):
+        if self.closed:
+            return
+        self.closed = True
+        self.cluster._mirror_closed(self)
+
+        if self.link is not None:
+            link, self.link = self.link, None
+            link.transport.loseConnection()
+
+        if self.sg is not None:
+            sg, self.sg = self.sg, None
+            self.cluster.mirror_server.close(sg)
+
+        waiting, self._waiting = self._waiting, []
+        if error is None:
+            error = StreamNotFoundError('Unknown stream %r' % self.name)
+        for w in waiting:
+            w.errback(error)
+
+
+class ClusterServer(object):
+    """A stream server wrapping the local one of a worker process,
+    making streams published in the other workers available for reading
+    too.
+
+    Everything is kept under run_dir: the stream registry and worker
+    link sockets - all the workers need to use the same one.
+    """
+    implements(IStreamServer)
+
+    cache_policy = DefaultCachePolicy()
+
+    def __init__(self, server, run_dir, worker_id, namespaces=None,
+                 threadpool=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        # for claiming streams in the registry
+        self.threadpool = threadpool
+
+        self.server = server
+        self.run_dir = run_dir
+        self.worker_id = worker_id
+        self.registry = StreamRegistry(os.path.join(run_dir, 'streams'),
+                                       worker_id)
+
+        self.mirror_server = inmemory.IMServer(namespaces)
+        self.origin = RelayOriginFactory(server, self.cache_policy)
+
+        # _mirrors: { (namespace, name) => _Mirror }
+        self._mirrors = {}
+        # _readers: { mirrored stream group => _Mirror }
+        self._readers = {}
+        # _published: { stream group => (namespace, name) }
+        self._published = {}
+        self._port = None
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.run_dir, 'worker-%d.sock' % (worker_id,))
+
+    def start(self):
+        path = self.socket_path(self.worker_id)
+        if os.path.exists(path):
+            os.unlink(path)
+        self._port = self.reactor.listenUNIX(path, self.origin)
+        return self._port
+
+    def stop(self):
+        if self._port is None:
+            return defer.succeed(None)
+        port, self._port = self._port, None
+        return defer.maybeDeferred(port.stopListening)
+
+    def open(self, name, mode='r', namespace=None):
+        if mode == 'l':
+            return defer.maybeDeferred(self._open_published, namespace,
+                                       name)
+
+        d = self.server.open(name, mode=mode, namespace=namespace)
+        if mode == 'r':
+            d.addErrback(self._open_remote, namespace, name)
+        return d
+
+    def _open_published(self, namespace, name):
+        def claimed(result):
+            if not result:
+                raise StreamExistsError('Stream already exists: %r' % name)
+            d = self.server.open(name, mode='l', namespace=namespace)
+            d.addCallbacks(opened, failed)
+            return d
+
+        def opened(sg):
+            self._published[sg] = (namespace, name)
+            return sg
+
+        def failed(failure):
+            self.registry.release(namespace, name)
+            return failure
+
+        d = run_in_thread(self.reactor, self.threadpool,
+                          self.registry.claim, namespace, name)
+        d.addCallback(claimed)
+        return d
+
+    def _open_remote(self, failure, namespace, name):
+        failure.trap(StreamNotFoundError)
+
+        key = (namespace, name)
+        mirror = self._mirrors.get(key)
+        if mirror is None:
+            owner = self.registry.lookup(namespace, name)
+            if owner is None or owner == self.worker_id:
+                return failure
+            log.debug('mirroring %r from worker %d', name, owner)
+            mirror = self._mirrors[key] = _Mirror(self, namespace, name,
+                                                  owner)
+            mirror.connect()
+
+        return mirror.open()
+
+    def _mirror_closed(self, mirror):
+        key = (mirror.namespace, mirror.name)
+        if self._mirrors.get(key) is mirror:
+            del self._mirrors[key]
+
+    def close(self, streamgroup):
+        mirror = self._readers.pop(streamgroup, None)
+        if mirror is not None:
+            d = self.mirror_server.close(streamgroup)
+            mirror.detach()
+            return d
+
+        key = self._published.pop(streamgroup, None)
+        if key is not None:
+            self.registry.release(*key)
+            self.origin.stream_closed(*key)
+
+        return self.server.close(streamgroup)
+
+    def delete(self, streamgroup):
+        return self.server.delete(streamgroup)
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    """Keeps a worker process running, restarting it when it dies
+    (unless the pool is stopping).
+    """
+    restart_delay = 1.0
+
+    def __init__(self, pool, worker_id):
+        self.pool = pool
+        self.worker_id = worker_id
+
+    def outReceived(self, data):
+        sys.stdout.write(data)
+
+    def errReceived(self, data):
+        sys.stderr.write(data)
+
+    def processEnded(self, reason):
+        self.pool.worker_ended(self, reason)
+
+
+class WorkerPool(object):
+    """Spawns count processes of argv, the worker id appended as the
+    last argument.
+    """
+    def __init__(self, argv, count, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.argv = list(argv)
+        self.count = count
+        self.workers = {}
+        self.stopping = False
+
+    def start(self):
+        for i in range(self.count):
+            self.spawn(i)
+        self.reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def spawn(self, worker_id):
+        if self.stopping:
+            return
+        p = WorkerProcessProtocol(self, worker_id)
+        argv = self.argv + [str(worker_id)]
+        self.reactor.spawnProcess(p, argv[0], argv, env=os.environ)
+        self.workers[worker_id] = p
+        log.info('started worker %d', worker_id)
+
+    def worker_ended(self, p, reason):
+        if self.workers.get(p.worker_id) is p:
+            del self.workers[p.worker_id]
+        if not self.stopping:
+            log.warning('worker %d ended: %s, restarting', p.worker_id,
+                        reason.value)
+            self.reactor.callLater(p.restart_delay, self.spawn, p.worker_id)
+
+    def stop(self):
+        self.stopping = True
+        for p in self.workers.values():
+            try:
+                p.transport.signalProcess('TERM')
+            except Exception, e:
+                log.debug('signalling worker %d: %s', p.worker_id, e)
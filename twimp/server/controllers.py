@@ -22,10 +22,14 @@ from twimp import chunks
 from twimp.primitives import _s_uchar, _s_double_uchar
 
 from twimp.helpers import vb_clone, vb
+from twimp.server.interfaces import ISyncStream
 
 LOG_CATEGORY = 'ctrls'
 import twimp.log
 log = twimp.log.get_logger(LOG_CATEGORY)
+log_flags = twimp.log.get_flags(LOG_CATEGORY)
+# for the per-frame events
+frame_log = twimp.log.RateLimitedLogger(log)
 
 
 # frame flags
@@ -37,7 +41,31 @@ TYPE_VIDEO = 'video/x-flv-tag-video'
 TYPE_AUDIO = 'audio/x-flv-tag-audio'
 
 
+def frame_writer(stream):
+    """Return the function to write frames to stream with: write_now()
+    of ISyncStream streams (not returning anything), write() of the
+    others."""
+    if ISyncStream.providedBy(stream):
+        return stream.write_now
+    return stream.write
+
+
+def write_headers(stream, data):
+    if ISyncStream.providedBy(stream):
+        stream.write_headers_now(data)
+    else:
+        stream.write_headers(data)
+
+
 class Controller(object):
+    # a twimp.metrics.SessionMetrics instance, or None
+    metrics = None
+    # a twimp.server.latency.FrameTracer instance, or None, and the
+    # names of the stream and of the subscriber (player) to trace as
+    tracer = None
+    trace_name = None
+    trace_label = None
+
     def __init__(self, streamgroup):
         self._sg = streamgroup
         self._nstream = None
@@ -81,14 +109,16 @@ class BufferingWriter(object):
         if self.mark:
             self.rewrite = True
 
-    def write(self, type, gp, flags, data):
+    def write(self, type, gp, flags, data, written=None):
+        # written: see chunks.Muxer.sendMessage(), not called for the
+        # frames buffered while prerolling
         if self.prerolling:
             b = self.bufs[type]
             b.append((gp, data))
         elif self.rewrite:
-            self._send_rewrite(gp, type, data)
+            self._send_rewrite(gp, type, data, written)
         else:
-            self._send(gp, type, data)
+            self._send(gp, type, data, written)
 
     def preroll_done(self):
         if self.rewrite:
@@ -126,11 +156,11 @@ class BufferingWriter(object):
         log.debug('preroll_done: done.')
 
     # "protected" write helpers
-    def _send(self, gp, type, data):
-        self.nstream.send(gp, type, data)
+    def _send(self, gp, type, data, written=None):
+        self.nstream.send(gp, type, data, written)
 
-    def _send_rewrite(self, gp, type, data):
-        self.nstream.send(gp - self.base_gp, type, data)
+    def _send_rewrite(self, gp, type, data, written=None):
+        self.nstream.send(gp - self.base_gp, type, data, written)
 
     def _send_many(self, type, frames):
         for gp, data in frames:
@@ -241,7 +271,14 @@ class RTMPPlayer(Controller):
         def subscr_callback_maker(writer, type_):
             # TODO: handle mute statuses
             def data_callback(gp, flags, data):
-                return writer.write(type_, gp, flags, vb_clone(data))
+                if self.metrics is not None:
+                    self.metrics.count_frame(len(data))
+                written = None
+                tracer = self.tracer
+                if tracer is not None and not writer.prerolling:
+                    written = tracer.delivery(self.trace_label)
+                return writer.write(type_, gp, flags, vb_clone(data),
+                                    written)
             return data_callback
 
         def do_subscribe(_result, s, type_, params):
@@ -317,8 +354,9 @@ class RTMPPlayer(Controller):
         return d
 
     def on_header_data_added(self, type_, ts, flags, data):
-        log.debug('=> %s, %s, %s, %s, %s',
-                  ts, type_, flags, self._nstream.id, len(data))
+        if log_flags.debug:
+            log.debug('=> %s, %s, %s, %s, %s',
+                      ts, type_, flags, self._nstream.id, len(data))
         self._nstream.send(0, type_, vb_clone(data))
 
     def on_mute_message(self, ts, type_, do_send):
@@ -355,6 +393,8 @@ class RTMPRecorder(Controller):
     def __init__(self, streamgroup):
         Controller.__init__(self, streamgroup)
         self._tracks = {}
+        # { type => frame_writer() of the track }
+        self._writers = {}
 
         self._stream_meta = None
         self._audio_headers = 0
@@ -409,6 +449,7 @@ class RTMPRecorder(Controller):
 
         def stream_made(stream):
             self._tracks[type_] = stream
+            self._writers[type_] = frame_writer(stream)
             d = stream.set_params({'type': sg_type})
             d.addCallback(set_caching)
             return d
@@ -424,6 +465,8 @@ class RTMPRecorder(Controller):
         if not stream:
             d = self._make_stream(ts, type_)
             if not d:
+                if self.metrics is not None:
+                    self.metrics.dropped += 1
                 return
             # FIXME: there should really be a queue between nstream and sg
             # instead, for the moment, we'll just re-try the on_data()
@@ -443,7 +486,7 @@ class RTMPRecorder(Controller):
                 frame_type, codec_id = ft_codec >> 4, ft_codec & 0x0f
 
             if frame_type == 1 and codec_id == 7 and h264_type == 0:
-                d = stream.write_headers(data)
+                write_headers(stream, data)
                 return
             elif frame_type is not None:
                 if frame_type == 1:
@@ -463,7 +506,7 @@ class RTMPRecorder(Controller):
 
             if codec_id == 10 and aac_type == 0:
                 self._audio_headers += 1
-                d = stream.write_headers(data)
+                write_headers(stream, data)
                 return
             elif codec_id != 10 and self._audio_headers == 0:
                 # Flash, doesn't use real headers for those formats,
@@ -471,15 +514,23 @@ class RTMPRecorder(Controller):
                 # empty packet (Flash doesn't seem to mind those)
                 # early on
                 self._audio_headers += 1
-                d = stream.write_headers(vb(data.peek(1)))
+                write_headers(stream, vb(data.peek(1)))
 
             if codec_id is not None:
                 flags = FF_KEYFRAME # audio usually is all keyframes
         else:
-            log.error('Unsupported data type: %r', type_)
+            frame_log.error('Unsupported data type: %r', type_)
+            if self.metrics is not None:
+                self.metrics.dropped += 1
             return
 
-        d = stream.write(ts, flags, data)
-        # TODO: have an errback here, (and after all stream.write*()
-        #       calls above) for a really distributed server
+        if self.metrics is not None:
+            self.metrics.count_frame(len(data))
+        tracer = self.tracer
+        traced = tracer is not None and tracer.begin(self.trace_name)
+        self._writers[type_](ts, flags, data)
+        if traced:
+            tracer.end()
+        # TODO: have an errback here, (and after all the async
+        #       stream.write*() calls) for a really distributed server
         #       implementation
@@ -0,0 +1,311 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Edge servers, pulling live streams from an origin RTMP server.
+
+Play requests for streams not published locally are served from local,
+in-memory copies, fed by a single upstream play session per stream
+(using the RTMP client), shared by all the local readers. Upstream
+sessions no longer read get closed after an idle timeout. The sessions
+of streams pulled from the same origin app share a single connection.
+"""
+
+from zope.interface import implements
+
+from twisted.internet import defer
+
+from twimp import chunks
+from twimp.clientpool import ClientConnectionPool
+from twimp.server.interfaces import IStreamServer
+from twimp.server.controllers import RTMPRecorder
+from twimp.server.errors import StreamNotFoundError
+from twimp.server import inmemory
+
+LOG_CATEGORY = 'edge'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+def meta_track_types(meta):
+    """Return the set of (internal) message types of the tracks
+    announced in the stream meta data.
+    """
+    types = set()
+    if 'videocodecid' in meta or meta.get('hasVideo'):
+        types.add(chunks.MSG_VIDEO)
+    if 'audiocodecid' in meta or meta.get('hasAudio'):
+        types.add(chunks.MSG_AUDIO)
+    return types
+
+
+class _UpstreamRecorder(RTMPRecorder):
+    """Records the upstream play session into the local stream group,
+    keeping the pull informed about the progress.
+    """
+    def __init__(self, streamgroup, pull):
+        RTMPRecorder.__init__(self, streamgroup)
+        self._pull = pull
+
+    def start(self):
+        self._nstream.set_listeners(data_callback=self.on_data,
+                                    meta_callback=self.on_meta,
+                                    status_callback=self._pull.on_status)
+        return defer.succeed(None)
+
+    def on_meta(self, ts, args):
+        RTMPRecorder.on_meta(self, ts, args)
+        if self._stream_meta is not None:
+            self._pull.on_meta(self._stream_meta)
+
+    def on_data(self, ts, type_, data):
+        RTMPRecorder.on_data(self, ts, type_, data)
+        self._pull.on_frame(type_)
+
+
+class _Pull(object):
+    """A local, in-memory copy of a stream played from the origin,
+    shared by all the local readers of the stream.
+    """
+    end_codes = ('NetStream.Play.Stop', 'NetStream.Play.UnpublishNotify')
+
+    def __init__(self, edge, namespace, name):
+        self.edge = edge
+        self.namespace = namespace
+        self.name = name
+
+        self.refs = 0
+        self.stream = None
+        self.sg = None
+        self.playing = False
+        self.ready = False
+        self.closed = False
+        self._waiting = []
+        self._expected = None
+        self._seen = set()
+        self._ready_call = None
+        self._idle_call = None
+
+    def connect(self):
+        url, self.upstream_name = self.edge.upstream(self.namespace,
+                                                     self.name)
+        d = self.edge.connect(url, self)
+        d.addCallbacks(self.stream_opened, self.link_lost)
+
+    def open(self):
+        if self._idle_call is not None:
+            self._idle_call.cancel()
+            self._idle_call = None
+
+        d = defer.Deferred()
+        if self.ready:
+            self._open_reader(d)
+        else:
+            self._waiting.append(d)
+        return d
+
+    def _open_reader(self, d):
+        rd = self.edge.mirror_server.open(self.name,
+                                          namespace=self.namespace)
+        rd.addCallback(self._attach)
+        rd.chainDeferred(d)
+
+    def _attach(self, sg):
+        self.refs += 1
+        self.edge._readers[sg] = self
+        return sg
+
+    def detach(self):
+        self.refs -= 1
+        if self.refs <= 0 and not self.closed:
+            self._idle_call = self.edge.reactor.callLater(
+                self.edge.idle_timeout, self._idle)
+
+    def _idle(self):
+        self._idle_call = None
+        log.debug('upstream of %r idle, closing', self.name)
+        self.close()
+
+    def stream_opened(self, stream):
+        self.stream = stream
+        if self.closed:
+            self.stream = None
+            self.edge.pool.close_stream(stream, force=True)
+            return
+
+        def opened(sg):
+            self.sg = sg
+            recorder = _UpstreamRecorder(sg, self)
+            return stream.play(self.upstream_name, recorder)
+
+        d = self.edge.mirror_server.open(self.name, mode='l',
+                                         namespace=self.namespace)
+        d.addCallback(opened)
+        d.addCallbacks(self._play_started, self._play_failed)
+
+    def _play_started(self, info):
+        if self.closed:
+            return
+        self.playing = True
+        self._ready_call = self.edge.reactor.callLater(
+            self.edge.ready_timeout, self._set_ready)
+        self._check_ready()
+
+    def _play_failed(self, failure):
+        log.info('pulling %r failed: %s', self.name, failure.value)
+        self.close()
+
+    def on_meta(self, meta):
+        self._expected = meta_track_types(meta)
+        self._check_ready()
+
+    def on_frame(self, type_):
+        self._seen.add(type_)
+        self._check_ready()
+
+    def on_status(self, ts, info):
+        if getattr(info, 'code', None) in self.end_codes:
+            log.debug('upstream of %r ended: %r', self.name, info)
+            self.close()
+
+    def _check_ready(self):
+        if self.ready or not self.playing or not self._seen:
+            return
+        if self._expected and not self._expected <= self._seen:
+            return
+        self._set_ready()
+
+    def _set_ready(self):
+        if self._ready_call is not None:
+            if self._ready_call.active():
+                self._ready_call.cancel()
+            self._ready_call = None
+
+        self.ready = True
+        waiting, self._waiting = self._waiting, []
+        for w in waiting:
+            self._open_reader(w)
+
+    def link_lost(self, reason):
+        if not self.closed:
+            log.info('upstream link of %r lost: %s', self.name,
+                     getattr(reason, 'value', reason))
+            self.close()
+
+    def close(self, error=None):
+        if self.closed:
+            return
+        self.closed = True
+        self.edge._pull_closed(self)
+
+        for call in (self._ready_call, self._idle_call):
+            if call is not None and call.active():
+                call.cancel()
+        self._ready_call = self._idle_call = None
+
+        if self.stream is not None:
+            stream, self.stream = self.stream, None
+            self.edge.pool.close_stream(stream, force=True)
+
+        if self.sg is not None:
+            sg, self.sg = self.sg, None
+            self.edge.mirror_server.close(sg)
+
+        waiting, self._waiting = self._waiting, []
+        if error is None:
+            error = StreamNotFoundError('Unknown stream %r' % self.name)
+        for w in waiting:
+            w.errback(error)
+
+
+class EdgeServer(object):
+    """A stream server wrapping a local one, making streams published
+    on the origin server (at url) available for reading, too.
+    """
+    implements(IStreamServer)
+
+    # seconds an upstream session is kept after its last reader is gone
+    idle_timeout = 10.0
+    # seconds a connection to the origin is kept after its last session
+    # is gone
+    connection_idle_timeout = 30.0
+    # seconds to wait for frames of all the announced tracks, before
+    # letting the readers in
+    ready_timeout = 1.0
+
+    def __init__(self, server, url, namespaces=None, connect_params=None,
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+        self.server = server
+        self.url = url
+        self.pool = ClientConnectionPool(connect_params,
+                                         self.connection_idle_timeout,
+                                         reactor)
+
+        self.mirror_server = inmemory.IMServer(namespaces)
+
+        # _pulls: { (namespace, name) => _Pull }
+        self._pulls = {}
+        # _readers: { pulled stream group => _Pull }
+        self._readers = {}
+
+    def upstream(self, namespace, name):
+        """Return the (url, name) of the origin stream to pull - override
+        to map namespaces/names onto different origin apps.
+        """
+        return self.url, name
+
+    def connect(self, url, pull):
+        """Return a Deferred firing with a client stream (on the origin
+        at url) to play the pulled stream on.
+        """
+        return self.pool.open_stream(url, pull.link_lost)
+
+    def open(self, name, mode='r', namespace=None):
+        d = self.server.open(name, mode=mode, namespace=namespace)
+        if mode == 'r':
+            d.addErrback(self._open_upstream, namespace, name)
+        return d
+
+    def _open_upstream(self, failure, namespace, name):
+        failure.trap(StreamNotFoundError)
+
+        key = (namespace, name)
+        pull = self._pulls.get(key)
+        if pull is None:
+            log.debug('pulling %r from upstream', name)
+            pull = self._pulls[key] = _Pull(self, namespace, name)
+            pull.connect()
+
+        return pull.open()
+
+    def _pull_closed(self, pull):
+        key = (pull.namespace, pull.name)
+        if self._pulls.get(key) is pull:
+            del self._pulls[key]
+
+    def close(self, streamgroup):
+        pull = self._readers.pop(streamgroup, None)
+        if pull is not None:
+            d = self.mirror_server.close(streamgroup)
+            pull.detach()
+            return d
+
+        return self.server.close(streamgroup)
+
+    def delete(self, streamgroup):
+        return self.server.delete(streamgroup)
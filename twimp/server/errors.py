@@ -32,3 +32,10 @@ class NamespaceNotFoundError(NotFoundError):
 class StreamExistsError(ValueError):
     pass
 
+
+class StreamReadOnlyError(ValueError):
+    pass
+
+
+class FrameTooLargeError(ValueError):
+    pass
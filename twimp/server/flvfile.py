@@ -0,0 +1,432 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from bisect import bisect_right
+import errno
+import os
+
+from zope.interface import implements
+
+from twisted.internet import defer
+
+from twimp import amf0
+from twimp.amf0 import OrderedDict
+from twimp import flv
+from twimp.server.interfaces import IStreamGroup, IStreamServer
+from twimp.server.controllers import FF_KEYFRAME, FF_INTERFRAME
+from twimp.server.controllers import TYPE_AUDIO, TYPE_VIDEO
+from twimp.server.ondisk import DServerStream, DServerStreamGroup
+from twimp.server.ondisk import DStream, DStreamGroup, _Segment
+
+from twimp.server.errors import InvalidFrameNumber, StreamNotFoundError
+from twimp.server.errors import NamespaceNotFoundError, StreamReadOnlyError
+
+from twimp.utils import run_in_thread
+from twimp.vecbuf import VecBuf
+
+LOG_CATEGORY = 'flvfile'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class FLVTrack(DServerStream):
+    """A read-only DServerStream, with all the frames living in a single
+    FLV file (shared with the other tracks of the file).
+    """
+    def __init__(self, group, segment, type_):
+        DServerStream.__init__(self, group, group.path)
+        self.segments = [segment]
+        self.params = {'type': type_}
+
+    def frame_data(self, frame):
+        return VecBuf([self.segments[0].view(self.offset[frame],
+                                             self.size[frame])])
+
+    def add_frame(self, grpos, flags, offset, size):
+        frame = len(self.grpos)
+        if frame and grpos < self.grpos[frame - 1]:
+            # keep the index sorted, whatever the muxer did
+            grpos = self.grpos[frame - 1]
+        self.grpos.append(grpos)
+        self.flags.append(flags)
+        self.offset.append(offset)
+        self.size.append(size)
+        if flags & FF_KEYFRAME:
+            self.keyframes.append(frame)
+
+
+def name_to_path(root, namespace, name, extension='.flv'):
+    """Map a stream name to a file under root, with namespaces being
+    subdirectories.
+
+    @return: path of the file, or None if name is not valid
+    """
+    if name.startswith('flv:'):
+        name = name[4:]
+    parts = name.split('/')
+    if namespace is not None:
+        parts.insert(0, namespace)
+    if [p for p in parts if p in ('', '.', '..') or os.sep in p]:
+        return None
+    if not parts[-1].endswith(extension):
+        parts[-1] += extension
+    return os.path.join(root, *parts)
+
+def _stat_file(path):
+    try:
+        st = os.stat(path)
+    except OSError, e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return None
+        raise
+    if not os.path.isfile(path):
+        return None
+    return st.st_size, st.st_mtime
+
+def _index_file(server, path, name, namespace, block_size):
+    """Scan the whole FLV file, in large sequential reads, picking up
+    tag headers (and script tags) only.
+
+    @rtype: DServerStreamGroup
+    """
+    sg = DServerStreamGroup(server, path, name, namespace)
+    tracks = {}
+    audio_headers = 0
+
+    f = open(path, 'rb')
+    try:
+        file_size = os.fstat(f.fileno()).st_size
+        segment = _Segment(path, file_size)
+
+        def read_data(offset, size):
+            f.seek(offset)
+            return f.read(size)
+
+        tags = flv.scan_tags(f, block_size)
+        for _pos, type_, ts, offset, size, head in tags:
+            if type_ == flv.TAG_DATA:
+                try:
+                    args = amf0.decode(VecBuf([read_data(offset, size)]))
+                except Exception, e:
+                    log.warning('%r: bad script tag at %d: %s', path,
+                                offset, e)
+                    continue
+                if len(args) > 1 and args[0] == 'onMetaData':
+                    sg.meta = dict(args[1])
+                    sg.meta.pop(flv.META_PADDING_KEY, None)
+                continue
+
+            if type_ == flv.TAG_VIDEO:
+                track_type = TYPE_VIDEO
+            elif type_ == flv.TAG_AUDIO:
+                track_type = TYPE_AUDIO
+            else:
+                continue
+
+            track = tracks.get(track_type)
+            if track is None:
+                track = tracks[track_type] = FLVTrack(sg, segment,
+                                                      track_type)
+                sg.streams.append(track)
+
+            if flv.is_sequence_header(type_, head):
+                data = read_data(offset, size)
+                track.headers.append((ts, 0, VecBuf([data])))
+                if type_ == flv.TAG_AUDIO:
+                    audio_headers += 1
+                continue
+
+            flags = 0
+            if type_ == flv.TAG_VIDEO and head:
+                if flv.is_video_keyframe(ord(head[0])):
+                    flags = FF_KEYFRAME
+                else:
+                    flags = FF_INTERFRAME
+            elif type_ == flv.TAG_AUDIO and head:
+                if audio_headers == 0 and ord(head[0]) >> 4 != 10:
+                    # same as the recorder does for non-AAC audio
+                    audio_headers += 1
+                    track.headers.append((ts, 0, VecBuf([head[:1]])))
+                flags = FF_KEYFRAME
+
+            track.add_frame(ts, flags, offset, size)
+    finally:
+        f.close()
+
+    return sg
+
+
+class _PlayClock(object):
+    """Common timeline for all the tracks of a single opened file.
+
+    Frames up to start_grpos + lead + (time elapsed since start) are
+    due to be sent.
+    """
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.start_time = None
+        self.start_grpos = 0
+        self.lead = 0
+
+    def start(self, grpos, preroll_end):
+        if self.start_time is None:
+            self.start_time = self.reactor.seconds()
+            self.start_grpos = grpos
+        self.lead = max(self.lead, preroll_end - self.start_grpos)
+
+    def horizon(self):
+        elapsed = self.reactor.seconds() - self.start_time
+        return self.start_grpos + self.lead + int(elapsed * 1000)
+
+    def delay_until(self, grpos):
+        due = (self.start_time +
+               (grpos - self.start_grpos - self.lead) / 1000.0)
+        return due - self.reactor.seconds()
+
+
+class _Pacer(object):
+    interval = 0.1
+
+    def __init__(self, server_stream, callback, pos, clock):
+        self._s = server_stream
+        self.callback = callback
+        self.pos = pos
+        self.clock = clock
+        self._call = None
+
+    def tick(self):
+        self._call = None
+        s = self._s
+        n = len(s.grpos)
+
+        end = bisect_right(s.grpos, self.clock.horizon(), self.pos)
+        pos, self.pos = self.pos, end
+        for i in xrange(pos, end):
+            self.callback(s.grpos[i], s.flags[i], s.frame_data(i))
+
+        if end < n:
+            delay = max(self.clock.delay_until(s.grpos[end]), self.interval)
+            self._call = self.clock.reactor.callLater(delay, self.tick)
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+
+class FLVStream(DStream):
+    """A single track of an FLV file.
+
+    Subscribing plays the track from the current position: preroll
+    frames are passed to the callback right away, the rest is paced in
+    real time, against a clock shared by all the tracks of the opened
+    group.
+    """
+    def __init__(self, server_stream, clock):
+        DStream.__init__(self, server_stream)
+        self._clock = clock
+        self._pacers = set()
+
+    def subscribe(self, callback, preroll_grpos_range=0, preroll_frames=0,
+                  preroll_from_frame=None, flag_mask=0):
+        s = self._s
+        n = len(s.grpos)
+
+        pos = self._pos
+        if preroll_from_frame is not None:
+            pos = preroll_from_frame
+            if not (0 <= pos < n):
+                e = InvalidFrameNumber('frame %r' % (preroll_from_frame))
+                return defer.fail(e)
+        elif flag_mask and pos < n:
+            fpos = s.find_flagged(pos, -abs(flag_mask))
+            if fpos is not None:
+                pos = fpos
+
+        if pos < n:
+            grpos = s.grpos[pos]
+            preroll_end = grpos
+            if preroll_grpos_range > 0:
+                preroll_end = grpos + preroll_grpos_range
+            elif preroll_frames > 0:
+                preroll_end = s.grpos[min(n, pos + preroll_frames) - 1]
+            self._clock.start(grpos, preroll_end)
+
+        pacer = _Pacer(s, callback, pos, self._clock)
+        self._pacers.add(pacer)
+        if pos < n:
+            pacer.tick()
+        return defer.succeed(pacer)
+
+    def unsubscribe(self, subscription):
+        subscription.stop()
+        self._pacers.discard(subscription)
+        return defer.succeed(None)
+
+    # 'protected' helper, for the server
+    def stop_playing(self):
+        for pacer in self._pacers:
+            pacer.stop()
+        self._pacers.clear()
+
+
+class FLVStreamGroup(DStreamGroup):
+    implements(IStreamGroup)
+
+    def __init__(self, server_streamgroup, clock):
+        self._clock = clock
+        DStreamGroup.__init__(self, server_streamgroup)
+
+    def build_stream(self, server_stream):
+        return FLVStream(server_stream, self._clock)
+
+    def seek(self, offset, whence=0):
+        # land all the tracks on the keyframe preceding offset
+        def sought(results):
+            grposes = [r[1] for r in results]
+            if not grposes:
+                return None
+            grpos = min(grposes)
+            return DStreamGroup.seek(self, grpos)
+
+        dl = defer.DeferredList([s.pseek(offset, whence,
+                                         flag_mask=-FF_KEYFRAME)
+                                 for s in self._streams],
+                                fireOnOneErrback=1, consumeErrors=1)
+        dl.addCallback(sought)
+        return dl
+
+
+class FLVFileServer(object):
+    """A (read-only) stream server playing FLV files from under root.
+
+    Files get indexed once, when first opened, and the index, along
+    with the memory mapping of the file, is shared by all the opened
+    groups. Indices of files not open anymore are kept for a while, up
+    to cache_size of them, and dropped when a file changes on disk.
+    """
+    implements(IStreamServer)
+
+    cache_size = 64
+    block_size = 1024 * 1024
+    extension = '.flv'
+
+    def __init__(self, root, namespaces=None, threadpool=None,
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        # used for pacing playback
+        self.clock = reactor
+        self.threadpool = threadpool
+
+        self.root = root
+        if namespaces:
+            self._namespaces = frozenset(namespaces)
+        else:
+            self._namespaces = frozenset([None])
+
+        # _files: { path => DServerStreamGroup }, least recently used first
+        self._files = OrderedDict()
+        # _loading: { path => [Deferred, ...] }
+        self._loading = {}
+
+    def run_in_thread(self, f, *args):
+        return run_in_thread(self.reactor, self.threadpool, f, *args)
+
+    def file_path(self, namespace, name):
+        return name_to_path(self.root, namespace, name, self.extension)
+
+    def open(self, name, mode='r', namespace=None):
+        if mode != 'r':
+            raise NotImplementedError('FLV files can only be read')
+
+        return defer.maybeDeferred(self._open_file, namespace, name)
+
+    def _open_file(self, namespace, name):
+        if namespace not in self._namespaces:
+            raise NamespaceNotFoundError('Unknown namespace %r' % namespace)
+        path = name and self.file_path(namespace, name)
+        if not path:
+            raise StreamNotFoundError('Unknown stream %r' % name)
+
+        waiting = self._loading.get(path)
+        if waiting is not None:
+            d = defer.Deferred()
+            waiting.append(d)
+            d.addCallback(lambda _: self._open_file(namespace, name))
+            return d
+
+        def got_stamp(stamp):
+            if stamp is None:
+                raise StreamNotFoundError('Unknown stream %r' % name)
+
+            server_sg = self._files.get(path)
+            if server_sg is not None and server_sg.stamp == stamp:
+                return self._attach(server_sg)
+
+            log.info('indexing %r', path)
+            d = self.run_in_thread(_index_file, self, path, name, namespace,
+                                   self.block_size)
+            d.addCallback(indexed, stamp)
+            return d
+
+        def indexed(server_sg, stamp):
+            server_sg.stamp = stamp
+            self._files.pop(path, None)
+            self._files[path] = server_sg
+            sg = self._attach(server_sg)
+            self._prune()
+            return sg
+
+        def done_loading(result):
+            for w in self._loading.pop(path, []):
+                w.callback(None)
+            return result
+
+        self._loading[path] = []
+        d = self.run_in_thread(_stat_file, path)
+        d.addCallback(got_stamp)
+        d.addBoth(done_loading)
+        return d
+
+    def _attach(self, server_sg):
+        server_sg.refs += 1
+        # most recently used go to the end
+        path = server_sg.path
+        if self._files.get(path) is server_sg:
+            del self._files[path]
+            self._files[path] = server_sg
+        return FLVStreamGroup(server_sg, _PlayClock(self.clock))
+
+    def _prune(self):
+        unused = [path for (path, server_sg) in self._files.iteritems()
+                  if server_sg.refs <= 0]
+        for path in unused[:max(0, len(unused) - self.cache_size)]:
+            del self._files[path]
+
+    def close(self, streamgroup):
+        if streamgroup.closed:
+            return defer.succeed(None)
+        streamgroup.closed = True
+
+        for s in streamgroup._streams:
+            s.stop_playing()
+        streamgroup._g.refs -= 1
+        self._prune()
+        return defer.succeed(None)
+
+    def delete(self, streamgroup):
+        return defer.fail(StreamReadOnlyError('FLV files are read-only'))
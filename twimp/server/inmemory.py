@@ -25,7 +25,7 @@ from twisted.internet import defer
 #     HAVE_TASKS = 0
 
 from twimp.server.interfaces import IStream, ILiveStream, IStreamGroup
-from twimp.server.interfaces import IStreamServer
+from twimp.server.interfaces import IStreamServer, ISyncStream
 
 from twimp.server.errors import InvalidFrameNumber, StreamNotFoundError
 from twimp.server.errors import NamespaceNotFoundError, StreamExistsError
@@ -55,7 +55,7 @@ class IMServerStreamGroup(object):
 
 
 class IMStream(object):
-    implements(IStream)
+    implements(IStream, ISyncStream)
 
     def __init__(self, server_stream):
         self._s = server_stream
@@ -129,7 +129,7 @@ class IMStream(object):
         return None, defer.succeed(None)
 
     def write_headers(self, data, grpos=0, flags=0):
-        self._s.headers.append((grpos, flags, data))
+        self.write_headers_now(data, grpos, flags)
         return defer.succeed(None)
 
     def seek(self, offset, whence=0, frames=None):
@@ -193,8 +193,7 @@ class IMStream(object):
 
 
     def write(self, grpos, flags, data):
-        self._s.data.append((grpos, flags, data))
-        self.notify_write_listeners(grpos, flags, data)
+        self.write_now(grpos, flags, data)
         return defer.succeed(None)
 
     def _scan_from_end(self, grpos_range, frames=None, flag_mask=0):
@@ -299,6 +298,17 @@ class IMStream(object):
         return defer.fail(InvalidFrameNumber('frame %r' % (frame,)))
 
 
+    ##
+    # ISyncStream interface implementation
+
+    def write_headers_now(self, data, grpos=0, flags=0):
+        self._s.headers.append((grpos, flags, data))
+
+    def write_now(self, grpos, flags, data):
+        self._s.data.append((grpos, flags, data))
+        self.notify_write_listeners(grpos, flags, data)
+
+
 class IMLiveStream(IMStream):
     implements(ILiveStream)
 
@@ -319,10 +329,9 @@ class IMLiveStream(IMStream):
 
         self._set_buffering(grpos_range=0, frames=0, flag_mask=0)
 
-    def write(self, grpos, flags, data):
+    def write_now(self, grpos, flags, data):
         self._write_selected(grpos, flags, data)
         self.notify_write_listeners(grpos, flags, data)
-        return defer.succeed(None)
 
     def set_buffering(self, grpos_range=0, frames=0, flag_mask=0):
         self._set_buffering(grpos_range=grpos_range, frames=frames,
@@ -158,6 +158,26 @@ class ILiveStream(IStream):
         """
 
 
+class ISyncStream(Interface):
+    # optional, provided (in addition to IStream) by the streams that
+    # can be written to right away - the in-memory ones, unlike the
+    # remote or on-disk ones; writing frames that way doesn't cost a
+    # Deferred per frame
+    #
+    # all methods sync, raising errors instead of failing Deferreds
+
+    def write_now(grpos, flags, data):
+        """
+        Same as IStream.write(), the subscribers get notified of the
+        frame before it returns.
+        """
+
+    def write_headers_now(data, grpos=0, flags=0):
+        """
+        Same as IStream.write_headers().
+        """
+
+
 class IStreamGroup(Interface):
     # * meta
     # * streams
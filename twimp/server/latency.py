@@ -0,0 +1,157 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Tracing the time live frames spend inside the server: from the
+message being demuxed off the publisher connection to the last chunk of
+it being written out to each player's transport.
+"""
+
+import time
+
+from twimp.profiling import Histogram
+
+LOG_CATEGORY = 'latency'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class FrameTracer(object):
+    """Samples one of every sample frames of each stream published
+    (see RTMPRecorder.tracer) and times it on its way to the players
+    (see RTMPPlayer.tracer).
+
+    Frames of live streams are handed to the players synchronously,
+    while being published - so the trace of the frame being written
+    is kept as current for the time of the write. Each player takes a
+    delivery() callback along with the frame to its muxer, which calls
+    it once the last chunk of the message gets written out, after any
+    time spent queued in the chunk producer.
+
+    Frames sent as part of a player's preroll are not traced.
+    """
+
+    sample = 16
+    worst = 10
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, sample=None, worst=None):
+        if sample is not None:
+            self.sample = sample
+        if worst is not None:
+            self.worst = worst
+
+        # (stream name, start time) of the frame being written, if traced
+        self.current = None
+        # when the message being dispatched was received, if known
+        self.received_at = None
+        # { stream name => frames since the last one traced }
+        self._counts = {}
+        # { stream name => Histogram }
+        self.streams = {}
+        # { stream name => { subscriber => [count, max, last] } }
+        self._subscribers = {}
+
+    def received(self):
+        """Called by the protocol as a (complete) data message comes
+        off the demuxer, before dispatching it."""
+        self.received_at = self.clock()
+
+    def begin(self, name):
+        """Called by the publisher of name, before writing a frame.
+
+        @return: whether the frame gets traced (and end() is to be
+                 called after writing it)
+        """
+        start, self.received_at = self.received_at, None
+        n = self._counts.get(name, 0) + 1
+        if n < self.sample:
+            self._counts[name] = n
+            return False
+        self._counts[name] = 0
+        if start is None:
+            start = self.clock()
+        self.current = name, start
+        return True
+
+    def end(self):
+        self.current = None
+
+    def delivery(self, subscriber):
+        """Called by a player, before writing a frame out.
+
+        @return: a callable to call once the frame got written out, or
+                 None if the frame isn't traced
+        """
+        if self.current is None:
+            return None
+        name, start = self.current
+        return lambda: self._record(name, start, subscriber)
+
+    def delivered(self, subscriber):
+        """Called by a player, after writing the current frame out."""
+        name, start = self.current
+        self._record(name, start, subscriber)
+
+    def _record(self, name, start, subscriber):
+        latency = self.clock() - start
+
+        h = self.streams.get(name)
+        if h is None:
+            h = self.streams[name] = Histogram()
+        h.record(latency)
+
+        subscribers = self._subscribers.setdefault(name, {})
+        s = subscribers.get(subscriber)
+        if s is None:
+            subscribers[subscriber] = [1, latency, latency]
+        else:
+            s[0] += 1
+            if latency > s[1]:
+                s[1] = latency
+            s[2] = latency
+
+    def forget(self, subscriber):
+        """Stop reporting subscriber (e.g. when the player is done)."""
+        for subscribers in self._subscribers.values():
+            subscribers.pop(subscriber, None)
+
+    def report(self):
+        """Return the latency percentiles of each stream, with the
+        worst of its subscribers: { name => dict }."""
+        report = {}
+        for name, h in self.streams.items():
+            r = report[name] = h.summary()
+            subscribers = sorted(self._subscribers.get(name, {}).items(),
+                                 key=lambda (_s, v): v[1], reverse=True)
+            r['worst'] = [dict(subscriber=s, count=c, max=m, last=l)
+                          for s, (c, m, l) in subscribers[:self.worst]]
+        return report
+
+    def format_report(self):
+        """Return the report as a (printable) table, times in
+        milliseconds."""
+        cols = ('p50', 'p90', 'p99', 'max')
+        lines = []
+        for name, r in sorted(self.report().items()):
+            lines.append('%-32s %9s' % ('stream ' + name, 'frames') +
+                         ''.join(' %9s' % c for c in cols))
+            lines.append('%-32s %9d' % ('', r['count']) +
+                         ''.join(' %9.3f' % (r[c] * 1000) for c in cols))
+            for w in r['worst']:
+                lines.append('  %-30s %9d %39.3f' % (w['subscriber'],
+                                                      w['count'],
+                                                      w['max'] * 1000))
+        return '\n'.join(lines)
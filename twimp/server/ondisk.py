@@ -0,0 +1,829 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+import errno
+import mmap
+import os
+import shutil
+import struct
+import urllib
+
+from zope.interface import implements, implementsOnly
+
+from twisted.internet import defer
+
+from twimp import amf0
+from twimp import flv
+from twimp.server.interfaces import ILiveStream, IStreamGroup
+from twimp.server.interfaces import IStreamServer
+from twimp.server.inmemory import IMStream, IMStreamGroup
+from twimp.server.controllers import FF_KEYFRAME, TYPE_AUDIO, TYPE_VIDEO
+from twimp.server.writers import ThreadedFileWriter, make_dirs
+
+from twimp.server.errors import InvalidFrameNumber, StreamNotFoundError
+from twimp.server.errors import NamespaceNotFoundError, StreamExistsError
+from twimp.server.errors import StreamReadOnlyError
+
+from twimp.utils import run_in_thread
+from twimp.vecbuf import VecBuf, flatten
+
+LOG_CATEGORY = 'ondisk'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+# on-disk layout of a single stream group:
+#
+#   <root>/<namespace>/<name>/meta           AMF0-encoded group meta
+#   <root>/<namespace>/<name>/<n>/params     AMF0-encoded stream params
+#   <root>/<namespace>/<name>/<n>/meta       AMF0-encoded stream meta
+#   <root>/<namespace>/<name>/<n>/headers    header records, each:
+#                                            _s_header_entry + data
+#   <root>/<namespace>/<name>/<n>/index      frame records, each:
+#                                            _s_index_entry
+#   <root>/<namespace>/<name>/<n>/%08d.flv   FLV segments holding the
+#                                            frames of stream n
+
+# grpos, flags, segment, offset of frame data in segment, frame size
+_s_index_entry = struct.Struct('>qLLLL')
+
+# grpos, flags, size
+_s_header_entry = struct.Struct('>qLL')
+
+DEFAULT_NAMESPACE_DIR = '_default_'
+
+_tag_types = {TYPE_AUDIO: flv.TAG_AUDIO,
+              TYPE_VIDEO: flv.TAG_VIDEO}
+
+
+def _quote_name(name):
+    quoted = urllib.quote(name, safe='')
+    if quoted.startswith('.'):
+        quoted = '%2E' + quoted[1:]
+    return quoted
+
+def _encode_dict(d):
+    vb = amf0.encode(dict(d))
+    return flatten(vb.read_seq(len(vb)))
+
+def _decode_dict(s):
+    return dict(amf0.decode_one(VecBuf([s])).iteritems())
+
+def _file_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return 0
+        raise
+
+def _read_file(path, default=None):
+    try:
+        f = open(path, 'rb')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return default
+        raise
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def _write_file(path, data):
+    make_dirs(os.path.dirname(path))
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+def _remove_tree(path, recreate=False):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    if recreate:
+        make_dirs(path)
+
+
+class _Segment(object):
+    """A single segment file, read through a (lazily re-made) read-only
+    memory mapping.
+    """
+    def __init__(self, path, size=0):
+        self.path = path
+        self.size = size        # bytes appended so far
+        self.written = size     # bytes known to have reached the file
+        self.writer = None
+        self._map = None
+
+    def view(self, offset, size):
+        end = offset + size
+        if self._map is None or len(self._map) < end:
+            self._remap()
+        return buffer(self._map, offset, size)
+
+    def _remap(self):
+        # note: old mappings are never explicitly closed, buffers
+        # handed out earlier may still point into them
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            self._map = mmap.mmap(fd, os.fstat(fd).st_size,
+                                  access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+
+class DServerStream(object):
+    def __init__(self, group, path):
+        self.group = group
+        self.path = path
+
+        self.meta = {}
+        self.params = {}
+        self.headers = []
+
+        # the frame index, one entry per frame, kept in columns
+        self.grpos = array('l')
+        self.flags = array('L')
+        self.seg = array('L')
+        self.offset = array('L')
+        self.size = array('L')
+
+        # frame numbers of all the keyframes
+        self.keyframes = array('L')
+
+        self.segments = []
+
+        # frames not yet known to be in their segment files:
+        # { frame => data } and deque([(segment, end offset, frame), ...])
+        self.pending = {}
+        self._pending_order = deque()
+
+        self.data_listeners = set()
+
+        self.writable = False
+        self._index_writer = None
+        self._headers_writer = None
+        self._tag_type = None
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, '%08d.flv' % (segment,))
+
+    def store(self, name, value):
+        return self.group.store(os.path.join(self.path, name),
+                                _encode_dict(value))
+
+    def frame_data(self, frame):
+        data = self.pending.get(frame)
+        if data is not None:
+            return data
+
+        segment = self.segments[self.seg[frame]]
+        return VecBuf([segment.view(self.offset[frame], self.size[frame])])
+
+    def find_flagged(self, pos, flag_mask):
+        """Find the frame closest to pos (including pos) with any of the
+        flags in abs(flag_mask) set, searching backward for negative
+        flag_mask and forward for positive.
+
+        @return: frame number or None if not found
+        """
+        n = len(self.flags)
+        if flag_mask < 0:
+            mask, pos = -flag_mask, min(pos, n - 1)
+            if mask == FF_KEYFRAME:
+                i = bisect_right(self.keyframes, pos) - 1
+                return self.keyframes[i] if i >= 0 else None
+            while pos >= 0:
+                if self.flags[pos] & mask:
+                    return pos
+                pos -= 1
+        elif flag_mask > 0:
+            mask = flag_mask
+            if mask == FF_KEYFRAME:
+                i = bisect_left(self.keyframes, pos)
+                return self.keyframes[i] if i < len(self.keyframes) else None
+            while pos < n:
+                if self.flags[pos] & mask:
+                    return pos
+                pos += 1
+        return None
+
+    def start_writing(self):
+        server = self.group.server
+        self._index_writer = server.make_writer(os.path.join(self.path,
+                                                             'index'))
+        self._headers_writer = server.make_writer(os.path.join(self.path,
+                                                               'headers'))
+        self.writable = True
+
+    def stop_writing(self):
+        self.writable = False
+        writers = [w for w in (self._index_writer, self._headers_writer) if w]
+        writers.extend(s.writer for s in self.segments if s.writer)
+        self._index_writer = self._headers_writer = None
+
+        def detach_segment_writers(result):
+            for s in self.segments:
+                s.writer = None
+            return result
+
+        dl = defer.DeferredList([w.close() for w in writers],
+                                fireOnOneErrback=1, consumeErrors=1)
+        dl.addBoth(detach_segment_writers)
+        return dl
+
+    def append_header(self, grpos, flags, data):
+        self.headers.append((grpos, flags, data))
+
+        size = len(data)
+        if isinstance(data, (str, buffer)):
+            seq = [data]
+        else:
+            seq = data.peek_seq(size)
+        self._headers_writer.write_seq([_s_header_entry.pack(grpos, flags,
+                                                              size)] + seq)
+
+    def append(self, grpos, flags, data):
+        if self._tag_type is None:
+            self._tag_type = _tag_types.get(self.params.get('type'),
+                                            flv.TAG_DATA)
+
+        size = len(data)
+        tag_size = flv.TAG_HEADER_SIZE + size + flv.TAG_TRAILER_SIZE
+
+        seg_no = len(self.segments) - 1
+        if seg_no < 0 or self.segments[seg_no].writer is None:
+            seg_no = self._new_segment()
+        else:
+            segment = self.segments[seg_no]
+            if (segment.size > flv.FILE_HEADER_SIZE and
+                segment.size + tag_size > self.group.server.segment_size):
+                seg_no = self._new_segment()
+
+        segment = self.segments[seg_no]
+        offset = segment.size + flv.TAG_HEADER_SIZE
+        segment.writer.write_seq(flv.encode_tag(self._tag_type,
+                                                grpos & 0xffffffff, data))
+        segment.size += tag_size
+
+        frame = len(self.grpos)
+        self.grpos.append(grpos)
+        self.flags.append(flags)
+        self.seg.append(seg_no)
+        self.offset.append(offset)
+        self.size.append(size)
+        if flags & FF_KEYFRAME:
+            self.keyframes.append(frame)
+
+        self._index_writer.write(_s_index_entry.pack(grpos, flags, seg_no,
+                                                     offset, size))
+
+        self.pending[frame] = data
+        self._pending_order.append((seg_no, offset + size, frame))
+
+        return frame
+
+    def _new_segment(self):
+        seg_no = len(self.segments)
+        segment = _Segment(self.segment_path(seg_no))
+
+        def written(count):
+            segment.written = count
+            self._release_pending()
+
+        segment.writer = self.group.server.make_writer(segment.path, 'wb',
+                                                       written_cb=written)
+        header = flv.encode_file_header(audio=self._tag_type == flv.TAG_AUDIO,
+                                        video=self._tag_type == flv.TAG_VIDEO)
+        segment.writer.write(header)
+        segment.size = len(header)
+
+        self.segments.append(segment)
+        return seg_no
+
+    def _release_pending(self):
+        order, segments = self._pending_order, self.segments
+        while order:
+            seg_no, end, frame = order[0]
+            if segments[seg_no].written < end:
+                break
+            order.popleft()
+            del self.pending[frame]
+
+
+class DServerStreamGroup(object):
+    def __init__(self, server, path, name=None, namespace=None):
+        self.meta = {}
+        self.streams = []
+
+        self.server = server
+        self.path = path
+        self.name = name
+        self.namespace = namespace
+
+        self.writable = False
+        self.refs = 0
+        self.next_stream_id = 0
+
+        # keeps stores of whole (meta, params) files in order
+        self._store_lock = defer.DeferredLock()
+
+    def store(self, path, data):
+        return self._store_lock.run(self.server.run_in_thread, _write_file,
+                                    path, data)
+
+    def add_stream(self):
+        path = os.path.join(self.path, str(self.next_stream_id))
+        self.next_stream_id += 1
+
+        ss = DServerStream(self, path)
+        self.streams.append(ss)
+        if self.writable:
+            ss.start_writing()
+        return ss
+
+    def start_writing(self):
+        self.writable = True
+        for ss in self.streams:
+            ss.start_writing()
+
+    def stop_writing(self):
+        self.writable = False
+        ds = [ss.stop_writing() for ss in self.streams]
+        # wait for any outstanding stores, too
+        ds.append(self._store_lock.run(lambda: None))
+        dl = defer.DeferredList(ds, fireOnOneErrback=1, consumeErrors=1)
+        dl.addCallback(lambda _: None)
+        return dl
+
+
+def _load_stream(group, path, repair=False):
+    ss = DServerStream(group, path)
+
+    params = _read_file(os.path.join(path, 'params'))
+    if params is not None:
+        ss.params = _decode_dict(params)
+
+    meta = _read_file(os.path.join(path, 'meta'))
+    if meta is not None:
+        ss.meta = _decode_dict(meta)
+
+    data = _read_file(os.path.join(path, 'headers'), '')
+    hsize, offset, end = _s_header_entry.size, 0, len(data)
+    while offset + hsize <= end:
+        grpos, flags, size = _s_header_entry.unpack_from(data, offset)
+        offset += hsize
+        if offset + size > end:
+            break
+        ss.headers.append((grpos, flags, VecBuf([data[offset:offset+size]])))
+        offset += size
+
+    data = _read_file(os.path.join(path, 'index'), '')
+    isize, seg_sizes = _s_index_entry.size, {}
+    for pos in xrange(0, len(data) - isize + 1, isize):
+        grpos, flags, seg, offset, size = _s_index_entry.unpack_from(data, pos)
+        if seg not in seg_sizes:
+            seg_sizes[seg] = _file_size(ss.segment_path(seg))
+        if offset + size > seg_sizes[seg]:
+            # the index got ahead of the data, last time around
+            break
+
+        if flags & FF_KEYFRAME:
+            ss.keyframes.append(len(ss.grpos))
+        ss.grpos.append(grpos)
+        ss.flags.append(flags)
+        ss.seg.append(seg)
+        ss.offset.append(offset)
+        ss.size.append(size)
+
+    valid = len(ss.grpos) * isize
+    if repair and valid < len(data):
+        log.warning('truncating index of %r to %d frames', path,
+                    len(ss.grpos))
+        f = open(os.path.join(path, 'index'), 'r+b')
+        try:
+            f.truncate(valid)
+        finally:
+            f.close()
+
+    if ss.seg:
+        for i in xrange(max(ss.seg) + 1):
+            size = seg_sizes.get(i)
+            if size is None:
+                size = _file_size(ss.segment_path(i))
+            ss.segments.append(_Segment(ss.segment_path(i), size))
+
+    return ss
+
+def _load_group(server, path, name, namespace, create=False):
+    if not os.path.isdir(path):
+        if not create:
+            return None
+        make_dirs(path)
+
+    sg = DServerStreamGroup(server, path, name, namespace)
+
+    meta = _read_file(os.path.join(path, 'meta'))
+    if meta is not None:
+        sg.meta = _decode_dict(meta)
+
+    ids = sorted(int(n) for n in os.listdir(path) if n.isdigit())
+    for i in ids:
+        sg.streams.append(_load_stream(sg, os.path.join(path, str(i)),
+                                       repair=create))
+    if ids:
+        sg.next_stream_id = ids[-1] + 1
+
+    return sg
+
+
+class DStream(IMStream):
+    """A stream stored on disk.
+
+    Frames are appended to FLV segment files and to a frame index by
+    background writers, and served back from memory-mapped segments -
+    data passed to read/subscribe callbacks are buffers pointing into
+    the mappings. Trimming is a noop: recordings only grow.
+    """
+    # not an ISyncStream, unlike IMStream: the writes go to the
+    # background writers
+    implementsOnly(ILiveStream)
+
+    def __init__(self, server_stream, writable=False):
+        IMStream.__init__(self, server_stream)
+        self._writable = writable
+
+    def _read_only(self):
+        return defer.fail(StreamReadOnlyError('stream opened read-only'))
+
+    def _seek(self, offset, whence, frames):
+        s = self._s
+        n = len(s.grpos)
+        last_grpos = s.grpos[n - 1] if n else 0
+
+        if frames is not None:
+            base = (0, self._pos, n)[whence]
+            pos = max(0, min(n, base + frames))
+            grpos = s.grpos[pos] if pos < n else last_grpos
+        else:
+            base = (0, self._grpos, last_grpos)[whence]
+            grpos = base + offset
+            pos = bisect_left(s.grpos, grpos)
+
+        self._pos, self._grpos = pos, grpos
+
+    def _scan_from_end(self, grpos_range, frames=None, flag_mask=0):
+        s = self._s
+        n = len(s.grpos)
+        if not n:
+            return None
+
+        pos = n - 1
+        if grpos_range > 0:
+            pos = bisect_left(s.grpos, s.grpos[n - 1] - grpos_range)
+        elif frames > 0:
+            pos = max(0, n - frames)
+
+        if flag_mask:
+            fpos = s.find_flagged(pos, flag_mask)
+            if fpos is not None:
+                pos = fpos
+
+        return pos
+
+    def _read_frames(self, callback, pos, end):
+        s = self._s
+        for i in xrange(pos, end):
+            callback(s.grpos[i], s.flags[i], s.frame_data(i))
+
+    # 'protected' helper, for the stream group
+    def read_until(self, callback, grpos):
+        if grpos > self._grpos:
+            return self.read(callback, grpos - self._grpos)
+        return None, defer.succeed(None)
+
+
+    ##
+    # IStream interface implementation
+
+    def set_params(self, params):
+        if not self._writable:
+            return self._read_only()
+        self._s.params = params.copy()
+        return self._s.store('params', self._s.params)
+
+    def set_meta(self, meta):
+        if not self._writable:
+            return self._read_only()
+        self._s.meta = meta.copy()
+        return self._s.store('meta', self._s.meta)
+
+    def write_headers(self, data, grpos=0, flags=0):
+        if not self._writable:
+            return self._read_only()
+        self._s.append_header(grpos, flags, data)
+        return defer.succeed(None)
+
+    def seek(self, offset, whence=0, frames=None):
+        self._seek(offset, whence, frames)
+        return defer.succeed(self._grpos)
+
+    def pseek(self, offset, whence=0, frames=None, flag_mask=0):
+        self._seek(offset, whence, frames)
+        if flag_mask:
+            s, pos = self._s, self._pos
+            if flag_mask < 0 and (pos >= len(s.grpos) or
+                                  s.grpos[pos] > self._grpos):
+                # the frame at pos is already past the seek target
+                pos -= 1
+            pos = s.find_flagged(pos, flag_mask)
+            if pos is not None:
+                self._pos, self._grpos = pos, self._s.grpos[pos]
+        return defer.succeed(self._grpos)
+
+    def read(self, callback, grpos_range, frames=None):
+        s = self._s
+        n = len(s.grpos)
+        pos, grpos = self._pos, self._grpos
+
+        if grpos_range:
+            end_grpos = grpos + grpos_range
+            end = bisect_left(s.grpos, end_grpos, pos)
+            self._read_frames(callback, pos, end)
+            if end < n:
+                grpos = end_grpos
+            elif end > pos:
+                grpos = s.grpos[end - 1]
+            pos = end
+        elif frames:
+            end = min(n, pos + frames)
+            self._read_frames(callback, pos, end)
+            if end > pos:
+                grpos = s.grpos[end - 1]
+            pos = end
+
+        self._pos, self._grpos = pos, grpos
+        return None, defer.succeed(None)
+
+    def write(self, grpos, flags, data):
+        if not self._writable:
+            return self._read_only()
+        self._s.append(grpos, flags, data)
+        self.notify_write_listeners(grpos, flags, data)
+        return defer.succeed(None)
+
+    def trim(self, grpos_range, frames=None, flag_mask=0):
+        return defer.succeed(None)
+
+    def set_buffering(self, grpos_range=0, frames=0, flag_mask=0):
+        # everything written is kept anyway
+        return defer.succeed(None)
+
+    def subscribe(self, callback, preroll_grpos_range=0, preroll_frames=0,
+                  preroll_from_frame=None, flag_mask=0):
+        pos = None
+        n = len(self._s.grpos)
+
+        if preroll_grpos_range > 0 or preroll_frames > 0:
+            pos = self._scan_from_end(preroll_grpos_range,
+                                      frames=preroll_frames,
+                                      flag_mask=flag_mask)
+        elif preroll_from_frame is not None:
+            pos = preroll_from_frame
+            if not (0 <= pos < n):
+                e = InvalidFrameNumber('frame %r' % (preroll_from_frame))
+                return defer.fail(e)
+
+        if pos is not None:
+            self._read_frames(callback, pos, n)
+
+        self._s.data_listeners.add(callback)
+        return defer.succeed(callback)
+
+    def find_frame_backward(self, grpos_range, frames=None, flag_mask=0):
+        return defer.succeed(self._scan_from_end(grpos_range, frames=frames,
+                                                 flag_mask=flag_mask))
+
+    def frame_to_grpos(self, frame):
+        n = len(self._s.grpos)
+        if frame < 0:
+            frame = n + frame
+
+        if 0 <= frame < n:
+            return defer.succeed(self._s.grpos[frame])
+
+        return defer.fail(InvalidFrameNumber('frame %r' % (frame,)))
+
+
+class DStreamGroup(IMStreamGroup):
+    implements(IStreamGroup)
+
+    def __init__(self, server_streamgroup, writable=False):
+        self._writable = writable
+        self.closed = False
+        IMStreamGroup.__init__(self, server_streamgroup)
+
+    def build_stream(self, server_stream):
+        return DStream(server_stream, writable=self._writable)
+
+    def set_meta(self, meta):
+        if not self._writable:
+            return defer.fail(StreamReadOnlyError('group opened read-only'))
+        self._g.meta = meta.copy()
+        return self._g.store(os.path.join(self._g.path, 'meta'),
+                             _encode_dict(self._g.meta))
+
+    def make_stream(self):
+        if not self._writable:
+            return defer.fail(StreamReadOnlyError('group opened read-only'))
+
+        s = self.build_stream(self._g.add_stream())
+        self._streams.append(s)
+        return defer.succeed(s)
+
+    def seek(self, offset, whence=0):
+        dl = defer.DeferredList([s.seek(offset, whence)
+                                 for s in self._streams],
+                                fireOnOneErrback=1, consumeErrors=1)
+        dl.addCallback(lambda results: None)
+        return dl
+
+    def read_to(self, callback, grpos, cb_args_map=None):
+        if cb_args_map is None:
+            cb_args_map = {}
+
+        def collector(frames, i, args):
+            def collect(gp, flags, data):
+                frames.append((gp, i, len(frames), flags, data, args))
+            return collect
+
+        frames = []
+        for i, s in enumerate(self._streams):
+            args = cb_args_map.get(s, ())
+            if not isinstance(args, (tuple, list)):
+                args = (args,)
+            s.read_until(collector(frames, i, args), grpos)
+
+        # merging the (sorted) runs of each stream, ordered by (gp,
+        # stream, frame): the keys are unique, data never compared
+        frames.sort()
+        for gp, _i, _n, flags, data, args in frames:
+            callback(gp, flags, data, *args)
+
+        return None, defer.succeed(None)
+
+
+class DServer(object):
+    """A stream server keeping stream groups on disk, under root.
+
+    Supported modes: 'r' (reading, also while being written in the same
+    server), 'w' (writing, replacing anything stored under the name
+    before) and 'a' (appending).
+    """
+    implements(IStreamServer)
+
+    segment_size = 64 * 1024 * 1024
+
+    def __init__(self, root, namespaces=None, threadpool=None,
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.threadpool = threadpool
+
+        self.root = root
+        if namespaces:
+            self._namespaces = frozenset(namespaces)
+        else:
+            self._namespaces = frozenset([None])
+
+        # _open: { (namespace, name) => DServerStreamGroup }
+        self._open = {}
+        # _loading: { (namespace, name) => [Deferred, ...] }
+        self._loading = {}
+
+    def run_in_thread(self, f, *args):
+        return run_in_thread(self.reactor, self.threadpool, f, *args)
+
+    def make_writer(self, path, mode='ab', written_cb=None):
+        return ThreadedFileWriter(path, mode, written_cb=written_cb,
+                                  threadpool=self.threadpool,
+                                  reactor=self.reactor, make_dirs=True)
+
+    def group_path(self, namespace, name):
+        if namespace is None:
+            ns_dir = DEFAULT_NAMESPACE_DIR
+        else:
+            ns_dir = _quote_name(namespace)
+        return os.path.join(self.root, ns_dir, _quote_name(name))
+
+    def open(self, name, mode='r', namespace=None):
+        if mode not in ('r', 'w', 'a'):
+            raise NotImplementedError('TBD later!')
+
+        return defer.maybeDeferred(self._open_group, namespace, name, mode)
+
+    def _open_group(self, namespace, name, mode):
+        if namespace not in self._namespaces:
+            raise NamespaceNotFoundError('Unknown namespace %r' % namespace)
+        if not name:
+            raise StreamNotFoundError('Unknown stream %r' % name)
+
+        key = (namespace, name)
+
+        waiting = self._loading.get(key)
+        if waiting is not None:
+            d = defer.Deferred()
+            waiting.append(d)
+            d.addCallback(lambda _: self._open_group(namespace, name, mode))
+            return d
+
+        server_sg = self._open.get(key)
+        if server_sg is not None:
+            if mode == 'r':
+                return self._attach(server_sg, False)
+            if server_sg.writable or mode == 'w':
+                raise StreamExistsError('Stream already open: %r' % name)
+            # appending to a group already open for reading
+            server_sg.start_writing()
+            return self._attach(server_sg, True)
+
+        path = self.group_path(namespace, name)
+        if mode == 'w':
+            d = self.run_in_thread(_remove_tree, path, True)
+            d.addCallback(lambda _: DServerStreamGroup(self, path, name,
+                                                       namespace))
+        else:
+            d = self.run_in_thread(_load_group, self, path, name, namespace,
+                                   mode == 'a')
+
+        def loaded(server_sg):
+            if server_sg is None:
+                raise StreamNotFoundError('Unknown stream %r' % name)
+            self._open[key] = server_sg
+            if mode != 'r':
+                server_sg.start_writing()
+            return self._attach(server_sg, mode != 'r')
+
+        def done_loading(result):
+            for w in self._loading.pop(key, []):
+                w.callback(None)
+            return result
+
+        self._loading[key] = []
+        d.addCallback(loaded)
+        d.addBoth(done_loading)
+        return d
+
+    def _attach(self, server_sg, writable):
+        server_sg.refs += 1
+        return DStreamGroup(server_sg, writable=writable)
+
+    def close(self, streamgroup):
+        if streamgroup.closed:
+            return defer.succeed(None)
+        streamgroup.closed = True
+
+        server_sg = streamgroup._g # cheating a bit...
+
+        d = defer.succeed(None)
+        if streamgroup._writable and server_sg.writable:
+            d = server_sg.stop_writing()
+
+        server_sg.refs -= 1
+        if server_sg.refs <= 0:
+            key = (server_sg.namespace, server_sg.name)
+            if self._open.get(key) is server_sg:
+                del self._open[key]
+
+        return d
+
+    def delete(self, streamgroup):
+        server_sg = streamgroup._g
+        key = (server_sg.namespace, server_sg.name)
+
+        def do_delete(_result):
+            if self._open.get(key) is server_sg:
+                del self._open[key]
+            return self.run_in_thread(_remove_tree, server_sg.path)
+
+        d = self.close(streamgroup)
+        d.addCallback(do_delete)
+        return d
@@ -0,0 +1,389 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+
+from zope.interface import implements
+
+from twisted.internet import defer
+
+from twimp import amf0
+from twimp import flv
+from twimp.server.interfaces import ILiveStream, IStreamGroup
+from twimp.server.interfaces import IStreamServer
+from twimp.server.controllers import FF_KEYFRAME, TYPE_AUDIO, TYPE_VIDEO
+from twimp.server.flvfile import name_to_path
+from twimp.server.writers import ThreadedFileWriter
+from twimp.utils import run_in_thread
+
+LOG_CATEGORY = 'recording'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+_tag_types = {TYPE_AUDIO: flv.TAG_AUDIO,
+              TYPE_VIDEO: flv.TAG_VIDEO}
+
+_copy_block_size = 1024 * 1024
+
+# encoded size of an entry of the keyframe index (two AMF numbers)
+_keyframe_entry_size = 2 * 9
+
+
+def _thin_keyframes(keyframes, count):
+    """Pick count entries of the keyframe index, evenly spread."""
+    times, positions = keyframes
+    n = len(times)
+    picked = [i * n // count for i in xrange(count)]
+    return [times[i] for i in picked], [positions[i] for i in picked]
+
+
+def _finalize_file(part_path, path, flags, meta, meta_size, keyframes):
+    """Fix up the header and the metadata of a just recorded file, and
+    move it in its final place.
+
+    A keyframe index not fitting in the reserved space gets thinned
+    out; the whole file only gets rewritten if the rest of the
+    metadata doesn't fit.
+    """
+    tag_overhead = flv.TAG_HEADER_SIZE + flv.TAG_TRAILER_SIZE
+    data_start = flv.FILE_HEADER_SIZE + tag_overhead + meta_size
+    file_size = os.stat(part_path).st_size
+
+    def final_meta(shift, keyframes=keyframes):
+        m = dict(meta, filesize=float(file_size + shift))
+        if keyframes:
+            times, positions = keyframes
+            m['keyframes'] = amf0.Object(
+                times=list(times),
+                filepositions=[float(p + shift) for p in positions])
+        return m
+
+    data = flv.encode_meta(final_meta(0), meta_size)
+    if data is None and keyframes and keyframes[0]:
+        empty = len(flv.encode_meta(final_meta(0, ([], []))))
+        count = min(len(keyframes[0]) - 1,
+                    (meta_size - empty) // _keyframe_entry_size)
+        # the padding takes a few bytes, too: maybe a few more tries
+        while data is None and count > 0:
+            data = flv.encode_meta(
+                final_meta(0, _thin_keyframes(keyframes, count)), meta_size)
+            count -= 1
+        if data is not None:
+            log.debug('%r: keyframe index thinned out to %d of %d entries',
+                      path, count + 1, len(keyframes[0]))
+
+    if data is not None:
+        f = open(part_path, 'r+b')
+        try:
+            f.seek(4)
+            f.write(chr(flags))
+            f.seek(flv.FILE_HEADER_SIZE)
+            f.writelines(flv.encode_tag(flv.TAG_DATA, 0, data))
+        finally:
+            f.close()
+        os.rename(part_path, path)
+        return
+
+    log.debug('rewriting %r, metadata grew past %d bytes', path, meta_size)
+    # the size of the encoded meta doesn't depend on the numbers in it
+    shift = len(flv.encode_meta(final_meta(0))) - meta_size
+    data = flv.encode_meta(final_meta(shift))
+
+    tmp_path = path + '.tmp'
+    src, dst = open(part_path, 'rb'), open(tmp_path, 'wb')
+    try:
+        dst.write(flv.encode_file_header(audio=flags & flv.FLAG_AUDIO,
+                                         video=flags & flv.FLAG_VIDEO))
+        dst.writelines(flv.encode_tag(flv.TAG_DATA, 0, data))
+        src.seek(data_start)
+        while True:
+            block = src.read(_copy_block_size)
+            if not block:
+                break
+            dst.write(block)
+    finally:
+        src.close()
+        dst.close()
+    os.rename(tmp_path, path)
+    os.unlink(part_path)
+
+
+class FLVRecording(object):
+    """Records frames of a set of tracks into a single FLV file, through
+    a ThreadedFileWriter.
+
+    The file is written under path + '.part' and moved to path only
+    once finalized - with the proper header flags and the metadata
+    (duration, filesize and, optionally, a keyframe index as the
+    common 'keyframes' object: times and filepositions).
+
+    When the writer reports being full (the disk not keeping up),
+    frames get dropped, video until the next keyframe.
+    """
+
+    def __init__(self, server, path, writer, keyframe_index=False,
+                 meta_reserve=4096):
+        self.server = server
+        self.path = path
+        self.writer = writer
+        self.keyframe_index = keyframe_index
+        self.meta_reserve = meta_reserve
+
+        self.meta = {}
+        self.size = 0
+        self.flags = 0
+        self.base_ts = None
+        self.last_ts = 0
+        self.dropped = 0
+        self.closed = False
+
+        self._times = []
+        self._positions = []
+        self._skip_video = False
+
+        self._write(flv.encode_file_header(audio=False, video=False))
+        self._write(flv.encode_tag(flv.TAG_DATA, 0,
+                                   flv.encode_meta({}, meta_reserve)))
+
+    def _write(self, seq):
+        self.writer.write_seq(seq)
+        for data in seq:
+            self.size += len(data)
+
+    def set_meta(self, meta):
+        self.meta = dict(meta)
+
+    def write_header(self, type_, data):
+        if self.writer.failure is not None:
+            return
+        self.flags |= (flv.FLAG_VIDEO if type_ == flv.TAG_VIDEO
+                       else flv.FLAG_AUDIO)
+        self._write(flv.encode_tag(type_, 0, data))
+
+    def write_frame(self, type_, grpos, flags, data):
+        video = type_ == flv.TAG_VIDEO
+
+        if self.writer.failure is not None:
+            # the recording is lost, the live stream goes on
+            self.dropped += 1
+            return
+        if self.writer.is_full():
+            if not self.dropped:
+                log.warning('%r: writing too slow, dropping frames',
+                            self.path)
+            self.dropped += 1
+            if video:
+                self._skip_video = True
+            return
+        if video and self._skip_video:
+            if not flags & FF_KEYFRAME:
+                self.dropped += 1
+                return
+            self._skip_video = False
+
+        if self.base_ts is None:
+            self.base_ts = grpos
+        ts = max(0, grpos - self.base_ts)
+        self.last_ts = max(self.last_ts, ts)
+
+        if video:
+            self.flags |= flv.FLAG_VIDEO
+            if self.keyframe_index and flags & FF_KEYFRAME:
+                self._times.append(ts / 1000.0)
+                self._positions.append(self.size)
+        else:
+            self.flags |= flv.FLAG_AUDIO
+
+        self._write(flv.encode_tag(type_, ts & 0xffffffff, data))
+
+    def close(self):
+        """Flush everything and finalize the file.
+
+        @rtype: Deferred
+        """
+        if self.closed:
+            return defer.succeed(None)
+        self.closed = True
+
+        meta = dict(self.meta)
+        meta['duration'] = self.last_ts / 1000.0
+        meta['lasttimestamp'] = self.last_ts / 1000.0
+        meta['hasVideo'] = bool(self.flags & flv.FLAG_VIDEO)
+        meta['hasAudio'] = bool(self.flags & flv.FLAG_AUDIO)
+
+        keyframes = None
+        if self.keyframe_index:
+            keyframes = (self._times, self._positions)
+
+        def finalize(_result):
+            return self.server.run_in_thread(_finalize_file,
+                                             self.writer.path, self.path,
+                                             self.flags, meta,
+                                             self.meta_reserve, keyframes)
+
+        def done(result):
+            if self.dropped:
+                log.warning('%r: %d frames dropped', self.path, self.dropped)
+            log.info('recorded %r (%d bytes)', self.path, self.size)
+            return result
+
+        d = self.writer.close()
+        d.addCallback(finalize)
+        d.addCallback(done)
+        return d
+
+
+class RecordingStream(object):
+    """Passes everything through to the wrapped stream, also recording
+    headers and frames written.
+    """
+    implements(ILiveStream)
+
+    def __init__(self, stream, recording):
+        self._stream = stream
+        self._recording = recording
+        self._tag_type = None
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def set_params(self, params):
+        self._tag_type = _tag_types.get(params.get('type'))
+        return self._stream.set_params(params)
+
+    def write_headers(self, data, grpos=0, flags=0):
+        if self._tag_type is not None:
+            self._recording.write_header(self._tag_type, data)
+        return self._stream.write_headers(data, grpos=grpos, flags=flags)
+
+    def write(self, grpos, flags, data):
+        if self._tag_type is not None:
+            self._recording.write_frame(self._tag_type, grpos, flags, data)
+        return self._stream.write(grpos, flags, data)
+
+
+class RecordingStreamGroup(object):
+    implements(IStreamGroup)
+
+    def __init__(self, streamgroup, recording):
+        self._sg = streamgroup
+        self.recording = recording
+
+    def __getattr__(self, name):
+        return getattr(self._sg, name)
+
+    def set_meta(self, meta):
+        self.recording.set_meta(meta)
+        return self._sg.set_meta(meta)
+
+    def make_stream(self):
+        d = self._sg.make_stream()
+        d.addCallback(RecordingStream, self.recording)
+        return d
+
+
+class RecordingServer(object):
+    """A stream server wrapping another one, and recording the stream
+    groups opened in one of modes into FLV files under root (laid out
+    the same way FLVFileServer expects them).
+
+    All the file I/O happens in a thread pool, a bounded amount of data
+    per recording queued at any time.
+    """
+    implements(IStreamServer)
+
+    # recording writers' settings
+    buffer_size = 512 * 1024
+    max_pending = 8 * 1024 * 1024
+    fsync = 'close'
+
+    keyframe_index = True
+    # room for the metadata with the keyframe index of an hour long
+    # recording with 2s GOPs (longer indices get thinned out to fit)
+    meta_reserve = 4096 + _keyframe_entry_size * 1800
+
+    def __init__(self, server, root, modes=('l',), threadpool=None,
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.threadpool = threadpool
+
+        self.server = server
+        self.root = root
+        self.modes = frozenset(modes)
+
+    def run_in_thread(self, f, *args):
+        return run_in_thread(self.reactor, self.threadpool, f, *args)
+
+    def record_path(self, namespace, name):
+        return name_to_path(self.root, namespace, name)
+
+    def make_writer(self, path):
+        w = ThreadedFileWriter(path, 'wb', threadpool=self.threadpool,
+                               reactor=self.reactor, make_dirs=True,
+                               fsync=self.fsync)
+        w.buffer_size = self.buffer_size
+        w.max_pending = self.max_pending
+        return w
+
+    def open(self, name, mode='r', namespace=None):
+        d = self.server.open(name, mode=mode, namespace=namespace)
+        if mode not in self.modes:
+            return d
+
+        path = self.record_path(namespace, name)
+        if path is None:
+            log.warning('not recording %r: invalid name', name)
+            return d
+
+        def opened(streamgroup):
+            recording = FLVRecording(self, path,
+                                     self.make_writer(path + '.part'),
+                                     keyframe_index=self.keyframe_index,
+                                     meta_reserve=self.meta_reserve)
+            return RecordingStreamGroup(streamgroup, recording)
+
+        d.addCallback(opened)
+        return d
+
+    def _unwrap(self, streamgroup):
+        if isinstance(streamgroup, RecordingStreamGroup):
+            return streamgroup._sg, streamgroup.recording.close()
+        return streamgroup, defer.succeed(None)
+
+    def close(self, streamgroup):
+        streamgroup, d = self._unwrap(streamgroup)
+
+        def close_wrapped(result):
+            # a failed recording shouldn't keep the stream open
+            d = self.server.close(streamgroup)
+            d.addCallback(lambda _: result)
+            return d
+
+        d.addBoth(close_wrapped)
+        return d
+
+    def delete(self, streamgroup):
+        streamgroup, d = self._unwrap(streamgroup)
+
+        def delete_wrapped(result):
+            d = self.server.delete(streamgroup)
+            d.addCallback(lambda _: result)
+            return d
+
+        d.addBoth(delete_wrapped)
+        return d
@@ -0,0 +1,803 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Live stream groups in shared memory.
+
+The frames of a stream group published through RingServer are written
+into a ring in a memory-mapped file under root (best on tmpfs, like
+/dev/shm), that any number of processes can map and read from. Frame
+data is copied out of the mapping before being handed to subscribers:
+they can hold on to it for long (e.g. players queuing it for writing
+out), while the writer overwrites the ring.
+
+Ring file layout (all the integers little-endian):
+
+  0     file header (_s_file_header)
+  64    counters - 8-byte words, updated by the writer only: frames
+        written, end of the data written (or being written), info
+        generation (odd while the info is being changed), closed flag
+  128   index - slots * _s_slot, frame n described in slot n % slots
+  ...   info - 4-byte size + group meta, stream params, meta and headers
+  ...   data - data_size bytes, frames stored back to back, wrapping
+
+The writer never waits for readers. A reader can tell a frame is gone
+by the sequence number of its slot (frame number + 1, 0 while the slot
+is being filled), or by the data end having moved more than data_size
+past the frame's data. That relies on the stores of the writer becoming
+visible in program order, as they do on x86.
+"""
+
+from itertools import chain
+import errno
+import mmap
+import os
+import struct
+
+from zope.interface import implements
+
+from twisted.internet import defer, task
+
+from twimp.server.interfaces import ILiveStream, IStreamGroup
+from twimp.server.interfaces import IStreamServer, ISyncStream
+from twimp.server.inmemory import IMStream, IMStreamGroup
+from twimp.server.controllers import FF_KEYFRAME
+from twimp.server.cluster import _pid_alive
+from twimp.server.ondisk import _decode_dict, _encode_dict, _quote_name
+from twimp.server.writers import make_dirs
+
+from twimp.server.errors import FrameTooLargeError, InvalidFrameNumber
+from twimp.server.errors import NamespaceNotFoundError, StreamExistsError
+from twimp.server.errors import StreamNotFoundError, StreamReadOnlyError
+
+from twimp.vecbuf import VecBuf, flatten
+
+LOG_CATEGORY = 'shmring'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+_MAGIC = 'TWRING\x00\x01'
+
+# magic, slots, data size, info size, writer's pid
+_s_file_header = struct.Struct('<8sLLLL')
+
+_COUNTERS_OFFSET = 64
+_FRAMES, _DATA_END, _INFO_GEN, _CLOSED = range(4)
+_s_counter = struct.Struct('<Q')
+
+_SLOTS_OFFSET = 128
+# sequence, grpos, data position, stream, flags, size
+_s_slot = struct.Struct('<QqQLLL4x')
+_s_slot_body = struct.Struct('<qQLLL')
+
+_s_size = struct.Struct('<L')
+# header grpos, flags, size
+_s_info_header = struct.Struct('<qLL')
+
+
+def _flat(data):
+    if isinstance(data, str):
+        return data
+    if isinstance(data, buffer):
+        return data[:]
+    return flatten(data.peek_seq(len(data)))
+
+def _encode_info(meta, streams):
+    """
+    @param streams: [(params, meta, [(grpos, flags, data), ...]), ...]
+    """
+    parts = []
+
+    def blob(s):
+        parts.append(_s_size.pack(len(s)))
+        parts.append(s)
+
+    blob(_encode_dict(meta))
+    parts.append(_s_size.pack(len(streams)))
+    for params, stream_meta, headers in streams:
+        blob(_encode_dict(params))
+        blob(_encode_dict(stream_meta))
+        parts.append(_s_size.pack(len(headers)))
+        for grpos, flags, data in headers:
+            parts.append(_s_info_header.pack(grpos, flags, len(data)))
+            parts.append(data)
+    return ''.join(parts)
+
+def _decode_info(data):
+    offset = [0]
+
+    def unpack(st):
+        values = st.unpack_from(data, offset[0])
+        offset[0] += st.size
+        return values
+
+    def blob():
+        size, = unpack(_s_size)
+        start = offset[0]
+        offset[0] += size
+        return data[start:start + size]
+
+    meta = _decode_dict(blob())
+    streams = []
+    count, = unpack(_s_size)
+    for _i in xrange(count):
+        params = _decode_dict(blob())
+        stream_meta = _decode_dict(blob())
+        headers = []
+        header_count, = unpack(_s_size)
+        for _j in xrange(header_count):
+            grpos, flags, size = unpack(_s_info_header)
+            start = offset[0]
+            offset[0] += size
+            headers.append((grpos, flags, data[start:start + size]))
+        streams.append((params, stream_meta, headers))
+    return meta, streams
+
+
+class FrameRing(object):
+    """A single-writer, multiple-reader ring of frames in a
+    memory-mapped file - see the module docstring for the layout.
+    """
+    def __init__(self, path, map_, writable=False):
+        self.path = path
+        self.writable = writable
+        self._map = map_
+
+        (magic, self.slots, self.data_size, self.info_size,
+         self.pid) = _s_file_header.unpack_from(map_, 0)
+        if magic != _MAGIC:
+            raise ValueError('not a frame ring: %r' % (path,))
+
+        self._info_offset = _SLOTS_OFFSET + self.slots * _s_slot.size
+        self._data_offset = self._info_offset + self.info_size
+        if len(map_) < self._data_offset + self.data_size:
+            raise ValueError('truncated frame ring: %r' % (path,))
+
+    def _get(self, counter):
+        return _s_counter.unpack_from(self._map,
+                                      _COUNTERS_OFFSET + counter * 8)[0]
+
+    def _set(self, counter, value):
+        _s_counter.pack_into(self._map, _COUNTERS_OFFSET + counter * 8,
+                             value)
+
+    def head(self):
+        """
+        @return: number of frames written so far
+        """
+        return self._get(_FRAMES)
+
+    def alive(self):
+        return not self._get(_CLOSED) and _pid_alive(self.pid)
+
+    def append(self, stream, grpos, flags, data):
+        """
+        @return: the frame number
+        """
+        if isinstance(data, (str, buffer)):
+            seq = [data]
+        else:
+            seq = data.peek_seq(len(data))
+        size = sum(len(d) for d in seq)
+        if size > self.data_size:
+            raise FrameTooLargeError('frame too large for the ring: %d'
+                                     % (size,))
+
+        pos = self._get(_DATA_END)
+        offset = pos % self.data_size
+        if offset + size > self.data_size:
+            # never split frames, start over at the beginning instead
+            pos += self.data_size - offset
+            offset = 0
+
+        # claim the space first, for readers to know what's overwritten
+        self._set(_DATA_END, pos + size)
+
+        m = self._map
+        m.seek(self._data_offset + offset)
+        for d in seq:
+            m.write(d)
+
+        n = self._get(_FRAMES)
+        slot = _SLOTS_OFFSET + (n % self.slots) * _s_slot.size
+        _s_counter.pack_into(m, slot, 0)
+        _s_slot_body.pack_into(m, slot + _s_counter.size, grpos, pos,
+                               stream, flags, size)
+        _s_counter.pack_into(m, slot, n + 1)
+
+        self._set(_FRAMES, n + 1)
+        return n
+
+    def frame(self, n, copy=False):
+        """
+        @param copy: whether to copy the data out of the ring
+
+        @return: (stream, grpos, flags, data) of frame n, or None if the
+                 frame has been overwritten (or not written yet); unless
+                 copied, data is a buffer into the ring, only valid
+                 until the writer overwrites it in turn
+        """
+        m = self._map
+        slot = _SLOTS_OFFSET + (n % self.slots) * _s_slot.size
+        if _s_counter.unpack_from(m, slot)[0] != n + 1:
+            return None
+        grpos, pos, stream, flags, size = _s_slot_body.unpack_from(
+            m, slot + _s_counter.size)
+        if (_s_counter.unpack_from(m, slot)[0] != n + 1 or
+            self._get(_DATA_END) > pos + self.data_size):
+            return None
+
+        offset = self._data_offset + pos % self.data_size
+        if not copy:
+            return stream, grpos, flags, buffer(m, offset, size)
+
+        data = m[offset:offset + size]
+        if self._get(_DATA_END) > pos + self.data_size:
+            # overwritten while copying
+            return None
+        return stream, grpos, flags, data
+
+    def set_info(self, data):
+        if _s_size.size + len(data) > self.info_size:
+            raise FrameTooLargeError('stream info too large for the ring:'
+                                     ' %d' % (len(data),))
+        gen = self._get(_INFO_GEN)
+        self._set(_INFO_GEN, gen + 1)
+        m = self._map
+        m.seek(self._info_offset)
+        m.write(_s_size.pack(len(data)))
+        m.write(data)
+        self._set(_INFO_GEN, gen + 2)
+
+    def info(self):
+        """
+        @return: (generation, data), data None if being changed just now
+        """
+        gen = self._get(_INFO_GEN)
+        if gen & 1:
+            return gen, None
+
+        start = self._info_offset + _s_size.size
+        size, = _s_size.unpack_from(self._map, self._info_offset)
+        data = self._map[start:start + min(size, self.info_size)]
+        if self._get(_INFO_GEN) != gen:
+            return gen, None
+        return gen, data
+
+    def close(self):
+        """Mark the ring closed and remove its file (writer only)."""
+        self._set(_CLOSED, 1)
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def create_ring(path, slots, data_size, info_size):
+    """Create a ring file, mapped for writing. The file is set up under
+    a temporary name, and only then linked in place, so that readers
+    never see it half-made.
+
+    @raise OSError: with errno EEXIST, if path exists already
+    """
+    size = (_SLOTS_OFFSET + slots * _s_slot.size + info_size + data_size)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        os.ftruncate(fd, size)
+        map_ = mmap.mmap(fd, size)
+        _s_file_header.pack_into(map_, 0, _MAGIC, slots, data_size,
+                                 info_size, os.getpid())
+        os.link(tmp_path, path)
+    finally:
+        os.close(fd)
+        os.unlink(tmp_path)
+    return FrameRing(path, map_, writable=True)
+
+def open_ring(path):
+    """Map an existing ring file for reading."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        map_ = mmap.mmap(fd, os.fstat(fd).st_size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    return FrameRing(path, map_)
+
+
+class RingServerStream(object):
+    def __init__(self, group, index):
+        self.group = group
+        self.index = index
+
+        self.meta = {}
+        self.params = {}
+        self.headers = []
+
+        self.data_listeners = set()
+
+        # frames got lost, waiting for a keyframe
+        self.skipping = False
+
+    def deliver(self, grpos, flags, data):
+        if self.skipping:
+            if not flags & FF_KEYFRAME:
+                return
+            self.skipping = False
+
+        for c in self.data_listeners:
+            try:
+                c(grpos, flags, VecBuf([data]))
+            except:
+                defer.fail()    # this should end up in logs somewhere... :/
+
+
+class RingServerStreamGroup(object):
+    def __init__(self, server, ring, name=None, namespace=None):
+        self.server = server
+        self.ring = ring
+        self.name = name
+        self.namespace = namespace
+        self.writable = ring.writable
+
+        self.meta = {}
+        self.streams = []
+
+        # frames up to pos have been passed to the listeners already
+        self.pos = ring.head()
+        self.info_generation = None
+        self.refs = 0
+        self.ended = False
+        self._poller = None
+
+    def add_stream(self):
+        s = RingServerStream(self, len(self.streams))
+        self.streams.append(s)
+        self.store_info()
+        return s
+
+    def store_info(self):
+        self.ring.set_info(_encode_info(self.meta,
+                                        [(s.params, s.meta, s.headers)
+                                         for s in self.streams]))
+
+    def load_info(self):
+        gen, data = self.ring.info()
+        if data is None or gen == self.info_generation:
+            return
+        self.info_generation = gen
+
+        meta, streams = _decode_info(data)
+        self.meta = meta
+        for i, (params, stream_meta, headers) in enumerate(streams):
+            if i == len(self.streams):
+                self.streams.append(RingServerStream(self, i))
+            s = self.streams[i]
+            s.params, s.meta, s.headers = params, stream_meta, headers
+
+    def append(self, stream, grpos, flags, data):
+        self.ring.append(stream.index, grpos, flags, data)
+        self.pos = self.ring.head()
+
+    def start_polling(self, interval):
+        self._poller = task.LoopingCall(self.poll)
+        self._poller.clock = self.server.reactor
+        self._poller.start(interval, now=False)
+
+    def stop_polling(self):
+        if self._poller is not None:
+            poller, self._poller = self._poller, None
+            poller.stop()
+
+    def poll(self):
+        ring = self.ring
+        self.load_info()
+
+        head = ring.head()
+        pos = start = self.pos
+        lost = max(0, head - ring.slots - pos)
+        pos += lost
+
+        while pos < head:
+            f = ring.frame(pos, copy=True)
+            pos += 1
+            if f is None:
+                lost += 1
+                continue
+            if lost:
+                self._frames_lost(lost)
+                lost = 0
+            index, grpos, flags, data = f
+            if index < len(self.streams):
+                self.streams[index].deliver(grpos, flags, data)
+        self.pos = pos
+
+        if lost:
+            self._frames_lost(lost)
+
+        # no news - check for the writer having gone away
+        if pos == start and not ring.alive():
+            log.debug('%r: ring closed', self.name)
+            self.end()
+
+    def _frames_lost(self, count):
+        log.warning('%r: reading too slow, %d frames lost', self.name, count)
+        for s in self.streams:
+            s.skipping = True
+
+    def end(self):
+        if self.ended:
+            return
+        self.ended = True
+        self.stop_polling()
+        if self.writable:
+            self.ring.close()
+
+
+class RingStream(IMStream):
+    """A stream living in a frame ring.
+
+    Streams are live only: there's no seeking nor reading, just
+    subscribing, with preroll from whatever is still in the ring.
+    Frames are numbered the same way for all the streams of the group.
+    """
+    implements(ILiveStream, ISyncStream)
+
+    def __init__(self, server_stream, writable=False):
+        IMStream.__init__(self, server_stream)
+        self._writable = writable
+
+    def _read_only(self):
+        return defer.fail(StreamReadOnlyError('stream opened read-only'))
+
+    def _check_writable(self):
+        if not self._writable:
+            raise StreamReadOnlyError('stream opened read-only')
+
+    def _frames_back(self, end=None):
+        """Iterate over the frames of this stream still in the ring,
+        newest first, from (not including) end.
+        """
+        g = self._s.group
+        ring = g.ring
+        if end is None:
+            end = g.pos
+        n = end - 1
+        oldest = max(0, ring.head() - ring.slots)
+        while n >= oldest:
+            f = ring.frame(n)
+            if f is None:
+                # overwritten, and so is everything before
+                return
+            if f[0] == self._s.index:
+                yield n, f[1], f[2], f[3]
+            n -= 1
+
+    def _scan_from_end(self, grpos_range, frames=None, flag_mask=0):
+        """
+        @return: list of (frame number, grpos, flags, data), oldest first
+        """
+        frames_back = self._frames_back()
+        found = []
+        last_grpos = None
+        rest = []
+        for f in frames_back:
+            if last_grpos is None:
+                last_grpos = f[1]
+            if grpos_range > 0:
+                if f[1] < last_grpos - grpos_range:
+                    rest = [f]
+                    break
+            elif len(found) >= (frames or 1):
+                rest = [f]
+                break
+            found.append(f)
+
+        if flag_mask < 0 and found:
+            mask = - flag_mask
+            if not found[-1][2] & mask:
+                extra = []
+                for f in chain(rest, frames_back):
+                    extra.append(f)
+                    if f[2] & mask:
+                        found.extend(extra)
+                        break
+
+        found.reverse()
+
+        if flag_mask > 0:
+            for i, f in enumerate(found):
+                if f[2] & flag_mask:
+                    found = found[i:]
+                    break
+
+        return found
+
+
+    ##
+    # IStream interface implementation
+
+    def set_params(self, params):
+        if not self._writable:
+            return self._read_only()
+        self._s.params = params.copy()
+        return defer.maybeDeferred(self._s.group.store_info)
+
+    def set_meta(self, meta):
+        if not self._writable:
+            return self._read_only()
+        self._s.meta = meta.copy()
+        return defer.maybeDeferred(self._s.group.store_info)
+
+    def read_headers(self, callback):
+        for grpos, flags, data in self._s.headers:
+            callback(grpos, flags, VecBuf([data]))
+        return None, defer.succeed(None)
+
+    def write_headers(self, data, grpos=0, flags=0):
+        return defer.maybeDeferred(self.write_headers_now, data, grpos,
+                                   flags)
+
+    def read(self, callback, grpos_range, frames=None):
+        raise NotImplementedError('ring streams are live only')
+
+    def write(self, grpos, flags, data):
+        try:
+            self.write_now(grpos, flags, data)
+        except (StreamReadOnlyError, FrameTooLargeError):
+            return defer.fail()
+        return defer.succeed(None)
+
+    def trim(self, grpos_range, frames=None, flag_mask=0):
+        # the ring overwrites the old frames by itself
+        return defer.succeed(None)
+
+    def set_buffering(self, grpos_range=0, frames=0, flag_mask=0):
+        # as much is buffered as fits in the ring
+        return defer.succeed(None)
+
+    def subscribe(self, callback, preroll_grpos_range=0, preroll_frames=0,
+                  preroll_from_frame=None, flag_mask=0):
+        preroll = []
+
+        if preroll_grpos_range > 0 or preroll_frames > 0:
+            preroll = self._scan_from_end(preroll_grpos_range,
+                                          frames=preroll_frames,
+                                          flag_mask=flag_mask)
+        elif preroll_from_frame is not None:
+            for f in self._frames_back():
+                if f[0] < preroll_from_frame:
+                    break
+                preroll.append(f)
+            if not preroll or preroll[-1][0] != preroll_from_frame:
+                e = InvalidFrameNumber('frame %r' % (preroll_from_frame))
+                return defer.fail(e)
+            preroll.reverse()
+
+        ring = self._s.group.ring
+        for n, grpos, flags, _data in preroll:
+            f = ring.frame(n, copy=True)
+            if f is None:
+                # overwritten in the meantime
+                continue
+            callback(grpos, flags, VecBuf([f[3]]))
+
+        self._s.data_listeners.add(callback)
+        return defer.succeed(callback)
+
+    def find_frame_backward(self, grpos_range, frames=None, flag_mask=0):
+        found = self._scan_from_end(grpos_range, frames=frames,
+                                    flag_mask=flag_mask)
+        if found:
+            return defer.succeed(found[0][0])
+        return defer.succeed(None)
+
+    def frame_to_grpos(self, frame):
+        if frame < 0:
+            frame = self._s.group.pos + frame
+
+        for n, grpos, _flags, _data in self._frames_back(frame + 1):
+            if n == frame:
+                return defer.succeed(grpos)
+            break
+
+        return defer.fail(InvalidFrameNumber('frame %r' % (frame,)))
+
+
+    ##
+    # ISyncStream interface implementation
+
+    def write_headers_now(self, data, grpos=0, flags=0):
+        self._check_writable()
+        self._s.headers.append((grpos, flags, _flat(data)))
+        self._s.group.store_info()
+
+    def write_now(self, grpos, flags, data):
+        self._check_writable()
+        self._s.group.append(self._s, grpos, flags, data)
+        self.notify_write_listeners(grpos, flags, data)
+
+
+class RingStreamGroup(IMStreamGroup):
+    implements(IStreamGroup)
+
+    def __init__(self, server_streamgroup, writable=False):
+        self._writable = writable
+        self.closed = False
+        IMStreamGroup.__init__(self, server_streamgroup)
+
+    def build_stream(self, server_stream):
+        return RingStream(server_stream, writable=self._writable)
+
+    def _sync_streams(self):
+        # streams might have been added by the writer in the meantime
+        new = self._g.streams[len(self._streams):]
+        self._streams.extend(self.build_streams(new))
+
+    def set_meta(self, meta):
+        if not self._writable:
+            return defer.fail(StreamReadOnlyError('group opened read-only'))
+        self._g.meta = meta.copy()
+        return defer.maybeDeferred(self._g.store_info)
+
+    def streams(self):
+        self._sync_streams()
+        return IMStreamGroup.streams(self)
+
+    def streams_by_params(self, template):
+        self._sync_streams()
+        return IMStreamGroup.streams_by_params(self, template)
+
+    def make_stream(self):
+        if not self._writable:
+            return defer.fail(StreamReadOnlyError('group opened read-only'))
+
+        s = self.build_stream(self._g.add_stream())
+        self._streams.append(s)
+        return defer.succeed(s)
+
+
+class RingServer(object):
+    """A stream server keeping live stream groups in frame rings under
+    root, for processes sharing root to read streams published in any
+    of them without copying the frames around.
+
+    Supported modes: 'l' (publishing) and 'r' (reading). Readers in the
+    publishing process get the frames right away, readers in other
+    processes poll the ring every poll_interval seconds.
+    """
+    implements(IStreamServer)
+
+    slots = 8192
+    data_size = 16 * 1024 * 1024
+    info_size = 256 * 1024
+    poll_interval = 0.01
+
+    def __init__(self, root, namespaces=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+        self.root = root
+        if namespaces:
+            self._namespaces = frozenset(namespaces)
+        else:
+            self._namespaces = frozenset([None])
+
+        # _open: { (namespace, name) => RingServerStreamGroup }
+        self._open = {}
+
+    def ring_path(self, namespace, name):
+        return os.path.join(self.root, '%s@%s.ring' % (
+                _quote_name(namespace or ''), _quote_name(name)))
+
+    def open(self, name, mode='r', namespace=None):
+        if mode not in ('r', 'l'):
+            raise NotImplementedError('TBD later!')
+
+        if mode == 'l':
+            return defer.maybeDeferred(self._open_live, namespace, name)
+        elif mode == 'r':
+            return defer.maybeDeferred(self._open_readable, namespace, name)
+
+    def _check_name(self, namespace, name):
+        if namespace not in self._namespaces:
+            raise NamespaceNotFoundError('Unknown namespace %r' % namespace)
+        if not name:
+            raise StreamNotFoundError('Unknown stream %r' % name)
+
+    def _create_ring(self, path):
+        make_dirs(self.root)
+        for _attempt in range(2):
+            try:
+                return create_ring(path, self.slots, self.data_size,
+                                   self.info_size)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            try:
+                ring = open_ring(path)
+            except (EnvironmentError, ValueError):
+                continue
+            if ring.alive():
+                return None
+
+            log.info('replacing stale ring %r', path)
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return None
+
+    def _open_live(self, namespace, name):
+        self._check_name(namespace, name)
+
+        key = (namespace, name)
+        server_sg = self._open.get(key)
+        if server_sg is not None and server_sg.writable:
+            raise StreamExistsError('Stream already exists: %r' % name)
+
+        ring = self._create_ring(self.ring_path(namespace, name))
+        if ring is None:
+            raise StreamExistsError('Stream already exists: %r' % name)
+
+        server_sg = RingServerStreamGroup(self, ring, name, namespace)
+        server_sg.store_info()
+        self._open[key] = server_sg
+        return self._attach(server_sg, True)
+
+    def _open_readable(self, namespace, name):
+        self._check_name(namespace, name)
+
+        key = (namespace, name)
+        server_sg = self._open.get(key)
+        if server_sg is None or server_sg.ended:
+            try:
+                ring = open_ring(self.ring_path(namespace, name))
+            except (EnvironmentError, ValueError):
+                ring = None
+            if ring is None or not ring.alive():
+                raise StreamNotFoundError('Unknown stream %r' % name)
+
+            server_sg = RingServerStreamGroup(self, ring, name, namespace)
+            server_sg.load_info()
+            server_sg.start_polling(self.poll_interval)
+            self._open[key] = server_sg
+
+        return self._attach(server_sg, False)
+
+    def _attach(self, server_sg, writable):
+        server_sg.refs += 1
+        return RingStreamGroup(server_sg, writable=writable)
+
+    def close(self, streamgroup):
+        if streamgroup.closed:
+            return defer.succeed(None)
+        streamgroup.closed = True
+
+        server_sg = streamgroup._g # cheating a bit...
+        server_sg.refs -= 1
+        if streamgroup._writable or server_sg.refs <= 0:
+            server_sg.end()
+            key = (server_sg.namespace, server_sg.name)
+            if self._open.get(key) is server_sg:
+                del self._open[key]
+
+        return defer.succeed(None)
+
+    def delete(self, streamgroup):
+        return self.close(streamgroup)
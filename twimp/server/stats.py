@@ -0,0 +1,91 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""An HTTP endpoint serving the counters of a MetricsRegistry: as JSON
+at /stats and in the Prometheus text format at /metrics - and the
+latency percentiles of a Profiler and of a FrameTracer, as JSON at
+/profile and /latency.
+"""
+
+from twisted.web import resource, server
+
+from twimp.utils import json
+
+LOG_CATEGORY = 'stats'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class _JSONStats(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(self.metrics.snapshot(), indent=2, sort_keys=True)
+
+
+class _PrometheusStats(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.metrics.prometheus()
+
+
+class _Report(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, reporter):
+        resource.Resource.__init__(self)
+        self.reporter = reporter
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(self.reporter.report(), indent=2, sort_keys=True)
+
+
+class StatsResource(resource.Resource):
+    def __init__(self, metrics, profiler=None, tracer=None):
+        resource.Resource.__init__(self)
+        if metrics is not None:
+            self.putChild('stats', _JSONStats(metrics))
+            self.putChild('metrics', _PrometheusStats(metrics))
+        if profiler is not None:
+            self.putChild('profile', _Report(profiler))
+        if tracer is not None:
+            self.putChild('latency', _Report(tracer))
+
+
+def listen_stats(port, metrics, profiler=None, tracer=None, interface='',
+                 reactor=None):
+    """Serve the counters of metrics (and the percentiles of profiler
+    and tracer) over HTTP on port.
+
+    @return: the listening port
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    site = server.Site(StatsResource(metrics, profiler, tracer))
+    site.noisy = False
+    log.info('serving stats on port %d', port)
+    return reactor.listenTCP(port, site, interface=interface)
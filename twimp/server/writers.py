@@ -0,0 +1,277 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import errno
+import os
+import time
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from twimp.utils import run_in_thread
+
+LOG_CATEGORY = 'writers'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class WriterClosedError(IOError):
+    pass
+
+
+def make_dirs(path):
+    """Like os.makedirs(), but don't complain about existing
+    directories. Safe to call from multiple threads."""
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class ThreadedFileWriter(object):
+    """Append data to a file without doing any file I/O in the
+    reactor thread.
+
+    Data passed to write()/write_seq() is only referenced, and handed
+    over to a thread pool in batches of at least buffer_size bytes (or
+    whatever accumulated after flush_delay seconds). There's at most
+    one batch per writer in flight at any time, so data lands in the
+    file in order.
+
+    max_pending, if set, is the number of bytes queued but not yet
+    written above which the writer reports being full - it's up to the
+    user to stop writing then (data is never refused).
+
+    fsync controls how hard the data gets pushed to the disk: None
+    leaves it to the OS, 'close' syncs when closing, 'batch' after
+    every batch, and a number syncs at most that often (in seconds),
+    plus on close.
+    """
+
+    buffer_size = 256 * 1024
+    flush_delay = 0.5
+    max_pending = None
+
+    def __init__(self, path, mode='ab', written_cb=None, threadpool=None,
+                 reactor=None, make_dirs=False, fsync=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.threadpool = threadpool
+
+        self.path = path
+        self.mode = mode
+        self.make_dirs = make_dirs
+        self.fsync = fsync
+
+        # bytes accepted so far and bytes already written to the file
+        self.queued = 0
+        self.written = 0
+
+        self._written_cb = written_cb
+
+        self._f = None
+        self._synced = 0
+        self._bufs = []
+        self._buf_len = 0
+        self._busy = False
+        self._timer = None
+        self._waiters = []      # [(queued position, Deferred), ...]
+        self._closing = None
+        self.closed = False
+        self.failure = None
+
+    def pending(self):
+        return self.queued - self.written
+
+    def is_full(self):
+        return (self.max_pending is not None and
+                self.queued - self.written >= self.max_pending)
+
+    def write(self, data):
+        self.write_seq((data,))
+
+    def write_seq(self, seq):
+        if self._closing is not None or self.closed:
+            raise WriterClosedError('writer for %r closed' % (self.path,))
+        if self.failure is not None:
+            # nothing more gets written after a failed batch
+            self.failure.raiseException()
+
+        n = 0
+        for data in seq:
+            self._bufs.append(data)
+            n += len(data)
+        self._buf_len += n
+        self.queued += n
+
+        if self._buf_len >= self.buffer_size:
+            self._kick()
+        elif self._timer is None and self.flush_delay is not None:
+            self._timer = self.reactor.callLater(self.flush_delay,
+                                                 self._timed_flush)
+
+    def flush(self):
+        """Make sure all the data queued so far gets written.
+
+        @return: a Deferred firing once it's been written
+        """
+        if self.failure:
+            return defer.fail(self.failure)
+
+        if self.written >= self.queued:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self._waiters.append((self.queued, d))
+        self._kick()
+        return d
+
+    def close(self):
+        """Flush and close the file.
+
+        @rtype: Deferred
+        """
+        if self.closed:
+            return defer.succeed(None)
+
+        if self._closing is not None:
+            d = defer.Deferred()
+            self._closing.append(d)
+            return d
+
+        self._closing = []
+
+        def do_close(result):
+            # closing the file even if flushing failed, passing the
+            # failure on
+            if self._f is None:
+                return result
+            d = self._in_thread(self._close_file)
+            if isinstance(result, failure.Failure):
+                d.addBoth(lambda _: result)
+            return d
+
+        def closed(result):
+            self.closed = True
+            waiting, self._closing = self._closing, None
+            for d in waiting:
+                d.callback(None)
+            return result
+
+        d = self.flush()
+        d.addBoth(self._cancel_timer_passthru)
+        d.addBoth(do_close)
+        d.addBoth(closed)
+        return d
+
+
+    def _in_thread(self, f, *args):
+        return run_in_thread(self.reactor, self.threadpool, f, *args)
+
+    def _cancel_timer_passthru(self, result):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        return result
+
+    def _timed_flush(self):
+        self._timer = None
+        self._kick()
+
+    def _kick(self):
+        if self._busy or not self._bufs:
+            return
+
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+
+        bufs, self._bufs = self._bufs, []
+        n, self._buf_len = self._buf_len, 0
+
+        self._busy = True
+        d = self._in_thread(self.write_batch, bufs)
+        d.addCallbacks(self._batch_done, self._batch_failed,
+                       callbackArgs=(n,))
+
+    def _batch_done(self, _result, n):
+        self._busy = False
+        self.written += n
+
+        waiting = []
+        while self._waiters and self._waiters[0][0] <= self.written:
+            waiting.append(self._waiters.pop(0)[1])
+
+        if self._written_cb:
+            self._written_cb(self.written)
+
+        if self._bufs and (self._waiters or
+                           self._buf_len >= self.buffer_size):
+            self._kick()
+        elif self._bufs and self._timer is None:
+            self._timer = self.reactor.callLater(self.flush_delay or 0,
+                                                 self._timed_flush)
+
+        for d in waiting:
+            d.callback(None)
+
+    def _batch_failed(self, failure):
+        self._busy = False
+        self.failure = failure
+        log.error('writing to %r failed: %s', self.path, failure.value)
+
+        # drop anything buffered, there's no sane way to continue
+        self._bufs, self._buf_len = [], 0
+
+        waiting, self._waiters = self._waiters, []
+        for _pos, d in waiting:
+            d.errback(failure)
+
+
+    # the following are run in the thread pool
+    def write_batch(self, bufs):
+        if self._f is None:
+            self._f = self._open_file()
+        self._f.writelines(bufs)
+        self._f.flush()
+
+        fsync = self.fsync
+        if fsync == 'batch':
+            os.fsync(self._f.fileno())
+        elif fsync not in (None, 'close'):
+            now = time.time()
+            if now - self._synced >= fsync:
+                os.fsync(self._f.fileno())
+                self._synced = now
+
+    def _open_file(self):
+        try:
+            return open(self.path, self.mode)
+        except IOError, e:
+            if not (self.make_dirs and e.errno == errno.ENOENT):
+                raise
+        make_dirs(os.path.dirname(self.path))
+        return open(self.path, self.mode)
+
+    def _close_file(self):
+        f, self._f = self._f, None
+        try:
+            if self.fsync is not None:
+                os.fsync(f.fileno())
+        finally:
+            f.close()
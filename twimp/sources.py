@@ -0,0 +1,472 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Media sources for publishing client streams, not needing any
+encoders: writing pre-made frames, paced on their timestamps or as fast
+as the connection takes them.
+"""
+
+import mmap
+import os
+import struct
+
+from zope.interface import implements
+
+from twisted.internet import defer
+
+from twimp import amf0
+from twimp import chunks
+from twimp import flv
+from twimp.interfaces import IThrottledSource
+from twimp.utils import run_in_thread
+from twimp.vecbuf import VecBuf
+
+LOG_CATEGORY = 'sources'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class PacedSource(object):
+    """Base class for sources writing (type_, ts, data) frames returned
+    by next_frame() to the stream.
+
+    In real-time mode the frames are written when due according to
+    their timestamps, otherwise as fast as the connection accepts them
+    (the stream throttles the source while congested).
+    """
+    implements(IThrottledSource)
+
+    # frames written per reactor iteration, when not in real-time mode
+    batch = 64
+
+    def __init__(self, realtime=True, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.realtime = realtime
+
+        self._stream = None
+        self._running = False
+        self._paused = False
+        self._pending = None
+        self._call = None
+        self._t0 = None
+        self._ts0 = None
+
+        self.frames = 0
+        self.bytes = 0
+
+    def connect(self, stream):
+        self._stream = stream
+
+    def disconnect(self):
+        self._stream = None
+
+    def start(self):
+        self._running = True
+        self._t0 = self.reactor.seconds()
+        self._ts0 = None
+        self._tick()
+
+    def stop(self):
+        self._running = False
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def next_frame(self):
+        """Return the next (type_, ts, data) frame to write, or None at
+        the end of the source.
+        """
+        raise NotImplementedError()
+
+    def ended(self):
+        """Called when there are no more frames to write."""
+        log.info('source ended after %d frames', self.frames)
+
+    def write_frame(self, type_, ts, data):
+        s = self._stream
+        self.frames += 1
+        self.bytes += len(data)
+        if type_ == chunks.MSG_VIDEO:
+            s.write_video(ts, data)
+        elif type_ == chunks.MSG_AUDIO:
+            s.write_audio(ts, data)
+        else:
+            s.write_meta(ts, data)
+
+    def _tick(self):
+        self._call = None
+        written = 0
+        while self._running and not self._paused:
+            if self._pending is None:
+                self._pending = self.next_frame()
+                if self._pending is None:
+                    self._running = False
+                    self.ended()
+                    return
+
+            type_, ts, data = self._pending
+            if self.realtime:
+                if self._ts0 is None:
+                    self._ts0 = ts
+                delay = (self._t0 + (ts - self._ts0) / 1000.0 -
+                         self.reactor.seconds())
+                if delay > 0:
+                    self._call = self.reactor.callLater(delay, self._tick)
+                    return
+            elif written >= self.batch:
+                self._call = self.reactor.callLater(0, self._tick)
+                return
+
+            self._pending = None
+            self.write_frame(type_, ts, data)
+            written += 1
+
+    ##
+    # IThrottledSource
+
+    def throttle(self):
+        # in real-time mode the frames keep coming, the stream drops
+        # them if needed
+        if self.realtime:
+            return
+        self._paused = True
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def unthrottle(self):
+        if self._paused:
+            self._paused = False
+            if self._running:
+                self._tick()
+
+    def frames_dropped(self, count, latency):
+        log.debug('%d frames dropped, %.3fs queued', count, latency)
+
+
+_s_seq = struct.Struct('>L')
+
+# tag data header bytes of the synthetic frames: H.264 config/key/inter
+# frames and AAC config/raw frames
+_SYN_V_HEADER = '\x17\x00\x00\x00\x00'
+_SYN_V_KEY = '\x17\x01\x00\x00\x00'
+_SYN_V_INTER = '\x27\x01\x00\x00\x00'
+_SYN_A_HEADER = '\xaf\x00'
+_SYN_A_RAW = '\xaf\x01'
+
+
+def synthetic_seq(type_, data):
+    """Return the sequence number of a frame made by SyntheticSource, or
+    None for headers or other data.
+    """
+    if type_ == chunks.MSG_VIDEO:
+        offset = len(_SYN_V_KEY)
+    elif type_ == chunks.MSG_AUDIO:
+        offset = len(_SYN_A_RAW)
+    else:
+        return None
+
+    if len(data) < offset + _s_seq.size:
+        return None
+    head = data.peek(offset + _s_seq.size)[:]
+    if head[1] != '\x01':
+        return None
+    return _s_seq.unpack_from(head, offset)[0]
+
+
+class SyntheticSource(PacedSource):
+    """Writes H.264/AAC-looking frames of the requested bitrates, the
+    (per track) frame sequence number at the start of the payload.
+    """
+
+    def __init__(self, framerate=25.0, video_bitrate=400,
+                 keyframe_interval=2.0, audio_bitrate=64, audio=True,
+                 realtime=True, reactor=None):
+        PacedSource.__init__(self, realtime, reactor)
+
+        self.framerate = framerate
+        self.keyframe_interval = keyframe_interval
+        self.audio = audio
+
+        self._v_size = max(0, int(video_bitrate * 125 / framerate))
+        # AAC frames of 1024 samples, at 44.1kHz
+        self._a_rate = 44100 / 1024.0
+        self._a_size = max(0, int(audio_bitrate * 125 / self._a_rate))
+        self._padding = '\0' * max(self._v_size, self._a_size)
+
+        self._v_seq = 0
+        self._a_seq = 0
+        self._headers = None
+
+    def meta(self):
+        meta = dict(duration=0.0, videocodecid=7, framerate=self.framerate)
+        if self.audio:
+            meta.update(audiocodecid=10, audiosamplerate=44100)
+        return meta
+
+    def _headers_frames(self):
+        frames = [(chunks.MSG_DATA, 0, amf0.encode('onMetaData',
+                                                   self.meta())),
+                  (chunks.MSG_VIDEO, 0, VecBuf([_SYN_V_HEADER,
+                                                '\x01\x42\x00\x1e'])),
+                  ]
+        if self.audio:
+            frames.append((chunks.MSG_AUDIO, 0,
+                           VecBuf([_SYN_A_HEADER, '\x12\x10'])))
+        return frames
+
+    def _frame(self, header, seq, size):
+        # size of the payload: sequence number included
+        return VecBuf([header, _s_seq.pack(seq),
+                       buffer(self._padding, 0, max(0, size - _s_seq.size))])
+
+    def next_frame(self):
+        if self._headers is None:
+            self._headers = self._headers_frames()
+        if self._headers:
+            return self._headers.pop(0)
+
+        v_ts = self._v_seq * 1000.0 / self.framerate
+        a_ts = self._a_seq * 1000.0 / self._a_rate
+        if self.audio and a_ts < v_ts:
+            self._a_seq += 1
+            return (chunks.MSG_AUDIO, int(a_ts),
+                    self._frame(_SYN_A_RAW, self._a_seq, self._a_size))
+
+        per_key = max(1, int(round(self.keyframe_interval * self.framerate)))
+        header = _SYN_V_INTER
+        if self._v_seq % per_key == 0:
+            header = _SYN_V_KEY
+        self._v_seq += 1
+        return (chunks.MSG_VIDEO, int(v_ts),
+                self._frame(header, self._v_seq, self._v_size))
+
+
+class FLVIndex(object):
+    """An index of the tags of an FLV file, mapped into memory: (msg
+    type, ts, data offset, data size, is sequence header) per tag.
+
+    The index can be shared by many sources of the same file. Building
+    it reads the whole file, see open_index() for doing that outside
+    of the reactor thread.
+    """
+
+    def __init__(self, path, block_size=1024 * 1024):
+        self.path = path
+        self.tags = []
+        # sources using the index, when got from open_index()
+        self.refs = 0
+
+        f = open(path, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            self.stamp = st.st_size, st.st_mtime
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._index(f, block_size)
+        finally:
+            f.close()
+
+    def _index(self, f, block_size):
+        tags = flv.scan_tags(f, block_size)
+        for _pos, type_, ts, offset, size, head in tags:
+            msg_type = flv.tag_to_msg_types.get(type_)
+            if msg_type is not None:
+                self.tags.append((msg_type, ts, offset, size,
+                                  flv.is_sequence_header(type_, head)))
+
+    def data(self, i):
+        _type, _ts, offset, size, _header = self.tags[i]
+        return buffer(self._map, offset, size)
+
+    def close(self):
+        # frame data handed out still refers to the mapping, which goes
+        # away along with the last of it
+        self._map = None
+
+
+# _indexes: { path => FLVIndex }, shared by all the sources of a file,
+# least recently used first
+_indexes = amf0.OrderedDict()
+# _loading: { path => [Deferred, ...] }
+_loading = {}
+# how many indexes not used by any source to keep around
+index_cache_size = 64
+
+def _load_index(path, index):
+    st = os.stat(path)
+    if index is not None and index.stamp == (st.st_size, st.st_mtime):
+        return index
+    log.info('indexing %r', path)
+    return FLVIndex(path)
+
+def open_index(path, reactor=None):
+    """Get an FLVIndex of the file at path, built in a thread, or
+    reused while the file doesn't change. Call release_index() once
+    done with it.
+
+    @rtype: Deferred
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+
+    waiting = _loading.get(path)
+    if waiting is not None:
+        d = defer.Deferred()
+        waiting.append(d)
+        d.addCallback(lambda _: open_index(path, reactor))
+        return d
+
+    def indexed(index):
+        old = _indexes.pop(path, None)
+        if old is not None and old is not index and old.refs <= 0:
+            old.close()
+        # most recently used go to the end
+        _indexes[path] = index
+        index.refs += 1
+        _prune_indexes()
+        return index
+
+    def done_loading(result):
+        for w in _loading.pop(path, []):
+            w.callback(None)
+        return result
+
+    _loading[path] = []
+    d = run_in_thread(reactor, None, _load_index, path, _indexes.get(path))
+    d.addCallback(indexed)
+    d.addBoth(done_loading)
+    return d
+
+def release_index(index):
+    """Stop using an index got from open_index(). Unused indexes are
+    kept for a while, up to index_cache_size of them, and closed once
+    dropped or replaced by a newer index of a changed file.
+    """
+    index.refs -= 1
+    if index.refs <= 0 and _indexes.get(index.path) is not index:
+        index.close()
+    _prune_indexes()
+
+def _prune_indexes():
+    unused = [path for (path, index) in _indexes.iteritems()
+              if index.refs <= 0]
+    for path in unused[:max(0, len(unused) - index_cache_size)]:
+        _indexes.pop(path).close()
+
+
+class FLVFileSource(PacedSource):
+    """Writes the tags of an FLV file (or an FLVIndex).
+
+    When looping, the file is written over and over again, with
+    timestamps continuing from the end of the previous pass (the meta
+    data and sequence headers are only written once).
+
+    Given a path, the file gets indexed with open_index() on start(),
+    and the index released on disconnect().
+    """
+
+    def __init__(self, path_or_index, loop=False, realtime=True,
+                 reactor=None):
+        PacedSource.__init__(self, realtime, reactor)
+
+        if isinstance(path_or_index, FLVIndex):
+            self.path = path_or_index.path
+            self.index = path_or_index
+        else:
+            self.path = path_or_index
+            self.index = None
+        # whether the index was got from open_index()
+        self._opened_index = False
+        self.loop = loop
+
+        self.passes = 0
+        self._pos = 0
+        self._ts_offset = 0
+        self._last_ts = 0
+        self._first_ts = None
+        self._gap = 1
+        self._opening = None
+
+    def start(self):
+        if self.index is not None:
+            PacedSource.start(self)
+            return
+
+        if self._opening is None:
+            d = self._opening = open_index(self.path, self.reactor)
+            d.addCallbacks(self._opened, self._open_failed,
+                           callbackArgs=(d,), errbackArgs=(d,))
+
+    def _opened(self, index, d):
+        if self._opening is not d:
+            # stopped in the meantime
+            release_index(index)
+            return
+        self._opening = None
+        self.index = index
+        self._opened_index = True
+        PacedSource.start(self)
+
+    def _open_failed(self, failure, d):
+        if self._opening is not d:
+            return
+        self._opening = None
+        log.error("couldn't index %r: %s", self.path,
+                  failure.getErrorMessage())
+        self.ended()
+
+    def stop(self):
+        self._opening = None
+        PacedSource.stop(self)
+
+    def disconnect(self):
+        PacedSource.disconnect(self)
+        if self._opened_index:
+            self._opened_index = False
+            release_index(self.index)
+            self.index = None
+
+    def _rewind(self):
+        self.passes += 1
+        self._pos = 0
+        # continuing where the previous pass ended, a frame later
+        self._ts_offset = self._last_ts + self._gap - self._first_ts
+
+    def next_frame(self):
+        if self.index is None:
+            # not started, indexing right away
+            self.index = FLVIndex(self.path)
+        tags = self.index.tags
+        while True:
+            if self._pos >= len(tags):
+                if not self.loop or self._first_ts is None:
+                    return None
+                self._rewind()
+
+            i, self._pos = self._pos, self._pos + 1
+            type_, ts, _offset, _size, is_header = tags[i]
+            if self.passes and (is_header or type_ == chunks.MSG_DATA):
+                continue
+
+            if self._first_ts is None:
+                self._first_ts = ts
+            ts += self._ts_offset
+            if ts > self._last_ts:
+                self._gap = max(1, ts - self._last_ts)
+                self._last_ts = ts
+
+            return type_, ts, VecBuf([self.index.data(i)])
@@ -0,0 +1,168 @@
+#   Copyright (c) 2011  Arek Korbik
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Timing out connections stalled in any phase of their life, with the
+timers of all the connections kept on a shared, coarse timer wheel.
+"""
+
+import math
+
+LOG_CATEGORY = 'timeouts'
+import twimp.log
+log = twimp.log.get_logger(LOG_CATEGORY)
+
+
+class _WheelTimer(object):
+    __slots__ = ('f', 'args', 'cancelled')
+
+    def __init__(self, f, args):
+        self.f = f
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        self.f = self.args = None
+
+
+class TimerWheel(object):
+    """Schedules (many) calls with the precision of resolution seconds,
+    using a single reactor call: all the calls due within a slot of the
+    wheel run together, at its end (never early).
+
+    Cancelled timers only get discarded when their slot comes, which
+    makes scheduling and cancelling equally cheap.
+    """
+
+    def __init__(self, resolution=1.0, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.resolution = resolution
+
+        # { slot => [timer, ...] }
+        self._slots = {}
+        self._call = None
+        self._call_slot = None
+
+    def schedule(self, delay, f, *args):
+        """Call f(*args) in (at least) delay seconds.
+
+        @return: the timer, with a cancel() method
+        """
+        timer = _WheelTimer(f, args)
+        slot = int(math.ceil((self.reactor.seconds() + delay) /
+                             self.resolution))
+        timers = self._slots.get(slot)
+        if timers is None:
+            timers = self._slots[slot] = []
+            if self._call_slot is None or slot < self._call_slot:
+                self._schedule_tick(slot)
+        timers.append(timer)
+        return timer
+
+    def pending(self):
+        """Return the number of timers scheduled (and not cancelled)."""
+        return sum(1 for timers in self._slots.itervalues()
+                   for t in timers if not t.cancelled)
+
+    def _schedule_tick(self, slot):
+        if self._call is not None:
+            self._call.cancel()
+        delay = max(0, slot * self.resolution - self.reactor.seconds())
+        self._call = self.reactor.callLater(delay, self._tick)
+        self._call_slot = slot
+
+    def _tick(self):
+        self._call = self._call_slot = None
+        now = self.reactor.seconds()
+        current = int(math.floor(now / self.resolution))
+
+        for slot in sorted(s for s in self._slots if s <= current):
+            for timer in self._slots.pop(slot):
+                if not timer.cancelled:
+                    f, args = timer.f, timer.args
+                    timer.cancel()
+                    try:
+                        f(*args)
+                    except Exception:
+                        log.exception('timer call failed')
+
+        if self._slots and self._call is None:
+            self._schedule_tick(min(self._slots))
+
+    def stop(self):
+        """Cancel all the timers."""
+        if self._call is not None:
+            self._call.cancel()
+            self._call = self._call_slot = None
+        self._slots = {}
+
+
+class ConnectionTimeouts(object):
+    """Per-phase timeouts (in seconds, None for no limit) for the
+    connections of a factory (see BaseFactory.timeouts):
+
+      * handshake - for completing the handshake,
+      * connect - from then, for connecting an app,
+      * command - from then, for starting to play or publish,
+      * idle - from then on, for any media (or other data) to flow,
+        either way.
+
+    Connections timed out get closed.
+    """
+
+    phases = ('handshake', 'connect', 'command', 'idle')
+
+    handshake = 10.0
+    connect = 10.0
+    command = 60.0
+    idle = 60.0
+
+    def __init__(self, resolution=1.0, reactor=None, **timeouts):
+        for phase, timeout in timeouts.items():
+            if phase not in self.phases:
+                raise TypeError('unknown phase %r' % (phase,))
+            setattr(self, phase, timeout)
+        self.wheel = TimerWheel(resolution, reactor)
+
+        # { phase => count }
+        self.timed_out = dict((phase, 0) for phase in self.phases)
+
+    def start(self, protocol, phase):
+        """Start timing protocol in phase.
+
+        @return: the timer (with a cancel() method), or None if the
+                 phase isn't limited
+        """
+        timeout = getattr(self, phase)
+        if timeout is None:
+            return None
+        activity = None
+        if phase == 'idle':
+            activity = protocol.activity()
+        return self.wheel.schedule(timeout, self._expired, protocol, phase,
+                                   activity)
+
+    def _expired(self, protocol, phase, activity):
+        if phase == 'idle':
+            current = protocol.activity()
+            if current != activity:
+                # still alive, check again later
+                protocol.set_timeout_phase(phase)
+                return
+
+        self.timed_out[phase] += 1
+        protocol.timedOut(phase)
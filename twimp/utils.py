@@ -17,7 +17,13 @@ from collections import deque
 import logging
 from operator import itemgetter
 
-from twisted.internet import protocol
+try:
+    import json
+except ImportError:
+    # python 2.5
+    import simplejson as json
+
+from twisted.internet import defer, protocol, threads
 from twisted.python import failure
 
 from twimp import vecbuf
@@ -38,11 +44,36 @@ def ms_time_wrapped(t):
 
     return ms_time(t) % 0x100000000
 
+def run_in_thread(reactor, threadpool, f, *args):
+    """Call f(*args) in threadpool, or the reactor's own thread pool
+    if None.
+
+    @rtype: Deferred
+    """
+    if threadpool is None:
+        threadpool = reactor.getThreadPool()
+    return threads.deferToThreadPool(reactor, threadpool, f, *args)
+
 
 class GeneratorWrapperProtocol(protocol.Protocol):
+    """Feeds the received data to a generator handler, which yields the
+    number of bytes it needs next.
+
+    The handler can also yield a Deferred, to wait for some result:
+    the data received meanwhile is buffered and the handler gets
+    resumed with the result (or the failure raised in it) once the
+    Deferred fires.
+    """
+
     def __init__(self, proto=None):
         self._buf = vecbuf.VecBuf()
         self._toread = 0
+        self._waiting = None
+        # all the bytes received
+        self.bytes_in = 0
+        # a SessionCapture (see twimp.capture), if the session is
+        # being captured
+        self.capture = None
 
         self._handler_changed = False
 
@@ -64,13 +95,31 @@ class GeneratorWrapperProtocol(protocol.Protocol):
         self._buf.read(len(self._buf))
         self._handler = None
         self._toread = None
+        if self._waiting is not None:
+            d, self._waiting = self._waiting, None
+            d.cancel()
 
     def dataReceived(self, data):
+        self.bytes_in += len(data)
+        if self.capture is not None:
+            self.capture.received(data)
         self._buf.write(data)
+        if self._waiting is None:
+            return self._feed()
 
+    def _feed(self, resume=None):
         while 1: # need to be able to retry immediately when handlers change
             try:
-                while len(self._buf) >= self._toread:
+                if resume is not None:
+                    # resuming the handler, after waiting on a Deferred
+                    send, resume = resume, None
+                    self._toread = send(self._handler)
+                while 1:
+                    if isinstance(self._toread, defer.Deferred):
+                        self._wait(self._toread)
+                        break
+                    if len(self._buf) < self._toread:
+                        break
                     self._toread = self._handler.send(self._buf)
                 break           # no data, no retry
             except StopIteration:
@@ -89,6 +138,25 @@ class GeneratorWrapperProtocol(protocol.Protocol):
                 log.info(f.value, exc_info=log.isEnabledFor(logging.DEBUG))
                 return f
 
+    def _wait(self, d):
+        self._waiting = d
+        d.addBoth(self._resume, d)
+
+    def _resume(self, result, d):
+        if self._waiting is not d:
+            # connection lost meanwhile
+            return
+        self._waiting = None
+
+        if isinstance(result, failure.Failure):
+            resume = result.throwExceptionIntoGenerator
+        else:
+            resume = lambda handler: handler.send(result)
+
+        if self._feed(resume) is not None:
+            # no caller to return the failure to here
+            self.transport.loseConnection()
+
 
 class FrameSorter(object):
     def __init__(self, callback, keys):